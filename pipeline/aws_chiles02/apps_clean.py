@@ -24,12 +24,19 @@ My Docker Apps
 """
 import logging
 import os
-
-import boto3
-from boto3.s3.transfer import S3Transfer
+import tarfile
 
 from aws_chiles02.apps_general import ErrorHandling
+from aws_chiles02.aws_registry import get_s3_client, get_s3_transfer
 from aws_chiles02.common import run_command, ProgressPercentage
+from aws_chiles02.s3_cache import extract_tar_from_cache, get_cache
+from aws_chiles02.s3_codec import CODEC_METADATA, CodecException, extract_tar_file
+from aws_chiles02.s3_download import download_file_resumable
+from aws_chiles02.s3_governor import get_governor, PRIORITY_INPUT, PRIORITY_PRODUCT
+from aws_chiles02.s3_stream import extract_tar_from_s3, upload_tars_to_s3, S3StreamException
+from aws_chiles02.settings_file import CODECS
+from aws_chiles02.tar_index import put_index_for_file
+from aws_chiles02.tar_members import MemberFilter
 from dfms.apps.dockerapp import DockerApp
 from dfms.drop import BarrierAppDROP
 
@@ -39,10 +46,28 @@ logging.getLogger('boto3').setLevel(logging.INFO)
 logging.getLogger('botocore').setLevel(logging.INFO)
 logging.getLogger('nose').setLevel(logging.INFO)
 logging.getLogger('s3transfer').setLevel(logging.INFO)
+QA_EXTENSIONS = [
+    '.image.mom.mean_freq',
+    '.image.mom.mean_ra',
+    '.image.mom.slice_ra',
+    '.image.slice.txt',
+    '.image.slice.svg',
+    '.image.rms.txt',
+    '.image.rms.svg',
+    '.image.onsource_centre.txt',
+    '.image.onsource_centre.svg',
+    '.image.onsource_south.txt',
+    '.image.onsource_south.svg',
+    '.image.boresight.txt',
+    '.image.boresight.svg',
+]
 
 
 class CopyCleanFromS3(BarrierAppDROP, ErrorHandling):
     def __init__(self, oid, uid, **kwargs):
+        self._stream_tar = None
+        self._include = None
+        self._exclude = None
         self._max_frequency = None
         self._min_frequency = None
         super(CopyCleanFromS3, self).__init__(oid, uid, **kwargs)
@@ -52,6 +77,10 @@ class CopyCleanFromS3(BarrierAppDROP, ErrorHandling):
         self._max_frequency = self._getArg(kwargs, 'max_frequency', None)
         self._min_frequency = self._getArg(kwargs, 'min_frequency', None)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
+        self._stream_tar = self._getArg(kwargs, 'stream_tar', True)
+        self._include = self._getArg(kwargs, 'include', [])
+        self._exclude = self._getArg(kwargs, 'exclude', [])
 
     def run(self):
         s3_input = self.inputs[0]
@@ -73,49 +102,115 @@ class CopyCleanFromS3(BarrierAppDROP, ErrorHandling):
         if not os.path.exists(measurement_set_dir):
             os.makedirs(measurement_set_dir)
 
-        full_path_tar_file = os.path.join(measurement_set_dir, TAR_FILE)
-        LOG.info('Tar: {0}'.format(full_path_tar_file))
-
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-        s3_object = s3.Object(bucket_name, key)
-        s3_size = s3_object.content_length
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.download_file(
-            bucket_name,
-            key,
-            full_path_tar_file,
-            callback=ProgressPercentage(
-                key,
-                s3_size
-            )
-        )
-        if not os.path.exists(full_path_tar_file):
-            message = 'The tar file {0} does not exist'.format(full_path_tar_file)
-            LOG.error(message)
-            self.send_error_message(
-                message,
-                self.oid,
-                self.uid
-            )
-            return 1
-
-        # Check the sizes match
-        tar_size = os.path.getsize(full_path_tar_file)
-        if s3_size != tar_size:
-            message = 'The sizes for {0} differ S3: {1}, local FS: {2}'.format(full_path_tar_file, s3_size, tar_size)
-            LOG.error(message)
-            self.send_error_message(
-                message,
-                self.oid,
-                self.uid
-            )
-            return 1
+        member_filter = MemberFilter(self._include, self._exclude)
+        s3_client = get_s3_client()
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+        s3_size = head['ContentLength']
+
+        cache = get_cache()
+        if cache is not None:
+            # The same inputs are read by several graphs so keep a copy on the node
+            try:
+                extract_tar_from_cache(
+                    cache,
+                    s3_client,
+                    bucket_name,
+                    key,
+                    measurement_set_dir,
+                    callback=ProgressPercentage(key, s3_size),
+                    member_filter=member_filter
+                )
+                return_code = 0
+            except (S3StreamException, CodecException, tarfile.TarError, EnvironmentError) as exception:
+                message = 'Fetching {0} through the cache failed: {1}'.format(key, exception)
+                LOG.exception(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+        elif self._stream_tar:
+            # Unpack the tar as it arrives so it is never staged on the disk
+            try:
+                with get_governor().transfer(PRIORITY_INPUT, ProgressPercentage(key, s3_size)) as callback:
+                    extract_tar_from_s3(
+                        s3_client,
+                        bucket_name,
+                        key,
+                        measurement_set_dir,
+                        s3_size,
+                        callback=callback,
+                        etag=head['ETag'],
+                        metadata=head.get('Metadata'),
+                        member_filter=member_filter
+                    )
+                return_code = 0
+            except (S3StreamException, CodecException, tarfile.TarError, EnvironmentError) as exception:
+                message = 'Streaming {0} failed: {1}'.format(key, exception)
+                LOG.exception(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+        else:
+            full_path_tar_file = os.path.join(measurement_set_dir, TAR_FILE)
+            LOG.info('Tar: {0}'.format(full_path_tar_file))
+            # The contents are checked against the ETag as they arrive
+            try:
+                with get_governor().transfer(PRIORITY_INPUT, ProgressPercentage(key, s3_size)) as callback:
+                    download_file_resumable(
+                        s3_client,
+                        bucket_name,
+                        key,
+                        full_path_tar_file,
+                        callback=callback
+                    )
+            except (S3StreamException, EnvironmentError) as exception:
+                message = 'Downloading {0} failed: {1}'.format(key, exception)
+                LOG.exception(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+            if not os.path.exists(full_path_tar_file):
+                message = 'The tar file {0} does not exist'.format(full_path_tar_file)
+                LOG.error(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
 
-        # The tar file exists and is the same size
-        bash = 'tar -xvf {0} -C {1}'.format(full_path_tar_file, measurement_set_dir)
-        return_code = run_command(bash)
+            # Check the sizes match
+            tar_size = os.path.getsize(full_path_tar_file)
+            if s3_size != tar_size:
+                message = 'The sizes for {0} differ S3: {1}, local FS: {2}'.format(full_path_tar_file, s3_size, tar_size)
+                LOG.error(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+
+            # The tar file exists and is the same size
+            if CODEC_METADATA in head.get('Metadata', {}) or member_filter.active:
+                # The tar on the node may not know the codec, so decode and filter it here
+                try:
+                    extract_tar_file(full_path_tar_file, measurement_set_dir, head.get('Metadata'), member_filter)
+                    return_code = 0
+                except (CodecException, tarfile.TarError, EnvironmentError):
+                    LOG.exception('Extracting {0}'.format(full_path_tar_file))
+                    return_code = 1
+            else:
+                bash = 'tar -xvf {0} -C {1}'.format(full_path_tar_file, measurement_set_dir)
+                return_code = run_command(bash)
 
         path_exists = os.path.exists(measurement_set)
         if return_code != 0 or not path_exists:
@@ -128,8 +223,10 @@ class CopyCleanFromS3(BarrierAppDROP, ErrorHandling):
             )
             return 1
 
-        os.remove(full_path_tar_file)
+        if cache is None and not self._stream_tar:
+            os.remove(full_path_tar_file)
 
+        member_filter.log_statistics(key)
         return 0
 
     def dataURL(self):
@@ -142,6 +239,8 @@ class CopyCleanToS3(BarrierAppDROP, ErrorHandling):
         self._min_frequency = None
         self._command = None
         self._only_image = None
+        self._stream_tar = None
+        self._codec = None
         super(CopyCleanToS3, self).__init__(oid, uid, **kwargs)
 
     def initialize(self, **kwargs):
@@ -149,7 +248,10 @@ class CopyCleanToS3(BarrierAppDROP, ErrorHandling):
         self._max_frequency = self._getArg(kwargs, 'max_frequency', None)
         self._min_frequency = self._getArg(kwargs, 'min_frequency', None)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
         self._only_image = self._getArg(kwargs, 'only_image', False)
+        self._stream_tar = self._getArg(kwargs, 'stream_tar', True)
+        self._codec = self._getArg(kwargs, 'codec', CODECS.get('clean'))
 
     def dataURL(self):
         return 'CopyCleanToS3'
@@ -177,52 +279,133 @@ class CopyCleanToS3(BarrierAppDROP, ErrorHandling):
             )
             return 0
 
-        # Make the tar file
-        tar_filename = os.path.join(measurement_set_dir, 'clean_{0}~{1}.tar'.format(self._min_frequency, self._max_frequency))
-        os.chdir(measurement_set_dir)
-        if self._only_image:
-            bash = 'tar -cvf {0} {1}.image {1}.psf.centre'.format(
-                tar_filename,
-                stem_name,
-            )
-        else:
-            bash = 'tar -cvf {0} {1}.flux {1}.image {1}.model {1}.residual {1}.psf'.format(
-                tar_filename,
-                stem_name,
-            )
-        return_code = run_command(bash)
-        path_exists = os.path.exists(tar_filename)
-        if return_code != 0 or not path_exists:
-            message = 'tar return_code: {0}, exists: {1}'.format(return_code, path_exists)
-            LOG.error(message)
-            self.send_error_message(
-                message,
-                self.oid,
-                self.uid,
-            )
+        s3_client = get_s3_client()
 
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
+        if self._stream_tar:
+            # Build the tars as they upload and publish them all at the same time
+            if self._only_image:
+                extensions = ['.image', '.psf.centre']
+            else:
+                extensions = ['.flux', '.image', '.model', '.residual', '.psf']
+            uploads = [(key, measurement_set_dir, [stem_name + extension for extension in extensions])]
+
+            # Centred images
+            if os.path.exists(measurement_set + '.image.centre'):
+                uploads.append((key + '.centre', measurement_set_dir, [stem_name + '.image.centre', stem_name + '.psf.centre']))
+
+            uploads.append((key + '.qa', measurement_set_dir, [stem_name + extension for extension in QA_EXTENSIONS]))
+            try:
+                # Each tar takes its own transfer slot
+                missing_members = upload_tars_to_s3(
+                    s3_client,
+                    bucket_name,
+                    uploads,
+                    extra_args={
+                        'StorageClass': 'REDUCED_REDUNDANCY',
+                    },
+                    callback_factory=ProgressPercentage,
+                    codec=self._codec,
+                    write_index=True,
+                    governor=get_governor(),
+                    priority=PRIORITY_PRODUCT
+                )
+            except (S3StreamException, CodecException, tarfile.TarError, EnvironmentError) as exception:
+                message = 'Streaming {0} failed: {1}'.format(key, exception)
+                LOG.exception(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+
+            return_code = 0
+            for upload_key, missing in missing_members.iteritems():
+                if len(missing) > 0:
+                    message = 'tar {0} is missing: {1}'.format(upload_key, ' '.join(missing))
+                    LOG.error(message)
+                    self.send_error_message(
+                        message,
+                        self.oid,
+                        self.uid,
+                    )
+                    return_code = 1
+        else:
+            if self._codec not in (None, 'none'):
+                LOG.warning('The {0} codec is only used when streaming, {1} will not be compressed'.format(self._codec, key))
+
+            # Make the tar file
+            tar_filename = os.path.join(measurement_set_dir, 'clean_{0}~{1}.tar'.format(self._min_frequency, self._max_frequency))
+            os.chdir(measurement_set_dir)
+            if self._only_image:
+                bash = 'tar -cvf {0} {1}.image {1}.psf.centre'.format(
+                    tar_filename,
+                    stem_name,
+                )
+            else:
+                bash = 'tar -cvf {0} {1}.flux {1}.image {1}.model {1}.residual {1}.psf'.format(
+                    tar_filename,
+                    stem_name,
+                )
+            return_code = run_command(bash)
+            path_exists = os.path.exists(tar_filename)
+            if return_code != 0 or not path_exists:
+                message = 'tar return_code: {0}, exists: {1}'.format(return_code, path_exists)
+                LOG.error(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid,
+                )
 
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.upload_file(
-            tar_filename,
-            bucket_name,
-            key,
-            callback=ProgressPercentage(
-                key,
-                float(os.path.getsize(tar_filename))
-            ),
-            extra_args={
-                'StorageClass': 'REDUCED_REDUNDANCY',
-            }
-        )
-
-        # Centred images
-        if os.path.exists(measurement_set + '.image.centre'):
-            tar_filename = os.path.join(measurement_set_dir, 'clean_{0}~{1}.centre.tar'.format(self._min_frequency, self._max_frequency))
-            bash = 'tar -cvf {0} {1}.image.centre {1}.psf.centre'.format(
+            transfer = get_s3_transfer()
+            with get_governor().transfer(PRIORITY_PRODUCT, ProgressPercentage(key, float(os.path.getsize(tar_filename)))) as callback:
+                transfer.upload_file(
+                    tar_filename,
+                    bucket_name,
+                    key,
+                    callback=callback,
+                    extra_args={
+                        'StorageClass': 'REDUCED_REDUNDANCY',
+                    }
+                )
+            put_index_for_file(s3_client, bucket_name, key, tar_filename, 'REDUCED_REDUNDANCY')
+
+            # Centred images
+            if os.path.exists(measurement_set + '.image.centre'):
+                tar_filename = os.path.join(measurement_set_dir, 'clean_{0}~{1}.centre.tar'.format(self._min_frequency, self._max_frequency))
+                bash = 'tar -cvf {0} {1}.image.centre {1}.psf.centre'.format(
+                    tar_filename,
+                    stem_name,
+                )
+                return_code = run_command(bash)
+                path_exists = os.path.exists(tar_filename)
+                if return_code != 0 or not path_exists:
+                    message = 'tar return_code: {0}, exists: {1}'.format(return_code, path_exists)
+                    LOG.error(message)
+                    self.send_error_message(
+                        message,
+                        self.oid,
+                        self.uid,
+                    )
+                with get_governor().transfer(PRIORITY_PRODUCT, ProgressPercentage(key, float(os.path.getsize(tar_filename)))) as callback:
+                    transfer.upload_file(
+                        tar_filename,
+                        bucket_name,
+                        key + '.centre',
+                        callback=callback,
+                        extra_args={
+                            'StorageClass': 'REDUCED_REDUNDANCY',
+                        }
+                    )
+
+            tar_filename = os.path.join(measurement_set_dir, 'clean_{0}~{1}.qa.tar'.format(self._min_frequency, self._max_frequency))
+            bash = 'tar -cvf {0} {1}.image.mom.mean_freq {1}.image.mom.mean_ra {1}.image.mom.slice_ra ' \
+                   '{1}.image.slice.txt {1}.image.slice.svg ' \
+                   '{1}.image.rms.txt {1}.image.rms.svg ' \
+                   '{1}.image.onsource_centre.txt {1}.image.onsource_centre.svg ' \
+                   '{1}.image.onsource_south.txt {1}.image.onsource_south.svg ' \
+                   '{1}.image.boresight.txt {1}.image.boresight.svg'.format(
                 tar_filename,
                 stem_name,
             )
@@ -236,51 +419,16 @@ class CopyCleanToS3(BarrierAppDROP, ErrorHandling):
                     self.oid,
                     self.uid,
                 )
-            transfer.upload_file(
-                tar_filename,
-                bucket_name,
-                key + '.centre',
-                callback=ProgressPercentage(
-                    key,
-                    float(os.path.getsize(tar_filename))
-                ),
-                extra_args={
-                    'StorageClass': 'REDUCED_REDUNDANCY',
-                }
-            )
-
-        tar_filename = os.path.join(measurement_set_dir, 'clean_{0}~{1}.qa.tar'.format(self._min_frequency, self._max_frequency))
-        bash = 'tar -cvf {0} {1}.image.mom.mean_freq {1}.image.mom.mean_ra {1}.image.mom.slice_ra ' \
-               '{1}.image.slice.txt {1}.image.slice.svg ' \
-               '{1}.image.rms.txt {1}.image.rms.svg ' \
-               '{1}.image.onsource_centre.txt {1}.image.onsource_centre.svg ' \
-               '{1}.image.onsource_south.txt {1}.image.onsource_south.svg ' \
-               '{1}.image.boresight.txt {1}.image.boresight.svg'.format(
-            tar_filename,
-            stem_name,
-        )
-        return_code = run_command(bash)
-        path_exists = os.path.exists(tar_filename)
-        if return_code != 0 or not path_exists:
-            message = 'tar return_code: {0}, exists: {1}'.format(return_code, path_exists)
-            LOG.error(message)
-            self.send_error_message(
-                message,
-                self.oid,
-                self.uid,
-            )
-        transfer.upload_file(
-            tar_filename,
-            bucket_name,
-            key + '.qa',
-            callback=ProgressPercentage(
-                key,
-                float(os.path.getsize(tar_filename))
-            ),
-            extra_args={
-                'StorageClass': 'REDUCED_REDUNDANCY',
-            }
-        )
+            with get_governor().transfer(PRIORITY_PRODUCT, ProgressPercentage(key, float(os.path.getsize(tar_filename)))) as callback:
+                transfer.upload_file(
+                    tar_filename,
+                    bucket_name,
+                    key + '.qa',
+                    callback=callback,
+                    extra_args={
+                        'StorageClass': 'REDUCED_REDUNDANCY',
+                    }
+                )
 
         return return_code
 
@@ -297,6 +445,7 @@ class CopyFitsToS3(BarrierAppDROP, ErrorHandling):
         self._max_frequency = self._getArg(kwargs, 'max_frequency', None)
         self._min_frequency = self._getArg(kwargs, 'min_frequency', None)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
 
     def dataURL(self):
         return 'CopyFitsToS3'
@@ -318,23 +467,17 @@ class CopyFitsToS3(BarrierAppDROP, ErrorHandling):
             LOG.warn('Measurement_set: {0}.fits does not exist'.format(measurement_set))
             return 0
 
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.upload_file(
-            fits_file,
-            bucket_name,
-            key,
-            callback=ProgressPercentage(
+        transfer = get_s3_transfer()
+        with get_governor().transfer(PRIORITY_PRODUCT, ProgressPercentage(key, float(os.path.getsize(fits_file)))) as callback:
+            transfer.upload_file(
+                fits_file,
+                bucket_name,
                 key,
-                float(os.path.getsize(fits_file))
-            ),
-            extra_args={
-                'StorageClass': 'REDUCED_REDUNDANCY',
-            }
-        )
+                callback=callback,
+                extra_args={
+                    'StorageClass': 'REDUCED_REDUNDANCY',
+                }
+            )
 
         return 0
 
@@ -367,6 +510,7 @@ class DockerClean(DockerApp, ErrorHandling):
         self._produce_qa = self._getArg(kwargs, 'produce_qa', 'yes')
         self._command = 'clean.sh %i0 %o0 %o0 '
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self._instance_type = self._getArg(kwargs, 'instance_type', None)
 
     def run(self):
         # Because of the lifecycle the drop isn't attached when the command is
@@ -395,7 +539,7 @@ class DockerClean(DockerApp, ErrorHandling):
         else:
             LOG.error('No input files')
 
-        super(DockerClean, self).run()
+        self.run_timed('clean', self._min_frequency, super(DockerClean, self).run)
 
     def dataURL(self):
         return 'docker container chiles02:latest'
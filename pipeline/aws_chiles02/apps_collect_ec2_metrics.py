@@ -26,13 +26,13 @@ import csv
 import logging
 import os
 
-import boto3
 import requests
 from datetime import datetime, timedelta
-from boto3.s3.transfer import S3Transfer
 
 from aws_chiles02.apps_general import ErrorHandling
+from aws_chiles02.aws_registry import get_client, get_s3_transfer
 from aws_chiles02.common import ProgressPercentage
+from aws_chiles02.s3_governor import get_governor, PRIORITY_BACKGROUND
 from dfms.drop import BarrierAppDROP
 
 
@@ -64,6 +64,7 @@ class EC2Metrics(BarrierAppDROP, ErrorHandling):
     def initialize(self, **kwargs):
         super(EC2Metrics, self).initialize(**kwargs)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
 
     def dataURL(self):
         return 'EC2Metrics'
@@ -71,15 +72,14 @@ class EC2Metrics(BarrierAppDROP, ErrorHandling):
     def run(self):
         output_file = self.outputs[0]
 
-        session = boto3.Session(profile_name='aws-chiles02')
-
         instance_id = requests.get('http://169.254.169.254/latest/meta-data/instance-id').content
-        ec2 = boto3.resource('ec2')
-        instance = ec2.Instance(instance_id)
+        ec2 = get_client('ec2')
+        reservations = ec2.describe_instances(InstanceIds=[instance_id])['Reservations']
+        instance = reservations[0]['Instances'][0]
 
-        cloud_watch = session.client('cloudwatch')
+        cloud_watch = get_client('cloudwatch')
         now = datetime.utcnow()
-        start_time = instance.launch_time
+        start_time = instance['LaunchTime']
         now_plus_10 = now + timedelta(minutes=10)
 
         with open(output_file, 'wb') as csv_file:
@@ -120,6 +120,7 @@ class CopyMetricsToS3(BarrierAppDROP, ErrorHandling):
     def initialize(self, **kwargs):
         super(CopyMetricsToS3, self).initialize(**kwargs)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
 
     def dataURL(self):
         return 'CopyMetricsToS3'
@@ -137,22 +138,16 @@ class CopyMetricsToS3(BarrierAppDROP, ErrorHandling):
             LOG.warn('Metrics file: {0} does not exist'.format(input_file))
             return 0
 
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.upload_file(
-            input_file,
-            bucket_name,
-            key,
-            callback=ProgressPercentage(
+        transfer = get_s3_transfer()
+        with get_governor().transfer(PRIORITY_BACKGROUND, ProgressPercentage(key, float(os.path.getsize(input_file)))) as callback:
+            transfer.upload_file(
+                input_file,
+                bucket_name,
                 key,
-                float(os.path.getsize(input_file))
-            ),
-            extra_args={
-                'StorageClass': 'REDUCED_REDUNDANCY',
-            }
-        )
+                callback=callback,
+                extra_args={
+                    'StorageClass': 'REDUCED_REDUNDANCY',
+                }
+            )
 
         return 0
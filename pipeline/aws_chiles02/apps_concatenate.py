@@ -25,12 +25,17 @@ My Docker Apps
 import logging
 import os
 import shutil
-
-import boto3
-from boto3.s3.transfer import S3Transfer
+import tarfile
 
 from aws_chiles02.apps_general import ErrorHandling
+from aws_chiles02.aws_registry import get_s3_client, get_s3_transfer
 from aws_chiles02.common import run_command, ProgressPercentage
+from aws_chiles02.s3_codec import CODEC_METADATA, CodecException, extract_tar_file
+from aws_chiles02.s3_download import download_file_resumable
+from aws_chiles02.s3_governor import get_governor, PRIORITY_INPUT, PRIORITY_PRODUCT
+from aws_chiles02.s3_stream import extract_tar_from_s3, upload_tar_to_s3, get_size_of_members, S3StreamException
+from aws_chiles02.tar_index import put_index_for_file
+from aws_chiles02.tar_members import MemberFilter
 from dfms.apps.dockerapp import DockerApp
 from dfms.drop import BarrierAppDROP
 
@@ -44,11 +49,18 @@ logging.getLogger('s3transfer').setLevel(logging.INFO)
 
 class CopyConcatenateFromS3(BarrierAppDROP, ErrorHandling):
     def __init__(self, oid, uid, **kwargs):
+        self._stream_tar = None
+        self._include = None
+        self._exclude = None
         super(CopyConcatenateFromS3, self).__init__(oid, uid, **kwargs)
 
     def initialize(self, **kwargs):
         super(CopyConcatenateFromS3, self).initialize(**kwargs)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
+        self._stream_tar = self._getArg(kwargs, 'stream_tar', True)
+        self._include = self._getArg(kwargs, 'include', [])
+        self._exclude = self._getArg(kwargs, 'exclude', ['*.flux', '*.model', '*.residual', '*.psf'])
 
     def dataURL(self):
         return 'CopyConcatenateFromS3'
@@ -75,49 +87,92 @@ class CopyConcatenateFromS3(BarrierAppDROP, ErrorHandling):
             # Make the directory
             os.makedirs(measurement_set_dir)
 
-        full_path_tar_file = os.path.join(measurement_set_dir, TAR_FILE)
-        LOG.info('Tar: {0}'.format(full_path_tar_file))
-
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-        s3_object = s3.Object(bucket_name, key)
-        s3_size = s3_object.content_length
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.download_file(
-                bucket_name,
-                key,
-                full_path_tar_file,
-                callback=ProgressPercentage(
-                    key,
-                    s3_size
+        member_filter = MemberFilter(self._include, self._exclude)
+        s3_client = get_s3_client()
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+        s3_size = head['ContentLength']
+
+        if self._stream_tar:
+            # Unpack the tar as it arrives so it is never staged on the disk
+            try:
+                with get_governor().transfer(PRIORITY_INPUT, ProgressPercentage(key, s3_size)) as callback:
+                    extract_tar_from_s3(
+                        s3_client,
+                        bucket_name,
+                        key,
+                        measurement_set_dir,
+                        s3_size,
+                        callback=callback,
+                        etag=head['ETag'],
+                        metadata=head.get('Metadata'),
+                        member_filter=member_filter
+                    )
+                return_code = 0
+            except (S3StreamException, CodecException, tarfile.TarError, EnvironmentError) as exception:
+                message = 'Streaming {0} failed: {1}'.format(key, exception)
+                LOG.exception(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
                 )
-        )
-        if not os.path.exists(full_path_tar_file):
-            message = 'The tar file {0} does not exist'.format(full_path_tar_file)
-            LOG.error(message)
-            self.send_error_message(
-                message,
-                self.oid,
-                self.uid
-            )
-            return 1
-
-        # Check the sizes match
-        tar_size = os.path.getsize(full_path_tar_file)
-        if s3_size != tar_size:
-            message = 'The sizes for {0} differ S3: {1}, local FS: {2}'.format(full_path_tar_file, s3_size, tar_size)
-            LOG.error(message)
-            self.send_error_message(
-                message,
-                self.oid,
-                self.uid
-            )
-            return 1
-
-        # The tar file exists and is the same size
-        bash = 'tar -xvf {0} -C {1}'.format(full_path_tar_file, measurement_set_dir)
-        return_code = run_command(bash)
+                return 1
+        else:
+            full_path_tar_file = os.path.join(measurement_set_dir, TAR_FILE)
+            LOG.info('Tar: {0}'.format(full_path_tar_file))
+            # The contents are checked against the ETag as they arrive
+            try:
+                with get_governor().transfer(PRIORITY_INPUT, ProgressPercentage(key, s3_size)) as callback:
+                    download_file_resumable(
+                        s3_client,
+                        bucket_name,
+                        key,
+                        full_path_tar_file,
+                        callback=callback
+                    )
+            except (S3StreamException, EnvironmentError) as exception:
+                message = 'Downloading {0} failed: {1}'.format(key, exception)
+                LOG.exception(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+            if not os.path.exists(full_path_tar_file):
+                message = 'The tar file {0} does not exist'.format(full_path_tar_file)
+                LOG.error(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+
+            # Check the sizes match
+            tar_size = os.path.getsize(full_path_tar_file)
+            if s3_size != tar_size:
+                message = 'The sizes for {0} differ S3: {1}, local FS: {2}'.format(full_path_tar_file, s3_size, tar_size)
+                LOG.error(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+
+            # The tar file exists and is the same size
+            if CODEC_METADATA in head.get('Metadata', {}) or member_filter.active:
+                # The tar on the node may not know the codec, so decode and filter it here
+                try:
+                    extract_tar_file(full_path_tar_file, measurement_set_dir, head.get('Metadata'), member_filter)
+                    return_code = 0
+                except (CodecException, tarfile.TarError, EnvironmentError):
+                    LOG.exception('Extracting {0}'.format(full_path_tar_file))
+                    return_code = 1
+            else:
+                bash = 'tar -xvf {0} -C {1}'.format(full_path_tar_file, measurement_set_dir)
+                return_code = run_command(bash)
 
         if return_code != 0:
             message = 'tar return_code: {0}'.format(return_code)
@@ -129,17 +184,10 @@ class CopyConcatenateFromS3(BarrierAppDROP, ErrorHandling):
             )
             return 1
 
-        os.remove(full_path_tar_file)
-
-        # Remove the stuff we don't need
-        LOG.info('measurement_set_dir: {0}'.format(measurement_set_dir))
-        for filename in os.listdir(measurement_set_dir):
-            LOG.debug('filename: {0}'.format(filename))
-            if filename.endswith(tuple(['.flux', '.model', '.residual', '.psf'])):
-                full_name = os.path.join(measurement_set_dir, filename)
-                LOG.info('full_name: {0}'.format(full_name))
-                shutil.rmtree(full_name, ignore_errors=True)
+        if not self._stream_tar:
+            os.remove(full_path_tar_file)
 
+        member_filter.log_statistics(key)
         return 0
 
 
@@ -147,6 +195,7 @@ class CopyConcatenateToS3(BarrierAppDROP, ErrorHandling):
     def __init__(self, oid, uid, **kwargs):
         self._width = None
         self._iterations = None
+        self._stream_tar = None
         super(CopyConcatenateToS3, self).__init__(oid, uid, **kwargs)
 
     def initialize(self, **kwargs):
@@ -154,6 +203,8 @@ class CopyConcatenateToS3(BarrierAppDROP, ErrorHandling):
         self._width = self._getArg(kwargs, 'width ', None)
         self._iterations = self._getArg(kwargs, 'iterations', None)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
+        self._stream_tar = self._getArg(kwargs, 'stream_tar', True)
 
     def dataURL(self):
         return 'CopyConcatenateToS3'
@@ -180,38 +231,62 @@ class CopyConcatenateToS3(BarrierAppDROP, ErrorHandling):
             )
             return 0
 
-        # Make the tar file
-        tar_filename = os.path.join(measurement_set_dir, 'image_{0}_{1}.cube.tar'.format(self._width, self._iterations))
-        os.chdir(measurement_set_dir)
-        bash = 'tar -cvf {0} {1}.cube'.format(tar_filename, stem_name)
-        return_code = run_command(bash)
-        path_exists = os.path.exists(tar_filename)
-        if return_code != 0 or not path_exists:
-            message = 'tar return_code: {0}, exists: {1}'.format(return_code, path_exists)
-            LOG.error(message)
-            self.send_error_message(
-                message,
-                self.oid,
-                self.uid
-            )
-
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
+        s3_client = get_s3_client()
+
+        if self._stream_tar:
+            # Build the tar as it uploads so it is never staged on the disk
+            try:
+                with get_governor().transfer(PRIORITY_PRODUCT, ProgressPercentage(key, get_size_of_members(measurement_set_dir, [stem_name + '.cube']))) as callback:
+                    upload_tar_to_s3(
+                        s3_client,
+                        bucket_name,
+                        key,
+                        measurement_set_dir,
+                        [stem_name + '.cube'],
+                        extra_args={
+                            'StorageClass': 'REDUCED_REDUNDANCY',
+                        },
+                        callback=callback,
+                        write_index=True
+                    )
+                return_code = 0
+            except (S3StreamException, CodecException, tarfile.TarError, EnvironmentError) as exception:
+                message = 'Streaming {0} failed: {1}'.format(key, exception)
+                LOG.exception(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+        else:
+            # Make the tar file
+            tar_filename = os.path.join(measurement_set_dir, 'image_{0}_{1}.cube.tar'.format(self._width, self._iterations))
+            os.chdir(measurement_set_dir)
+            bash = 'tar -cvf {0} {1}.cube'.format(tar_filename, stem_name)
+            return_code = run_command(bash)
+            path_exists = os.path.exists(tar_filename)
+            if return_code != 0 or not path_exists:
+                message = 'tar return_code: {0}, exists: {1}'.format(return_code, path_exists)
+                LOG.error(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
 
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.upload_file(
-            tar_filename,
-            bucket_name,
-            key,
-            callback=ProgressPercentage(
+            transfer = get_s3_transfer()
+            with get_governor().transfer(PRIORITY_PRODUCT, ProgressPercentage(key, float(os.path.getsize(tar_filename)))) as callback:
+                transfer.upload_file(
+                    tar_filename,
+                    bucket_name,
                     key,
-                    float(os.path.getsize(tar_filename))
-            ),
-            extra_args={
-                'StorageClass': 'REDUCED_REDUNDANCY',
-            }
-        )
+                    callback=callback,
+                    extra_args={
+                        'StorageClass': 'REDUCED_REDUNDANCY',
+                    }
+                )
+            put_index_for_file(s3_client, bucket_name, key, tar_filename, 'REDUCED_REDUNDANCY')
 
         # Clean up
         shutil.rmtree(measurement_set_dir, ignore_errors=True)
@@ -27,27 +27,53 @@ import logging
 import os
 import shutil
 import sqlite3
+import threading
+import time
 
-import boto3
-from boto3.s3.transfer import S3Transfer
-
-from aws_chiles02.common import run_command, ProgressPercentage
+from aws_chiles02.aws_registry import get_s3_transfer, send_message, set_parallel_streams
+from aws_chiles02.common import run_command, ProgressPercentage, bytes2human, get_free_space
+from aws_chiles02.s3_cache import get_cache
+from aws_chiles02.s3_governor import get_governor, PRIORITY_BACKGROUND
+from aws_chiles02.scheduler import TIMINGS_MEMBER, write_timings
 from aws_chiles02.settings_file import AWS_REGION
 from dfms.drop import BarrierAppDROP, FileDROP, DirectoryContainer
 
 LOG = logging.getLogger(__name__)
 
+LOG_FILE_DIR = '/mnt/dfms/dfms_root'
+# The apps on a node append to the same timings file
+_timings_lock = threading.Lock()
+
 
 class ErrorHandling(object):
     def __init__(self):
         self._session_id = None
         self._error_message = None
 
+    def run_timed(self, kind, frequency, run):
+        """
+        Run the task and append how long it took to the node's timings, which are
+        collected with its logs to fit the scheduler's cost model
+        """
+        size = get_size_of_paths([drop.path for drop in self.inputs if getattr(drop, 'path', None) is not None])
+        start = time.time()
+        result = run()
+        seconds = time.time() - start
+
+        instance_type = getattr(self, '_instance_type', None)
+        if instance_type is not None:
+            try:
+                with _timings_lock:
+                    write_timings(
+                        os.path.join(LOG_FILE_DIR, TIMINGS_MEMBER),
+                        [[kind, instance_type, size, frequency, '{0:.1f}'.format(seconds), self._session_id, self.uid]]
+                    )
+            except EnvironmentError:
+                LOG.exception('Recording the timing of {0}'.format(self.uid))
+        return result
+
     def send_error_message(self, message_text, oid, uid, queue='dfms-messages', region=AWS_REGION, profile_name='aws-chiles02'):
         self._error_message = message_text
-        session = boto3.Session(profile_name=profile_name)
-        sqs = session.resource('sqs', region_name=region)
-        queue = sqs.get_queue_by_name(QueueName=queue)
         message = {
             'session_id': self._session_id,
             'oid': oid,
@@ -55,9 +81,15 @@ class ErrorHandling(object):
             'message': message_text,
         }
         json_message = json.dumps(message, indent=2)
-        queue.send_message(
-            MessageBody=json_message,
-        )
+        send_message(queue, json_message, region, profile_name=profile_name)
+
+    def set_parallel_streams(self, kwargs):
+        """
+        Size the shared S3 connection pools for the streams the graph runs on this node
+        """
+        parallel_streams = kwargs.get('parallel_streams')
+        if parallel_streams is not None:
+            set_parallel_streams(int(parallel_streams))
 
     @property
     def error_message(self):
@@ -68,6 +100,22 @@ class ErrorHandling(object):
         return self._session_id
 
 
+def get_size_of_paths(paths):
+    """
+    The bytes in the files under the paths
+    """
+    size = 0
+    for path in paths:
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+        for directory_name, _, file_names in os.walk(path):
+            for file_name in file_names:
+                file_path = os.path.join(directory_name, file_name)
+                if not os.path.islink(file_path):
+                    size += os.path.getsize(file_path)
+    return size
+
+
 class CopyLogFilesApp(BarrierAppDROP, ErrorHandling):
     def __init__(self, oid, uid, **kwargs):
         super(CopyLogFilesApp, self).__init__(oid, uid, **kwargs)
@@ -75,12 +123,13 @@ class CopyLogFilesApp(BarrierAppDROP, ErrorHandling):
     def initialize(self, **kwargs):
         super(CopyLogFilesApp, self).initialize(**kwargs)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
 
     def dataURL(self):
         return type(self).__name__
 
     def run(self):
-        log_file_dir = '/mnt/dfms/dfms_root'
+        log_file_dir = LOG_FILE_DIR
         s3_output = self.outputs[0]
         bucket_name = s3_output.bucket
         key = s3_output.key
@@ -89,7 +138,10 @@ class CopyLogFilesApp(BarrierAppDROP, ErrorHandling):
         # Make the tar file
         tar_filename = os.path.join(log_file_dir, 'log.tar')
         os.chdir(log_file_dir)
-        bash = 'tar -cvf {0} {1}'.format(tar_filename, 'dfms*.log')
+        members = 'dfms*.log'
+        if os.path.exists(os.path.join(log_file_dir, TIMINGS_MEMBER)):
+            members += ' ' + TIMINGS_MEMBER
+        bash = 'tar -cvf {0} {1}'.format(tar_filename, members)
         return_code = run_command(bash)
         path_exists = os.path.exists(tar_filename)
         if return_code != 0 or not path_exists:
@@ -102,23 +154,17 @@ class CopyLogFilesApp(BarrierAppDROP, ErrorHandling):
             )
             return return_code
 
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.upload_file(
-            tar_filename,
-            bucket_name,
-            key,
-            callback=ProgressPercentage(
+        transfer = get_s3_transfer()
+        with get_governor().transfer(PRIORITY_BACKGROUND, ProgressPercentage(key, float(os.path.getsize(tar_filename)))) as callback:
+            transfer.upload_file(
+                tar_filename,
+                bucket_name,
                 key,
-                float(os.path.getsize(tar_filename))
-            ),
-            extra_args={
-                'StorageClass': 'REDUCED_REDUNDANCY',
-            }
-        )
+                callback=callback,
+                extra_args={
+                    'StorageClass': 'REDUCED_REDUNDANCY',
+                }
+            )
 
 
 class CleanupDirectories(BarrierAppDROP, ErrorHandling):
@@ -137,9 +183,13 @@ class CleanupDirectories(BarrierAppDROP, ErrorHandling):
     def run(self):
         input_files = [i.path for i in self.inputs if isinstance(i, (FileDROP, DirectoryContainer))]
         LOG.info('input_files: {0}'.format(input_files))
+        cache = get_cache()
         for input_file in input_files:
             LOG.debug('Looking at {0}'.format(input_file))
-            if os.path.exists(input_file):
+            if cache is not None and cache.contains(input_file):
+                # The cache outlives the graph, it trims itself below
+                LOG.warning('Not removing {0} as it holds the cache {1}'.format(input_file, cache.directory))
+            elif os.path.exists(input_file):
                 if os.path.isdir(input_file):
                     LOG.info('Removing directory {0}'.format(input_file))
 
@@ -172,6 +222,59 @@ class CleanupDirectories(BarrierAppDROP, ErrorHandling):
                             self.uid
                         )
 
+        if cache is not None and not self._dry_run:
+            cache.evict()
+            cache.log_statistics()
+
+
+class WaitForDiskSpace(BarrierAppDROP, ErrorHandling):
+    """
+    Hold back a download until the volume has room for it
+    """
+    def __init__(self, oid, uid, **kwargs):
+        self._directory = None
+        self._required_bytes = None
+        self._reserve_fraction = None
+        self._poll_interval = None
+        self._timeout = None
+        super(WaitForDiskSpace, self).__init__(oid, uid, **kwargs)
+
+    def initialize(self, **kwargs):
+        super(WaitForDiskSpace, self).initialize(**kwargs)
+        self._session_id = self._getArg(kwargs, 'session_id', None)
+        self._directory = self._getArg(kwargs, 'directory', '/mnt/dfms/dfms_root')
+        self._required_bytes = self._getArg(kwargs, 'required_bytes', 0)
+        # Always leave this much of the volume free for the splits still running
+        self._reserve_fraction = self._getArg(kwargs, 'reserve_fraction', 0.05)
+        self._poll_interval = self._getArg(kwargs, 'poll_interval', 60)
+        self._timeout = self._getArg(kwargs, 'timeout', 12 * 60 * 60)
+
+    def dataURL(self):
+        return type(self).__name__
+
+    def run(self):
+        start = time.time()
+        while True:
+            free, total = get_free_space(self._directory)
+            needed = self._required_bytes + int(total * self._reserve_fraction)
+            if free >= needed:
+                LOG.info('{0} has {1} free, {2} needed after {3:.0f}s'.format(
+                    self._directory, bytes2human(free), bytes2human(needed), time.time() - start))
+                return 0
+
+            if time.time() - start > self._timeout:
+                message = 'Gave up waiting for {0} on {1}, only {2} free'.format(bytes2human(needed), self._directory, bytes2human(free))
+                LOG.error(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+
+            LOG.debug('{0} has {1} free, waiting for {2}'.format(self._directory, bytes2human(free), bytes2human(needed)))
+            time.sleep(self._poll_interval)
+
 
 class InitializeSqliteApp(BarrierAppDROP, ErrorHandling):
     def __init__(self, oid, uid, **kwargs):
@@ -25,11 +25,12 @@ My Docker Apps
 import logging
 import os
 
-import boto3
-from boto3.s3.transfer import S3Transfer
-
 from aws_chiles02.apps_general import ErrorHandling
+from aws_chiles02.aws_registry import get_s3_client, get_s3_transfer
 from aws_chiles02.common import ProgressPercentage
+from aws_chiles02.s3_download import download_file_resumable
+from aws_chiles02.s3_governor import get_governor, PRIORITY_INPUT, PRIORITY_PRODUCT
+from aws_chiles02.s3_stream import S3StreamException
 from dfms.drop import BarrierAppDROP
 
 LOG = logging.getLogger(__name__)
@@ -46,6 +47,7 @@ class CopyFitsFromS3(BarrierAppDROP, ErrorHandling):
     def initialize(self, **kwargs):
         super(CopyFitsFromS3, self).initialize(**kwargs)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
 
     def dataURL(self):
         return 'CopyFitsFromS3'
@@ -64,21 +66,28 @@ class CopyFitsFromS3(BarrierAppDROP, ErrorHandling):
             LOG.warn('fits_file: {0} exists'.format(fits_file_name))
             return 0
 
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-        s3_object = s3.Object(bucket_name, key)
-        s3_size = s3_object.content_length
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.download_file(
-                bucket_name,
-                key,
-                fits_file_name,
-                callback=ProgressPercentage(
+        s3_client = get_s3_client()
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+        s3_size = head['ContentLength']
+        # The contents are checked against the ETag as they arrive
+        try:
+            with get_governor().transfer(PRIORITY_INPUT, ProgressPercentage(key, s3_size)) as callback:
+                download_file_resumable(
+                    s3_client,
+                    bucket_name,
                     key,
-                    s3_size
+                    fits_file_name,
+                    callback=callback
                 )
-        )
+        except (S3StreamException, EnvironmentError) as exception:
+            message = 'Downloading {0} failed: {1}'.format(key, exception)
+            LOG.exception(message)
+            self.send_error_message(
+                message,
+                self.oid,
+                self.uid
+            )
+            return 1
         if not os.path.exists(fits_file_name):
             message = 'The fits file {0} does not exist'.format(fits_file_name)
             LOG.error(message)
@@ -101,6 +110,7 @@ class CopyJpeg2000ToS3(BarrierAppDROP, ErrorHandling):
     def initialize(self, **kwargs):
         super(CopyJpeg2000ToS3, self).initialize(**kwargs)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
 
     def dataURL(self):
         return 'CopyJpeg2000ToS3'
@@ -126,22 +136,16 @@ class CopyJpeg2000ToS3(BarrierAppDROP, ErrorHandling):
             )
             return 0
 
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.upload_file(
-            jpeg_file_name,
-            bucket_name,
-            key,
-            callback=ProgressPercentage(
-                    key,
-                    float(os.path.getsize(jpeg_file_name))
-            ),
-            extra_args={
-                'StorageClass': 'REDUCED_REDUNDANCY',
-            }
-        )
+        transfer = get_s3_transfer()
+        with get_governor().transfer(PRIORITY_PRODUCT, ProgressPercentage(key, float(os.path.getsize(jpeg_file_name)))) as callback:
+            transfer.upload_file(
+                jpeg_file_name,
+                bucket_name,
+                key,
+                callback=callback,
+                extra_args={
+                    'StorageClass': 'REDUCED_REDUNDANCY',
+                }
+            )
 
         return 0
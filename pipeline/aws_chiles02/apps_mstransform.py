@@ -25,13 +25,19 @@ My Docker Apps
 import logging
 import os
 import shutil
-
-import boto3
-from boto3.s3.transfer import S3Transfer
+import tarfile
 
 from aws_chiles02.apps_general import ErrorHandling
+from aws_chiles02.aws_registry import get_s3_client, get_s3_transfer
 from aws_chiles02.check_measurement_set import CheckMeasurementSet
 from aws_chiles02.common import run_command, ProgressPercentage
+from aws_chiles02.s3_codec import CODEC_METADATA, CodecException, extract_tar_file
+from aws_chiles02.s3_download import download_file_resumable
+from aws_chiles02.s3_governor import get_governor, PRIORITY_INPUT, PRIORITY_PRODUCT
+from aws_chiles02.s3_stream import extract_tar_from_s3, upload_tar_to_s3, get_size_of_members, S3StreamException
+from aws_chiles02.settings_file import CODECS
+from aws_chiles02.tar_index import put_index_for_file
+from aws_chiles02.tar_members import MemberFilter
 from dfms.apps.dockerapp import DockerApp
 from dfms.drop import BarrierAppDROP
 
@@ -45,11 +51,20 @@ logging.getLogger('s3transfer').setLevel(logging.INFO)
 
 class CopyMsTransformFromS3(BarrierAppDROP, ErrorHandling):
     def __init__(self, oid, uid, **kwargs):
+        self._stream_tar = None
+        self._include = None
+        self._exclude = None
         super(CopyMsTransformFromS3, self).__init__(oid, uid, **kwargs)
 
     def initialize(self, **kwargs):
         super(CopyMsTransformFromS3, self).initialize(**kwargs)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
+        # The observation tars are hundreds of GB, so by default they are staged
+        # with a download that can resume rather than streamed
+        self._stream_tar = self._getArg(kwargs, 'stream_tar', False)
+        self._include = self._getArg(kwargs, 'include', [])
+        self._exclude = self._getArg(kwargs, 'exclude', [])
 
     def dataURL(self):
         return 'app CopyMsTransformFromS3'
@@ -74,55 +89,98 @@ class CopyMsTransformFromS3(BarrierAppDROP, ErrorHandling):
         if not os.path.exists(measurement_set_dir):
             os.makedirs(measurement_set_dir)
 
-        # The following will need (16 + 1) * 262144000 bytes of heap space, ie approximately 4.5G.
-        # Note setting minimum as well as maximum heap results in OutOfMemory errors at times!
-        # The -d64 is to make sure we are using a 64bit JVM.
-        # When extracting to the tar we need even more
-        full_path_tar_file = os.path.join(measurement_set_dir, TAR_FILE)
-        LOG.info('Tar: {0}'.format(full_path_tar_file))
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-
-        s3_object = s3.Object(bucket_name, key)
-        s3_size = s3_object.content_length
-
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.download_file(
-            bucket_name,
-            key,
-            full_path_tar_file,
-            callback=ProgressPercentage(
-                key,
-                s3_size
-            )
-        )
-
-        if not os.path.exists(full_path_tar_file):
-            message = 'The tar file {0} does not exist'.format(full_path_tar_file)
-            LOG.error(message)
-            self.send_error_message(
-                message,
-                self.oid,
-                self.uid
-            )
-            return 1
-
-        # Check the sizes match
-        tar_size = os.path.getsize(full_path_tar_file)
-        if s3_size != tar_size:
-            message = 'The sizes for {0} differ S3: {1}, local FS: {2}'.format(full_path_tar_file, s3_size, tar_size)
-            LOG.error(message)
-            self.send_error_message(
-                message,
-                self.oid,
-                self.uid
-            )
-            return 1
-
-        # The tar file exists and is the same size
-        bash = 'tar -xvf {0} -C {1}'.format(full_path_tar_file, measurement_set_dir)
-        return_code = run_command(bash)
+        member_filter = MemberFilter(self._include, self._exclude)
+        s3_client = get_s3_client()
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+        s3_size = head['ContentLength']
+
+        if self._stream_tar:
+            # Unpack the tar as it arrives so it is never staged on the disk
+            try:
+                with get_governor().transfer(PRIORITY_INPUT, ProgressPercentage(key, s3_size)) as callback:
+                    extract_tar_from_s3(
+                        s3_client,
+                        bucket_name,
+                        key,
+                        measurement_set_dir,
+                        s3_size,
+                        callback=callback,
+                        etag=head['ETag'],
+                        metadata=head.get('Metadata'),
+                        member_filter=member_filter
+                    )
+                return_code = 0
+            except (S3StreamException, CodecException, tarfile.TarError, EnvironmentError) as exception:
+                message = 'Streaming {0} failed: {1}'.format(key, exception)
+                LOG.exception(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+        else:
+            # The following will need (16 + 1) * 262144000 bytes of heap space, ie approximately 4.5G.
+            # Note setting minimum as well as maximum heap results in OutOfMemory errors at times!
+            # The -d64 is to make sure we are using a 64bit JVM.
+            # When extracting to the tar we need even more
+            full_path_tar_file = os.path.join(measurement_set_dir, TAR_FILE)
+            LOG.info('Tar: {0}'.format(full_path_tar_file))
+
+            # A rerun only fetches the parts missing from the checkpoint left by the last attempt
+            try:
+                with get_governor().transfer(PRIORITY_INPUT, ProgressPercentage(key, s3_size)) as callback:
+                    download_file_resumable(
+                        s3_client,
+                        bucket_name,
+                        key,
+                        full_path_tar_file,
+                        callback=callback
+                    )
+            except (S3StreamException, EnvironmentError) as exception:
+                message = 'Downloading {0} failed, it will resume on a rerun: {1}'.format(key, exception)
+                LOG.exception(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+
+            if not os.path.exists(full_path_tar_file):
+                message = 'The tar file {0} does not exist'.format(full_path_tar_file)
+                LOG.error(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+
+            # Check the sizes match
+            tar_size = os.path.getsize(full_path_tar_file)
+            if s3_size != tar_size:
+                message = 'The sizes for {0} differ S3: {1}, local FS: {2}'.format(full_path_tar_file, s3_size, tar_size)
+                LOG.error(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+
+            # The tar file exists and is the same size
+            if CODEC_METADATA in head.get('Metadata', {}) or member_filter.active:
+                # The tar on the node may not know the codec, so decode and filter it here
+                try:
+                    extract_tar_file(full_path_tar_file, measurement_set_dir, head.get('Metadata'), member_filter)
+                    return_code = 0
+                except (CodecException, tarfile.TarError, EnvironmentError):
+                    LOG.exception('Extracting {0}'.format(full_path_tar_file))
+                    return_code = 1
+            else:
+                bash = 'tar -xvf {0} -C {1}'.format(full_path_tar_file, measurement_set_dir)
+                return_code = run_command(bash)
 
         path_exists = os.path.exists(measurement_set)
         if return_code != 0 or not path_exists:
@@ -135,7 +193,9 @@ class CopyMsTransformFromS3(BarrierAppDROP, ErrorHandling):
             )
             return 1
 
-        os.remove(full_path_tar_file)
+        if not self._stream_tar:
+            os.remove(full_path_tar_file)
+        member_filter.log_statistics(key)
         return 0
 
 
@@ -143,6 +203,8 @@ class CopyMsTransformToS3(BarrierAppDROP, ErrorHandling):
     def __init__(self, oid, uid, **kwargs):
         self._max_frequency = None
         self._min_frequency = None
+        self._stream_tar = None
+        self._codec = None
         super(CopyMsTransformToS3, self).__init__(oid, uid, **kwargs)
 
     def initialize(self, **kwargs):
@@ -150,6 +212,9 @@ class CopyMsTransformToS3(BarrierAppDROP, ErrorHandling):
         self._max_frequency = self._getArg(kwargs, 'max_frequency', None)
         self._min_frequency = self._getArg(kwargs, 'min_frequency', None)
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self.set_parallel_streams(kwargs)
+        self._stream_tar = self._getArg(kwargs, 'stream_tar', True)
+        self._codec = self._getArg(kwargs, 'codec', CODECS.get('split'))
 
     def dataURL(self):
         return 'app CopyMsTransformToS3'
@@ -176,38 +241,66 @@ class CopyMsTransformToS3(BarrierAppDROP, ErrorHandling):
             )
             return 0
 
-        # Make the tar file
-        tar_filename = os.path.join(measurement_set_dir, 'vis.tar')
-        os.chdir(measurement_set_dir)
-        bash = 'tar -cvf {0} {1}'.format(tar_filename, directory_name)
-        return_code = run_command(bash)
-        path_exists = os.path.exists(tar_filename)
-        if return_code != 0 or not path_exists:
-            message = 'tar return_code: {0}, exists: {1}'.format(return_code, path_exists)
-            LOG.error(message)
-            self.send_error_message(
-                message,
-                self.oid,
-                self.uid
-            )
-
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-
-        s3_client = s3.meta.client
-        transfer = S3Transfer(s3_client)
-        transfer.upload_file(
-            tar_filename,
-            bucket_name,
-            key,
-            callback=ProgressPercentage(
-                key,
-                float(os.path.getsize(tar_filename))
-            ),
-            extra_args={
-                'StorageClass': 'REDUCED_REDUNDANCY',
-            }
-        )
+        s3_client = get_s3_client()
+
+        if self._stream_tar:
+            # Build the tar as it uploads so it is never staged on the disk
+            try:
+                with get_governor().transfer(PRIORITY_PRODUCT, ProgressPercentage(key, get_size_of_members(measurement_set_dir, [directory_name]))) as callback:
+                    upload_tar_to_s3(
+                        s3_client,
+                        bucket_name,
+                        key,
+                        measurement_set_dir,
+                        [directory_name],
+                        extra_args={
+                            'StorageClass': 'REDUCED_REDUNDANCY',
+                        },
+                        callback=callback,
+                        codec=self._codec,
+                        write_index=True
+                    )
+                return_code = 0
+            except (S3StreamException, CodecException, tarfile.TarError, EnvironmentError) as exception:
+                message = 'Streaming {0} failed: {1}'.format(key, exception)
+                LOG.exception(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+                return 1
+        else:
+            if self._codec not in (None, 'none'):
+                LOG.warning('The {0} codec is only used when streaming, {1} will not be compressed'.format(self._codec, key))
+
+            # Make the tar file
+            tar_filename = os.path.join(measurement_set_dir, 'vis.tar')
+            os.chdir(measurement_set_dir)
+            bash = 'tar -cvf {0} {1}'.format(tar_filename, directory_name)
+            return_code = run_command(bash)
+            path_exists = os.path.exists(tar_filename)
+            if return_code != 0 or not path_exists:
+                message = 'tar return_code: {0}, exists: {1}'.format(return_code, path_exists)
+                LOG.error(message)
+                self.send_error_message(
+                    message,
+                    self.oid,
+                    self.uid
+                )
+
+            transfer = get_s3_transfer()
+            with get_governor().transfer(PRIORITY_PRODUCT, ProgressPercentage(key, float(os.path.getsize(tar_filename)))) as callback:
+                transfer.upload_file(
+                    tar_filename,
+                    bucket_name,
+                    key,
+                    callback=callback,
+                    extra_args={
+                        'StorageClass': 'REDUCED_REDUNDANCY',
+                    }
+                )
+            put_index_for_file(s3_client, bucket_name, key, tar_filename, 'REDUCED_REDUNDANCY')
 
         # Clean up
         shutil.rmtree(measurement_set_dir, ignore_errors=True)
@@ -229,6 +322,7 @@ class DockerMsTransform(DockerApp, ErrorHandling):
         self._min_frequency = self._getArg(kwargs, 'min_frequency', None)
         self._command = 'mstransform.sh %i0 %o0 {0} {1} {2} {3}'
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self._instance_type = self._getArg(kwargs, 'instance_type', None)
 
     def run(self):
         # Because of the lifecycle the drop isn't attached when the command is
@@ -239,7 +333,7 @@ class DockerMsTransform(DockerApp, ErrorHandling):
             self._max_frequency,
             json_drop['Bottom edge'],
         )
-        super(DockerMsTransform, self).run()
+        self.run_timed('mstransform', self._min_frequency, super(DockerMsTransform, self).run)
 
         check_measurement_set = CheckMeasurementSet(
             os.path.join(
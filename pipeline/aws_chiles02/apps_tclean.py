@@ -70,6 +70,7 @@ class DockerTclean(DockerApp, ErrorHandling):
         self._produce_qa = self._getArg(kwargs, 'produce_qa', 'yes')
         self._command = 'tclean.sh %i0 %o0 %o0 '
         self._session_id = self._getArg(kwargs, 'session_id', None)
+        self._instance_type = self._getArg(kwargs, 'instance_type', None)
 
     def run(self):
         # Because of the lifecycle the drop isn't attached when the command is
@@ -98,7 +99,7 @@ class DockerTclean(DockerApp, ErrorHandling):
         else:
             LOG.error('No input files')
 
-        super(DockerTclean, self).run()
+        self.run_timed('clean', self._min_frequency, super(DockerTclean, self).run)
 
     def dataURL(self):
         return 'docker container chiles02:latest'
@@ -0,0 +1,136 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+A process wide registry of boto3 sessions, clients, transfer managers and SQS queues.
+
+A node manager runs thousands of drops. Building a session loads the credentials and every
+client resolves its endpoints and opens its own connection pool, so the apps share them.
+Clients are thread safe once created but sessions are not, so everything is created under
+a lock and only clients are handed out.
+"""
+import logging
+import threading
+
+import boto3
+from boto3.s3.transfer import S3Transfer, TransferConfig
+from botocore.config import Config
+
+from aws_chiles02.settings_file import PARALLEL_STREAMS
+
+LOG = logging.getLogger(__name__)
+
+PROFILE_NAME = 'aws-chiles02'
+# The number of threads each S3Transfer uses
+TRANSFER_CONCURRENCY = 4
+
+_lock = threading.RLock()
+_parallel_streams = None
+_sessions = {}
+_clients = {}
+_transfers = {}
+_queue_urls = {}
+
+
+def set_parallel_streams(parallel_streams):
+    """
+    Size the connection pools for the number of parallel streams the node runs.
+    The apps call this with their graph's value, so the pools only ever grow to the
+    largest graph on the node. Clients built for a smaller size are dropped and
+    rebuilt on next use.
+    """
+    global _parallel_streams
+    with _lock:
+        if _parallel_streams is None or parallel_streams > _parallel_streams:
+            LOG.info('Parallel streams changed from {0} to {1}'.format(_parallel_streams, parallel_streams))
+            _parallel_streams = parallel_streams
+            _clients.clear()
+            _transfers.clear()
+
+
+def get_max_pool_connections():
+    """
+    Every stream can have a transfer running with its own threads, plus a few
+    connections for HEAD requests and the like. Until a graph says otherwise the
+    settings file is used.
+    """
+    parallel_streams = PARALLEL_STREAMS if _parallel_streams is None else _parallel_streams
+    return parallel_streams * TRANSFER_CONCURRENCY + 2
+
+
+def get_session(profile_name=PROFILE_NAME):
+    with _lock:
+        session = _sessions.get(profile_name)
+        if session is None:
+            session = boto3.Session(profile_name=profile_name)
+            _sessions[profile_name] = session
+        return session
+
+
+def get_client(service_name, region=None, profile_name=PROFILE_NAME, use_ssl=True):
+    key = (profile_name, service_name, region, use_ssl)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = get_session(profile_name).client(
+                service_name,
+                region_name=region,
+                use_ssl=use_ssl,
+                config=Config(max_pool_connections=get_max_pool_connections())
+            )
+            _clients[key] = client
+        return client
+
+
+def get_s3_client(region=None, profile_name=PROFILE_NAME):
+    return get_client('s3', region=region, profile_name=profile_name, use_ssl=False)
+
+
+def get_s3_transfer(region=None, profile_name=PROFILE_NAME):
+    key = (profile_name, region)
+    with _lock:
+        transfer = _transfers.get(key)
+        if transfer is None:
+            transfer = S3Transfer(
+                get_s3_client(region=region, profile_name=profile_name),
+                config=TransferConfig(max_concurrency=TRANSFER_CONCURRENCY)
+            )
+            _transfers[key] = transfer
+        return transfer
+
+
+def get_queue_url(queue_name, region, profile_name=PROFILE_NAME):
+    key = (profile_name, region, queue_name)
+    with _lock:
+        queue_url = _queue_urls.get(key)
+        if queue_url is None:
+            sqs = get_client('sqs', region=region, profile_name=profile_name)
+            queue_url = sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
+            _queue_urls[key] = queue_url
+        return queue_url
+
+
+def send_message(queue_name, message_body, region, profile_name=PROFILE_NAME):
+    sqs = get_client('sqs', region=region, profile_name=profile_name)
+    sqs.send_message(
+        QueueUrl=get_queue_url(queue_name, region, profile_name=profile_name),
+        MessageBody=message_body,
+    )
@@ -0,0 +1,175 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Measure how building a graph scales with the number of drops.
+
+A synthetic graph shaped like the mstransform one is built: each day is copied in and
+split into frequencies on one node, every split writing a container that is copied back
+to S3. The time to build, finalise, tag and find the roots is reported along with the
+memory used, and optionally the time the old per node scan of the drop list would take.
+"""
+import argparse
+import logging
+import resource
+import time
+
+from aws_chiles02.build_graph_common import AbstractBuildGraph
+
+LOG = logging.getLogger(__name__)
+
+# The mstransform graph makes about this many drops per frequency of a day
+DROPS_PER_FREQUENCY = 5
+FREQUENCIES_PER_DAY = 120
+# The apps are named after the real ones so the graph can be simulated, they are never run
+APP_COPY_FROM_S3 = 'aws_chiles02.apps_mstransform.CopyMsTransformFromS3'
+APP_MS_TRANSFORM = 'aws_chiles02.apps_mstransform.DockerMsTransform'
+APP_COPY_TO_S3 = 'aws_chiles02.apps_mstransform.CopyMsTransformToS3'
+
+
+class SyntheticBuildGraph(AbstractBuildGraph):
+    def __init__(self, days, frequencies, nodes, shutdown=True, instance_type='i2.2xlarge', parallel_streams=None):
+        """
+        :param parallel_streams: chain the splits of a day into this many streams as the
+            mstransform graph does, or run them all side by side if None
+        """
+        node_details = {
+            instance_type: [{'ip_address': '10.0.{0}.{1}'.format(node // 250, node % 250)} for node in range(nodes)]
+        }
+        super(SyntheticBuildGraph, self).__init__('bucket', shutdown, node_details, '/mnt/dfms/dfms_root', 'session', '10.1.0.1')
+        self._days = days
+        self._frequencies = frequencies
+        self._parallel_streams = parallel_streams
+        self._nodes = [instance['ip_address'] for instance in node_details[instance_type]]
+
+    @property
+    def node_details(self):
+        return self._node_details
+
+    def new_carry_over_data(self):
+        return None
+
+    def build_graph(self):
+        for day in range(self._days):
+            node_id = self._nodes[day % len(self._nodes)]
+            s3_drop = self.create_s3_drop(node_id, self._bucket_name, 'observation_data/day_{0}.tar'.format(day), 'aws-chiles02', 's3_in')
+            copy_from_s3 = self.create_app(node_id, APP_COPY_FROM_S3, 'app_copy_from_s3')
+            measurement_set = self.create_directory_container(node_id, 'dir_in_ms')
+            copy_from_s3.addInput(s3_drop)
+            copy_from_s3.addOutput(measurement_set)
+
+            barrier_drop = self.create_barrier_app(node_id)
+            last_elements = {}
+            for frequency in range(self._frequencies):
+                split = self.create_app(node_id, APP_MS_TRANSFORM, 'app_ms_transform')
+                result = self.create_directory_container(node_id, 'dir_split')
+                split.addInput(measurement_set)
+                split.addOutput(result)
+
+                copy_to_s3 = self.create_app(node_id, APP_COPY_TO_S3, 'app_copy_mstransform')
+                s3_out = self.create_s3_drop(node_id, self._bucket_name, 'split_4/{0}/day_{1}.tar'.format(frequency, day), 'aws-chiles02', 's3_out')
+                copy_to_s3.addInput(result)
+                copy_to_s3.addOutput(s3_out)
+
+                if self._parallel_streams is not None:
+                    stream = frequency % self._parallel_streams
+                    if stream in last_elements:
+                        split.addInput(last_elements[stream])
+                    last_elements[stream] = s3_out
+
+                memory_drop = self.create_memory_drop(node_id)
+                barrier_drop.addInput(s3_out)
+                barrier_drop.addOutput(memory_drop)
+
+        self.copy_logfiles_and_shutdown()
+
+
+def scan_per_node(graph):
+    """
+    What copy_logfiles_and_shutdown used to do, scan every drop for every node
+    """
+    count = 0
+    for list_ips in graph._node_details.values():
+        for instance_details in list_ips:
+            node_id = instance_details['ip_address']
+            for drop in graph.drop_list:
+                if drop['type'] in ['plain', 'container'] and drop['node'] == node_id:
+                    count += 1
+    return count
+
+
+def benchmark(drop_counts, nodes, compare=False):
+    """
+    Build a graph of roughly each size
+
+    :return: a list of (drops, build seconds, tag seconds, roots seconds, scan seconds or None, max rss)
+    """
+    results = []
+    for drop_count in drop_counts:
+        frequencies = min(FREQUENCIES_PER_DAY, max(1, drop_count // DROPS_PER_FREQUENCY))
+        days = max(1, drop_count // (frequencies * DROPS_PER_FREQUENCY))
+        graph = SyntheticBuildGraph(days, frequencies, nodes)
+
+        start = time.time()
+        graph.build_graph()
+        build = time.time() - start
+
+        start = time.time()
+        graph.tag_all_app_drops({'session_id': 'session'})
+        tag = time.time() - start
+
+        start = time.time()
+        graph.get_roots()
+        roots = time.time() - start
+
+        scan = None
+        if compare:
+            start = time.time()
+            scan_per_node(graph)
+            scan = time.time() - start
+
+        results.append((len(graph.drop_list), build, tag, roots, scan, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    return results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser('Benchmark building synthetic graphs')
+    parser.add_argument('--drops', type=int, nargs='+', default=[10 ** 4, 10 ** 5, 10 ** 6], help='the approximate number of drops')
+    parser.add_argument('--nodes', type=int, default=30, help='the number of nodes')
+    parser.add_argument('--compare', action='store_true', help='also time the old scan of the drop list for each node')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    for drops, build, tag, roots, scan, max_rss in benchmark(arguments.drops, arguments.nodes, arguments.compare):
+        LOG.info('{0:,} drops: build {1:.2f}s, tag {2:.2f}s, roots {3:.2f}s{4}, max rss {5:,}kB'.format(
+            drops,
+            build,
+            tag,
+            roots,
+            ', old scan {0:.2f}s'.format(scan) if scan is not None else '',
+            max_rss))
+
+
+if __name__ == "__main__":
+    main()
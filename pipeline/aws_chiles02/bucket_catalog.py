@@ -0,0 +1,384 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+A local SQLite catalog of what is in the bucket.
+
+The work planners need to know which days have been split into which frequencies, which
+splits have had uvsub run on them and so on. Paging through tens of thousands of keys
+every time is slow, so the keys are kept in a catalog with the frequency and day parsed
+out and indexed. A prefix is refreshed by listing its sub-prefixes in parallel and
+applying the differences, and is left alone if it was refreshed recently.
+"""
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from Queue import Queue
+from calendar import timegm
+from os.path import expanduser, join
+
+from aws_chiles02.aws_registry import get_s3_client
+from aws_chiles02.common import set_logging_level
+from aws_chiles02.settings_file import INPUT_MS_SUFFIX_TAR
+
+LOG = logging.getLogger(__name__)
+
+CATALOG_DIRECTORY = expanduser('~/.aws-chiles02')
+# How many seconds a refresh of a prefix is trusted for
+MAX_AGE = 15 * 60
+LIST_THREADS = 8
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS s3_object (
+        key TEXT PRIMARY KEY,
+        prefix TEXT NOT NULL,
+        extension TEXT,
+        size INTEGER,
+        etag TEXT,
+        last_modified REAL,
+        frequency TEXT,
+        bottom_frequency INTEGER,
+        top_frequency INTEGER,
+        day TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS s3_object_frequency ON s3_object (prefix, frequency, day)',
+    'CREATE INDEX IF NOT EXISTS s3_object_day ON s3_object (prefix, day)',
+    '''CREATE TABLE IF NOT EXISTS refresh (
+        prefix TEXT PRIMARY KEY,
+        refreshed REAL
+    )''',
+]
+
+FREQUENCY_DIRECTORY = re.compile(r'^(\d+)_(\d+)$')
+CLEANED_TAR = re.compile(r'^cleaned_(\d+)_(\d+)\.tar')
+
+
+def parse_key(key):
+    """
+    Pull the prefix, extension, frequency and day out of a key
+
+    >>> parse_key('split_4/1020_1024/13B-266.sb28624226.eb28625769.56669.43262586805.tar')
+    ('split_4', '.tar', '1020_1024', 1020, 1024, '13B-266.sb28624226.eb28625769.56669.43262586805')
+    >>> parse_key('observation_data/13B-266.sb28624226.eb28625769.56669.43262586805_calibrated_deepfield.ms.tar')
+    ('observation_data', '.tar', None, None, None, '13B-266.sb28624226.eb28625769.56669.43262586805')
+    >>> parse_key('clean_4_10_1/cleaned_1020_1024.tar.qa')
+    ('clean_4_10_1', '.qa', '1020_1024', 1020, 1024, None)
+    >>> parse_key('uvsub_4/1020_1024/day.tar.idx')
+    ('uvsub_4', '.idx', '1020_1024', 1020, 1024, 'day')
+    """
+    elements = key.split('/')
+    prefix = elements[0]
+    name = elements[-1]
+    extension = os.path.splitext(name)[1]
+    frequency = bottom_frequency = top_frequency = day = None
+
+    if len(elements) == 3:
+        match = FREQUENCY_DIRECTORY.match(elements[1])
+        if match is not None:
+            frequency = elements[1]
+            bottom_frequency, top_frequency = int(match.group(1)), int(match.group(2))
+            if '.tar' in name:
+                day = name[:name.index('.tar')]
+    elif len(elements) == 2:
+        if name.endswith(INPUT_MS_SUFFIX_TAR):
+            day = name[:-len(INPUT_MS_SUFFIX_TAR)]
+        match = CLEANED_TAR.match(name)
+        if match is not None:
+            bottom_frequency, top_frequency = int(match.group(1)), int(match.group(2))
+            frequency = '{0}_{1}'.format(bottom_frequency, top_frequency)
+
+    return prefix, extension, frequency, bottom_frequency, top_frequency, day
+
+
+def get_catalog_filename(bucket_name):
+    return join(CATALOG_DIRECTORY, 'catalog_{0}.db'.format(bucket_name))
+
+
+def list_keys(s3_client, bucket_name, prefix, delimiter=None):
+    """
+    List the keys under a prefix
+
+    :return: a list of (key, size, etag, last modified) and the common prefixes if there is a delimiter
+    """
+    keys = []
+    common_prefixes = []
+    arguments = {'Bucket': bucket_name, 'Prefix': prefix}
+    if delimiter is not None:
+        arguments['Delimiter'] = delimiter
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**arguments):
+        for s3_object in page.get('Contents', []):
+            keys.append((
+                s3_object['Key'],
+                s3_object['Size'],
+                s3_object['ETag'],
+                timegm(s3_object['LastModified'].utctimetuple()),
+            ))
+        for common_prefix in page.get('CommonPrefixes', []):
+            common_prefixes.append(common_prefix['Prefix'])
+    return keys, common_prefixes
+
+
+class BucketCatalog(object):
+    def __init__(self, bucket_name, filename=None, s3_client=None, max_age=MAX_AGE, threads=LIST_THREADS):
+        """
+        :param bucket_name: the bucket
+        :param filename: the SQLite database, by default one per bucket in ~/.aws-chiles02
+        :param max_age: seconds before a prefix is listed again
+        """
+        self._bucket_name = bucket_name
+        if filename is None:
+            if not os.path.exists(CATALOG_DIRECTORY):
+                os.makedirs(CATALOG_DIRECTORY)
+            filename = get_catalog_filename(bucket_name)
+        self._s3_client = s3_client
+        self._max_age = max_age
+        self._threads = threads
+        self._connection = sqlite3.connect(filename)
+        with self._connection:
+            for statement in SCHEMA:
+                self._connection.execute(statement)
+
+    def close(self):
+        self._connection.close()
+
+    def _get_s3_client(self):
+        if self._s3_client is None:
+            self._s3_client = get_s3_client()
+        return self._s3_client
+
+    def is_fresh(self, prefix):
+        row = self._connection.execute('SELECT refreshed FROM refresh WHERE prefix = ?', (prefix,)).fetchone()
+        return row is not None and time.time() - row[0] < self._max_age
+
+    def refresh(self, prefixes, force=False):
+        """
+        Bring the catalog up to date for the top level prefixes, such as split_4, that are stale
+        """
+        for prefix in prefixes:
+            if not force and self.is_fresh(prefix):
+                LOG.debug('{0} is fresh'.format(prefix))
+                continue
+
+            start = time.time()
+            keys = self._list_prefix(prefix)
+            inserted, updated, deleted = self._apply(prefix, keys, start)
+            LOG.info('Refreshed {0} in {1:.1f}s, {2} keys, {3} new, {4} changed, {5} gone'.format(
+                prefix, time.time() - start, len(keys), inserted, updated, deleted))
+
+    def _list_prefix(self, prefix):
+        s3_client = self._get_s3_client()
+        # The objects at the top level and the sub-prefixes, which are listed in parallel
+        keys, shards = list_keys(s3_client, self._bucket_name, prefix + '/', delimiter='/')
+
+        queue = Queue()
+        for shard in shards:
+            queue.put(shard)
+        errors = []
+        lock = threading.Lock()
+
+        def list_shards():
+            while True:
+                try:
+                    shard = queue.get_nowait()
+                except Exception:
+                    return
+                try:
+                    shard_keys, _ = list_keys(s3_client, self._bucket_name, shard)
+                    with lock:
+                        keys.extend(shard_keys)
+                except Exception as exception:
+                    LOG.exception('Listing {0}'.format(shard))
+                    with lock:
+                        errors.append('{0}: {1}'.format(shard, exception))
+
+        threads = []
+        for count in range(min(self._threads, len(shards))):
+            thread = threading.Thread(target=list_shards, name='list-{0}'.format(count))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if len(errors) > 0:
+            # A partial listing would make keys look deleted
+            raise IOError('Listing {0} failed: {1}'.format(prefix, ', '.join(errors)))
+        return keys
+
+    def _apply(self, prefix, keys, refreshed):
+        existing = dict(self._connection.execute('SELECT key, etag FROM s3_object WHERE prefix = ?', (prefix,)).fetchall())
+        inserted = updated = 0
+        with self._connection:
+            for key, size, etag, last_modified in keys:
+                old_etag = existing.pop(key, None)
+                if old_etag == etag:
+                    continue
+                if old_etag is None:
+                    inserted += 1
+                else:
+                    updated += 1
+                parsed = parse_key(key)
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO s3_object VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key,) + parsed[:2] + (size, etag, last_modified) + parsed[2:]
+                )
+            self._connection.executemany('DELETE FROM s3_object WHERE key = ?', [(key,) for key in existing.keys()])
+            self._connection.execute('INSERT OR REPLACE INTO refresh VALUES (?, ?)', (prefix, refreshed))
+        return inserted, updated, len(existing)
+
+    def forget(self, keys):
+        """
+        Remove deleted keys and mark their prefixes stale so the next refresh lists them again
+        """
+        prefixes = set([key.split('/')[0] for key in keys])
+        with self._connection:
+            self._connection.executemany('DELETE FROM s3_object WHERE key = ?', [(key,) for key in keys])
+            self._connection.executemany('DELETE FROM refresh WHERE prefix = ?', [(prefix,) for prefix in prefixes])
+        LOG.info('Forgot {0} keys, {1} now stale'.format(len(keys), ', '.join(sorted(prefixes))))
+
+    def get_keys(self, prefix, extension='.tar'):
+        """
+        The keys under a prefix, by default only the tar files
+        """
+        return set([row[0] for row in self._connection.execute(
+            'SELECT key FROM s3_object WHERE prefix = ? AND extension = ?', (prefix, extension)
+        )])
+
+    def get_all_keys(self, prefix):
+        return set([row[0] for row in self._connection.execute('SELECT key FROM s3_object WHERE prefix = ?', (prefix,))])
+
+    def get_observations(self, prefix='observation_data'):
+        """
+        The measurement sets to split as a list of (tar file name, size)
+        """
+        return [
+            (key.split('/')[-1], size) for key, size in self._connection.execute(
+                'SELECT key, size FROM s3_object WHERE prefix = ? AND day IS NOT NULL ORDER BY key', (prefix,)
+            )
+        ]
+
+    def get_frequencies(self, prefix):
+        return set([row[0] for row in self._connection.execute(
+            'SELECT DISTINCT frequency FROM s3_object WHERE prefix = ? AND extension = ? AND frequency IS NOT NULL', (prefix, '.tar')
+        )])
+
+    def get_size_by_frequency(self, prefix):
+        """
+        The total size of the tar files for each frequency, such as all the days of a uvsub
+        """
+        return dict(self._connection.execute(
+            'SELECT frequency, SUM(size) FROM s3_object WHERE prefix = ? AND extension = ? AND frequency IS NOT NULL GROUP BY frequency',
+            (prefix, '.tar')
+        ).fetchall())
+
+    def get_frequencies_by_day(self, prefix):
+        """
+        The frequencies done for each day, such as the splits made from each observation
+        """
+        frequencies_per_day = {}
+        for day, frequency in self._connection.execute(
+                'SELECT day, frequency FROM s3_object WHERE prefix = ? AND extension = ? AND day IS NOT NULL AND frequency IS NOT NULL',
+                (prefix, '.tar')):
+            frequencies_per_day.setdefault(day, []).append(frequency)
+        return frequencies_per_day
+
+    def get_days_missing_frequency(self, prefix, frequency, days_prefix='observation_data'):
+        """
+        The days in days_prefix with no tar file for the frequency in prefix
+        """
+        return [row[0] for row in self._connection.execute(
+            '''SELECT day FROM s3_object AS days
+               WHERE days.prefix = ? AND days.extension = ? AND days.day IS NOT NULL
+               AND NOT EXISTS (
+                   SELECT 1 FROM s3_object AS done
+                   WHERE done.prefix = ? AND done.frequency = ? AND done.day = days.day AND done.extension = ?
+               )
+               ORDER BY day''',
+            (days_prefix, '.tar', prefix, frequency, '.tar')
+        )]
+
+    def get_missing(self, source_prefix, target_prefix):
+        """
+        The (frequency, day) tar files in source_prefix without a matching one in target_prefix,
+        for example the splits that haven't had uvsub run on them
+        """
+        return self._connection.execute(
+            '''SELECT source.frequency, source.day FROM s3_object AS source
+               WHERE source.prefix = ? AND source.extension = ? AND source.frequency IS NOT NULL AND source.day IS NOT NULL
+               AND NOT EXISTS (
+                   SELECT 1 FROM s3_object AS target
+                   WHERE target.prefix = ? AND target.frequency = source.frequency AND target.day = source.day AND target.extension = ?
+               )
+               ORDER BY source.bottom_frequency, source.day''',
+            (source_prefix, '.tar', target_prefix, '.tar')
+        ).fetchall()
+
+    def get_size(self, key):
+        """
+        The size of a key, None if it isn't in the catalog
+        """
+        row = self._connection.execute('SELECT size FROM s3_object WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+
+def get_catalog(bucket_name, prefixes, force=False):
+    """
+    Open the catalog for a bucket with the prefixes brought up to date
+    """
+    catalog = BucketCatalog(bucket_name)
+    catalog.refresh(prefixes, force=force)
+    return catalog
+
+
+def forget_keys(bucket_name, keys):
+    """
+    Remove deleted keys from the bucket's catalog, if there is one
+    """
+    if len(keys) > 0 and os.path.exists(get_catalog_filename(bucket_name)):
+        catalog = BucketCatalog(bucket_name)
+        catalog.forget(keys)
+        catalog.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser('Refresh the local catalog of a bucket')
+    parser.add_argument('bucket', help='the bucket to access')
+    parser.add_argument('prefixes', nargs='+', help='the top level prefixes, for example observation_data split_4')
+    parser.add_argument('-f', '--force', action='store_true', help='list the prefixes even if they are fresh')
+    parser.add_argument('-v', '--verbosity', action='count', default=0, help='increase output verbosity')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    set_logging_level(arguments.verbosity)
+    catalog = get_catalog(arguments.bucket, arguments.prefixes, force=arguments.force)
+    for prefix in arguments.prefixes:
+        LOG.info('{0}: {1} tar files'.format(prefix, len(catalog.get_keys(prefix))))
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+A shared engine for the bucket maintenance tools.
+
+Everything is worked out from the listing, which already carries the size and storage
+class, so a HEAD is only made when something like the restore status is needed and then
+from a pool of threads. A prefix is split into shards by listing a couple of levels with a
+delimiter and the shards are listed in parallel. Deletes go in batches of up to 1000 keys
+through delete_objects and the deleted keys are dropped from the local catalog of the bucket.
+With dry_run set nothing is changed and the report says what would be.
+"""
+import logging
+import threading
+from Queue import Empty, Queue
+from collections import namedtuple
+
+from aws_chiles02.aws_registry import get_s3_client
+from aws_chiles02.bucket_catalog import forget_keys
+from aws_chiles02.common import bytes2human
+
+LOG = logging.getLogger(__name__)
+
+# The most keys delete_objects will take
+DELETE_BATCH_SIZE = 1000
+MAINTENANCE_THREADS = 8
+# How many levels of delimiter listing are used to find the shards
+SHARD_DEPTH = 2
+
+ObjectInfo = namedtuple('ObjectInfo', ['key', 'size', 'storage_class', 'last_modified'])
+MultipartUpload = namedtuple('MultipartUpload', ['key', 'upload_id', 'initiated'])
+
+
+def run_in_threads(function, items, threads=MAINTENANCE_THREADS, name='maintenance'):
+    """
+    Call function on each item from a pool of threads
+
+    :return: the results in the same order as the items
+    """
+    results = [None] * len(items)
+    errors = []
+    lock = threading.Lock()
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[index] = function(item)
+            except Exception as exception:
+                LOG.exception('{0} failed on {1}'.format(name, item))
+                with lock:
+                    errors.append('{0}: {1}'.format(item, exception))
+
+    workers = []
+    for count in range(min(threads, len(items))):
+        thread = threading.Thread(target=worker, name='{0}-{1}'.format(name, count))
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        thread.join()
+
+    if len(errors) > 0:
+        raise IOError('{0} failed: {1}'.format(name, ', '.join(errors)))
+    return results
+
+
+class MaintenanceReport(object):
+    """
+    What a maintenance pass looked at and what it did, or would have done on a dry run
+    """
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.checked = 0
+        self.checked_bytes = 0
+        self.prefixes = {}
+        self.storage_classes = {}
+        self.deleted = 0
+        self.deleted_bytes = 0
+        self.aborted = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add_checked(self, objects):
+        with self._lock:
+            for s3_object in objects:
+                self.checked += 1
+                self.checked_bytes += s3_object.size
+                for totals, name in [(self.prefixes, s3_object.key.split('/')[0]), (self.storage_classes, s3_object.storage_class)]:
+                    count, size = totals.get(name, (0, 0))
+                    totals[name] = (count + 1, size + s3_object.size)
+
+    def add_deleted(self, count, size):
+        with self._lock:
+            self.deleted += count
+            self.deleted_bytes += size
+
+    def add_aborted(self, count):
+        with self._lock:
+            self.aborted += count
+
+    def add_error(self, error):
+        with self._lock:
+            self.errors.append(error)
+
+    def log(self):
+        LOG.info('Checked {0:,} objects, {1}'.format(self.checked, bytes2human(self.checked_bytes)))
+        for title, totals in [('prefix', self.prefixes), ('storage class', self.storage_classes)]:
+            for name in sorted(totals.keys()):
+                count, size = totals[name]
+                LOG.info('  {0} {1}: {2:,} objects, {3}'.format(title, name, count, bytes2human(size)))
+        verb = 'Would delete' if self.dry_run else 'Deleted'
+        if self.deleted > 0:
+            LOG.info('{0} {1:,} objects, {2}'.format(verb, self.deleted, bytes2human(self.deleted_bytes)))
+        if self.aborted > 0:
+            LOG.info('{0} {1:,} multipart uploads'.format('Would abort' if self.dry_run else 'Aborted', self.aborted))
+        for error in self.errors:
+            LOG.error(error)
+
+
+class BucketMaintenance(object):
+    def __init__(self, bucket_name, s3_client=None, threads=MAINTENANCE_THREADS, dry_run=False, catalog=None):
+        """
+        :param bucket_name: the bucket
+        :param threads: how many listings, delete batches or HEADs run at once
+        :param dry_run: report what would be deleted or aborted without doing it
+        :param catalog: the BucketCatalog to remove deleted keys from, by default the bucket's own if it has one
+        """
+        self._bucket_name = bucket_name
+        self._s3_client = s3_client if s3_client is not None else get_s3_client()
+        self._threads = threads
+        self._catalog = catalog
+        self.dry_run = dry_run
+        self.report = MaintenanceReport(dry_run)
+
+    def _list(self, prefix, delimiter=None):
+        objects = []
+        common_prefixes = []
+        arguments = {'Bucket': self._bucket_name, 'Prefix': prefix}
+        if delimiter is not None:
+            arguments['Delimiter'] = delimiter
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**arguments):
+            for s3_object in page.get('Contents', []):
+                objects.append(ObjectInfo(
+                    s3_object['Key'],
+                    s3_object['Size'],
+                    s3_object.get('StorageClass', 'STANDARD'),
+                    s3_object.get('LastModified'),
+                ))
+            for common_prefix in page.get('CommonPrefixes', []):
+                common_prefixes.append(common_prefix['Prefix'])
+        return objects, common_prefixes
+
+    def list_objects(self, prefix='', key_filter=None, depth=SHARD_DEPTH):
+        """
+        List everything under the prefix, sharding on the first depth levels of '/'
+
+        :param key_filter: if given only the objects it returns True for are kept
+        """
+        objects = []
+        shards = [prefix]
+        for _ in range(depth):
+            next_shards = []
+            for shard_objects, common_prefixes in run_in_threads(lambda shard: self._list(shard, '/'), shards, self._threads, 'list'):
+                objects.extend(shard_objects)
+                next_shards.extend(common_prefixes)
+            shards = next_shards
+            if len(shards) == 0:
+                break
+        for shard_objects, _ in run_in_threads(self._list, shards, self._threads, 'list'):
+            objects.extend(shard_objects)
+
+        if key_filter is not None:
+            objects = [s3_object for s3_object in objects if key_filter(s3_object)]
+        self.report.add_checked(objects)
+        LOG.debug('Listed {0:,} objects under "{1}" from {2} shards'.format(len(objects), prefix, len(shards)))
+        return objects
+
+    def _delete_batch(self, batch):
+        if self.dry_run:
+            for s3_object in batch:
+                LOG.info('Would delete {0}, size: {1:,}'.format(s3_object.key, s3_object.size))
+            self.report.add_deleted(len(batch), sum([s3_object.size for s3_object in batch]))
+            return []
+
+        response = self._s3_client.delete_objects(
+            Bucket=self._bucket_name,
+            Delete={'Objects': [{'Key': s3_object.key} for s3_object in batch], 'Quiet': True},
+        )
+        failed = set()
+        for error in response.get('Errors', []):
+            failed.add(error['Key'])
+            self.report.add_error('Deleting {0}: {1} {2}'.format(error['Key'], error.get('Code'), error.get('Message')))
+        deleted = [s3_object for s3_object in batch if s3_object.key not in failed]
+        self.report.add_deleted(len(deleted), sum([s3_object.size for s3_object in deleted]))
+        return [s3_object.key for s3_object in deleted]
+
+    def delete_objects(self, objects):
+        """
+        Delete the objects in batches of DELETE_BATCH_SIZE keys, a failed key is recorded in the report
+        """
+        batches = [objects[start:start + DELETE_BATCH_SIZE] for start in range(0, len(objects), DELETE_BATCH_SIZE)]
+        deleted_keys = []
+        for keys in run_in_threads(self._delete_batch, batches, self._threads, 'delete'):
+            deleted_keys.extend(keys)
+
+        # SQLite connections stay on the thread that made them so the catalog is updated here
+        if self._catalog is not None:
+            if len(deleted_keys) > 0:
+                self._catalog.forget(deleted_keys)
+        else:
+            forget_keys(self._bucket_name, deleted_keys)
+
+    def head_objects(self, keys):
+        """
+        HEAD the keys from the thread pool for the things a listing does not return
+
+        :return: a dictionary of key to the head_object response
+        """
+        responses = run_in_threads(
+            lambda key: self._s3_client.head_object(Bucket=self._bucket_name, Key=key), keys, self._threads, 'head'
+        )
+        return dict(zip(keys, responses))
+
+    def list_multipart_uploads(self, prefix=''):
+        uploads = []
+        paginator = self._s3_client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=self._bucket_name, Prefix=prefix):
+            for upload in page.get('Uploads', []):
+                uploads.append(MultipartUpload(upload['Key'], upload['UploadId'], upload['Initiated']))
+        return uploads
+
+    def _abort(self, upload):
+        LOG.info('{0} {1}, initiated: {2}'.format('Would abort' if self.dry_run else 'Aborting', upload.key, upload.initiated))
+        if not self.dry_run:
+            self._s3_client.abort_multipart_upload(Bucket=self._bucket_name, Key=upload.key, UploadId=upload.upload_id)
+        self.report.add_aborted(1)
+
+    def abort_multipart_uploads(self, uploads):
+        run_in_threads(self._abort, uploads, self._threads, 'abort')
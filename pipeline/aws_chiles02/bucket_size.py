@@ -25,9 +25,8 @@ Calculate the size of a bucket
 import argparse
 import logging
 
-import boto3
-
-from aws_chiles02.common import bytes2human
+from aws_chiles02.bucket_maintenance import BucketMaintenance
+from aws_chiles02.common import set_logging_level
 
 LOG = logging.getLogger(__name__)
 
@@ -35,32 +34,18 @@ LOG = logging.getLogger(__name__)
 def parse_arguments():
     parser = argparse.ArgumentParser('How much data is stored in a bucket')
     parser.add_argument('bucket', help='the bucket to access')
+    parser.add_argument('-p', '--prefix', default='', help='only size the keys under this prefix')
     parser.add_argument('-v', '--verbosity', action='count', default=0, help='increase output verbosity')
     return parser.parse_args()
 
 
 def main():
     arguments = parse_arguments()
-    logging.basicConfig(level=logging.INFO)
-    if arguments.verbosity == 0:
-        logging.getLogger('boto3').setLevel(level=logging.WARN)
-        logging.getLogger('botocore').setLevel(level=logging.WARN)
-        logging.getLogger('nose').setLevel(level=logging.WARN)
-
-    session = boto3.Session(profile_name='aws-chiles02')
-    s3 = session.resource('s3', use_ssl=False)
-
-    bucket = s3.Bucket(arguments.bucket)
-    size = 0
-    count = 0
-    for key in bucket.objects.all():
-        size += key.size
-        count += 1
-
-        if count % 100 == 0:
-            LOG.info('Count: {0}, size: {1}'.format(count, bytes2human(size)))
+    set_logging_level(arguments.verbosity)
 
-    LOG.info('Size: {0}'.format(bytes2human(size)))
+    maintenance = BucketMaintenance(arguments.bucket)
+    maintenance.list_objects(arguments.prefix)
+    maintenance.report.log()
 
 
 if __name__ == "__main__":
@@ -29,7 +29,9 @@ from aws_chiles02.apps_general import CleanupDirectories
 from aws_chiles02.apps_tclean import DockerTclean
 from aws_chiles02.common import get_module_name
 from aws_chiles02.build_graph_common import AbstractBuildGraph
+from aws_chiles02.scheduler import get_nodes, schedule_tasks
 from aws_chiles02.settings_file import CONTAINER_CHILES02
+from aws_chiles02.tar_index import INDEX_SUFFIX
 
 
 class CarryOverDataClean:
@@ -78,7 +80,6 @@ class BuildGraphClean(AbstractBuildGraph):
         self._produce_qa = produce_qa
         self._clean_tclean = clean_tclean
         self._map_frequency_to_node = None
-        self._list_ip = []
         self._s3_client = None
 
     def new_carry_over_data(self):
@@ -190,25 +191,22 @@ class BuildGraphClean(AbstractBuildGraph):
         return self._map_frequency_to_node[frequency_to_process]
 
     def _build_node_map(self):
-        self._list_ip = []
-        for key, values in self._node_details.iteritems():
-            for value in values:
-                self._list_ip.append(value['ip_address'])
+        schedule = schedule_tasks(
+            'clean',
+            [(frequency_pair.size, frequency_pair.bottom_frequency) for frequency_pair in self._work_to_do],
+            get_nodes(self._node_details)
+        )
+        schedule.log()
 
         self._map_frequency_to_node = {}
-        count = 0
-        for frequency_to_process in self._work_to_do:
-            self._map_frequency_to_node[frequency_to_process] = self._list_ip[count]
-
-            count += 1
-            if count >= len(self._list_ip):
-                count = 0
+        for frequency_to_process, assignment in zip(self._work_to_do, schedule.assignments):
+            self._map_frequency_to_node[frequency_to_process] = assignment.node_id
 
     def _build_s3_download(self, node_id, frequency_pair):
         s3_objects = []
         prefix = '{0}/{1}_{2}'.format(self._s3_uvsub_name, frequency_pair.bottom_frequency, frequency_pair.top_frequency)
         for key in self._bucket.objects.filter(Prefix=prefix):
-            if not key.key.startswith('stats'):
+            if not key.key.startswith('stats') and not key.key.endswith(INDEX_SUFFIX):
                 s3_objects.append(key.key)
 
         parallel_streams = [None] * self._parallel_streams
@@ -25,9 +25,12 @@ The abstract graph builder
 import os
 import uuid
 from abc import ABCMeta, abstractmethod
+from collections import defaultdict
 
 from aws_chiles02.apps_general import CopyLogFilesApp
 from aws_chiles02.common import get_module_name
+from aws_chiles02.disk_budget import DiskBudget, get_volumes
+from aws_chiles02.graph_serializer import compact_drop
 from dfms.apps.bash_shell_app import BashShellApp
 from dfms.drop import dropdict, DirectoryContainer, BarrierAppDROP
 
@@ -40,15 +43,22 @@ class AbstractBuildGraph:
 
     def __init__(self, bucket_name, shutdown, node_details, volume, session_id, dim_ip):
         self._drop_list = []
+        # Indexes kept up to date by add_drop so finalising the graph does not rescan the list per node
+        self._drops_by_node = defaultdict(lambda: defaultdict(list))
+        self._drops_by_type = defaultdict(list)
         self._map_carry_over_data = {}
         self._bucket_name = bucket_name
         self._shutdown = shutdown
         self._bucket = None
         self._node_details = node_details
-        self._volume = volume
+        # The volume may be a list of scratch directories, one per ephemeral device
+        self._volumes = get_volumes(volume)
+        self._volume = self._volumes[0]
         self._session_id = session_id
         self._dim_ip = dim_ip
+        self._parallel_streams = None
         self._counters = {}
+        self._disk_budget = DiskBudget(node_details, self._volumes)
 
         for key, list_ips in self._node_details.iteritems():
             for instance_details in list_ips:
@@ -59,7 +69,42 @@ class AbstractBuildGraph:
         return self._drop_list
 
     def add_drop(self, drop):
+        compact_drop(drop)
         self._drop_list.append(drop)
+        self._drops_by_node[drop.get('node')][drop['type']].append(drop)
+        self._drops_by_type[drop['type']].append(drop)
+
+    def get_drops_for_node(self, node_id, drop_types=None):
+        """
+        The drops on a node, optionally only those of the given types
+        """
+        drops_by_type = self._drops_by_node.get(node_id, {})
+        if drop_types is None:
+            drop_types = drops_by_type.keys()
+        drops = []
+        for drop_type in drop_types:
+            drops.extend(drops_by_type.get(drop_type, []))
+        return drops
+
+    def get_drops_of_type(self, drop_type):
+        return list(self._drops_by_type.get(drop_type, []))
+
+    def get_roots(self):
+        """
+        The oids of the drops nothing feeds into, the same as dfms.droputils.get_roots in one pass
+        """
+        non_roots = set()
+        for drop_type in ['app', 'socket']:
+            for drop in self._drops_by_type.get(drop_type, []):
+                if drop.get('inputs') or drop.get('streamingInputs'):
+                    non_roots.add(drop['oid'])
+                non_roots.update(drop.get('outputs') or [])
+        for drop in self._drops_by_type.get('plain', []):
+            if drop.get('producers'):
+                non_roots.add(drop['oid'])
+            non_roots.update(drop.get('consumers') or [])
+            non_roots.update(drop.get('streamingConsumers') or [])
+        return set([drop['oid'] for drop in self._drop_list]) - non_roots
 
     def get_oid(self, count_type):
         count = self._counters.get(count_type)
@@ -86,20 +131,16 @@ class AbstractBuildGraph:
             for instance_details in list_ips:
                 node_id = instance_details['ip_address']
 
-                copy_log_drop = self.create_app(node_id, get_module_name(CopyLogFilesApp), 'copy_log_files_app')
-
                 # After everything is complete
-                for drop in self._drop_list:
-                    if drop['type'] in ['plain', 'container'] and drop['node'] == node_id:
-                        copy_log_drop.addInput(drop)
+                drops = self.get_drops_for_node(node_id, ['plain', 'container'])
+                copy_log_drop = self.create_app(node_id, get_module_name(CopyLogFilesApp), 'copy_log_files_app')
+                for drop in drops:
+                    copy_log_drop.addInput(drop)
 
                 s3_drop_out = self.create_s3_drop(
                     node_id,
                     self._bucket_name,
-                    '{0}/{1}.tar'.format(
-                        self._session_id,
-                        node_id,
-                    ),
+                    self._get_log_key(node_id),
                     'aws-chiles02',
                     oid='s3_out'
                 )
@@ -115,10 +156,52 @@ class AbstractBuildGraph:
 
                         dim_shutdown_drop.addInput(memory_drop)
 
-    def tag_all_app_drops(self, tags):
+    def _get_instance_type(self, node_id):
+        for instance_type, list_ips in self._node_details.iteritems():
+            for instance_details in list_ips:
+                if instance_details['ip_address'] == node_id:
+                    return instance_details.get('instance_type', instance_type)
+        return None
+
+    def _get_log_key(self, node_id):
+        return '{0}/{1}.tar'.format(self._session_id, node_id)
+
+    def bind_nodes(self, node_details, dim_ip=None):
+        """
+        Move a graph built for placeholder nodes onto the nodes that reported in. The
+        placement depends on the instance types, so there must be as many of each type.
+
+        :return: False if the nodes don't match and the graph has to be built again
+        """
+        if sorted(node_details.keys()) != sorted(self._node_details.keys()):
+            return False
+        mapping = {}
+        for instance_type, list_ips in self._node_details.iteritems():
+            if len(list_ips) != len(node_details[instance_type]):
+                return False
+            for placeholder, instance_details in zip(list_ips, node_details[instance_type]):
+                mapping[placeholder['ip_address']] = instance_details['ip_address']
+        log_keys = dict([(self._get_log_key(placeholder), self._get_log_key(node_id)) for placeholder, node_id in mapping.iteritems()])
+        if dim_ip is not None:
+            mapping[self._dim_ip] = dim_ip
+            self._dim_ip = dim_ip
+
+        self._drops_by_node = defaultdict(lambda: defaultdict(list))
         for drop in self._drop_list:
-            if drop['type'] == 'app':
-                drop.update(tags)
+            node_id = drop.get('node')
+            if node_id in mapping:
+                drop['node'] = mapping[node_id]
+            if drop.get('key') in log_keys:
+                drop['key'] = log_keys[drop['key']]
+            compact_drop(drop)
+            self._drops_by_node[drop.get('node')][drop['type']].append(drop)
+        self._map_carry_over_data = dict([(mapping[node_id], carry_over_data) for node_id, carry_over_data in self._map_carry_over_data.iteritems()])
+        self._node_details = node_details
+        return True
+
+    def tag_all_app_drops(self, tags):
+        for drop in self._drops_by_type['app']:
+            drop.update(tags)
 
     @abstractmethod
     def build_graph(self):
@@ -172,6 +255,9 @@ class AbstractBuildGraph:
             "input_error_threshold": input_error_threshold,
             "node": node_id,
         })
+        if self._parallel_streams is not None:
+            # The S3 apps size the node's shared connection pools from this
+            drop['parallel_streams'] = self._parallel_streams
         drop.update(key_word_arguments)
         self.add_drop(drop)
         return drop
@@ -190,11 +276,15 @@ class AbstractBuildGraph:
             "input_error_threshold": input_error_threshold,
             "node": node_id,
         })
+        instance_type = self._get_instance_type(node_id)
+        if instance_type is not None:
+            # The apps record their timings against it
+            drop['instance_type'] = instance_type
         drop.update(key_word_arguments)
         self.add_drop(drop)
         return drop
 
-    def create_directory_container(self, node_id, oid='directory_container', expire_after_use=True):
+    def create_directory_container(self, node_id, oid='directory_container', expire_after_use=True, volume=None):
         oid_text = self.get_oid(oid)
         # uid_text = self.get_uuid()
         drop = dropdict({
@@ -203,7 +293,7 @@ class AbstractBuildGraph:
             "oid": oid_text,
             # "uid": uid_text,
             "precious": False,
-            "dirname": os.path.join(self._volume, oid_text),
+            "dirname": os.path.join(volume if volume is not None else self._volume, oid_text),
             "check_exists": False,
             "expireAfterUse": expire_after_use,
             "node": node_id,
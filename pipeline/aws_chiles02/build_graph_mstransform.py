@@ -22,19 +22,42 @@
 """
 Build the physical graph
 """
+import math
 import operator
 import os
 
+from aws_chiles02.apps_general import CleanupDirectories, WaitForDiskSpace
 from aws_chiles02.apps_mstransform import DockerMsTransform, DockerListobs, CopyMsTransformFromS3, CopyMsTransformToS3
 from aws_chiles02.common import get_module_name, get_observation, make_groups_of_frequencies
 from aws_chiles02.build_graph_common import AbstractBuildGraph
-from aws_chiles02.settings_file import CONTAINER_CHILES02, SIZE_1GB
+from aws_chiles02.disk_budget import USABLE_FRACTION
+from aws_chiles02.instance_catalog import get_instance_type
+from aws_chiles02.scheduler import get_nodes, schedule_tasks
+from aws_chiles02.settings_file import CONTAINER_CHILES02, PREFETCH_FRACTION, SIZE_1GB
+
+# A staged download holds the tar and the unpacked measurement set for a while
+PREFETCH_DISK_FACTOR = 2.1
+# A split written by mstransform against its share of the day
+SPLIT_DISK_FACTOR = 1.2
+# The most a day takes up on the disks at once: the tar, the measurement set and the splits
+DAY_DISK_FACTOR = 2.8
+
+
+def fits_on(instance_type, day_size):
+    """
+    Whether a day fits on the disks of the instance type, up to about 500GB on an i2.2xlarge
+
+    >>> fits_on('i2.2xlarge', 500 * SIZE_1GB), fits_on('i2.2xlarge', 600 * SIZE_1GB), fits_on('i2.4xlarge', 600 * SIZE_1GB)
+    (True, False, True)
+    """
+    return day_size * DAY_DISK_FACTOR <= get_instance_type(instance_type).local_storage * USABLE_FRACTION
 
 
 class CarryOverDataMsTransform:
     def __init__(self):
         self.drop_listobs = None
         self.barrier_drop = None
+        self.prefetch_drop = None
 
 
 class BuildGraphMsTransform(AbstractBuildGraph):
@@ -48,9 +71,11 @@ class BuildGraphMsTransform(AbstractBuildGraph):
             shutdown,
             width,
             session_id,
-            dim_ip):
+            dim_ip,
+            prefetch_fraction=PREFETCH_FRACTION):
         super(BuildGraphMsTransform, self).__init__(bucket_name, shutdown, node_details, volume, session_id, dim_ip)
         self._work_to_do = work_to_do
+        self._prefetch_fraction = prefetch_fraction
         self._parallel_streams = parallel_streams
         self._s3_split_name = 'split_{0}'.format(width)
 
@@ -70,8 +95,12 @@ class BuildGraphMsTransform(AbstractBuildGraph):
             list_frequency_groups = self._work_to_do[day_to_process]
             frequency_groups = make_groups_of_frequencies(list_frequency_groups, self._parallel_streams)
 
+            reservation = self._disk_budget.reserve(node_id, self._get_disk_footprint(day_to_process, len(list_frequency_groups)))
             add_output_s3 = []
-            if carry_over_data.drop_listobs is not None:
+            if carry_over_data.prefetch_drop is not None:
+                # The download starts part way through the last day's splits, once there is room for it
+                add_output_s3.append(self._wait_for_disk_space(carry_over_data.prefetch_drop, day_to_process, node_id, reservation.volume))
+            elif carry_over_data.drop_listobs is not None:
                 add_output_s3.append(carry_over_data.drop_listobs)
 
             measurement_set, properties, drop_listobs = \
@@ -79,14 +108,17 @@ class BuildGraphMsTransform(AbstractBuildGraph):
                     day_to_process,
                     carry_over_data.barrier_drop,
                     add_output_s3,
-                    node_id
+                    node_id,
+                    reservation
                 )
 
             carry_over_data.drop_listobs = drop_listobs
 
             outputs = []
+            chains = []
             for group in frequency_groups:
                 last_element = None
+                chain = []
                 for frequency_pairs in group:
                     last_element = self._split(
                         last_element,
@@ -94,11 +126,17 @@ class BuildGraphMsTransform(AbstractBuildGraph):
                         measurement_set,
                         properties,
                         get_observation(day_to_process.full_tar_name),
-                        node_id
+                        node_id,
+                        reservation.volume
                     )
+                    chain.append(last_element)
 
                 if last_element is not None:
                     outputs.append(last_element)
+                    chains.append(chain)
+
+            if self._prefetch_fraction > 0 and len(chains) > 0:
+                carry_over_data.prefetch_drop = self._prefetch_trigger(chains, node_id)
 
             barrier_drop = self.create_barrier_app(node_id)
             carry_over_data.barrier_drop = barrier_drop
@@ -107,9 +145,25 @@ class BuildGraphMsTransform(AbstractBuildGraph):
                 if output is not None:
                     barrier_drop.addInput(output)
 
+            # Free the day's space once all the splits are in S3
+            clean_up = self.create_app(node_id, get_module_name(CleanupDirectories), 'app_cleanup_directories')
+            memory_drop = self.create_memory_drop(node_id)
+            clean_up.addInput(measurement_set)
+            for output in outputs:
+                clean_up.addInput(output)
+            clean_up.addOutput(memory_drop)
+            reservation.release_on(memory_drop)
+
         self.copy_logfiles_and_shutdown()
 
-    def _split(self, last_element, frequency_pairs, measurement_set, properties, observation_name, node_id):
+    def _get_disk_footprint(self, day_to_process, number_of_splits):
+        """
+        The input measurement set plus the splits that can be on the disk at once
+        """
+        split_size = day_to_process.size * SPLIT_DISK_FACTOR / max(1, number_of_splits)
+        return int(day_to_process.size * PREFETCH_DISK_FACTOR + min(self._parallel_streams, number_of_splits) * split_size)
+
+    def _split(self, last_element, frequency_pairs, measurement_set, properties, observation_name, node_id, volume):
         casa_py_drop = self.create_docker_app(
             node_id,
             get_module_name(DockerMsTransform),
@@ -119,7 +173,7 @@ class BuildGraphMsTransform(AbstractBuildGraph):
             min_frequency=frequency_pairs.bottom_frequency,
             max_frequency=frequency_pairs.top_frequency,
         )
-        result = self.create_directory_container(node_id, 'dir_split')
+        result = self.create_directory_container(node_id, 'dir_split', volume=volume)
         casa_py_drop.addInput(measurement_set)
         casa_py_drop.addInput(properties)
         if last_element is not None:
@@ -151,7 +205,7 @@ class BuildGraphMsTransform(AbstractBuildGraph):
 
         return s3_drop_out
 
-    def _setup_measurement_set(self, day_to_process, barrier_drop, add_output_s3, node_id):
+    def _setup_measurement_set(self, day_to_process, barrier_drop, add_output_s3, node_id, reservation):
         s3_drop = self.create_s3_drop(
             node_id,
             self._bucket_name,
@@ -165,12 +219,15 @@ class BuildGraphMsTransform(AbstractBuildGraph):
                 drop.addOutput(s3_drop)
 
         copy_from_s3 = self.create_app(node_id, get_module_name(CopyMsTransformFromS3), 'app_copy_mstransform_from_s3')
-        measurement_set = self.create_directory_container(node_id, 'dir_in_ms', expire_after_use=False)
+        measurement_set = self.create_directory_container(node_id, 'dir_in_ms', expire_after_use=False, volume=reservation.volume)
 
         if barrier_drop is not None:
             barrier_drop.addOutput(measurement_set)
         copy_from_s3.addInput(s3_drop)
         copy_from_s3.addOutput(measurement_set)
+        # Wait for earlier days to be cleaned up if the disk would be overcommitted
+        for gate in reservation.gates:
+            copy_from_s3.addInput(gate)
 
         drop_listobs = self.create_docker_app(node_id, get_module_name(DockerListobs), 'app_listobs', CONTAINER_CHILES02, 'listobs')
         properties = self.create_json_drop(node_id)
@@ -179,97 +236,48 @@ class BuildGraphMsTransform(AbstractBuildGraph):
 
         return measurement_set, properties, drop_listobs
 
+    def _prefetch_trigger(self, chains, node_id):
+        """
+        A drop that completes when every chain of splits is prefetch_fraction of the way through
+        """
+        barrier_drop = self.create_barrier_app(node_id, 'barrier_prefetch')
+        for chain in chains:
+            index = min(len(chain), max(1, int(math.ceil(len(chain) * self._prefetch_fraction)))) - 1
+            barrier_drop.addInput(chain[index])
+
+        memory_drop = self.create_memory_drop(node_id)
+        barrier_drop.addOutput(memory_drop)
+        return memory_drop
+
+    def _wait_for_disk_space(self, prefetch_drop, day_to_process, node_id, volume):
+        wait_for_disk_space = self.create_app(
+            node_id,
+            get_module_name(WaitForDiskSpace),
+            'app_wait_for_disk_space',
+            directory=volume,
+            required_bytes=int(day_to_process.size * PREFETCH_DISK_FACTOR),
+        )
+        wait_for_disk_space.addInput(prefetch_drop)
+        return wait_for_disk_space
+
     def _get_next_node(self, day_to_process):
         return self._map_day_to_node[day_to_process]
 
     def _build_node_map(self):
-        # Set up the allocation directory
-        allocation = {}
-        for key, values in self._node_details.iteritems():
-            allocation_dictionary = {}
-            allocation[key] = allocation_dictionary
-            for value in values:
-                allocation_dictionary[value['ip_address']] = []
-
-        for day_to_process in self._work_to_do.keys():
-            if day_to_process.size <= 500 * SIZE_1GB:
-                allocation_dictionary = allocation['i2.2xlarge']
-                self._add_to_shortest_list(allocation_dictionary, day_to_process)
-            else:
-                allocation_dictionary = allocation['i2.4xlarge']
-                self._add_to_shortest_list(allocation_dictionary, day_to_process)
-
-        # Now balance the nodes a bit if needed
-        if allocation.get('i2.2xlarge') is not None and allocation.get('i2.4xlarge') is not None:
-            max_2xlarge = self._get_max(allocation['i2.2xlarge'])
-            min_4xlarge = self._get_min(allocation['i2.4xlarge'])
-
-            if max_2xlarge > min_4xlarge + 1:
-                self._move_nodes(allocation['i2.2xlarge'], allocation['i2.4xlarge'])
-
-        # Build the map
+        days = self._work_to_do.keys()
+        schedule = schedule_tasks(
+            'mstransform',
+            [(day_to_process.size, None) for day_to_process in days],
+            get_nodes(self._node_details),
+            # The biggest days don't fit on the disks of the smaller instances
+            can_run=lambda index, instance_type: fits_on(instance_type, days[index].size)
+        )
+        schedule.log()
+
         self._map_day_to_node = {}
-        for values in allocation.values():
-            for key, days in values.iteritems():
-                for day in days:
-                    self._map_day_to_node[day] = key
+        for day_to_process, assignment in zip(days, schedule.assignments):
+            self._map_day_to_node[day_to_process] = assignment.node_id
 
     @property
     def map_day_to_node(self):
         return self._map_day_to_node
-
-    @staticmethod
-    def _add_to_shortest_list(allocation_dictionary, day_to_process):
-        shortest_list = None
-        for allocation_list in allocation_dictionary.values():
-            if shortest_list is None:
-                shortest_list = allocation_list
-            elif len(allocation_list) < len(shortest_list):
-                shortest_list = allocation_list
-
-        shortest_list.append(day_to_process)
-
-    @staticmethod
-    def _get_biggest_list(i2_2xlists):
-        biggest_list = None
-        for allocation_list in i2_2xlists.values():
-            if biggest_list is None:
-                biggest_list = allocation_list
-            elif len(allocation_list) > len(biggest_list):
-                biggest_list = allocation_list
-
-        return biggest_list
-
-    @staticmethod
-    def _get_max(allocation_dictionary):
-        max_list_size = None
-        for allocation_list in allocation_dictionary.values():
-            if max_list_size is None:
-                max_list_size = len(allocation_list)
-            elif len(allocation_list) > max_list_size:
-                max_list_size = len(allocation_list)
-
-        return max_list_size
-
-    @staticmethod
-    def _get_min(allocation_dictionary):
-        min_list_size = None
-        for allocation_list in allocation_dictionary.values():
-            if min_list_size is None:
-                min_list_size = len(allocation_list)
-            elif len(allocation_list) < min_list_size:
-                min_list_size = len(allocation_list)
-
-        return min_list_size
-
-    def _move_nodes(self, i2_2xlists, i2_4xlists):
-        max_2xlarge = None
-        min_4xlarge = None
-
-        while max_2xlarge is None or max_2xlarge > min_4xlarge + 1:
-            biggest_list = self._get_biggest_list(i2_2xlists)
-            day_to_process = biggest_list.pop()
-            self._add_to_shortest_list(i2_4xlists, day_to_process)
-
-            max_2xlarge = self._get_max(i2_2xlists)
-            min_4xlarge = self._get_min(i2_4xlists)
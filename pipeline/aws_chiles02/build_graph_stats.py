@@ -26,6 +26,7 @@ from aws_chiles02.apps_general import CleanupDirectories
 from aws_chiles02.apps_stats import CopyStatsFromS3, DockerStats
 from aws_chiles02.common import get_module_name
 from aws_chiles02.build_graph_common import AbstractBuildGraph
+from aws_chiles02.scheduler import get_nodes, schedule_tasks
 from aws_chiles02.settings_file import CONTAINER_CHILES02
 
 
@@ -44,8 +45,7 @@ class BuildGraphStats(AbstractBuildGraph):
         self._password = password
         self._width = width
         self._database_hostname = database_hostname
-        self._list_ip = []
-        self._node_index = 0
+        self._assignments = None
 
     def new_carry_over_data(self):
         return CarryOverDataStats()
@@ -53,30 +53,27 @@ class BuildGraphStats(AbstractBuildGraph):
     def build_graph(self):
         self._build_node_map()
 
-        node_id = self._get_next_node()
-        count_on_node = 0
-        for uvsub_to_process in self._work_to_do:
-            self._build_stats_chain(uvsub_to_process, count_on_node, node_id)
-
-            count_on_node += 1
-            if count_on_node >= self._parallel_streams:
-                count_on_node = 0
-                node_id = self._get_next_node()
+        for uvsub_to_process, assignment in zip(self._work_to_do, self._assignments):
+            self._build_stats_chain(uvsub_to_process, assignment.slot, assignment.node_id)
 
         self.copy_logfiles_and_shutdown(True)
 
-    def _get_next_node(self):
-        next_node = self._list_ip[self._node_index]
-        self._node_index += 1
-        if self._node_index >= len(self._list_ip):
-            self._node_index = 0
-
-        return next_node
-
     def _build_node_map(self):
-        for key, values in self._node_details.iteritems():
-            for value in values:
-                self._list_ip.append(value['ip_address'])
+        # Each of the parallel streams on a node is a slot that runs its tasks one after the other
+        schedule = schedule_tasks(
+            'stats',
+            [(self._get_uvsub_size(uvsub_to_process), int(uvsub_to_process[1])) for uvsub_to_process in self._work_to_do],
+            get_nodes(self._node_details),
+            slots=self._parallel_streams
+        )
+        schedule.log()
+        self._assignments = schedule.assignments
+
+    @staticmethod
+    def _get_uvsub_size(uvsub_to_process):
+        if len(uvsub_to_process) > 3:
+            return uvsub_to_process[3]
+        return None
 
     def _build_stats_chain(self, uvsub_to_process, count_on_node, node_id):
         # Get the carry over
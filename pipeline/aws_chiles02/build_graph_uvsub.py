@@ -27,7 +27,13 @@ from aws_chiles02.apps_stats import DockerStats, CopyStatsToS3
 from aws_chiles02.apps_uvsub import CopyUvsubFromS3, DockerUvsub, CopyUvsubToS3
 from aws_chiles02.common import get_module_name
 from aws_chiles02.build_graph_common import AbstractBuildGraph
-from aws_chiles02.settings_file import CONTAINER_CHILES02
+from aws_chiles02.scheduler import get_nodes, schedule_tasks
+from aws_chiles02.settings_file import CONTAINER_CHILES02, SIZE_1GB
+
+# The split and its uvsub output are on the disk together
+UVSUB_DISK_FACTOR = 2.2
+# For work lists made before the size of the split was known
+DEFAULT_SPLIT_SIZE = 5 * SIZE_1GB
 
 
 class CarryOverDataUvsub:
@@ -44,8 +50,7 @@ class BuildGraphUvsub(AbstractBuildGraph):
         self._scan_statistics = scan_statistics
         self._s3_uvsub_name = uvsub_directory_name
         self._s3_split_name = 'split_{0}'.format(width)
-        self._list_ip = []
-        self._node_index = 0
+        self._assignments = None
 
     def new_carry_over_data(self):
         return CarryOverDataUvsub()
@@ -53,31 +58,21 @@ class BuildGraphUvsub(AbstractBuildGraph):
     def build_graph(self):
         self._build_node_map()
 
-        node_id = self._get_next_node()
-        count_on_node = 0
-        for split_to_process in self._work_to_do:
-            self._build_uvsub_chain(split_to_process, count_on_node, node_id)
-
-            count_on_node += 1
-            if count_on_node >= self._parallel_streams:
-                count_on_node = 0
-                node_id = self._get_next_node()
+        for split_to_process, assignment in zip(self._work_to_do, self._assignments):
+            self._build_uvsub_chain(split_to_process, assignment.slot, assignment.node_id)
 
         self.copy_logfiles_and_shutdown(True)
 
-    def _get_next_node(self):
-        next_node = self._list_ip[self._node_index]
-        self._node_index += 1
-        if self._node_index >= len(self._list_ip):
-            self._node_index = 0
-
-        return next_node
-
     def _build_node_map(self):
-        self._list_ip = []
-        for key, values in self._node_details.iteritems():
-            for value in values:
-                self._list_ip.append(value['ip_address'])
+        # Each of the parallel streams on a node is a slot that runs its tasks one after the other
+        schedule = schedule_tasks(
+            'uvsub',
+            [(self._get_split_size(split_to_process), int(split_to_process[0].split('_')[0])) for split_to_process in self._work_to_do],
+            get_nodes(self._node_details),
+            slots=self._parallel_streams
+        )
+        schedule.log()
+        self._assignments = schedule.assignments
 
     def _build_uvsub_chain(self, split_to_process, count_on_node, node_id):
         # Get the carry over
@@ -97,6 +92,7 @@ class BuildGraphUvsub(AbstractBuildGraph):
             oid='s3_in',
         )
 
+        reservation = self._disk_budget.reserve(node_id, int(self._get_split_size(split_to_process) * UVSUB_DISK_FACTOR))
         frequencies = split_to_process[0].split('_')
         copy_from_s3 = self.create_app(
             node_id,
@@ -108,7 +104,8 @@ class BuildGraphUvsub(AbstractBuildGraph):
         )
         measurement_set = self.create_directory_container(
             node_id,
-            'dir_in_ms'
+            'dir_in_ms',
+            volume=reservation.volume
         )
 
         # The order of arguments is important so don't put anything in front of these
@@ -116,6 +113,9 @@ class BuildGraphUvsub(AbstractBuildGraph):
         copy_from_s3.addOutput(measurement_set)
         if carry_over_data.memory_drop_list[count_on_node] is not None:
             copy_from_s3.addInput(carry_over_data.memory_drop_list[count_on_node])
+        # Wait for other chains to clear their directories if the disk would be overcommitted
+        for gate in reservation.gates:
+            copy_from_s3.addInput(gate)
 
         # Do the UV subtraction
         casa_py_uvsub_drop = self.create_docker_app(
@@ -128,7 +128,7 @@ class BuildGraphUvsub(AbstractBuildGraph):
             max_frequency=frequencies[1],
             w_projection_planes=self._w_projection_planes,
         )
-        result = self.create_directory_container(node_id, 'dir_uvsub_output')
+        result = self.create_directory_container(node_id, 'dir_uvsub_output', volume=reservation.volume)
         casa_py_uvsub_drop.addInput(measurement_set)
         casa_py_uvsub_drop.addOutput(result)
 
@@ -210,3 +210,10 @@ class BuildGraphUvsub(AbstractBuildGraph):
 
         # Remember the end of the tail
         carry_over_data.memory_drop_list[count_on_node] = memory_drop
+        reservation.release_on(memory_drop)
+
+    @staticmethod
+    def _get_split_size(split_to_process):
+        if len(split_to_process) > 2 and split_to_process[2] is not None:
+            return split_to_process[2]
+        return DEFAULT_SPLIT_SIZE
@@ -29,8 +29,8 @@ Clean up multipart files
 import argparse
 import logging
 import datetime
-import boto3
 
+from aws_chiles02.bucket_maintenance import BucketMaintenance
 from aws_chiles02.common import set_logging_level
 from constants import utc
 
@@ -46,18 +46,17 @@ def main():
     args = parser.parse_args()
 
     set_logging_level(args.verbosity)
-    session = boto3.Session(profile_name='aws-chiles02')
-    s3 = session.resource('s3', use_ssl=False)
-
-    bucket = s3.Bucket(args.bucket)
+    # Without --cancel or --force this is a report of what would be cancelled
+    maintenance = BucketMaintenance(args.bucket, dry_run=not (args.cancel or args.force))
 
     now = datetime.datetime.now(utc)
     one_day_ago = now - datetime.timedelta(hours=24)
-    for item in bucket.multipart_uploads.all():
-        LOG.info('key_name: {0}, initiated: {1}'.format(item.key, item.initiated))
-        if (item.initiated < one_day_ago and args.cancel) or args.force:
-            LOG.info('Cancelling {0}'.format(item.key))
-            item.abort()
+    uploads = maintenance.list_multipart_uploads()
+    for upload in uploads:
+        LOG.info('key_name: {0}, initiated: {1}'.format(upload.key, upload.initiated))
+
+    maintenance.abort_multipart_uploads([upload for upload in uploads if upload.initiated < one_day_ago or args.force])
+    maintenance.report.log()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,219 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Choose the instance types and counts for a run from a deadline or a budget.
+
+Every fleet of up to two instance types is scheduled with the same cost model and
+placement the builders use, giving its predicted wall clock time and what it costs at
+the current spot prices. The nodes are paid for from the request until they finish their
+share of the work, so idle nodes cost as much as busy ones. With a deadline the cheapest
+fleet that meets it is chosen, with a budget the fastest fleet that fits in it.
+"""
+import itertools
+import logging
+from collections import namedtuple
+
+from aws_chiles02.aws_registry import get_client
+from aws_chiles02.instance_catalog import get_instance_type, get_instance_type_names
+from aws_chiles02.scheduler import get_cost_model, schedule_tasks
+from aws_chiles02.settings_file import AWS_REGION, AWS_SUBNETS
+from aws_chiles02.spot_provisioner import get_spot_prices
+
+LOG = logging.getLogger(__name__)
+
+Plan = namedtuple('Plan', ['fleet', 'makespan', 'cost'])
+
+# Seconds from the request until a node can start work, paid for but doing nothing
+BOOT_TIME = 900.0
+# The most nodes of one instance type and the most instance types in a fleet
+MAX_NODES = 20
+MAX_TYPES = 2
+# How far over the current price to bid
+BID_MARKUP = 1.25
+
+
+def get_candidate_instance_types(spot_prices):
+    """
+    The priced instance types with instance storage to work on
+    """
+    return [name for name in get_instance_type_names() if name in spot_prices and get_instance_type(name).local_storage > 0]
+
+
+class _CachedCostModel(object):
+    """
+    The same fleets are scheduled over and over, so only predict each task once per instance type
+    """
+    def __init__(self, cost_model):
+        self._cost_model = cost_model
+        self._predictions = {}
+
+    def predict(self, kind, instance_type, size=0, frequency=None):
+        key = (kind, instance_type, size, frequency)
+        seconds = self._predictions.get(key)
+        if seconds is None:
+            seconds = self._cost_model.predict(kind, instance_type, size, frequency)
+            self._predictions[key] = seconds
+        return seconds
+
+
+class CapacityPlanner(object):
+    def __init__(
+            self,
+            kind,
+            tasks,
+            spot_prices,
+            instance_types=None,
+            cost_model=None,
+            slots=1,
+            can_run=None,
+            boot_time=BOOT_TIME,
+            max_nodes=MAX_NODES,
+            max_types=MAX_TYPES):
+        """
+        :param kind: the kind of task, such as mstransform
+        :param tasks: a list of (size, frequency) as the scheduler takes them
+        :param spot_prices: dollars per hour for each instance type
+        :param instance_types: the instance types to choose from, all those with a price if None
+        :param can_run: an optional function of (task index, instance type) for tasks that only fit some nodes
+        """
+        self._kind = kind
+        self._tasks = tasks
+        self._spot_prices = spot_prices
+        self._instance_types = instance_types if instance_types is not None else get_candidate_instance_types(spot_prices)
+        self._cost_model = _CachedCostModel(cost_model if cost_model is not None else get_cost_model())
+        self._slots = slots
+        self._can_run = can_run
+        self._boot_time = boot_time
+        self._max_nodes = max_nodes
+        self._max_types = max_types
+        self._plans = None
+
+    def _can_run_on(self, instance_types):
+        if self._can_run is None:
+            return True
+        return all([any([self._can_run(index, instance_type) for instance_type in instance_types]) for index in range(len(self._tasks))])
+
+    def evaluate(self, fleet):
+        """
+        :param fleet: a list of (instance type, count)
+        :return: the Plan for the fleet or None if some of the tasks can't run on it
+        """
+        if not self._can_run_on([instance_type for instance_type, _ in fleet]):
+            return None
+
+        nodes = []
+        for instance_type, count in fleet:
+            nodes.extend([('{0}-{1}'.format(instance_type, index), instance_type) for index in range(count)])
+        schedule = schedule_tasks(self._kind, self._tasks, nodes, self._cost_model, slots=self._slots, can_run=self._can_run)
+        cost = sum([
+            self._spot_prices[instance_type] * (self._boot_time + schedule.finish_times[node_id]) / 3600.0 for node_id, instance_type in nodes
+        ])
+        return Plan(tuple(fleet), self._boot_time + schedule.makespan, cost)
+
+    def _get_fleets(self):
+        for number_types in range(1, min(self._max_types, len(self._instance_types)) + 1):
+            for instance_types in itertools.combinations(sorted(self._instance_types), number_types):
+                if not self._can_run_on(instance_types):
+                    continue
+                for counts in itertools.product(range(1, self._max_nodes + 1), repeat=number_types):
+                    # More nodes than tasks can only sit idle
+                    if sum(counts) <= max(1, len(self._tasks)):
+                        yield zip(instance_types, counts)
+
+    def plans(self):
+        """
+        Every fleet that can run the tasks, fastest first
+        """
+        if self._plans is None:
+            self._plans = sorted(
+                [plan for plan in [self.evaluate(fleet) for fleet in self._get_fleets()] if plan is not None],
+                key=lambda plan: (plan.makespan, plan.cost))
+        return self._plans
+
+    def plan(self, deadline=None, budget=None):
+        """
+        :param deadline: seconds from the request to the end of the run
+        :param budget: dollars for the run
+        :return: the cheapest Plan that meets the deadline and budget, or the fastest within
+            the budget if there is only a budget. None if nothing can run the tasks.
+        """
+        plans = self.plans()
+        if len(plans) == 0:
+            return None
+
+        feasible = [plan for plan in plans if (deadline is None or plan.makespan <= deadline) and (budget is None or plan.cost <= budget)]
+        if len(feasible) == 0:
+            if deadline is not None:
+                LOG.warning('Nothing meets the deadline of {0:.1f} hours{1}, using the fastest'.format(
+                    deadline / 3600.0,
+                    ' within ${0:.2f}'.format(budget) if budget is not None else ''))
+                return plans[0]
+            LOG.warning('Nothing fits in ${0:.2f}, using the cheapest'.format(budget))
+            return min(plans, key=lambda plan: (plan.cost, plan.makespan))
+
+        if deadline is None and budget is not None:
+            return feasible[0]
+        return min(feasible, key=lambda plan: (plan.cost, plan.makespan))
+
+    def get_nodes_required(self, plan, bid_markup=BID_MARKUP):
+        """
+        The nodes to ask for, as get_nodes_required in the generators returns them
+        """
+        nodes = [{
+            'number_instances': count,
+            'instance_type': instance_type,
+            'spot_price': round(self._spot_prices[instance_type] * bid_markup, 4),
+        } for instance_type, count in plan.fleet]
+        return nodes, sum([count for _, count in plan.fleet])
+
+
+def log_plan(plan):
+    LOG.info('Planned {0}: {1:.1f} hours for ${2:.2f}'.format(
+        ', '.join(['{0} x {1}'.format(count, instance_type) for instance_type, count in plan.fleet]),
+        plan.makespan / 3600.0,
+        plan.cost))
+
+
+def get_current_spot_prices(instance_types=None):
+    """
+    The cheapest spot price in our zones for each instance type
+    """
+    instance_types = instance_types if instance_types is not None else get_instance_type_names()
+    prices = get_spot_prices(get_client('ec2', region=AWS_REGION), instance_types, AWS_SUBNETS.keys())
+    return dict([(instance_type, zone_prices[0][0]) for instance_type, zone_prices in prices.iteritems() if len(zone_prices) > 0])
+
+
+def plan_nodes_required(kind, tasks, deadline=None, budget=None, instance_types=None, slots=1, can_run=None):
+    """
+    Plan the nodes for the generators' create commands at the current spot prices
+
+    :param deadline: hours from the request to the end of the run
+    :param budget: dollars for the run
+    :return: the nodes to ask for and how many there are, as get_nodes_required returns them
+    """
+    planner = CapacityPlanner(kind, tasks, get_current_spot_prices(instance_types), instance_types=instance_types, slots=slots, can_run=can_run)
+    plan = planner.plan(deadline=deadline * 3600.0 if deadline is not None else None, budget=budget)
+    if plan is None:
+        LOG.error('None of the instance types can run the {0} tasks'.format(kind))
+        return [], 0
+    log_plan(plan)
+    return planner.get_nodes_required(plan)
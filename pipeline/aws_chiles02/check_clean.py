@@ -26,19 +26,20 @@ Check the CVEL output
 """
 import logging
 import argparse
-import boto3
 
+from aws_chiles02.bucket_catalog import BucketCatalog
 from aws_chiles02.common import get_list_frequency_groups, set_logging_level
 
 LOG = logging.getLogger(__name__)
 
 
-def get_clean(bucket, width=None, iterations=None, arcsec=None, prefix=None):
+def get_clean(catalog, width=None, iterations=None, arcsec=None, prefix=None):
     if prefix is None:
         prefix = 'clean_{0}_{1}_{2}'.format(width, iterations, arcsec)
+    catalog.refresh([prefix])
     clean_data = []
-    for key in bucket.objects.filter(Prefix=prefix):
-        elements = key.key.split('/')
+    for key in catalog.get_all_keys(prefix):
+        elements = key.split('/')
         if len(elements) >= 2:
             if len(elements[1]) > 0:
                 clean_data.append(elements[1])
@@ -84,12 +85,10 @@ def parse_arguments():
 def main():
     arguments = parse_arguments()
     set_logging_level(arguments.verbosity)
-    session = boto3.Session(profile_name='aws-chiles02')
-    s3 = session.resource('s3', use_ssl=False)
-    bucket = s3.Bucket(arguments.bucket)
+    catalog = BucketCatalog(arguments.bucket)
 
     # Get the data we need
-    clean_entries = get_clean(bucket, width=arguments.width, iterations=arguments.iterations, arcsec=arguments.arcsec, prefix=arguments.prefix)
+    clean_entries = get_clean(catalog, width=arguments.width, iterations=arguments.iterations, arcsec=arguments.arcsec, prefix=arguments.prefix)
 
     # Is it what we expect
     analyse_data(clean_entries, arguments.width)
@@ -112,26 +112,43 @@ class CheckMeasurementSet:
     def _check_tables(self, extension_list):
         LOG.info('Measurement Set: {0}'.format(self._measurement_set))
         if os.path.exists(self._measurement_set):
-            # Take a copy of the list
-            to_find = list(extension_list)
-
+            filenames = []
             for filename in os.listdir(self._measurement_set):
                 full_pathname = os.path.join(self._measurement_set, filename)
                 LOG.debug('filename: {0}, full_pathname: {1}'.format(filename, full_pathname))
                 if os.path.isfile(full_pathname):
-                    filename_stub, file_extension = os.path.splitext(filename)
-                    LOG.debug('filename_stub: {0}, file_extension: {1}'.format(filename_stub, file_extension))
-
-                    if filename_stub == 'table' and file_extension in to_find:
-                        LOG.debug('Found {0}{1}'.format(filename_stub, file_extension))
-                        to_find.remove(file_extension)
-
-                    if len(to_find) == 0:
-                        break
+                    filenames.append(filename)
 
-            if len(to_find) > 0:
-                return 'The following extensions are missing\n  {0}'.format(' '.join(to_find))
+            return find_missing_tables(filenames, extension_list)
         else:
             LOG.warning('Measurement Set: {0} does not exist'.format(self._measurement_set))
 
         return None
+
+
+def find_missing_tables(filenames, extension_list):
+    """
+    Check the table files of a measurement set are all there
+
+    >>> find_missing_tables(['table.dat', 'table.f1', 'table.info'], ['.dat', '.f1'])
+    >>> find_missing_tables(['table.dat'], ['.dat', '.f1', '.f2'])
+    'The following extensions are missing\\n  .f1 .f2'
+    """
+    # Take a copy of the list
+    to_find = list(extension_list)
+
+    for filename in filenames:
+        filename_stub, file_extension = os.path.splitext(filename)
+        LOG.debug('filename_stub: {0}, file_extension: {1}'.format(filename_stub, file_extension))
+
+        if filename_stub == 'table' and file_extension in to_find:
+            LOG.debug('Found {0}{1}'.format(filename_stub, file_extension))
+            to_find.remove(file_extension)
+
+        if len(to_find) == 0:
+            break
+
+    if len(to_find) > 0:
+        return 'The following extensions are missing\n  {0}'.format(' '.join(to_find))
+
+    return None
@@ -25,23 +25,17 @@ Check the splits
 import logging
 
 import argparse
-import boto3
 import collections
 
+from aws_chiles02.bucket_catalog import get_catalog
 from aws_chiles02.common import get_list_frequency_groups, FrequencyPair, set_logging_level
 from aws_chiles02.generate_mstransform_graph import MeasurementSetData
 
 LOG = logging.getLogger(__name__)
 
 
-def get_measurement_sets(bucket):
-    list_measurement_sets = []
-    for key in bucket.objects.filter(Prefix='observation_data'):
-        if key.key.endswith('_calibrated_deepfield.ms.tar'):
-            elements = key.key.split('/')
-            if len(elements) >= 2:
-                list_measurement_sets.append(MeasurementSetData(elements[1], key.size))
-    return list_measurement_sets
+def get_measurement_sets(catalog):
+    return [MeasurementSetData(full_tar_name, size) for full_tar_name, size in catalog.get_observations()]
 
 
 def parse_arguments():
@@ -52,12 +46,11 @@ def parse_arguments():
     return parser.parse_args()
 
 
-def get_split(bucket, width):
+def get_split(catalog, width):
     split_data = []
-    for key in bucket.objects.filter(Prefix='split_{0}'.format(width)):
-        elements = key.key.split('/')
-        if len(elements) > 2:
-            split_data.append([elements[2][:-4], elements[1]])
+    for day, frequencies in catalog.get_frequencies_by_day('split_{0}'.format(width)).iteritems():
+        for frequency in frequencies:
+            split_data.append([day, frequency])
 
     return split_data
 
@@ -102,13 +95,12 @@ def analyse_data(measurement_sets, split_entries, width):
 def main():
     arguments = parse_arguments()
     set_logging_level(arguments.verbosity)
-    session = boto3.Session(profile_name='aws-chiles02')
-    s3 = session.resource('s3', use_ssl=False)
-    bucket = s3.Bucket(arguments.bucket)
+    catalog = get_catalog(arguments.bucket, ['observation_data', 'split_{0}'.format(arguments.width)])
 
     # Get the data we need
-    measurement_sets = get_measurement_sets(bucket)
-    split_entries = get_split(bucket, arguments.width)
+    measurement_sets = get_measurement_sets(catalog)
+    split_entries = get_split(catalog, arguments.width)
+    catalog.close()
 
     analyse_data(measurement_sets, split_entries, arguments.width)
 
@@ -43,7 +43,7 @@ def main():
     arguments = parse_arguments()
     set_logging_level(arguments.verbosity)
 
-    work_to_do = WorkToDo(arguments.width, arguments.bucket, get_s3_uvsub_name(arguments.width), get_s3_split_name(arguments.width))
+    work_to_do = WorkToDo(arguments.width, arguments.bucket, get_s3_uvsub_name(arguments.width), get_s3_split_name(arguments.width), None, None)
     work_to_do.calculate_work_to_do()
 
     for work_item in work_to_do.work_to_do:
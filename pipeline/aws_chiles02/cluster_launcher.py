@@ -0,0 +1,204 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Bring the cluster up while the graph is being built.
+
+The node managers and the island manager are requested together, reporting in on a queue
+of their own, and the graph is built for placeholder nodes of the instance types asked for
+while they boot. When the node managers report in, their addresses are written to S3 for the
+island manager, which waits for them before starting, and are bound into the graph. If the
+instances that started are not the ones asked for, the graph has to be built again for the
+real nodes.
+"""
+import getpass
+import logging
+import threading
+import time
+
+from aws_chiles02.aws_registry import get_s3_client
+from aws_chiles02.common import get_uuid
+from aws_chiles02.ec2_controller import EC2Controller
+from aws_chiles02.generate_common import build_hosts, log_boot_timeline
+from aws_chiles02.rendezvous import SqsRendezvous, get_run_queue_name
+from aws_chiles02.settings_file import AWS_REGION
+from aws_chiles02.user_data import get_node_manager_user_data, get_data_island_manager_user_data
+
+LOG = logging.getLogger(__name__)
+
+ISLAND_MANAGER_INSTANCE_TYPE = 'm4.large'
+PLACEHOLDER_DIM = 'island-manager-placeholder'
+
+
+def get_placeholder_node_details(nodes_required):
+    """
+    Node details for the instances asked for, to build the graph before they are running
+
+    >>> get_placeholder_node_details([{'instance_type': 'i2.2xlarge', 'number_instances': 2, 'spot_price': 0.5}])
+    {'i2.2xlarge': [{'ip_address': 'i2.2xlarge-placeholder-0'}, {'ip_address': 'i2.2xlarge-placeholder-1'}]}
+    """
+    node_details = {}
+    for node_required in nodes_required:
+        list_ips = node_details.setdefault(node_required['instance_type'], [])
+        for _ in range(node_required['number_instances']):
+            list_ips.append({'ip_address': '{0}-placeholder-{1}'.format(node_required['instance_type'], len(list_ips))})
+    return node_details
+
+
+class _Starter(threading.Thread):
+    """
+    Start the instances of an EC2Controller in the background
+    """
+    def __init__(self, ec2_controller):
+        super(_Starter, self).__init__()
+        self.daemon = True
+        self.ec2_controller = ec2_controller
+        self._report = None
+        self._exception = None
+
+    def run(self):
+        try:
+            self._report = self.ec2_controller.start_instances()
+        except Exception as exception:
+            LOG.exception('Starting instances')
+            self._exception = exception
+
+    def result(self):
+        self.join()
+        if self._exception is not None:
+            raise self._exception
+        return self._report
+
+
+class ClusterLauncher(object):
+    def __init__(self, ami_id, nodes_required, boto_data, bucket_name, name, spot_price, node_manager_arguments=None, island_manager_arguments=None):
+        """
+        :param name: what the run is called in the instance names
+        :param spot_price: the bid for the island manager
+        :param node_manager_arguments: extra arguments for the node manager user data
+        :param island_manager_arguments: extra arguments for the island manager user data
+        """
+        self._ami_id = ami_id
+        self._nodes_required = nodes_required
+        self._boto_data = boto_data
+        self._bucket_name = bucket_name
+        self._name = name
+        self._spot_price = spot_price
+        self._node_manager_arguments = node_manager_arguments or {}
+        self._island_manager_arguments = island_manager_arguments or {}
+        self.uuid = get_uuid()
+        # The island manager reports under its own uuid so the two groups can't be confused
+        self._island_manager_uuid = '{0}-dim'.format(self.uuid)
+        self._hosts_key = 'hosts/{0}'.format(self._island_manager_uuid)
+        self._queue_name = get_run_queue_name(self.uuid)
+        self._rendezvous = None
+        self._requested = None
+        self._nodes = None
+        self._island_manager = None
+
+    @property
+    def placeholder_node_details(self):
+        return get_placeholder_node_details(self._nodes_required)
+
+    def _get_tags(self, name):
+        return [
+            {
+                'Key': 'Owner',
+                'Value': getpass.getuser(),
+            },
+            {
+                'Key': 'Name',
+                'Value': name,
+            },
+            {
+                'Key': 'uuid',
+                'Value': self.uuid,
+            }
+        ]
+
+    def start(self):
+        """
+        Request the node managers and the island manager, returning straight away
+        """
+        self._rendezvous = SqsRendezvous([self.uuid, self._island_manager_uuid], self._queue_name)
+        self._requested = time.time()
+        self._nodes = _Starter(EC2Controller(
+            self._ami_id,
+            self._nodes_required,
+            get_node_manager_user_data(self._boto_data, self.uuid, queue=self._queue_name, **self._node_manager_arguments),
+            AWS_REGION,
+            tags=self._get_tags('DALiuGE NM - {0}'.format(self._name))
+        ))
+        self._island_manager = _Starter(EC2Controller(
+            self._ami_id,
+            [
+                {
+                    'number_instances': 1,
+                    'instance_type': ISLAND_MANAGER_INSTANCE_TYPE,
+                    'spot_price': self._spot_price
+                }
+            ],
+            get_data_island_manager_user_data(
+                self._boto_data,
+                None,
+                self._island_manager_uuid,
+                hosts_bucket=self._bucket_name,
+                hosts_key=self._hosts_key,
+                queue=self._queue_name,
+                **self._island_manager_arguments
+            ),
+            AWS_REGION,
+            tags=self._get_tags('DALiuGE DIM - {0}'.format(self._name))
+        ))
+        self._nodes.start()
+        self._island_manager.start()
+
+    def wait_for_nodes(self, wait=600):
+        """
+        Wait for the node managers and tell the island manager where they are
+
+        :return: the node details of the node managers that reported in
+        """
+        provisioned = self._nodes.result()
+        reported_running = self._rendezvous.wait(self.uuid, len(provisioned.instance_ids), wait)
+        if len(reported_running) > 0:
+            get_s3_client().put_object(Bucket=self._bucket_name, Key=self._hosts_key, Body=build_hosts(reported_running))
+            log_boot_timeline(reported_running, self._requested)
+        return reported_running
+
+    def wait_for_island_manager(self, wait=600):
+        """
+        :return: the ip address of the island manager or None if it didn't start
+        """
+        provisioned = self._island_manager.result()
+        running = self._rendezvous.wait(self._island_manager_uuid, len(provisioned.instance_ids), wait)
+        get_s3_client().delete_object(Bucket=self._bucket_name, Key=self._hosts_key)
+        self._rendezvous.close()
+        instances = running.get(ISLAND_MANAGER_INSTANCE_TYPE, [])
+        return instances[0]['ip_address'] if len(instances) == 1 else None
+
+    def terminate_island_manager(self):
+        """
+        The island manager is waiting for nodes that won't come
+        """
+        provisioned = self._island_manager.result()
+        self._island_manager.ec2_controller.terminate_instances(provisioned.instance_ids)
+        self._rendezvous.close()
@@ -0,0 +1,128 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Merge the task timings the nodes of a session recorded into the timings file the
+scheduler's cost model is fitted from.
+
+Each node's log tar, session_id/node.tar, carries the timings its apps appended as they
+ran. A timing is identified by its session and drop uid so collecting a session again
+doesn't count anything twice.
+"""
+import argparse
+import csv
+import logging
+import os
+import tarfile
+
+from aws_chiles02.aws_registry import get_s3_client
+from aws_chiles02.bucket_catalog import list_keys
+from aws_chiles02.common import set_logging_level
+from aws_chiles02.scheduler import TIMINGS_MEMBER, write_timings
+from aws_chiles02.settings_file import TIMINGS_FILE
+
+LOG = logging.getLogger(__name__)
+
+
+def read_timings_from_tar(fileobj):
+    """
+    The rows of the timings file in a log tar read as a stream
+    """
+    rows = []
+    tar = tarfile.open(fileobj=fileobj, mode='r|')
+    for member in tar:
+        if os.path.basename(member.name) == TIMINGS_MEMBER and member.isfile():
+            rows.extend([row for row in csv.reader(tar.extractfile(member)) if len(row) >= 5])
+    tar.close()
+    return rows
+
+
+def merge_timings(rows, filename=TIMINGS_FILE):
+    """
+    Append the rows that aren't in the timings file yet
+
+    :return: the number of rows added
+    """
+    seen = set()
+    if os.path.exists(filename):
+        with open(filename, 'rb') as timings_file:
+            seen = set([tuple(row[5:]) for row in csv.reader(timings_file) if len(row) > 5])
+    else:
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    new_rows = []
+    for row in rows:
+        # Rows without an identity can't be told apart so they are always added
+        identity = tuple(row[5:])
+        if identity and identity in seen:
+            continue
+        seen.add(identity)
+        new_rows.append(row)
+    if len(new_rows) > 0:
+        write_timings(filename, new_rows)
+    return len(new_rows)
+
+
+def collect_timings(bucket_name, session_id, filename=TIMINGS_FILE, s3_client=None):
+    """
+    Merge the timings from the log tars of a session
+
+    :return: the number of timings added
+    """
+    s3_client = s3_client if s3_client is not None else get_s3_client()
+    keys, _ = list_keys(s3_client, bucket_name, session_id + '/')
+    rows = []
+    for key, _, _, _ in keys:
+        if not key.endswith('.tar'):
+            continue
+        body = s3_client.get_object(Bucket=bucket_name, Key=key)['Body']
+        try:
+            rows.extend(read_timings_from_tar(body))
+        except tarfile.TarError as exception:
+            LOG.warning('Skipping {0}: {1}'.format(key, exception))
+        finally:
+            body.close()
+
+    added = merge_timings(rows, filename)
+    LOG.info('{0} timings in {1}, {2} new'.format(len(rows), session_id, added))
+    return added
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser('Merge the task timings of sessions into the timings file')
+    parser.add_argument('bucket', help='the bucket the logs are in')
+    parser.add_argument('session_ids', nargs='+', help='the sessions to collect')
+    parser.add_argument('--timings', default=TIMINGS_FILE, help='the CSV file of timings')
+    parser.add_argument('-v', '--verbosity', action='count', default=0, help='increase output verbosity')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    set_logging_level(arguments.verbosity)
+    for session_id in arguments.session_ids:
+        collect_timings(arguments.bucket, session_id, arguments.timings)
+
+
+if __name__ == "__main__":
+    main()
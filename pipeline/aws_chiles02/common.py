@@ -22,6 +22,7 @@
 """
 Common code to
 """
+import errno
 import getpass
 import logging
 import os
@@ -29,7 +30,7 @@ import subprocess
 import threading
 import time
 import uuid
-from cStringIO import StringIO
+from collections import deque, namedtuple
 from os.path import join, expanduser
 
 from configobj import ConfigObj
@@ -40,9 +41,11 @@ LOG = logging.getLogger(__name__)
 
 
 class FrequencyPair:
-    def __init__(self, bottom_frequency, top_frequency):
+    def __init__(self, bottom_frequency, top_frequency, size=None):
         self.bottom_frequency = bottom_frequency
         self.top_frequency = top_frequency
+        # The bytes of input for the frequency, if it is known
+        self.size = size
         self._name = 'FrequencyPair({0}, {1})'.format(bottom_frequency, top_frequency)
         self._underscore_name = '{0}_{1}'.format(bottom_frequency, top_frequency)
 
@@ -173,11 +176,31 @@ def get_observation(s3_path):
     return elements
 
 
+# How much of a command's output is kept, the rest is counted and sampled
+HEAD_LINES = 50
+TAIL_LINES = 200
+SAMPLE_EVERY = 1000
+
+CommandResult = namedtuple('CommandResult', ['return_code', 'wall_time', 'user_time', 'system_time', 'max_rss', 'lines', 'output'])
+
+
 class OutputStream(threading.Thread):
-    def __init__(self):
-        super(OutputStream, self).__init__()
-        self.done = False
-        self.buffer = StringIO()
+    """
+    Read a command's output as it is written, keeping the first and last lines.
+
+    tar -v lists every file in a measurement set and CASA can log for hours, so only a
+    bounded amount is held in memory. Every sample_every lines one is logged, so there is
+    a sign of life from a long run.
+    """
+    def __init__(self, command, head_lines=HEAD_LINES, tail_lines=TAIL_LINES, sample_every=SAMPLE_EVERY):
+        super(OutputStream, self).__init__(name='output-{0}'.format(command[:20]))
+        self.daemon = True
+        self.command = command
+        self.head_lines = head_lines
+        self.sample_every = sample_every
+        self.head = []
+        self.tail = deque(maxlen=tail_lines)
+        self.lines = 0
         self.read, self.write = os.pipe()
         self.reader = os.fdopen(self.read)
         self.start()
@@ -186,34 +209,81 @@ class OutputStream(threading.Thread):
         return self.write
 
     def run(self):
-        while not self.done:
-            self.buffer.write(self.reader.readline())
+        for line in iter(self.reader.readline, ''):
+            self.lines += 1
+            if len(self.head) < self.head_lines:
+                self.head.append(line)
+            else:
+                self.tail.append(line)
+            if self.sample_every > 0 and self.lines % self.sample_every == 0:
+                LOG.info('{0}, line {1}: {2}'.format(self.command, self.lines, line.rstrip()))
 
         self.reader.close()
 
     def close(self):
-        self.done = True
-        os.close(self.write)
+        # The child holds its own copy, so the reader sees the end of the file once it exits
+        if self.write is not None:
+            os.close(self.write)
+            self.write = None
+
+    def getvalue(self):
+        skipped = self.lines - len(self.head) - len(self.tail)
+        if skipped > 0:
+            return '{0}... {1} lines skipped ...\n{2}'.format(''.join(self.head), skipped, ''.join(self.tail))
+        return ''.join(self.head) + ''.join(self.tail)
 
     def __enter__(self):
-        # Theoretically could be used to set up things not in __init__
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
 
-def run_command(command):
+def execute_command(command, head_lines=HEAD_LINES, tail_lines=TAIL_LINES, sample_every=SAMPLE_EVERY):
+    """
+    Run a shell command, blocking in wait4 until it exits rather than polling.
+
+    :return: a CommandResult with the exit code, the wall, user and system seconds and the
+        peak resident set size in bytes of the command, and its trimmed output
+    """
     LOG.info(command)
-    with OutputStream() as stream:
+    start = time.time()
+    with OutputStream(command, head_lines, tail_lines, sample_every) as stream:
         process = subprocess.Popen(command, bufsize=1, shell=True, stdout=stream, stderr=subprocess.STDOUT, env=os.environ.copy())
-        while process.poll() is None:
-            time.sleep(1)
+        stream.close()
+        while True:
+            try:
+                _, status, rusage = os.wait4(process.pid, 0)
+                break
+            except OSError as exception:
+                if exception.errno != errno.EINTR:
+                    raise
+    wall_time = time.time() - start
+
+    if os.WIFSIGNALED(status):
+        return_code = -os.WTERMSIG(status)
+    else:
+        return_code = os.WEXITSTATUS(status)
+    # Stop Popen trying to reap the process again
+    process.returncode = return_code
+
+    stream.join()
+    # ru_maxrss is in kilobytes on Linux
+    result = CommandResult(return_code, wall_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss * 1024, stream.lines, stream.getvalue())
+    LOG.info('{0}, return code {1}, wall {2:.1f}s, user {3:.1f}s, system {4:.1f}s, peak RSS {5}, {6} lines of output follow.\n{7}'.format(
+        command,
+        result.return_code,
+        result.wall_time,
+        result.user_time,
+        result.system_time,
+        bytes2human(result.max_rss),
+        result.lines,
+        result.output))
+    return result
 
-    output = stream.buffer.getvalue()
-    LOG.info('{0}, output follows.\n{1}'.format(command, output))
 
-    return process.returncode
+def run_command(command):
+    return execute_command(command).return_code
 
 
 def get_argument(config, key, prompt, help_text=None, data_type=None, default=None, allowed=None, use_stored=True):
@@ -280,6 +350,14 @@ def get_uuid():
     return str(uuid.uuid4())
 
 
+def get_free_space(directory):
+    """
+    The bytes free to an unprivileged user and the total bytes of the file system holding directory
+    """
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize, stat.f_blocks * stat.f_frsize
+
+
 class ProgressPercentage:
     def __init__(self, filename, expected_size):
         self._filename = filename
@@ -0,0 +1,117 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Keep the chains running on a node within its scratch disk.
+
+Each chain of apps reserves its estimated footprint on one of the node's volumes when it
+is added to the graph. If the volume's budget is used up, the new chain is gated on the
+drops that mark the end of the oldest chains holding space on that volume, so at run time
+it can only start once their directories have been cleaned up. Where a node has more than
+one volume the chain goes on the one with the most budget left.
+"""
+import logging
+
+from aws_chiles02.common import bytes2human
+from aws_chiles02.instance_catalog import get_instance_type
+
+LOG = logging.getLogger(__name__)
+
+# What is left after the swap, Docker's storage and the file system
+USABLE_FRACTION = 0.9
+
+
+class Reservation(object):
+    def __init__(self, node_id, volume, size, gates, held):
+        self.node_id = node_id
+        self.volume = volume
+        self.size = size
+        self.gates = gates
+        self._held = held
+
+    def release_on(self, release_drop):
+        """
+        Say which drop completes once the chain's directories are gone
+        """
+        self._held[1] = release_drop
+
+
+class _Volume(object):
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.used = 0
+        # The live reservations in the order they were made as [size, release drop]
+        self.held = []
+
+    @property
+    def free(self):
+        return self.capacity - self.used
+
+
+class DiskBudget(object):
+    def __init__(self, node_details, volumes, usable_fraction=USABLE_FRACTION):
+        """
+        :param node_details: the nodes by instance type, as the builders get them
+        :param volumes: the scratch directories on each node, each given an equal share of the disk
+        """
+        self._volumes = {}
+        for instance_type, list_instances in node_details.iteritems():
+            capacity = int(get_instance_type(instance_type).local_storage * usable_fraction / len(volumes))
+            for instance_details in list_instances:
+                self._volumes[instance_details['ip_address']] = [_Volume(path, capacity) for path in volumes]
+
+    def reserve(self, node_id, size):
+        """
+        Reserve size bytes on the node
+
+        :return: a Reservation with the volume to use and the drops the chain must wait for
+        """
+        volume = max(self._volumes[node_id], key=lambda candidate: candidate.free)
+        gates = []
+        while volume.free < size and len(volume.held) > 0:
+            held_size, release_drop = volume.held.pop(0)
+            volume.used -= held_size
+            if release_drop is not None:
+                gates.append(release_drop)
+
+        if volume.free < size:
+            LOG.warning('A chain needs {0} but {1}:{2} only has {3}'.format(
+                bytes2human(size), node_id, volume.path, bytes2human(volume.capacity)))
+        held = [size, None]
+        volume.used += size
+        volume.held.append(held)
+        return Reservation(node_id, volume.path, size, gates, held)
+
+    def used(self, node_id):
+        return sum([volume.used for volume in self._volumes[node_id]])
+
+
+def get_volumes(volume):
+    """
+    The scratch directories from a comma separated volume argument
+
+    >>> get_volumes('/mnt/dfms/dfms_root')
+    ['/mnt/dfms/dfms_root']
+    >>> get_volumes('/mnt/disk0/dfms_root, /mnt/disk1/dfms_root')
+    ['/mnt/disk0/dfms_root', '/mnt/disk1/dfms_root']
+    """
+    return [path.strip() for path in volume.split(',') if path.strip()]
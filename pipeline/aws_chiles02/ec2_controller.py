@@ -22,13 +22,13 @@
 """
 An EC2 Controller
 """
-import datetime
 import logging
-import time
 
 import boto3
 
+from aws_chiles02.instance_catalog import get_instance_type
 from aws_chiles02.settings_file import AWS_SUBNETS, AWS_SECURITY_GROUPS, AWS_KEY_NAME
+from aws_chiles02.spot_provisioner import DEADLINE, SpotProvisioner
 
 LOG = logging.getLogger(__name__)
 
@@ -58,118 +58,27 @@ class EC2Controller(object):
         self._ec2 = session.resource('ec2', region_name=region)
         self._ec2_client = self._ec2.meta.client
 
-    def start_instances(self):
-        for instance_required in self._instances_required:
-            self._start_instances(instance_required['instance_type'], instance_required['number_instances'], instance_required['spot_price'])
-
-    def _start_instances(self, instance_type, total_number_instances, spot_price, start_spots_step=10):
-        for node_id in range(0, total_number_instances, start_spots_step):
-            if node_id + start_spots_step < total_number_instances:
-                number_instances = start_spots_step
-            else:
-                number_instances = total_number_instances - node_id
-
-            zone = self._get_cheapest_availability_zone(instance_type, spot_price)
-
-            if zone is None:
-                raise BidPriceException('Bid price too low')
-
-            now_plus = datetime.datetime.utcnow() + datetime.timedelta(minutes=10)
-            spot_request = self._ec2_client.request_spot_instances(
-                    SpotPrice=str(spot_price),
-                    InstanceCount=number_instances,
-                    ValidUntil=now_plus.isoformat(),
-                    LaunchSpecification=self._build_launch_specification(zone, instance_type)
+    def start_instances(self, deadline=DEADLINE):
+        """
+        Request all the instances at once
+
+        :return: a ProvisioningReport of what was started and how long it took
+        """
+        provisioner = SpotProvisioner(self._ec2_client, self._build_launch_specification, AWS_SUBNETS.keys(), deadline=deadline)
+        report = provisioner.provision(self._instances_required)
+        if len(report.instance_ids) == 0 and len(report.priced_out) > 0:
+            raise BidPriceException('Bid price too low')
+
+        if self._tags is not None and len(report.instance_ids) > 0:
+            self._ec2_client.create_tags(
+                    Resources=report.instance_ids,
+                    Tags=self._tags
             )
-            # Wait for EC2 to provision the instance
-            time.sleep(10)
-            instance_ids = [None] * number_instances
-            spot_instance_request_ids = [i['SpotInstanceRequestId'] for i in spot_request['SpotInstanceRequests']]
-            error_count = 0
-
-            while len(filter(lambda x: x is None, instance_ids)) > 0 and error_count < 3:
-                try:
-                    requests = self._ec2_client.describe_spot_instance_requests(
-                            SpotInstanceRequestIds=spot_instance_request_ids
-                    )
-                except Exception:
-                    LOG.exception('Error count = {0}'.format(error_count))
-                    error_count += 1
-                if requests is None:
-                    # Wait for AWS to catch up
-                    time.sleep(10)
-                else:
-                    count = 0
-                    for request_status in requests['SpotInstanceRequests']:
-                        if request_status['State'] == 'active' and request_status['Status']['Code'] == 'fulfilled':
-                            LOG.info('{0}, state: {1}, status:{2}'.format(request_status['SpotInstanceRequestId'], request_status['State'], request_status['Status']['Code']))
-                            instance_ids[count] = request_status['InstanceId']
-                        elif request_status['State'] == 'cancelled':
-                            LOG.warning('Request {0} cancelled. Status: {1}'.format(
-                                    request_status['SpotInstanceRequestId'],
-                                    request_status['Status']['Code']))
-                            if request_status['Status']['Code'] == 'request-canceled-and-instance-running':
-                                instance_ids[count] = request_status['InstanceId']
-                            else:
-                                instance_ids[count] = 'cancelled'
-                        elif request_status['State'] == 'failed':
-                            LOG.warning('Request {0} failed. Status: {1}. Fault: {2}'.format(
-                                    request_status['SpotInstanceRequestId'],
-                                    request_status['Status']['Code'],
-                                    request_status['Status']['Message'])
-                            )
-                            instance_ids[count] = 'failed'
-                        elif request_status['State'] == 'open':
-                            LOG.info('{0}, state: {1}, status:{2}'.format(request_status['SpotInstanceRequestId'], request_status['State'], request_status['Status']['Code']))
-                            if request_status['Status']['Code'] == 'capacity-oversubscribed':
-                                instance_ids[count] = 'failed'
-                            else:
-                                instance_ids[count] = None
-                        else:
-                            LOG.info('{0}, state: {1}, status:{2}'.format(request_status['SpotInstanceRequestId'], request_status['State'], request_status['Status']['Code']))
-                            instance_ids[count] = None
-                        count += 1
-                    time.sleep(10)
-
-            if self._tags is not None:
-                valid_instance_ids = filter(lambda x: x != 'failed' and x != 'cancelled', instance_ids)
-                if len(valid_instance_ids) > 0:
-                    self._ec2_client.create_tags(
-                            Resources=valid_instance_ids,
-                            Tags=self._tags
-                    )
-
-    def _get_cheapest_availability_zone(self, instance_type, spot_price):
-        # Get the zones we have subnets in
-        availability_zones = []
-        for key, value in AWS_SUBNETS.iteritems():
-            availability_zones.append(key)
-
-        prices = self._ec2_client.describe_spot_price_history(
-            StartTime=datetime.datetime.now().isoformat(),
-            InstanceTypes=[instance_type],
-            ProductDescriptions=['Linux/UNIX (Amazon VPC)'],
-        )
-
-        best_price = None
-        for spot_price in prices['SpotPriceHistory']:
-            LOG.info('Spot Price {0} - {1}'.format(spot_price['SpotPrice'], spot_price['AvailabilityZone']))
-            if spot_price['AvailabilityZone'] not in availability_zones:
-                # Ignore this one
-                LOG.info('Ignoring spot price {0} - {1}'.format(spot_price['SpotPrice'], spot_price['AvailabilityZone']))
-            elif spot_price['SpotPrice'] != 0.0 and best_price is None:
-                best_price = spot_price
-            elif spot_price['SpotPrice'] != 0.0 and spot_price['SpotPrice'] < best_price['SpotPrice']:
-                best_price = spot_price
-        if best_price is None:
-            LOG.info('No Spot Price')
-            return None
-        elif float(best_price['SpotPrice']) > spot_price:
-            LOG.info('Spot Price higher than bid price')
-            return None
+        return report
 
-        LOG.info('bid_price: {0}, spot_price: {1}, zone: {2}'.format(spot_price, best_price['SpotPrice'], best_price['AvailabilityZone']))
-        return best_price['AvailabilityZone']
+    def terminate_instances(self, instance_ids):
+        if len(instance_ids) > 0:
+            self._ec2_client.terminate_instances(InstanceIds=instance_ids)
 
     def _build_launch_specification(self, zone, instance_type):
         specification = {
@@ -180,76 +89,7 @@ class EC2Controller(object):
             'InstanceType': instance_type,
             'SubnetId': AWS_SUBNETS[zone],
         }
-        if instance_type == 'i2.2xlarge':
-            specification['BlockDeviceMappings'] = [
-                {
-                    "DeviceName": "/dev/sdb",
-                    "VirtualName": "ephemeral0"
-                },
-                {
-                    "DeviceName": "/dev/sdc",
-                    "VirtualName": "ephemeral1"
-                },
-            ]
-        elif instance_type == 'i2.xlarge':
-            specification['BlockDeviceMappings'] = [
-                {
-                    "DeviceName": "/dev/sdb",
-                    "VirtualName": "ephemeral0"
-                },
-            ]
-        elif instance_type == 'i2.4xlarge':
-            specification['BlockDeviceMappings'] = [
-                {
-                    "DeviceName": "/dev/sdb",
-                    "VirtualName": "ephemeral0"
-                },
-                {
-                    "DeviceName": "/dev/sdc",
-                    "VirtualName": "ephemeral1"
-                },
-                {
-                    "DeviceName": "/dev/sdd",
-                    "VirtualName": "ephemeral2"
-                },
-                {
-                    "DeviceName": "/dev/sde",
-                    "VirtualName": "ephemeral3"
-                },
-            ]
-        elif instance_type == 'i2.8xlarge':
-            specification['BlockDeviceMappings'] = [
-                {
-                    "DeviceName": "/dev/sdb",
-                    "VirtualName": "ephemeral0"
-                },
-                {
-                    "DeviceName": "/dev/sdc",
-                    "VirtualName": "ephemeral1"
-                },
-                {
-                    "DeviceName": "/dev/sdd",
-                    "VirtualName": "ephemeral2"
-                },
-                {
-                    "DeviceName": "/dev/sde",
-                    "VirtualName": "ephemeral3"
-                },
-                {
-                    "DeviceName": "/dev/sdf",
-                    "VirtualName": "ephemeral4"
-                },
-                {
-                    "DeviceName": "/dev/sdg",
-                    "VirtualName": "ephemeral5"
-                },
-                {
-                    "DeviceName": "/dev/sdh",
-                    "VirtualName": "ephemeral6"
-                },
-                {
-                    "DeviceName": "/dev/sdi",
-                    "VirtualName": "ephemeral7"
-                },
-            ]
+        block_device_mappings = get_instance_type(instance_type).block_device_mappings()
+        if len(block_device_mappings) > 0:
+            specification['BlockDeviceMappings'] = block_device_mappings
         return specification
@@ -24,8 +24,7 @@ The error handler class
 """
 import json
 
-import boto3
-
+from aws_chiles02.aws_registry import send_message
 from aws_chiles02.settings_file import AWS_REGION
 
 
@@ -50,9 +49,6 @@ class ErrorListener(object):
             queue='dfms-messages',
             region=AWS_REGION,
             profile_name='aws-chiles02'):
-        session = boto3.Session(profile_name=profile_name)
-        sqs = session.resource('sqs', region_name=region)
-        queue = sqs.get_queue_by_name(QueueName=queue)
         message = {
             'session_id': session_id,
             'uid': uid,
@@ -60,6 +56,4 @@ class ErrorListener(object):
             'message': message_text,
         }
         json_message = json.dumps(message, indent=2)
-        queue.send_message(
-            MessageBody=json_message,
-        )
+        send_message(queue, json_message, region, profile_name=profile_name)
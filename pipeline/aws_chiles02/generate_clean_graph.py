@@ -23,24 +23,23 @@
 Build a dictionary for the execution graph
 """
 import argparse
-import getpass
 import httplib
 import json
 import logging
 import os
 from time import sleep
 
-import boto3
 import sys
 from configobj import ConfigObj
 
+from aws_chiles02.bucket_catalog import get_catalog
 from aws_chiles02.build_graph_clean import BuildGraphClean
-from aws_chiles02.common import get_session_id, get_list_frequency_groups, get_argument, get_aws_credentials, get_uuid, get_log_level
-from aws_chiles02.ec2_controller import EC2Controller
-from aws_chiles02.generate_common import get_reported_running, build_hosts, get_nodes_running
-from aws_chiles02.settings_file import AWS_REGION, AWS_AMI_ID, DIM_PORT
-from aws_chiles02.user_data import get_node_manager_user_data, get_data_island_manager_user_data
-from dfms.droputils import get_roots
+from aws_chiles02.capacity_planner import plan_nodes_required
+from aws_chiles02.common import FrequencyPair, get_session_id, get_list_frequency_groups, get_argument, get_aws_credentials, get_log_level
+from aws_chiles02.cluster_launcher import ClusterLauncher, PLACEHOLDER_DIM
+from aws_chiles02.generate_common import get_nodes_running
+from aws_chiles02.graph_serializer import append_graph, write_graph_file
+from aws_chiles02.settings_file import AWS_AMI_ID, DIM_PORT
 from dfms.manager.client import DataIslandManagerClient
 
 LOG = logging.getLogger(__name__)
@@ -48,35 +47,23 @@ PARALLEL_STREAMS = 12
 
 
 class WorkToDo:
-    def __init__(self, width, bucket_name, s3_clean_name, min_frequency, max_frequency, s3_uvsub_name):
+    def __init__(self, width, bucket_name, s3_clean_name, min_frequency, max_frequency, s3_uvsub_name, force=False):
         self._width = width
         self._bucket_name = bucket_name
         self._s3_clean_name = s3_clean_name
         self._s3_uvsub_name = s3_uvsub_name
         self._min_frequency = min_frequency
         self._max_frequency = max_frequency
+        self._force = force
         self._work_already_done = None
-        self._bucket = None
         self._list_frequencies = None
         self._work_to_do = []
 
     def calculate_work_to_do(self):
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-
-        cleaned_objects = []
-        self._bucket = s3.Bucket(self._bucket_name)
-        for key in self._bucket.objects.filter(Prefix='{0}'.format(self._s3_clean_name)):
-            cleaned_objects.append(key.key)
-            LOG.info('{0} found'.format(key.key))
-
-        uvsub_frequencies = []
-        for key in self._bucket.objects.filter(Prefix='{0}'.format(self._s3_uvsub_name)):
-            elements = key.key.split('/')
-            if len(elements) == 3:
-                if elements[1] not in uvsub_frequencies:
-                    uvsub_frequencies.append(elements[1])
-                    LOG.info('{0} found'.format(key.key))
+        catalog = get_catalog(self._bucket_name, [self._s3_clean_name, self._s3_uvsub_name], force=self._force)
+        cleaned_objects = catalog.get_keys(self._s3_clean_name)
+        uvsub_sizes = catalog.get_size_by_frequency(self._s3_uvsub_name)
+        catalog.close()
 
         # Get work we've already done
         self._list_frequencies = get_list_frequency_groups(self._width)
@@ -93,8 +80,10 @@ class WorkToDo:
                 frequency_pair.top_frequency,
             )
             uvsub_frequency = '{0}_{1}'.format(frequency_pair.bottom_frequency, frequency_pair.top_frequency)
-            if expected_tar_file not in cleaned_objects and uvsub_frequency in uvsub_frequencies:
-                self._work_to_do.append(frequency_pair)
+            if expected_tar_file not in cleaned_objects and uvsub_frequency in uvsub_sizes:
+                self._work_to_do.append(
+                    FrequencyPair(frequency_pair.bottom_frequency, frequency_pair.top_frequency, uvsub_sizes[uvsub_frequency])
+                )
 
     @property
     def work_to_do(self):
@@ -135,7 +124,10 @@ def create_and_generate(
         produce_qa,
         uvsub_directory_name,
         fits_directory_name,
-        clean_tclean):
+        clean_tclean,
+        deadline=None,
+        budget=None,
+        force=False):
     boto_data = get_aws_credentials('aws-chiles02')
     if boto_data is not None:
         work_to_do = WorkToDo(
@@ -145,109 +137,73 @@ def create_and_generate(
             min_frequency,
             max_frequency,
             uvsub_directory_name,
+            force=force,
         )
         work_to_do.calculate_work_to_do()
 
-        nodes_required, node_count = get_nodes_required(work_to_do.work_to_do, frequencies_per_node, spot_price)
+        if deadline is not None or budget is not None:
+            nodes_required, node_count = plan_nodes_required(
+                'clean',
+                [(frequency_pair.size, frequency_pair.bottom_frequency) for frequency_pair in work_to_do.work_to_do],
+                deadline=deadline,
+                budget=budget)
+        else:
+            nodes_required, node_count = get_nodes_required(work_to_do.work_to_do, frequencies_per_node, spot_price)
 
         if len(nodes_required) > 0:
-            uuid = get_uuid()
-            ec2_data = EC2Controller(
+            launcher = ClusterLauncher(
                 ami_id,
                 nodes_required,
-                get_node_manager_user_data(boto_data, uuid, log_level=log_level),
-                AWS_REGION,
-                tags=[
-                    {
-                        'Key': 'Owner',
-                        'Value': getpass.getuser(),
-                    },
-                    {
-                        'Key': 'Name',
-                        'Value': 'DALiuGE NM - Clean',
-                    },
-                    {
-                        'Key': 'uuid',
-                        'Value': uuid,
-                    }
-                ]
-            )
-            ec2_data.start_instances()
+                boto_data,
+                bucket_name,
+                'Clean',
+                spot_price,
+                node_manager_arguments={'log_level': log_level},
+                island_manager_arguments={'need_node_manager': True, 'log_level': log_level})
+            launcher.start()
 
-            reported_running = get_reported_running(
-                uuid,
-                node_count,
-                wait=600
-            )
+            session_id = get_session_id()
 
+            def build_graph(node_details, dim_ip):
+                graph = BuildGraphClean(
+                    work_to_do=work_to_do.work_to_do,
+                    bucket_name=bucket_name,
+                    volume=volume,
+                    parallel_streams=PARALLEL_STREAMS,
+                    node_details=node_details,
+                    shutdown=add_shutdown,
+                    width=frequency_width,
+                    iterations=iterations,
+                    arcsec=arcsec,
+                    w_projection_planes=w_projection_planes,
+                    robust=robust,
+                    image_size=image_size,
+                    clean_channel_average=clean_channel_average,
+                    clean_directory_name=clean_directory_name,
+                    only_image=only_image,
+                    session_id=session_id,
+                    dim_ip=dim_ip,
+                    produce_qa=produce_qa,
+                    uvsub_directory_name=uvsub_directory_name,
+                    fits_directory_name=fits_directory_name,
+                    clean_tclean=clean_tclean
+                )
+                graph.build_graph()
+                return graph
+
+            # Build the graph while the instances boot
+            graph = build_graph(launcher.placeholder_node_details, PLACEHOLDER_DIM)
+
+            reported_running = launcher.wait_for_nodes()
             if len(reported_running) == 0:
                 LOG.error('Nothing has reported ready')
+                launcher.terminate_island_manager()
             else:
-                hosts = build_hosts(reported_running)
-
-                # Create the Data Island Manager
-                data_island_manager = EC2Controller(
-                    ami_id,
-                    [
-                        {
-                            'number_instances': 1,
-                            'instance_type': 'm4.large',
-                            'spot_price': spot_price
-                        }
-                    ],
-                    get_data_island_manager_user_data(boto_data, hosts, uuid, need_node_manager=True, log_level=log_level),
-                    AWS_REGION,
-                    tags=[
-                        {
-                            'Key': 'Owner',
-                            'Value': getpass.getuser(),
-                        },
-                        {
-                            'Key': 'Name',
-                            'Value': 'DALiuGE DIM - Clean',
-                        },
-                        {
-                            'Key': 'uuid',
-                            'Value': uuid,
-                        }
-                    ]
-                )
-                data_island_manager.start_instances()
-                data_island_manager_running = get_reported_running(
-                        uuid,
-                        1,
-                        wait=600
-                )
-
-                if len(data_island_manager_running['m4.large']) == 1:
-                    # Now build the graph
-                    session_id = get_session_id()
-                    instance_details = data_island_manager_running['m4.large'][0]
-                    host = instance_details['ip_address']
-                    graph = BuildGraphClean(
-                        work_to_do=work_to_do.work_to_do,
-                        bucket_name=bucket_name,
-                        volume=volume,
-                        parallel_streams=PARALLEL_STREAMS,
-                        node_details=reported_running,
-                        shutdown=add_shutdown,
-                        width=frequency_width,
-                        iterations=iterations,
-                        arcsec=arcsec,
-                        w_projection_planes=w_projection_planes,
-                        robust=robust,
-                        image_size=image_size,
-                        clean_channel_average=clean_channel_average,
-                        clean_directory_name=clean_directory_name,
-                        only_image=only_image,
-                        session_id=session_id,
-                        dim_ip=host,
-                        produce_qa=produce_qa,
-                        uvsub_directory_name=uvsub_directory_name,
-                        fits_directory_name=fits_directory_name,
-                        clean_tclean=clean_tclean
-                    )
-                    graph.build_graph()
+                host = launcher.wait_for_island_manager()
+                if host is not None:
+                    if not graph.bind_nodes(reported_running, dim_ip=host):
+                        LOG.info('The nodes running are not the ones asked for, building the graph again')
+                        graph = build_graph(reported_running, host)
 
                     # TODO: Safe the run parameters
 
@@ -255,8 +211,8 @@ def create_and_generate(
                     client = DataIslandManagerClient(host, DIM_PORT)
 
                     client.create_session(session_id)
-                    client.append_graph(session_id, graph.drop_list)
-                    client.deploy_session(session_id, get_roots(graph.drop_list))
+                    append_graph(client, session_id, graph.drop_list)
+                    client.deploy_session(session_id, graph.get_roots())
     else:
         LOG.error('Unable to find the AWS credentials')
 
@@ -340,8 +296,8 @@ def use_and_generate(
             client = DataIslandManagerClient(host, port)
 
             client.create_session(session_id)
-            client.append_graph(session_id, graph.drop_list)
-            client.deploy_session(session_id, get_roots(graph.drop_list))
+            append_graph(client, session_id, graph.drop_list)
+            client.deploy_session(session_id, graph.get_roots())
 
         else:
             LOG.warning('No nodes are running')
@@ -404,10 +360,7 @@ def generate_json(
         produce_qa=produce_qa,
         clean_tclean=clean_tclean)
     graph.build_graph()
-    json_dumps = json.dumps(graph.drop_list, indent=2)
-    LOG.info(json_dumps)
-    with open("/tmp/json_clean.txt", "w") as json_file:
-        json_file.write(json_dumps)
+    write_graph_file(graph.drop_list, "/tmp/json_clean.txt")
 
 
 def command_json(args):
@@ -460,6 +413,9 @@ def command_create(args):
         uvsub_directory_name=args.uvsub_directory_name,
         fits_directory_name=args.fits_directory_name,
         clean_tclean=args.clean_tclean,
+        deadline=args.deadline,
+        budget=args.budget,
+        force=args.force,
     )
 
 
@@ -636,6 +592,9 @@ def parser_arguments(command_line=sys.argv[1:]):
     parser_create.add_argument('ami', help='the ami to use')
     parser_create.add_argument('spot_price', type=float, help='the spot price')
     parser_create.add_argument('--frequencies_per_node', type=int, help='the number of frequencies per node', default=1)
+    parser_create.add_argument('--deadline', type=float, help='plan the cheapest instances that finish in this many hours')
+    parser_create.add_argument('--budget', type=float, help='plan the fastest instances that cost at most this many dollars')
+    parser_create.add_argument('--force', action='store_true', help='list the bucket again even if the catalog is fresh')
     parser_create.set_defaults(func=command_create)
 
     parser_use = subparsers.add_parser('use', parents=[common_parser], help='use what is running and deploy')
@@ -22,40 +22,16 @@
 """
 The common generate code
 """
-import json
 import logging
+from collections import namedtuple
 
 import boto3
-import time
 
-from aws_chiles02.settings_file import AWS_REGION, QUEUE
+from aws_chiles02.settings_file import AWS_REGION
 
 LOG = logging.getLogger(__name__)
 
-
-def get_reported_running(uuid, count, wait=600):
-    session = boto3.Session(profile_name='aws-chiles02')
-    sqs = session.resource('sqs', region_name=AWS_REGION)
-    queue = sqs.get_queue_by_name(QueueName=QUEUE)
-    nodes_running = {}
-    stop_time = time.time() + wait
-    messages_received = 0
-    while time.time() <= stop_time and messages_received < count:
-        for message in queue.receive_messages(MaxNumberOfMessages=10, VisibilityTimeout=100, WaitTimeSeconds=10):
-            json_message = message.body
-            message_details = json.loads(json_message)
-            if message_details['uuid'] == uuid:
-                ip_addresses = nodes_running.get(message_details['instance_type'])
-                if ip_addresses is None:
-                    ip_addresses = []
-                    nodes_running[message_details['instance_type']] = ip_addresses
-                ip_addresses.append(message_details)
-                LOG.info('{0} - {1} has started successfully'.format(message_details['ip_address'], message_details['instance_type']))
-                messages_received += 1
-                message.delete()
-                LOG.info('{0} of {1} started'.format(messages_received, count))
-
-    return nodes_running
+BootPhase = namedtuple('BootPhase', ['name', 'nodes', 'start', 'end', 'duration', 'slowest_duration', 'slowest_node'])
 
 
 def get_nodes_running(host_list):
@@ -84,3 +60,66 @@ def build_hosts(reported_running):
             hosts.append(value['ip_address'])
 
     return ','.join(hosts)
+
+
+def _median(values):
+    """
+    >>> _median([3, 1, 2])
+    2
+    >>> _median([4, 1, 2, 3])
+    2.5
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def get_boot_timeline(reported_running):
+    """
+    Aggregate the boot phases the nodes reported. Phases that ran alongside each other
+    overlap, so the median start and end of each phase in seconds since boot show where
+    the start up time went, and the slowest node shows the stragglers.
+
+    :return: a BootPhase for each phase in order of its median start
+    """
+    durations = {}
+    starts = {}
+    ends = {}
+    for values in reported_running.values():
+        for value in values:
+            for name, start, end in value.get('boot_phases', []):
+                durations.setdefault(name, []).append((end - start, value['ip_address']))
+                starts.setdefault(name, []).append(start)
+                ends.setdefault(name, []).append(end)
+            if 'ready' in value:
+                starts.setdefault('ready', []).append(value['ready'])
+                ends.setdefault('ready', []).append(value['ready'])
+                durations.setdefault('ready', []).append((value['ready'], value['ip_address']))
+
+    timeline = []
+    for name in durations.keys():
+        slowest_duration, slowest_node = max(durations[name])
+        timeline.append(BootPhase(
+            name,
+            len(durations[name]),
+            _median(starts[name]),
+            _median(ends[name]),
+            _median([duration for duration, _ in durations[name]]),
+            slowest_duration,
+            slowest_node,
+        ))
+    return sorted(timeline, key=lambda phase: (phase.start, phase.end))
+
+
+def log_boot_timeline(reported_running, requested=None):
+    """
+    :param requested: when the instances were asked for, to show how long EC2 took to boot them
+    """
+    if requested is not None:
+        booted = [value['booted'] - requested for values in reported_running.values() for value in values if 'booted' in value]
+        if len(booted) > 0:
+            LOG.info('Booted a median of {0:.0f}s after the request, the slowest after {1:.0f}s'.format(_median(booted), max(booted)))
+    for phase in get_boot_timeline(reported_running):
+        LOG.info('{0:<20} {1:>3} nodes  {2:6.0f}s - {3:6.0f}s  median {4:6.0f}s  slowest {5:6.0f}s on {6}'.format(*phase))
@@ -23,7 +23,6 @@
 Build a dictionary for the execution graph
 """
 import argparse
-import getpass
 import httplib
 import json
 import logging
@@ -34,12 +33,11 @@ import sys
 from configobj import ConfigObj
 
 from aws_chiles02.build_graph_concatenate import BuildGraphConcatenation
-from aws_chiles02.common import get_session_id, get_argument, get_aws_credentials, get_uuid
-from aws_chiles02.ec2_controller import EC2Controller
-from aws_chiles02.generate_common import get_reported_running, build_hosts, get_nodes_running
-from aws_chiles02.settings_file import AWS_REGION, AWS_AMI_ID, DIM_PORT
-from aws_chiles02.user_data import get_node_manager_user_data, get_data_island_manager_user_data
-from dfms.droputils import get_roots
+from aws_chiles02.common import get_session_id, get_argument, get_aws_credentials
+from aws_chiles02.cluster_launcher import ClusterLauncher, PLACEHOLDER_DIM
+from aws_chiles02.generate_common import get_nodes_running
+from aws_chiles02.graph_serializer import append_graph, write_graph_file
+from aws_chiles02.settings_file import AWS_AMI_ID, DIM_PORT
 from dfms.manager.client import DataIslandManagerClient
 
 LOG = logging.getLogger(__name__)
@@ -53,8 +51,7 @@ def get_s3_clean_name(width, iterations, arcsec):
 def create_and_generate(bucket_name, frequency_width, ami_id, spot_price, volume, add_shutdown, iterations):
     boto_data = get_aws_credentials('aws-chiles02')
     if boto_data is not None:
-        uuid = get_uuid()
-        ec2_data = EC2Controller(
+        launcher = ClusterLauncher(
             ami_id,
             [
                 {
@@ -63,90 +60,50 @@ def create_and_generate(bucket_name, frequency_width, ami_id, spot_price, volume
                     'spot_price': spot_price
                 }
             ],
-            get_node_manager_user_data(boto_data, uuid),
-            AWS_REGION,
-            tags=[
-                {
-                    'Key': 'Owner',
-                    'Value': getpass.getuser(),
-                },
-                {
-                    'Key': 'Name',
-                    'Value': 'DALiuGE NM - Concatenate',
-                },
-                {
-                    'Key': 'uuid',
-                    'Value': uuid,
-                }
-            ]
-        )
-        ec2_data.start_instances()
-
-        reported_running = get_reported_running(
-            uuid,
-            1,
-            wait=600
-        )
-        hosts = build_hosts(reported_running)
+            boto_data,
+            bucket_name,
+            'Concatenate',
+            spot_price)
+        launcher.start()
 
-        # Create the Data Island Manager
-        data_island_manager = EC2Controller(
-            ami_id,
-            [
-                {
-                    'number_instances': 1,
-                    'instance_type': 'm4.large',
-                    'spot_price': spot_price
-                }
-            ],
-            get_data_island_manager_user_data(boto_data, hosts, uuid),
-            AWS_REGION,
-            tags=[
-                {
-                    'Key': 'Owner',
-                    'Value': getpass.getuser(),
-                },
-                {
-                    'Key': 'Name',
-                    'Value': 'DALiuGE DIM - Concatenate',
-                },
-                {
-                    'Key': 'uuid',
-                    'Value': uuid,
-                },
-            ]
-        )
-        data_island_manager.start_instances()
-        data_island_manager_running = get_reported_running(
-            uuid,
-            1,
-            wait=600
-        )
+        session_id = get_session_id()
 
-        if len(data_island_manager_running['m4.large']) == 1:
-            # Now build the graph
-            session_id = get_session_id()
-            instance_details = data_island_manager_running['m4.large'][0]
-            host = instance_details['ip_address']
+        def build_graph(node_details, dim_ip):
             graph = BuildGraphConcatenation(
                 bucket_name,
                 volume,
                 PARALLEL_STREAMS,
-                reported_running,
+                node_details,
                 add_shutdown,
                 frequency_width,
                 iterations,
                 '2arcsec',  # TODO: Pass as a parameter
                 session_id,
-                host)
+                dim_ip)
             graph.build_graph()
+            return graph
+
+        # Build the graph while the instances boot
+        graph = build_graph(launcher.placeholder_node_details, PLACEHOLDER_DIM)
+
+        reported_running = launcher.wait_for_nodes()
+        if len(reported_running) == 0:
+            LOG.error('Nothing has reported ready')
+            launcher.terminate_island_manager()
+            return
+
+        host = launcher.wait_for_island_manager()
+        if host is not None:
+            if not graph.bind_nodes(reported_running, dim_ip=host):
+                LOG.info('The nodes running are not the ones asked for, building the graph again')
+                graph = build_graph(reported_running, host)
 
             LOG.info('Connection to {0}:{1}'.format(host, DIM_PORT))
             client = DataIslandManagerClient(host, DIM_PORT)
 
             client.create_session(session_id)
-            client.append_graph(session_id, graph.drop_list)
-            client.deploy_session(session_id, get_roots(graph.drop_list))
+            append_graph(client, session_id, graph.drop_list)
+            client.deploy_session(session_id, graph.get_roots())
     else:
         LOG.error('Unable to find the AWS credentials')
 
@@ -176,8 +133,8 @@ def use_and_generate(host, port, bucket_name, frequency_width, volume, add_shutd
             client = DataIslandManagerClient(host, port)
 
             client.create_session(session_id)
-            client.append_graph(session_id, graph.drop_list)
-            client.deploy_session(session_id, get_roots(graph.drop_list))
+            append_graph(client, session_id, graph.drop_list)
+            client.deploy_session(session_id, graph.get_roots())
 
         else:
             LOG.warning('No nodes are running')
@@ -192,10 +149,7 @@ def command_json(args):
 
     graph = BuildGraphConcatenation(args.bucket, args.volume, args.parallel_streams, node_details, args.shutdown, args.width, args.iterations, 'session_id', '1.2.3.4')
     graph.build_graph()
-    json_dumps = json.dumps(graph.drop_list, indent=2)
-    LOG.info(json_dumps)
-    with open("/tmp/json_split.txt", "w") as json_file:
-        json_file.write(json_dumps)
+    write_graph_file(graph.drop_list, "/tmp/json_split.txt")
 
 
 def command_create(args):
@@ -23,7 +23,6 @@
 Build a dictionary for the execution graph
 """
 import argparse
-import getpass
 import httplib
 import json
 import logging
@@ -34,12 +33,11 @@ import sys
 from configobj import ConfigObj
 
 from aws_chiles02.build_graph_find_bad_measurement_set import BuildGraphFindBadMeasurementSet
-from aws_chiles02.common import get_session_id, get_argument, get_aws_credentials, get_uuid
-from aws_chiles02.ec2_controller import EC2Controller
-from aws_chiles02.generate_common import get_reported_running, build_hosts, get_nodes_running
-from aws_chiles02.settings_file import AWS_REGION, AWS_AMI_ID, DIM_PORT
-from aws_chiles02.user_data import get_node_manager_user_data, get_data_island_manager_user_data
-from dfms.droputils import get_roots
+from aws_chiles02.common import get_session_id, get_argument, get_aws_credentials
+from aws_chiles02.cluster_launcher import ClusterLauncher, PLACEHOLDER_DIM
+from aws_chiles02.generate_common import get_nodes_running
+from aws_chiles02.graph_serializer import append_graph, write_graph_file
+from aws_chiles02.settings_file import AWS_AMI_ID, DIM_PORT
 from dfms.manager.client import DataIslandManagerClient
 
 LOG = logging.getLogger(__name__)
@@ -61,8 +59,7 @@ def get_nodes_required(work_to_do, frequencies_per_node, spot_price):
 def create_and_generate(bucket_name, frequency_width, ami_id, spot_price, volume, bottom_frequency, nodes, add_shutdown):
     boto_data = get_aws_credentials('aws-chiles02')
     if boto_data is not None:
-        uuid = get_uuid()
-        ec2_data = EC2Controller(
+        launcher = ClusterLauncher(
             ami_id,
             [
                 {
@@ -71,94 +68,49 @@ def create_and_generate(bucket_name, frequency_width, ami_id, spot_price, volume
                     'spot_price': spot_price
                 }
             ],
-            get_node_manager_user_data(boto_data, uuid),
-            AWS_REGION,
-            tags=[
-                {
-                    'Key': 'Owner',
-                    'Value': getpass.getuser(),
-                },
-                {
-                    'Key': 'Name',
-                    'Value': 'DALiuGE NM - Find bad MS',
-                },
-                {
-                    'Key': 'uuid',
-                    'Value': uuid,
-                }
-            ]
-        )
-        ec2_data.start_instances()
+            boto_data,
+            bucket_name,
+            'Find bad MS',
+            spot_price)
+        launcher.start()
 
-        reported_running = get_reported_running(
-            uuid,
-            nodes,
-            wait=600
-        )
+        session_id = get_session_id()
 
+        def build_graph(node_details, dim_ip):
+            graph = BuildGraphFindBadMeasurementSet(
+                bucket_name,
+                volume,
+                PARALLEL_STREAMS,
+                node_details,
+                add_shutdown,
+                frequency_width,
+                bottom_frequency,
+                session_id,
+                dim_ip,
+            )
+            graph.build_graph()
+            return graph
+
+        # Build the graph while the instances boot
+        graph = build_graph(launcher.placeholder_node_details, PLACEHOLDER_DIM)
+
+        reported_running = launcher.wait_for_nodes()
         if len(reported_running) == 0:
             LOG.error('Nothing has reported ready')
+            launcher.terminate_island_manager()
         else:
-            hosts = build_hosts(reported_running)
-
-            # Create the Data Island Manager
-            data_island_manager = EC2Controller(
-                ami_id,
-                [
-                    {
-                        'number_instances': 1,
-                        'instance_type': 'm4.large',
-                        'spot_price': spot_price
-                    }
-                ],
-                get_data_island_manager_user_data(boto_data, hosts, uuid),
-                AWS_REGION,
-                tags=[
-                    {
-                        'Key': 'Owner',
-                        'Value': getpass.getuser(),
-                    },
-                    {
-                        'Key': 'Name',
-                        'Value': 'DALiuGE DIM - Find bad MS',
-                    },
-                    {
-                        'Key': 'uuid',
-                        'Value': uuid,
-                    }
-                ]
-            )
-            data_island_manager.start_instances()
-            data_island_manager_running = get_reported_running(
-                    uuid,
-                    1,
-                    wait=600
-            )
-
-            if len(data_island_manager_running['m4.large']) == 1:
-                # Now build the graph
-                session_id = get_session_id()
-                instance_details = data_island_manager_running['m4.large'][0]
-                host = instance_details['ip_address']
-                graph = BuildGraphFindBadMeasurementSet(
-                    bucket_name,
-                    volume,
-                    PARALLEL_STREAMS,
-                    reported_running,
-                    add_shutdown,
-                    frequency_width,
-                    bottom_frequency,
-                    session_id,
-                    host,
-                )
-                graph.build_graph()
+            host = launcher.wait_for_island_manager()
+            if host is not None:
+                if not graph.bind_nodes(reported_running, dim_ip=host):
+                    LOG.info('The nodes running are not the ones asked for, building the graph again')
+                    graph = build_graph(reported_running, host)
 
                 LOG.info('Connection to {0}:{1}'.format(host, DIM_PORT))
                 client = DataIslandManagerClient(host, DIM_PORT)
 
                 client.create_session(session_id)
-                client.append_graph(session_id, graph.drop_list)
-                client.deploy_session(session_id, get_roots(graph.drop_list))
+                append_graph(client, session_id, graph.drop_list)
+                client.deploy_session(session_id, graph.get_roots())
     else:
         LOG.error('Unable to find the AWS credentials')
 
@@ -198,8 +150,8 @@ def use_and_generate(host, port, bucket_name, frequency_width, volume, bottom_fr
             client = DataIslandManagerClient(host, port)
 
             client.create_session(session_id)
-            client.append_graph(session_id, graph.drop_list)
-            client.deploy_session(session_id, get_roots(graph.drop_list))
+            append_graph(client, session_id, graph.drop_list)
+            client.deploy_session(session_id, graph.get_roots())
 
         else:
             LOG.warning('No nodes are running')
@@ -221,10 +173,7 @@ def command_json(args):
         '1.2.3.4',
     )
     graph.build_graph()
-    json_dumps = json.dumps(graph.drop_list, indent=2)
-    LOG.info(json_dumps)
-    with open("/tmp/json_clean.txt", "w") as json_file:
-        json_file.write(json_dumps)
+    write_graph_file(graph.drop_list, "/tmp/json_clean.txt")
 
 
 def command_create(args):
@@ -23,52 +23,51 @@
 Build a dictionary for the execution graph
 """
 import argparse
-import getpass
 import httplib
 import json
 import logging
-
-import boto3
 import sys
 
-from aws_chiles02.build_graph_mstransform import BuildGraphMsTransform
-from aws_chiles02.common import get_session_id, get_list_frequency_groups, FrequencyPair, get_argument, get_aws_credentials, MeasurementSetData, get_uuid
-from aws_chiles02.ec2_controller import EC2Controller
-from aws_chiles02.generate_common import get_reported_running, get_nodes_running, build_hosts
-from aws_chiles02.settings_file import AWS_REGION, AWS_AMI_ID, SIZE_1GB, DIM_PORT
-from aws_chiles02.user_data import get_node_manager_user_data, get_data_island_manager_user_data
-from dfms.droputils import get_roots
+from aws_chiles02.bucket_catalog import get_catalog
+from aws_chiles02.build_graph_mstransform import BuildGraphMsTransform, fits_on
+from aws_chiles02.capacity_planner import plan_nodes_required
+from aws_chiles02.common import get_session_id, get_list_frequency_groups, FrequencyPair, get_argument, get_aws_credentials, MeasurementSetData
+from aws_chiles02.cluster_launcher import ClusterLauncher, PLACEHOLDER_DIM
+from aws_chiles02.generate_common import get_nodes_running, build_hosts
+from aws_chiles02.graph_serializer import append_graph, write_graph_file
+from aws_chiles02.instance_catalog import get_instance_type_names
+from aws_chiles02.settings_file import AWS_AMI_ID, DIM_PORT
 from dfms.manager.client import DataIslandManagerClient
 
 LOG = logging.getLogger(__name__)
 
+# The instance types for the days that fit on the smaller one and for the rest
+INSTANCE_TYPE1 = 'i2.2xlarge'
+INSTANCE_TYPE2 = 'i2.4xlarge'
+
 
 class WorkToDo:
-    def __init__(self, width, bucket_name, s3_split_name):
+    def __init__(self, width, bucket_name, s3_split_name, force=False):
         self._width = width
         self._bucket_name = bucket_name
         self._s3_split_name = s3_split_name
+        self._force = force
         self._work_already_done = None
-        self._bucket = None
         self._list_frequencies = None
         self._work_to_do = {}
 
     def calculate_work_to_do(self):
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
+        catalog = get_catalog(self._bucket_name, ['observation_data', self._s3_split_name], force=self._force)
 
         list_measurement_sets = []
-        self._bucket = s3.Bucket(self._bucket_name)
-        for key in self._bucket.objects.filter(Prefix='observation_data'):
-            if key.key.endswith('_calibrated_deepfield.ms.tar'):
-                LOG.info('Found {0}'.format(key.key))
-
-                elements = key.key.split('/')
-                list_measurement_sets.append(MeasurementSetData(elements[1], key.size))
+        for full_tar_name, size in catalog.get_observations():
+            LOG.info('Found {0}'.format(full_tar_name))
+            list_measurement_sets.append(MeasurementSetData(full_tar_name, size))
 
         # Get work we've already done
         self._list_frequencies = get_list_frequency_groups(self._width)
-        self._work_already_done = self._get_work_already_done()
+        self._work_already_done = catalog.get_frequencies_by_day(self._s3_split_name)
+        catalog.close()
 
         for day_to_process in list_measurement_sets:
             day_work_already_done = self._work_already_done.get(day_to_process.short_name)
@@ -79,25 +78,6 @@ class WorkToDo:
             else:
                 self._work_to_do[day_to_process] = list_frequency_groups
 
-    def _get_work_already_done(self):
-        frequencies_per_day = {}
-        for key in self._bucket.objects.filter(Prefix=self._s3_split_name):
-            elements = key.key.split('/')
-
-            if len(elements) > 2:
-                day_key = elements[2]
-                # Remove the .tar
-                day_key = day_key[:-4]
-
-                frequencies = frequencies_per_day.get(day_key)
-                if frequencies is None:
-                    frequencies = []
-                    frequencies_per_day[day_key] = frequencies
-
-                frequencies.append(elements[1])
-
-        return frequencies_per_day
-
     def _get_details_for_measurement_set(self, splits_done):
         frequency_groups = []
         if splits_done is None:
@@ -129,13 +109,15 @@ def get_s3_split_name(width):
     return 'split_{0}'.format(width)
 
 
-def get_nodes_required(days, days_per_node, spot_price1, spot_price2):
+def get_nodes_required(days, days_per_node, spot_price1, spot_price2, instance_type1=INSTANCE_TYPE1, instance_type2=INSTANCE_TYPE2):
     nodes = []
     counts = [0, 0]
     for day in days:
-        if day.size <= 500 * SIZE_1GB:
+        if fits_on(instance_type1, day.size):
             counts[0] += 1
         else:
+            if not fits_on(instance_type2, day.size):
+                LOG.warning('{0} is too big for the disks of an {1}'.format(day, instance_type2))
             counts[1] += 1
 
     node_count = 0
@@ -144,7 +126,7 @@ def get_nodes_required(days, days_per_node, spot_price1, spot_price2):
         node_count += count
         nodes.append({
             'number_instances': count,
-            'instance_type': 'i2.4xlarge',
+            'instance_type': instance_type2,
             'spot_price': spot_price2
         })
     if counts[0] > 0:
@@ -152,112 +134,89 @@ def get_nodes_required(days, days_per_node, spot_price1, spot_price2):
         node_count += count
         nodes.append({
             'number_instances': count,
-            'instance_type': 'i2.2xlarge',
+            'instance_type': instance_type1,
             'spot_price': spot_price1
         })
 
     return nodes, node_count
 
 
-def create_and_generate(bucket_name, frequency_width, ami_id, spot_price1, spot_price2, volume, days_per_node, add_shutdown):
+def create_and_generate(
+        bucket_name,
+        frequency_width,
+        ami_id,
+        spot_price1,
+        spot_price2,
+        volume,
+        days_per_node,
+        add_shutdown,
+        instance_type1=INSTANCE_TYPE1,
+        instance_type2=INSTANCE_TYPE2,
+        deadline=None,
+        budget=None,
+        force=False):
     boto_data = get_aws_credentials('aws-chiles02')
     if boto_data is not None:
         work_to_do = WorkToDo(
             width=frequency_width,
             bucket_name=bucket_name,
-            s3_split_name=get_s3_split_name(frequency_width))
+            s3_split_name=get_s3_split_name(frequency_width),
+            force=force)
         work_to_do.calculate_work_to_do()
 
         days = work_to_do.work_to_do.keys()
-        nodes_required, node_count = get_nodes_required(
-            days=days,
-            days_per_node=days_per_node,
-            spot_price1=spot_price1,
-            spot_price2=spot_price2)
+        if deadline is not None or budget is not None:
+            nodes_required, node_count = plan_nodes_required(
+                'mstransform',
+                [(day.size, None) for day in days],
+                deadline=deadline,
+                budget=budget,
+                can_run=lambda index, instance_type: fits_on(instance_type, days[index].size))
+        else:
+            nodes_required, node_count = get_nodes_required(
+                days=days,
+                days_per_node=days_per_node,
+                spot_price1=spot_price1,
+                spot_price2=spot_price2,
+                instance_type1=instance_type1,
+                instance_type2=instance_type2)
 
         if len(nodes_required) > 0:
-            uuid = get_uuid()
-            ec2_data = EC2Controller(
-                ami_id,
-                nodes_required,
-                get_node_manager_user_data(boto_data, uuid),
-                AWS_REGION,
-                tags=[
-                    {
-                        'Key': 'Owner',
-                        'Value': getpass.getuser(),
-                    },
-                    {
-                        'Key': 'Name',
-                        'Value': 'DALiuGE NM - MsTransform',
-                    },
-                    {
-                        'Key': 'uuid',
-                        'Value': uuid,
-                    }
-                ]
-
-            )
-            ec2_data.start_instances()
+            launcher = ClusterLauncher(ami_id, nodes_required, boto_data, bucket_name, 'MsTransform', spot_price1)
+            launcher.start()
 
-            reported_running = get_reported_running(
-                uuid,
-                node_count,
-                wait=600
-            )
-            hosts = build_hosts(reported_running)
-
-            # Create the Data Island Manager
-            data_island_manager = EC2Controller(
-                ami_id,
-                [
-                    {
-                        'number_instances': 1,
-                        'instance_type': 'm4.large',
-                        'spot_price': spot_price1
-                    }
-                ],
-                get_data_island_manager_user_data(boto_data, hosts, uuid),
-                AWS_REGION,
-                tags=[
-                    {
-                        'Key': 'Owner',
-                        'Value': getpass.getuser(),
-                    },
-                    {
-                        'Key': 'Name',
-                        'Value': 'DALiuGE DIM - MsTransform',
-                    },
-                    {
-                        'Key': 'uuid',
-                        'Value': uuid,
-                    }
-                ]
-            )
-            data_island_manager.start_instances()
-            data_island_manager_running = get_reported_running(
-                uuid,
-                1,
-                wait=600
-            )
+            session_id = get_session_id()
 
-            if len(data_island_manager_running['m4.large']) == 1:
-                # Now build the graph
-                session_id = get_session_id()
-                instance_details = data_island_manager_running['m4.large'][0]
-                host = instance_details['ip_address']
+            def build_graph(node_details, dim_ip):
                 graph = BuildGraphMsTransform(
                     work_to_do=work_to_do.work_to_do,
                     bucket_name=bucket_name,
                     volume=volume,
                     parallel_streams=7,
-                    node_details=reported_running,
+                    node_details=node_details,
                     shutdown=add_shutdown,
                     width=frequency_width,
                     session_id=session_id,
-                    dim_ip=hosts,
+                    dim_ip=dim_ip,
                 )
                 graph.build_graph()
+                return graph
+
+            # Build the graph while the instances boot
+            graph = build_graph(launcher.placeholder_node_details, PLACEHOLDER_DIM)
+
+            reported_running = launcher.wait_for_nodes()
+            if len(reported_running) == 0:
+                LOG.error('Nothing has reported ready')
+                launcher.terminate_island_manager()
+                return
+            hosts = build_hosts(reported_running)
+            if not graph.bind_nodes(reported_running, dim_ip=hosts):
+                LOG.info('The nodes running are not the ones asked for, building the graph again')
+                graph = build_graph(reported_running, hosts)
+
+            host = launcher.wait_for_island_manager()
+            if host is not None:
                 graph.tag_all_app_drops({
                     "session_id": session_id,
                 })
@@ -266,8 +225,8 @@ def create_and_generate(bucket_name, frequency_width, ami_id, spot_price1, spot_
                 client = DataIslandManagerClient(host, DIM_PORT)
 
                 client.create_session(session_id)
-                client.append_graph(session_id, graph.drop_list)
-                client.deploy_session(session_id, get_roots(graph.drop_list))
+                append_graph(client, session_id, graph.drop_list)
+                client.deploy_session(session_id, graph.get_roots())
     else:
         LOG.error('Unable to find the AWS credentials')
 
@@ -313,8 +272,8 @@ def use_and_generate(host, port, bucket_name, frequency_width, volume, add_shutd
             client = DataIslandManagerClient(host, port)
 
             client.create_session(session_id)
-            client.append_graph(session_id, graph.drop_list)
-            client.deploy_session(session_id, get_roots(graph.drop_list))
+            append_graph(client, session_id, graph.drop_list)
+            client.deploy_session(session_id, graph.get_roots())
 
         else:
             LOG.warning('No nodes are running')
@@ -325,8 +284,8 @@ def build_json(bucket, width, volume, nodes, parallel_streams, add_shutdown):
     work_to_do.calculate_work_to_do()
 
     node_details = {
-        'i2.2xlarge': [{'ip_address': 'node_i2_{0}'.format(i)} for i in range(0, nodes)],
-        'i2.4xlarge': [{'ip_address': 'node_i4_{0}'.format(i)} for i in range(0, nodes)],
+        INSTANCE_TYPE1: [{'ip_address': 'node_i2_{0}'.format(i)} for i in range(0, nodes)],
+        INSTANCE_TYPE2: [{'ip_address': 'node_i4_{0}'.format(i)} for i in range(0, nodes)],
     }
     graph = BuildGraphMsTransform(
         work_to_do=work_to_do.work_to_do,
@@ -340,10 +299,7 @@ def build_json(bucket, width, volume, nodes, parallel_streams, add_shutdown):
         dim_ip='1.2.3.4'
     )
     graph.build_graph()
-    json_dumps = json.dumps(graph.drop_list, indent=2)
-    LOG.info(json_dumps)
-    with open("/tmp/json_mstransform.txt", "w") as json_file:
-        json_file.write(json_dumps)
+    write_graph_file(graph.drop_list, "/tmp/json_mstransform.txt")
 
 
 def command_create(args):
@@ -356,6 +312,11 @@ def command_create(args):
         volume=args.volume,
         days_per_node=args.days_per_node,
         add_shutdown=args.shutdown,
+        instance_type1=args.instance_type1,
+        instance_type2=args.instance_type2,
+        deadline=args.deadline,
+        budget=args.budget,
+        force=args.force,
     )
 
 
@@ -389,8 +350,10 @@ def interactive(config):
     get_argument(config, 'shutdown', 'Add the shutdown node', data_type=bool, help_text='add a shutdown drop', default=True)
     if config['create_use_json'] == 'create':
         get_argument(config, 'ami', 'AMI Id', help_text='the AMI to use', default=AWS_AMI_ID)
-        get_argument(config, 'spot_price_i2.2xlarge', 'Spot Price for i2.2xlarge', help_text='the spot price')
-        get_argument(config, 'spot_price_i2_4xlarge', 'Spot Price for i2.4xlarge', help_text='the spot price')
+        get_argument(config, 'instance_type1', 'Instance type for the smaller days', help_text='the instance type', default=INSTANCE_TYPE1, allowed=get_instance_type_names())
+        get_argument(config, 'instance_type2', 'Instance type for the larger days', help_text='the instance type', default=INSTANCE_TYPE2, allowed=get_instance_type_names())
+        get_argument(config, 'spot_price_i2.2xlarge', 'Spot Price for {0}'.format(config['instance_type1']), help_text='the spot price')
+        get_argument(config, 'spot_price_i2_4xlarge', 'Spot Price for {0}'.format(config['instance_type2']), help_text='the spot price')
         get_argument(config, 'days_per_node', 'Number of days per node', data_type=int, help_text='the number of days per node', default=1)
     elif config['create_use_json'] == 'use':
         get_argument(config, 'dim', 'Data Island Manager', help_text='the IP to the DataIsland Manager')
@@ -400,7 +363,7 @@ def interactive(config):
 
     # Run the command
     if config['create_use_json'] == 'create':
-        command_line = 'create {0} {1} {2} {3} {4} {5} {6} {7}'.format(
+        command_line = 'create {0} {1} {2} {3} {4} {5} {6} {7} {8} {9}'.format(
             config['bucket_name'],
             config['volume'],
             config['ami'],
@@ -408,6 +371,8 @@ def interactive(config):
             config['spot_price_i2_4xlarge'],
             '--days_per_node ' + config['days_per_node'],
             '--width ' + config['width'],
+            '--instance_type1 ' + config['instance_type1'],
+            '--instance_type2 ' + config['instance_type2'],
             '--shutdown' if config['shutdown'] else ''
         )
         create_and_generate(
@@ -419,6 +384,8 @@ def interactive(config):
             volume=config['volume'],
             days_per_node=config['days_per_node'],
             add_shutdown=config['shutdown'],
+            instance_type1=config['instance_type1'],
+            instance_type2=config['instance_type2'],
         )
     elif config['create_use_json'] == 'use':
         command_line = 'use {0} {1} {2} {3} {4} {5}'.format(
@@ -467,9 +434,14 @@ def parser_arguments(command_line=sys.argv[1:]):
 
     parser_create = subparsers.add_parser('create', parents=[common_parser], help='run and deploy')
     parser_create.add_argument('ami', help='the ami to use')
-    parser_create.add_argument('spot_price1', type=float, help='the spot price for the i2.2xlarge instances')
-    parser_create.add_argument('spot_price2', type=float, help='the spot price for the i2.4xlarge instances')
+    parser_create.add_argument('spot_price1', type=float, help='the spot price for the first instance type')
+    parser_create.add_argument('spot_price2', type=float, help='the spot price for the second instance type')
     parser_create.add_argument('--days_per_node', type=int, help='the number of days per node', default=1)
+    parser_create.add_argument('--instance_type1', choices=get_instance_type_names(), help='the instance type for the days that fit on it', default=INSTANCE_TYPE1)
+    parser_create.add_argument('--instance_type2', choices=get_instance_type_names(), help='the instance type for the larger days', default=INSTANCE_TYPE2)
+    parser_create.add_argument('--deadline', type=float, help='plan the cheapest instances that finish in this many hours')
+    parser_create.add_argument('--budget', type=float, help='plan the fastest instances that cost at most this many dollars')
+    parser_create.add_argument('--force', action='store_true', help='list the bucket again even if the catalog is fresh')
     parser_create.set_defaults(func=command_create)
 
     parser_use = subparsers.add_parser('use', parents=[common_parser], help='use what is running and deploy')
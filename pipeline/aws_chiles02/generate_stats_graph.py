@@ -23,7 +23,6 @@
 Build a dictionary for the execution graph
 """
 import argparse
-import getpass
 import httplib
 import json
 import logging
@@ -31,16 +30,15 @@ import os
 import sys
 from time import sleep
 
-import boto3
 from configobj import ConfigObj
 
+from aws_chiles02.bucket_catalog import get_catalog
 from aws_chiles02.build_graph_stats import BuildGraphStats
-from aws_chiles02.common import get_session_id, get_argument, get_aws_credentials, get_uuid, get_log_level
-from aws_chiles02.ec2_controller import EC2Controller
-from aws_chiles02.generate_common import get_reported_running, build_hosts, get_nodes_running
-from aws_chiles02.settings_file import AWS_REGION, AWS_AMI_ID, DIM_PORT
-from aws_chiles02.user_data import get_node_manager_user_data, get_data_island_manager_user_data
-from dfms.droputils import get_roots
+from aws_chiles02.common import get_session_id, get_argument, get_aws_credentials, get_log_level
+from aws_chiles02.cluster_launcher import ClusterLauncher, PLACEHOLDER_DIM
+from aws_chiles02.generate_common import get_nodes_running
+from aws_chiles02.graph_serializer import append_graph, write_graph_file
+from aws_chiles02.settings_file import AWS_AMI_ID, DIM_PORT
 from dfms.manager.client import DataIslandManagerClient
 
 LOG = logging.getLogger(__name__)
@@ -48,45 +46,43 @@ PARALLEL_STREAMS = 8
 
 
 class WorkToDo:
-    def __init__(self, input_dir, bucket_name, s3_uvsub_name, connection):
+    def __init__(self, input_dir, bucket_name, s3_uvsub_name, connection, force=False):
         self._input_dir = input_dir
         self._bucket_name = bucket_name
+        self._force = force
         self._work_already_done = None
-        self._bucket = None
         self._list_frequencies = None
         self._work_to_do = []
         self._connection = connection
 
     def calculate_work_to_do(self):
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
+        catalog = get_catalog(self._bucket_name, [self._input_dir], force=self._force)
 
         found_csv = []
-        self._bucket = s3.Bucket(self._bucket_name)
-        for key in self._bucket.objects.filter(Prefix='{0}'.format(self._input_dir)):
-            if key.key.endswith('.csv'):
-                LOG.debug('csv {0} found'.format(key.key))
-                found_csv.append('')
-
-        for key in self._bucket.objects.filter(Prefix='{0}'.format(self._input_dir)):
-            if key.key.endswith('.tar'):
-                LOG.debug('uvsub {0} found'.format(key.key))
-                elements = key.key.split('/')
-                frequencies = elements[1].split('_')
-                expected_uvsub_name = '{0} {1} {2} {3}'.format(
-                    self._input_dir,
-                    elements[2],
-                    frequencies[0],
-                    frequencies[1]
+        for key in catalog.get_keys(self._input_dir, '.csv'):
+            LOG.debug('csv {0} found'.format(key))
+            found_csv.append('')
+
+        for key in sorted(catalog.get_keys(self._input_dir)):
+            LOG.debug('uvsub {0} found'.format(key))
+            elements = key.split('/')
+            frequencies = elements[1].split('_')
+            expected_uvsub_name = '{0} {1} {2} {3}'.format(
+                self._input_dir,
+                elements[2],
+                frequencies[0],
+                frequencies[1]
+            )
+            if expected_uvsub_name not in visstat_data_rows:
+                self._work_to_do.append(
+                    [
+                        elements[2],
+                        frequencies[0],
+                        frequencies[1],
+                        catalog.get_size(key),
+                    ]
                 )
-                if expected_uvsub_name not in visstat_data_rows:
-                    self._work_to_do.append(
-                        [
-                            elements[2],
-                            frequencies[0],
-                            frequencies[1]
-                        ]
-                    )
+        catalog.close()
 
     @property
     def work_to_do(self):
@@ -103,116 +99,66 @@ def get_nodes_required(node_count, spot_price):
     return nodes, node_count
 
 
-def create_and_generate(bucket_name, input_dir, ami_id, spot_price, volume, nodes, add_shutdown, log_level):
+def create_and_generate(bucket_name, input_dir, ami_id, spot_price, volume, nodes, add_shutdown, log_level, force=False):
     boto_data = get_aws_credentials('aws-chiles02')
     if boto_data is not None:
-        work_to_do = WorkToDo(frequency_width, bucket_name, get_s3_uvsub_name(frequency_width), database_connection)
+        work_to_do = WorkToDo(frequency_width, bucket_name, get_s3_uvsub_name(frequency_width), database_connection, force=force)
         work_to_do.calculate_work_to_do()
 
         nodes_required, node_count = get_nodes_required(nodes, spot_price)
 
         if len(nodes_required) > 0:
-            uuid = get_uuid()
-            ec2_data = EC2Controller(
+            launcher = ClusterLauncher(
                 ami_id,
                 nodes_required,
-                get_node_manager_user_data(boto_data, uuid, max_request_size=50, log_level=log_level),
-                AWS_REGION,
-                tags=[
-                    {
-                        'Key': 'Owner',
-                        'Value': getpass.getuser(),
-                    },
-                    {
-                        'Key': 'Name',
-                        'Value': 'DALiuGE NM - Stats',
-                    },
-                    {
-                        'Key': 'uuid',
-                        'Value': uuid,
-                    }
-                ]
-            )
-            ec2_data.start_instances()
+                boto_data,
+                bucket_name,
+                'Stats',
+                spot_price,
+                node_manager_arguments={'max_request_size': 50, 'log_level': log_level},
+                island_manager_arguments={'need_node_manager': True, 'max_request_size': 50})
+            launcher.start()
 
-            reported_running = get_reported_running(
-                uuid,
-                node_count,
-                wait=600
-            )
+            session_id = get_session_id()
+
+            def build_graph(node_details, dim_ip):
+                graph = BuildGraphStats(
+                    work_to_do.work_to_do,
+                    bucket_name,
+                    volume,
+                    PARALLEL_STREAMS,
+                    node_details,
+                    add_shutdown,
+                    frequency_width,
+                    session_id,
+                    map_day_name,
+                    password,
+                    database_ip,
+                    dim_ip
+                )
+                graph.build_graph()
+                return graph
+
+            # Build the graph while the instances boot
+            graph = build_graph(launcher.placeholder_node_details, PLACEHOLDER_DIM)
 
+            reported_running = launcher.wait_for_nodes()
             if len(reported_running) == 0:
                 LOG.error('Nothing has reported ready')
+                launcher.terminate_island_manager()
             else:
-                hosts = build_hosts(reported_running)
-
-                # Create the Data Island Manager
-                data_island_manager = EC2Controller(
-                    ami_id,
-                    [
-                        {
-                            'number_instances': 1,
-                            'instance_type': 'm4.large',
-                            'spot_price': spot_price
-                        }
-                    ],
-                    get_data_island_manager_user_data(
-                        boto_data,
-                        hosts,
-                        uuid,
-                        need_node_manager=True,
-                        max_request_size=50
-                    ),
-                    AWS_REGION,
-                    tags=[
-                        {
-                            'Key': 'Owner',
-                            'Value': getpass.getuser(),
-                        },
-                        {
-                            'Key': 'Name',
-                            'Value': 'DALiuGE DIM - Stats',
-                        },
-                        {
-                            'Key': 'uuid',
-                            'Value': uuid,
-                        }
-                    ]
-                )
-                data_island_manager.start_instances()
-                data_island_manager_running = get_reported_running(
-                        uuid,
-                        1,
-                        wait=600,
-                )
-
-                if len(data_island_manager_running['m4.large']) == 1:
-                    # Now build the graph
-                    session_id = get_session_id()
-                    instance_details = data_island_manager_running['m4.large'][0]
-                    host = instance_details['ip_address']
-                    graph = BuildGraphStats(
-                        work_to_do.work_to_do,
-                        bucket_name,
-                        volume,
-                        PARALLEL_STREAMS,
-                        reported_running,
-                        add_shutdown,
-                        frequency_width,
-                        session_id,
-                        map_day_name,
-                        password,
-                        database_ip,
-                        host
-                    )
-                    graph.build_graph()
+                host = launcher.wait_for_island_manager()
+                if host is not None:
+                    if not graph.bind_nodes(reported_running, dim_ip=host):
+                        LOG.info('The nodes running are not the ones asked for, building the graph again')
+                        graph = build_graph(reported_running, host)
 
                     LOG.info('Connection to {0}:{1}'.format(host, DIM_PORT))
                     client = DataIslandManagerClient(host, DIM_PORT)
 
                     client.create_session(session_id)
-                    client.append_graph(session_id, graph.drop_list)
-                    client.deploy_session(session_id, get_roots(graph.drop_list))
+                    append_graph(client, session_id, graph.drop_list)
+                    client.deploy_session(session_id, graph.get_roots())
     else:
         LOG.error('Unable to find the AWS credentials')
 
@@ -258,8 +204,8 @@ def use_and_generate(host, port, bucket_name, input_dir, volume, add_shutdown):
             client = DataIslandManagerClient(host, port)
 
             client.create_session(session_id)
-            client.append_graph(session_id, graph.drop_list)
-            client.deploy_session(session_id, get_roots(graph.drop_list))
+            append_graph(client, session_id, graph.drop_list)
+            client.deploy_session(session_id, graph.get_roots())
 
         else:
             LOG.warning('No nodes are running')
@@ -287,10 +233,7 @@ def generate_json(input_dir, bucket, nodes, volume, shutdown):
         '1.2.3.4'
     )
     graph.build_graph()
-    json_dumps = json.dumps(graph.drop_list, indent=2)
-    LOG.info(json_dumps)
-    with open("/tmp/json_stats.txt", "w") as json_file:
-        json_file.write(json_dumps)
+    write_graph_file(graph.drop_list, "/tmp/json_stats.txt")
 
 
 def command_json(args):
@@ -313,7 +256,8 @@ def command_create(args):
         args.volume,
         args.nodes,
         args.shutdown,
-        log_level
+        log_level,
+        force=args.force,
     )
 
 
@@ -417,6 +361,7 @@ def parser_arguments(command_line=sys.argv[1:]):
     parser_create.add_argument('ami', help='the ami to use')
     parser_create.add_argument('spot_price', type=float, help='the spot price')
     parser_create.add_argument('--nodes', type=int, help='the number of nodes', default=1)
+    parser_create.add_argument('--force', action='store_true', help='list the bucket again even if the catalog is fresh')
     parser_create.set_defaults(func=command_create)
 
     parser_use = subparsers.add_parser('use', parents=[common_parser], help='use what is running and deploy')
@@ -23,24 +23,22 @@
 Build a dictionary for the execution graph
 """
 import argparse
-import getpass
 import httplib
 import json
 import logging
 import os
 from time import sleep
 
-import boto3
 import sys
 from configobj import ConfigObj
 
+from aws_chiles02.bucket_catalog import get_catalog
 from aws_chiles02.build_graph_uvsub import BuildGraphUvsub
-from aws_chiles02.common import get_session_id, get_argument, get_aws_credentials, get_uuid
-from aws_chiles02.ec2_controller import EC2Controller
-from aws_chiles02.generate_common import get_reported_running, build_hosts, get_nodes_running
-from aws_chiles02.settings_file import AWS_REGION, AWS_AMI_ID, DIM_PORT
-from aws_chiles02.user_data import get_node_manager_user_data, get_data_island_manager_user_data
-from dfms.droputils import get_roots
+from aws_chiles02.common import get_session_id, get_argument, get_aws_credentials
+from aws_chiles02.cluster_launcher import ClusterLauncher, PLACEHOLDER_DIM
+from aws_chiles02.generate_common import get_nodes_running
+from aws_chiles02.graph_serializer import append_graph, write_graph_file
+from aws_chiles02.settings_file import AWS_AMI_ID, DIM_PORT
 from dfms.manager.client import DataIslandManagerClient
 
 LOG = logging.getLogger(__name__)
@@ -55,51 +53,40 @@ class WorkToDo:
             s3_uvsub_name,
             s3_split_name,
             min_frequency,
-            max_frequency):
+            max_frequency,
+            force=False):
         self._width = width
         self._bucket_name = bucket_name
         self._s3_uvsub_name = s3_uvsub_name
         self._s3_split_name = s3_split_name
         self._min_frequency = min_frequency
         self._max_frequency = max_frequency
+        self._force = force
 
         self._work_already_done = None
-        self._bucket = None
         self._work_to_do = []
 
     def calculate_work_to_do(self):
-        session = boto3.Session(profile_name='aws-chiles02')
-        s3 = session.resource('s3', use_ssl=False)
-
-        uvsub_objects = []
-        self._bucket = s3.Bucket(self._bucket_name)
-        for key in self._bucket.objects.filter(Prefix='{0}'.format(self._s3_uvsub_name)):
-            uvsub_objects.append(key.key)
-            LOG.info('uvsub {0} found'.format(key.key))
-
-        for key in self._bucket.objects.filter(Prefix='{0}'.format(self._s3_split_name)):
-            LOG.info('split {0} found'.format(key.key))
-            elements = key.key.split('/')
-            if len(elements) == 3:
-                expected_uvsub_name = '{0}/{1}/{2}'.format(
-                    self._s3_uvsub_name,
-                    elements[1],
-                    elements[2],
-                )
-                if expected_uvsub_name not in uvsub_objects:
-                    frequencies = elements[1].split('_')
-                    # Use the min and max frequency
-                    if self._min_frequency is not None and int(frequencies[1]) < self._min_frequency:
-                        continue
-                    if self._max_frequency is not None and int(frequencies[0]) > self._max_frequency:
-                        continue
-
-                    self._work_to_do.append(
-                        [
-                            elements[1],
-                            elements[2],
-                        ]
-                    )
+        catalog = get_catalog(self._bucket_name, [self._s3_split_name, self._s3_uvsub_name], force=self._force)
+
+        # The splits that don't have a uvsub
+        for frequency, day in catalog.get_missing(self._s3_split_name, self._s3_uvsub_name):
+            LOG.info('split {0}/{1}/{2}.tar needs a uvsub'.format(self._s3_split_name, frequency, day))
+            frequencies = frequency.split('_')
+            # Use the min and max frequency
+            if self._min_frequency is not None and int(frequencies[1]) < self._min_frequency:
+                continue
+            if self._max_frequency is not None and int(frequencies[0]) > self._max_frequency:
+                continue
+
+            self._work_to_do.append(
+                [
+                    frequency,
+                    day + '.tar',
+                    catalog.get_size('{0}/{1}/{2}.tar'.format(self._s3_split_name, frequency, day)),
+                ]
+            )
+        catalog.close()
 
     @property
     def work_to_do(self):
@@ -133,7 +120,8 @@ def create_and_generate(
         max_frequency,
         scan_statistics,
         uvsub_directory_name,
-        dump_json):
+        dump_json,
+        force=False):
     boto_data = get_aws_credentials('aws-chiles02')
     if boto_data is not None:
         work_to_do = WorkToDo(
@@ -143,111 +131,66 @@ def create_and_generate(
             s3_split_name=get_s3_split_name(frequency_width),
             min_frequency=min_frequency,
             max_frequency=max_frequency,
+            force=force,
         )
         work_to_do.calculate_work_to_do()
 
         nodes_required, node_count = get_nodes_required(nodes, spot_price)
 
         if len(nodes_required) > 0:
-            uuid = get_uuid()
-            ec2_data = EC2Controller(
+            launcher = ClusterLauncher(
                 ami_id,
                 nodes_required,
-                get_node_manager_user_data(boto_data, uuid, max_request_size=50),
-                AWS_REGION,
-                tags=[
-                    {
-                        'Key': 'Owner',
-                        'Value': getpass.getuser(),
-                    },
-                    {
-                        'Key': 'Name',
-                        'Value': 'DALiuGE NM - Uvsub',
-                    },
-                    {
-                        'Key': 'uuid',
-                        'Value': uuid,
-                    }
-                ]
-            )
-            ec2_data.start_instances()
+                boto_data,
+                bucket_name,
+                'Uvsub',
+                spot_price,
+                node_manager_arguments={'max_request_size': 50},
+                island_manager_arguments={'max_request_size': 50, 'need_node_manager': True})
+            launcher.start()
 
-            reported_running = get_reported_running(
-                uuid,
-                node_count,
-                wait=600
-            )
+            session_id = get_session_id()
 
+            def build_graph(node_details, dim_ip):
+                graph = BuildGraphUvsub(
+                    work_to_do=work_to_do.work_to_do,
+                    bucket_name=bucket_name,
+                    volume=volume,
+                    parallel_streams=PARALLEL_STREAMS,
+                    node_details=node_details,
+                    shutdown=add_shutdown,
+                    scan_statistics=scan_statistics,
+                    width=frequency_width,
+                    w_projection_planes=w_projection_planes,
+                    uvsub_directory_name=uvsub_directory_name,
+                    session_id=session_id,
+                    dim_ip=dim_ip)
+                graph.build_graph()
+                return graph
+
+            # Build the graph while the instances boot
+            graph = build_graph(launcher.placeholder_node_details, PLACEHOLDER_DIM)
+
+            reported_running = launcher.wait_for_nodes()
             if len(reported_running) == 0:
                 LOG.error('Nothing has reported ready')
+                launcher.terminate_island_manager()
             else:
-                hosts = build_hosts(reported_running)
-
-                # Create the Data Island Manager
-                data_island_manager = EC2Controller(
-                    ami_id,
-                    [
-                        {
-                            'number_instances': 1,
-                            'instance_type': 'm4.large',
-                            'spot_price': spot_price
-                        }
-                    ],
-                    get_data_island_manager_user_data(boto_data, hosts, uuid, max_request_size=50, need_node_manager=True),
-                    AWS_REGION,
-                    tags=[
-                        {
-                            'Key': 'Owner',
-                            'Value': getpass.getuser(),
-                        },
-                        {
-                            'Key': 'Name',
-                            'Value': 'DALiuGE DIM - Uvsub',
-                        },
-                        {
-                            'Key': 'uuid',
-                            'Value': uuid,
-                        }
-                    ]
-                )
-                data_island_manager.start_instances()
-                data_island_manager_running = get_reported_running(
-                    uuid,
-                    1,
-                    wait=600
-                )
-
-                if len(data_island_manager_running['m4.large']) == 1:
-                    # Now build the graph
-                    session_id = get_session_id()
-                    instance_details = data_island_manager_running['m4.large'][0]
-                    host = instance_details['ip_address']
-                    graph = BuildGraphUvsub(
-                        work_to_do=work_to_do.work_to_do,
-                        bucket_name=bucket_name,
-                        volume=volume,
-                        parallel_streams=PARALLEL_STREAMS,
-                        node_details=reported_running,
-                        shutdown=add_shutdown,
-                        scan_statistics=scan_statistics,
-                        width=frequency_width,
-                        w_projection_planes=w_projection_planes,
-                        uvsub_directory_name=uvsub_directory_name,
-                        session_id=session_id,
-                        dim_ip=host)
-                    graph.build_graph()
+                host = launcher.wait_for_island_manager()
+                if host is not None:
+                    if not graph.bind_nodes(reported_running, dim_ip=host):
+                        LOG.info('The nodes running are not the ones asked for, building the graph again')
+                        graph = build_graph(reported_running, host)
 
                     if dump_json:
-                        json_dumps = json.dumps(graph.drop_list, indent=2)
-                        with open("/tmp/json_uvsub.txt", "w") as json_file:
-                            json_file.write(json_dumps)
+                        write_graph_file(graph.drop_list, "/tmp/json_uvsub.txt")
 
                     LOG.info('Connection to {0}:{1}'.format(host, DIM_PORT))
                     client = DataIslandManagerClient(host, DIM_PORT)
 
                     client.create_session(session_id)
-                    client.append_graph(session_id, graph.drop_list)
-                    client.deploy_session(session_id, get_roots(graph.drop_list))
+                    append_graph(client, session_id, graph.drop_list)
+                    client.deploy_session(session_id, graph.get_roots())
     else:
         LOG.error('Unable to find the AWS credentials')
 
@@ -309,16 +252,14 @@ def use_and_generate(
             graph.build_graph()
 
             if dump_json:
-                json_dumps = json.dumps(graph.drop_list, indent=2)
-                with open("/tmp/json_uvsub.txt", "w") as json_file:
-                    json_file.write(json_dumps)
+                write_graph_file(graph.drop_list, "/tmp/json_uvsub.txt")
 
             LOG.info('Connection to {0}:{1}'.format(host, port))
             client = DataIslandManagerClient(host, port)
 
             client.create_session(session_id)
-            client.append_graph(session_id, graph.drop_list)
-            client.deploy_session(session_id, get_roots(graph.drop_list))
+            append_graph(client, session_id, graph.drop_list)
+            client.deploy_session(session_id, graph.get_roots())
 
         else:
             LOG.warning('No nodes are running')
@@ -362,10 +303,7 @@ def generate_json(
         session_id='session_id',
         dim_ip='1.2.3.4')
     graph.build_graph()
-    json_dumps = json.dumps(graph.drop_list, indent=2)
-    LOG.info(json_dumps)
-    with open("/tmp/json_uvsub.txt", "w") as json_file:
-        json_file.write(json_dumps)
+    write_graph_file(graph.drop_list, "/tmp/json_uvsub.txt")
 
 
 def command_json(args):
@@ -398,6 +336,7 @@ def command_create(args):
         scan_statistics=args.scan_statistics,
         dump_json=False,
         uvsub_directory_name=args.uvsub_directory_name,
+        force=args.force,
     )
 
 
@@ -526,6 +465,7 @@ def parser_arguments(command_line=sys.argv[1:]):
     parser_create.add_argument('ami', help='the ami to use')
     parser_create.add_argument('spot_price', type=float, help='the spot price')
     parser_create.add_argument('--nodes', type=int, help='the number of nodes', default=1)
+    parser_create.add_argument('--force', action='store_true', help='list the bucket again even if the catalog is fresh')
     parser_create.set_defaults(func=command_create)
 
     parser_use = subparsers.add_parser('use', parents=[common_parser], help='use what is running and deploy')
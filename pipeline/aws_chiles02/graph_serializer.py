@@ -0,0 +1,128 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Keep the physical graphs small in memory and on the wire.
+
+A big graph has hundreds of thousands of drops that repeat the same node, app and bucket
+strings, so those values are interned as the drops are added. The graph is written as
+compact JSON a chunk of drops at a time rather than being built up as one indented
+string, and is appended to the island manager in batches of bounded size. Each batch
+holds the drops of one node, so few relationships cross a batch.
+"""
+import json
+import logging
+from collections import OrderedDict
+
+LOG = logging.getLogger(__name__)
+
+# The values that are repeated across many drops
+INTERNED_KEYS = ['type', 'node', 'app', 'container', 'storage', 'bucket', 'profile_name', 'image', 'user']
+CHUNK_SIZE = 1000
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def compact_drop(drop):
+    """
+    Intern the repeated values of a drop so every drop shares the one copy
+
+    >>> drop1 = compact_drop({'node': ''.join(['10.0.0.', '1']), 'app': 'aws_chiles02.apps_general.CopyLogFilesApp'})
+    >>> drop2 = compact_drop({'node': ''.join(['10.0.0.', '1'])})
+    >>> drop1['node'] is drop2['node']
+    True
+    """
+    for key in INTERNED_KEYS:
+        value = drop.get(key)
+        if type(value) is str:
+            drop[key] = intern(value)
+    return drop
+
+
+def encode_drop(drop):
+    return _encoder.encode(drop)
+
+
+def write_graph(drops, output, chunk_size=CHUNK_SIZE):
+    """
+    Write the drops to a file like object as a compact JSON list, chunk_size drops at a time
+
+    :return: the number of drops written
+    """
+    count = 0
+    chunk = []
+    output.write('[')
+    for drop in drops:
+        chunk.append(encode_drop(drop))
+        if len(chunk) >= chunk_size:
+            output.write((',' if count > 0 else '') + ','.join(chunk))
+            count += len(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        output.write((',' if count > 0 else '') + ','.join(chunk))
+        count += len(chunk)
+    output.write(']')
+    return count
+
+
+def get_batches(drops, max_bytes=MAX_BATCH_BYTES):
+    """
+    Split the drops into batches of at most max_bytes of JSON, keeping each node's drops together.
+    A single drop bigger than max_bytes goes in a batch of its own.
+    """
+    drops_by_node = OrderedDict()
+    for drop in drops:
+        drops_by_node.setdefault(drop.get('node'), []).append(drop)
+
+    for node_drops in drops_by_node.values():
+        batch = []
+        batch_bytes = 0
+        for drop in node_drops:
+            drop_bytes = len(encode_drop(drop)) + 1
+            if len(batch) > 0 and batch_bytes + drop_bytes > max_bytes:
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(drop)
+            batch_bytes += drop_bytes
+        if len(batch) > 0:
+            yield batch
+
+
+def append_graph(client, session_id, drops, max_bytes=MAX_BATCH_BYTES):
+    """
+    Append the graph to a session on the island manager in bounded batches
+
+    :return: the number of batches sent
+    """
+    count = 0
+    for batch in get_batches(drops, max_bytes):
+        client.append_graph(session_id, batch)
+        count += 1
+    LOG.info('Appended {0:,} drops to {1} in {2} batches'.format(len(drops), session_id, count))
+    return count
+
+
+def write_graph_file(drops, filename):
+    with open(filename, 'w') as json_file:
+        count = write_graph(drops, json_file)
+    LOG.info('Wrote {0:,} drops to {1}'.format(count, filename))
@@ -0,0 +1,466 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Replay a physical graph offline to predict its makespan and cost before renting the nodes.
+
+The drops are run on the nodes the graph builder put them on. The CASA apps wait for one of
+the node's slots and take the time the cost model predicts for their input size. The S3
+copies share the node's network, each stream capped at what a single S3 connection gives.
+Everything else, barriers, clean ups and the like, takes a second. The sizes flow through
+the graph from the S3 objects that are read in: a directory written by an app holds what
+the app read, so a split of a day gets its share of the day.
+"""
+import argparse
+import heapq
+import itertools
+import logging
+from collections import namedtuple
+
+from aws_chiles02.instance_catalog import REFERENCE_INSTANCE_TYPE, get_instance_type
+from aws_chiles02.scheduler import get_cost_model, get_nodes
+from aws_chiles02.settings_file import SIZE_1GB
+
+LOG = logging.getLogger(__name__)
+
+NodeCapacity = namedtuple('NodeCapacity', ['slots', 'bandwidth'])
+SweepPoint = namedtuple('SweepPoint', ['parameters', 'makespan', 'cost'])
+
+SIZE_1MB = 1024 * 1024
+# What one S3 connection gets
+STREAM_BANDWIDTH = 60 * SIZE_1MB
+# The seconds taken by the apps that do no real work
+APP_OVERHEAD = 1.0
+# The size assumed for an S3 object that is read in but not in the sizes given
+DEFAULT_SIZE = 10 * SIZE_1GB
+# The kind of task in the cost model for each CASA app
+APP_KINDS = {
+    'DockerMsTransform': 'mstransform',
+    'DockerUvsub': 'uvsub',
+    'DockerClean': 'clean',
+    'DockerTclean': 'clean',
+    'DockerStats': 'stats',
+}
+# How much an app writes for every byte it reads, apps not listed write nothing worth moving
+OUTPUT_RATIOS = {
+    'mstransform': 1.0,
+    'uvsub': 1.0,
+    'clean': 0.01,
+    'transfer': 1.0,
+}
+# The data drops an app reads in full, the others only carry the order
+BULK_DATA = ['container', 'file']
+
+
+def get_class_name(app):
+    """
+    >>> get_class_name('aws_chiles02.apps_mstransform.DockerMsTransform')
+    'DockerMsTransform'
+    """
+    return app.split('.')[-1] if app else ''
+
+
+def get_kind(app):
+    """
+    The kind of work an app does: a task in the cost model, a transfer or None
+
+    >>> get_kind('aws_chiles02.apps_uvsub.CopyUvsubFromS3'), get_kind('aws_chiles02.apps_uvsub.DockerUvsub')
+    ('transfer', 'uvsub')
+    >>> get_kind('dfms.apps.bash_shell_app.BashShellApp') is None
+    True
+    """
+    class_name = get_class_name(app)
+    if class_name.startswith('Copy') and (class_name.endswith('FromS3') or class_name.endswith('ToS3')):
+        return 'transfer'
+    return APP_KINDS.get(class_name)
+
+
+class SimulationResult(object):
+    def __init__(self, starts, finishes, node_finish, instance_types, busy, transferring, capacities, critical_path):
+        self.starts = starts
+        self.finishes = finishes
+        self.node_finish = node_finish
+        self.instance_types = instance_types
+        self.busy = busy
+        self.transferring = transferring
+        self.capacities = capacities
+        self.critical_path = critical_path
+
+    @property
+    def makespan(self):
+        return max(self.node_finish.values()) if self.node_finish else 0.0
+
+    def utilisation(self, node_id):
+        """
+        The fraction of the node's life its CASA slots and its network were busy
+        """
+        finish = self.node_finish.get(node_id, 0.0)
+        if finish <= 0:
+            return 0.0, 0.0
+        return self.busy[node_id] / (finish * self.capacities[node_id].slots), self.transferring[node_id] / finish
+
+    def cost(self, spot_prices):
+        """
+        The dollars paid for the nodes, each running until its last drop is done
+
+        :param spot_prices: dollars an hour, either one price or a dict by instance type
+        """
+        total = 0.0
+        for node_id, finish in self.node_finish.iteritems():
+            price = spot_prices.get(self.instance_types[node_id], 0.0) if isinstance(spot_prices, dict) else spot_prices
+            total += price * finish / 3600.0
+        return total
+
+    def log(self, spot_prices=None):
+        LOG.info('Makespan {0:.1f} hours{1}'.format(
+            self.makespan / 3600.0,
+            ', costing ${0:.2f}'.format(self.cost(spot_prices)) if spot_prices is not None else ''))
+        for node_id in sorted(self.node_finish.keys()):
+            compute, network = self.utilisation(node_id)
+            LOG.info('  {0} ({1}): finished after {2:.1f} hours, CASA {3:.0%}, network {4:.0%}'.format(
+                node_id, self.instance_types[node_id], self.node_finish[node_id] / 3600.0, compute, network))
+        LOG.info('Critical path:')
+        for oid, app, node_id, start, finish in self.critical_path:
+            LOG.info('  {0:.1f}h - {1:.1f}h {2} {3} on {4}'.format(start / 3600.0, finish / 3600.0, oid, get_class_name(app), node_id))
+
+
+class _Network(object):
+    """
+    The transfers on a node, sharing its bandwidth equally
+    """
+    def __init__(self, bandwidth):
+        self.bandwidth = float(bandwidth)
+        self.remaining = {}
+        self.last = 0.0
+        self.version = 0
+
+    def rate(self):
+        return min(STREAM_BANDWIDTH, self.bandwidth / len(self.remaining)) if self.remaining else 0.0
+
+    def advance(self, now):
+        """
+        Move the transfers on to now, returning how long the network was in use
+        """
+        elapsed = now - self.last
+        rate = self.rate()
+        for oid in self.remaining.keys():
+            self.remaining[oid] -= elapsed * rate
+        self.last = now
+        return elapsed if self.remaining else 0.0
+
+    def next_finish(self):
+        oid = min(self.remaining.keys(), key=lambda key: (self.remaining[key], key))
+        return self.last + max(0.0, self.remaining[oid]) / self.rate(), oid
+
+
+def get_capacity(instance_type):
+    """
+    Half the vCPUs run CASA and the network performance class gives the bandwidth
+
+    >>> get_capacity('i2.2xlarge')
+    NodeCapacity(slots=4, bandwidth=125829120)
+    """
+    instance = get_instance_type(instance_type)
+    return NodeCapacity(instance.slots, instance.bandwidth)
+
+
+class GraphSimulator(object):
+    def __init__(self, drop_list, node_details, cost_model=None, capacities=None, sizes=None, default_size=DEFAULT_SIZE, durations=None):
+        """
+        :param drop_list: the drops from a BuildGraph class
+        :param node_details: the instance types and ip addresses of the nodes
+        :param capacities: a NodeCapacity for each instance type to override the instance catalog
+        :param sizes: the bytes in the S3 objects that are read in, by key
+        :param durations: seconds for each app class name to override the models
+        """
+        self._cost_model = cost_model if cost_model is not None else get_cost_model()
+        self._capacities = dict(capacities or {})
+        self._sizes = sizes or {}
+        self._default_size = default_size
+        self._durations = durations or {}
+        self._drops = dict([(drop['oid'], drop) for drop in drop_list])
+        self._instance_types = dict(get_nodes(node_details))
+        self._inputs = {}
+        self._outputs = {}
+        for drop in drop_list:
+            if drop['type'] == 'app':
+                oid = drop['oid']
+                self._inputs[oid] = [input_oid for input_oid in (drop.get('inputs') or []) + (drop.get('streamingInputs') or []) if input_oid in self._drops]
+                self._outputs[oid] = [output_oid for output_oid in drop.get('outputs') or [] if output_oid in self._drops]
+                for output_oid in self._outputs[oid]:
+                    self._inputs.setdefault(output_oid, []).append(oid)
+        self._consumers = {}
+        for oid, inputs in self._inputs.iteritems():
+            for input_oid in inputs:
+                self._consumers.setdefault(input_oid, []).append(oid)
+
+    def _instance_type(self, node_id):
+        return self._instance_types.get(node_id, REFERENCE_INSTANCE_TYPE)
+
+    def _capacity(self, node_id):
+        instance_type = self._instance_type(node_id)
+        if instance_type in self._capacities:
+            return self._capacities[instance_type]
+        return get_capacity(instance_type)
+
+    def _topological_order(self):
+        waiting = dict([(oid, len(self._inputs.get(oid, []))) for oid in self._drops])
+        order = sorted([oid for oid, count in waiting.iteritems() if count == 0])
+        for oid in order:
+            for consumer in self._consumers.get(oid, []):
+                waiting[consumer] -= 1
+                if waiting[consumer] == 0:
+                    order.append(consumer)
+        if len(order) != len(self._drops):
+            raise ValueError('The graph has a cycle through {0} drops'.format(len(self._drops) - len(order)))
+        return order
+
+    def _reads(self, app, drop):
+        if drop['type'] in BULK_DATA:
+            return True
+        return drop.get('storage') == 's3' and get_kind(app.get('app')) == 'transfer'
+
+    def _get_sizes(self, order):
+        """
+        The bytes each app reads and each data drop holds
+        """
+        sizes = {}
+        for oid in order:
+            drop = self._drops[oid]
+            if drop['type'] == 'app':
+                class_name = get_class_name(drop.get('app'))
+                work = 0.0
+                for input_oid in self._inputs[oid]:
+                    input_drop = self._drops[input_oid]
+                    if self._reads(drop, input_drop):
+                        # Apps of the same class reading the one input each take a share of it
+                        readers = [consumer for consumer in self._consumers[input_oid] if get_class_name(self._drops[consumer].get('app')) == class_name]
+                        work += sizes[input_oid] / len(readers)
+                sizes[oid] = work
+            elif drop.get('storage') in ['memory', 'json']:
+                sizes[oid] = 0.0
+            elif len(self._inputs.get(oid, [])) == 0:
+                sizes[oid] = float(self._sizes.get(drop.get('key'), self._default_size)) if drop.get('storage') == 's3' else 0.0
+            else:
+                written = 0.0
+                for producer in self._inputs[oid]:
+                    outputs = [output_oid for output_oid in self._outputs[producer] if self._drops[output_oid].get('storage') not in ['memory', 'json']]
+                    written += sizes[producer] * OUTPUT_RATIOS.get(get_kind(self._drops[producer].get('app')), 0.0) / max(1, len(outputs))
+                sizes[oid] = written
+        return sizes
+
+    def _duration(self, drop, size):
+        class_name = get_class_name(drop.get('app'))
+        if class_name in self._durations:
+            return float(self._durations[class_name])
+        kind = get_kind(drop.get('app'))
+        if kind is None or kind == 'transfer':
+            return APP_OVERHEAD
+        return self._cost_model.predict(kind, self._instance_type(drop.get('node')), size, drop.get('min_frequency'))
+
+    def run(self):
+        order = self._topological_order()
+        sizes = self._get_sizes(order)
+        waiting = dict([(oid, len(self._inputs.get(oid, []))) for oid in self._drops])
+        node_ids = set(self._instance_types.keys()) | set([drop.get('node') for drop in self._drops.itervalues()])
+        free_slots = dict([(node_id, self._capacity(node_id).slots) for node_id in node_ids])
+        queued = dict([(node_id, []) for node_id in node_ids])
+        networks = dict([(node_id, _Network(self._capacity(node_id).bandwidth)) for node_id in node_ids])
+        busy = dict([(node_id, 0.0) for node_id in node_ids])
+        transferring = dict([(node_id, 0.0) for node_id in node_ids])
+        starts = {}
+        finishes = {}
+        # The input that finished last, which is what held each drop up
+        causes = {}
+        # A heap of (time, sequence, event, oid or node id, version)
+        events = []
+        sequence = itertools.count()
+
+        def schedule_transfers(node_id, now):
+            network = networks[node_id]
+            network.version += 1
+            if network.remaining:
+                finish, _ = network.next_finish()
+                heapq.heappush(events, (finish, next(sequence), 'network', node_id, network.version))
+
+        def start(oid, now):
+            drop = self._drops[oid]
+            node_id = drop.get('node')
+            starts[oid] = now
+            if get_kind(drop.get('app')) == 'transfer' and get_class_name(drop.get('app')) not in self._durations:
+                network = networks[node_id]
+                transferring[node_id] += network.advance(now)
+                network.remaining[oid] = sizes[oid]
+                schedule_transfers(node_id, now)
+            else:
+                heapq.heappush(events, (now + self._duration(drop, sizes[oid]), next(sequence), 'finish', oid, None))
+
+        def ready(oid, now):
+            drop = self._drops[oid]
+            if drop['type'] != 'app':
+                complete(oid, now)
+            elif get_kind(drop.get('app')) not in [None, 'transfer']:
+                node_id = drop.get('node')
+                if free_slots[node_id] > 0:
+                    free_slots[node_id] -= 1
+                    start(oid, now)
+                else:
+                    queued[node_id].append(oid)
+            else:
+                start(oid, now)
+
+        def complete(oid, now):
+            finishes[oid] = now
+            drop = self._drops[oid]
+            if drop['type'] == 'app' and get_kind(drop.get('app')) not in [None, 'transfer']:
+                node_id = drop.get('node')
+                busy[node_id] += now - starts[oid]
+                if queued[node_id]:
+                    start(queued[node_id].pop(0), now)
+                else:
+                    free_slots[node_id] += 1
+            for consumer in self._consumers.get(oid, []):
+                waiting[consumer] -= 1
+                if waiting[consumer] == 0:
+                    causes[consumer] = oid
+                    ready(consumer, now)
+
+        for oid in order:
+            if len(self._inputs.get(oid, [])) == 0:
+                ready(oid, 0.0)
+
+        while events:
+            now, _, event, key, version = heapq.heappop(events)
+            if event == 'finish':
+                complete(key, now)
+            elif version == networks[key].version:
+                network = networks[key]
+                transferring[key] += network.advance(now)
+                _, oid = network.next_finish()
+                del network.remaining[oid]
+                schedule_transfers(key, now)
+                complete(oid, now)
+
+        node_finish = {}
+        for oid, finish in finishes.iteritems():
+            node_id = self._drops[oid].get('node')
+            node_finish[node_id] = max(node_finish.get(node_id, 0.0), finish)
+
+        return SimulationResult(
+            starts,
+            finishes,
+            node_finish,
+            dict([(node_id, self._instance_type(node_id)) for node_id in node_finish]),
+            busy,
+            transferring,
+            dict([(node_id, self._capacity(node_id)) for node_id in node_finish]),
+            self._critical_path(finishes, starts, causes)
+        )
+
+    def _critical_path(self, finishes, starts, causes):
+        """
+        Follow what held each drop up back from the last drop to finish
+
+        :return: a list of (oid, app, node id, start, finish) for the apps on the path
+        """
+        if not finishes:
+            return []
+        oid = max(finishes.keys(), key=lambda key: (finishes[key], key))
+        path = []
+        while oid is not None:
+            drop = self._drops[oid]
+            if drop['type'] == 'app':
+                path.append((oid, drop.get('app'), drop.get('node'), starts[oid], finishes[oid]))
+            oid = causes.get(oid)
+        path.reverse()
+        return path
+
+
+def simulate(drop_list, node_details, **key_word_arguments):
+    return GraphSimulator(drop_list, node_details, **key_word_arguments).run()
+
+
+def sweep(make_graph, grid, spot_prices, deadline=None, **key_word_arguments):
+    """
+    Simulate the graph for every combination of the parameters
+
+    :param make_graph: a function of the parameters returning (drop list, node details, sizes)
+    :param grid: a list of values for each parameter, by name
+    :param deadline: the most seconds a run may take
+    :return: the SweepPoints, cheapest first with any that miss the deadline after the rest
+    """
+    names = sorted(grid.keys())
+    points = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        parameters = dict(zip(names, values))
+        drop_list, node_details, sizes = make_graph(**parameters)
+        result = simulate(drop_list, node_details, sizes=sizes, **key_word_arguments)
+        points.append(SweepPoint(parameters, result.makespan, result.cost(spot_prices)))
+        LOG.info('{0}: {1:.1f} hours, ${2:.2f}'.format(parameters, points[-1].makespan / 3600.0, points[-1].cost))
+
+    return sorted(points, key=lambda point: (deadline is not None and point.makespan > deadline, point.cost, point.makespan))
+
+
+def make_mstransform_graph(days, frequencies, day_size, instance_type, nodes, parallel_streams):
+    """
+    A synthetic mstransform graph with each node taking its share of the days
+    """
+    from aws_chiles02.benchmark_build_graph import SyntheticBuildGraph
+    graph = SyntheticBuildGraph(days, frequencies, nodes, instance_type=instance_type, parallel_streams=parallel_streams)
+    graph.build_graph()
+    sizes = dict([('observation_data/day_{0}.tar'.format(day), day_size) for day in range(days)])
+    return graph.drop_list, graph.node_details, sizes
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser('Predict the makespan and cost of an mstransform run')
+    parser.add_argument('--days', type=int, default=60, help='the number of days')
+    parser.add_argument('--frequencies', type=int, default=120, help='the frequency splits of each day')
+    parser.add_argument('--day-size', type=int, default=100, help='the size of a day in GB')
+    parser.add_argument('--instance-type', default=REFERENCE_INSTANCE_TYPE, help='the instance type of the nodes')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10], help='the numbers of nodes to try')
+    parser.add_argument('--parallel-streams', type=int, nargs='+', default=[4], help='the numbers of parallel streams to try')
+    parser.add_argument('--spot-price', type=float, required=True, help='the spot price in dollars an hour')
+    parser.add_argument('--deadline', type=float, help='the most hours the run may take')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the utilisation and critical path of the cheapest')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+
+    def make_graph(nodes, parallel_streams):
+        return make_mstransform_graph(arguments.days, arguments.frequencies, arguments.day_size * SIZE_1GB, arguments.instance_type, nodes, parallel_streams)
+
+    deadline = arguments.deadline * 3600.0 if arguments.deadline is not None else None
+    points = sweep(make_graph, {'nodes': arguments.nodes, 'parallel_streams': arguments.parallel_streams}, arguments.spot_price, deadline)
+    cheapest = points[0]
+    if deadline is not None and cheapest.makespan > deadline:
+        LOG.warning('Nothing finishes within {0} hours'.format(arguments.deadline))
+    LOG.info('Cheapest: {0} taking {1:.1f} hours for ${2:.2f}'.format(cheapest.parameters, cheapest.makespan / 3600.0, cheapest.cost))
+    if arguments.verbose:
+        drop_list, node_details, sizes = make_graph(**cheapest.parameters)
+        simulate(drop_list, node_details, sizes=sizes).log(arguments.spot_price)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+What each instance type has to work with.
+
+The launch specifications, the RAID set up on the nodes, the disk budgets, the cost model
+and the simulator all take the instance types from here rather than knowing them by name.
+The speeds are relative to an i2.2xlarge for each kind of task. The i2 figures come from
+earlier runs, the i3 ones are estimates until timings are recorded for them and the cost
+model is fitted. More types can be added, or these overridden, in a CSV file.
+"""
+import csv
+import logging
+import os
+from collections import namedtuple
+
+from aws_chiles02.settings_file import INSTANCE_CATALOG_FILE, SIZE_1GB
+
+LOG = logging.getLogger(__name__)
+
+SIZE_1MB = 1024 * 1024
+REFERENCE_INSTANCE_TYPE = 'i2.2xlarge'
+# The kinds of task there are speeds for, in the order of the CSV columns
+KINDS = ['mstransform', 'uvsub', 'clean', 'stats']
+# Bytes per second for each network performance class
+NETWORK_BANDWIDTH = {
+    'moderate': 60 * SIZE_1MB,
+    'high': 120 * SIZE_1MB,
+    'up-to-10G': 300 * SIZE_1MB,
+    '10G': 800 * SIZE_1MB,
+    '25G': 2000 * SIZE_1MB,
+}
+# The device names the instance store volumes are mapped to, NVMe volumes appear by themselves
+DEVICE_NAMES = ['/dev/sd{0}'.format(letter) for letter in 'bcdefghijklmnopqrstuvwxy']
+
+
+class InstanceType(namedtuple('InstanceType', ['name', 'vcpus', 'memory', 'disks', 'disk_size', 'nvme', 'network', 'speeds'])):
+    """
+    memory and disk_size are in bytes, disks is the number of instance store volumes
+    """
+    __slots__ = ()
+
+    @property
+    def family(self):
+        return self.name.split('.')[0]
+
+    @property
+    def local_storage(self):
+        return self.disks * self.disk_size
+
+    @property
+    def slots(self):
+        """
+        How many CASA tasks run side by side, half the vCPUs
+        """
+        return max(1, self.vcpus // 2)
+
+    @property
+    def bandwidth(self):
+        return NETWORK_BANDWIDTH[self.network]
+
+    def speed(self, kind=None):
+        """
+        How much faster than an i2.2xlarge it runs the kind of task, going by the vCPUs for
+        kinds there are no figures for
+        """
+        if kind in self.speeds:
+            return self.speeds[kind]
+        return self.vcpus / 8.0
+
+    def block_device_mappings(self):
+        """
+        The instance store volumes for the launch specification
+        """
+        if self.nvme:
+            return []
+        return [
+            {
+                'DeviceName': DEVICE_NAMES[index],
+                'VirtualName': 'ephemeral{0}'.format(index),
+            } for index in range(self.disks)
+        ]
+
+
+def _make(name, vcpus, memory_gb, disks, disk_size_gb, nvme, network, speeds):
+    return InstanceType(
+        name,
+        vcpus,
+        int(memory_gb * SIZE_1GB),
+        disks,
+        int(disk_size_gb * SIZE_1GB),
+        nvme,
+        network,
+        dict(zip(KINDS, speeds)) if speeds is not None else {},
+    )
+
+
+_CATALOG = dict([(instance_type.name, instance_type) for instance_type in [
+    # name, vCPUs, memory GB, instance store volumes, GB each, NVMe, network and the speed for each of the KINDS
+    _make('m4.large', 2, 8, 0, 0, False, 'moderate', None),
+    _make('i2.xlarge', 4, 30.5, 1, 800, False, 'moderate', (0.5, 0.5, 0.5, 0.5)),
+    _make('i2.2xlarge', 8, 61, 2, 800, False, 'high', (1.0, 1.0, 1.0, 1.0)),
+    _make('i2.4xlarge', 16, 122, 4, 800, False, 'high', (2.0, 2.0, 2.0, 2.0)),
+    _make('i2.8xlarge', 32, 244, 8, 800, False, '10G', (4.0, 4.0, 4.0, 4.0)),
+    _make('i3.xlarge', 4, 30.5, 1, 950, True, 'up-to-10G', (0.8, 0.55, 0.55, 0.8)),
+    _make('i3.2xlarge', 8, 61, 1, 1900, True, 'up-to-10G', (1.6, 1.1, 1.1, 1.6)),
+    _make('i3.4xlarge', 16, 122, 2, 1900, True, 'up-to-10G', (3.0, 2.2, 2.2, 3.0)),
+    _make('i3.8xlarge', 32, 244, 4, 1900, True, '10G', (5.5, 4.4, 4.4, 5.5)),
+    _make('i3.16xlarge', 64, 488, 8, 1900, True, '25G', (10.0, 8.8, 8.8, 10.0)),
+]])
+_loaded = False
+
+
+def load_catalog(filename):
+    """
+    Read instance types from a CSV file of name, vCPUs, memory in GB, disks, disk size in GB,
+    NVMe (true or false), network class and then a speed for each of the KINDS
+    """
+    instance_types = []
+    with open(filename, 'rb') as catalog_file:
+        for row in csv.reader(catalog_file):
+            if len(row) < 7 or row[0].startswith('#'):
+                continue
+            instance_types.append(_make(
+                row[0],
+                int(row[1]),
+                float(row[2]),
+                int(row[3]),
+                float(row[4]),
+                row[5].strip().lower() == 'true',
+                row[6].strip(),
+                [float(speed) for speed in row[7:7 + len(KINDS)]] or None,
+            ))
+    return instance_types
+
+
+def _get_catalog():
+    global _loaded
+    if not _loaded:
+        _loaded = True
+        if INSTANCE_CATALOG_FILE is not None and os.path.exists(INSTANCE_CATALOG_FILE):
+            for instance_type in load_catalog(INSTANCE_CATALOG_FILE):
+                _CATALOG[instance_type.name] = instance_type
+    return _CATALOG
+
+
+def get_instance_type_names():
+    return sorted(_get_catalog().keys())
+
+
+def get_instance_type(name):
+    """
+    >>> get_instance_type('i3.4xlarge').local_storage // SIZE_1GB
+    3800
+    """
+    catalog = _get_catalog()
+    instance_type = catalog.get(name)
+    if instance_type is None:
+        LOG.warning('{0} is not in the instance catalog, treating it as an {1}'.format(name, REFERENCE_INSTANCE_TYPE))
+        instance_type = catalog[REFERENCE_INSTANCE_TYPE]
+    return instance_type
+
+
+def get_fallback(name):
+    """
+    The next size up in the same family and how many of this one it replaces
+
+    >>> get_fallback('i2.2xlarge')
+    ('i2.4xlarge', 2)
+    >>> get_fallback('i2.8xlarge') is None
+    True
+    """
+    catalog = _get_catalog()
+    instance_type = catalog.get(name)
+    if instance_type is None:
+        return None
+    for candidate in catalog.values():
+        if candidate.family == instance_type.family and candidate.vcpus == 2 * instance_type.vcpus:
+            return candidate.name, 2
+    return None
@@ -25,9 +25,9 @@ Scan the S3 bucket looking for bad splits
 import argparse
 import logging
 
-import boto3
-
-from aws_chiles02.common import human2bytes
+from aws_chiles02.bucket_maintenance import BucketMaintenance
+from aws_chiles02.common import human2bytes, set_logging_level
+from aws_chiles02.tar_index import INDEX_SUFFIX
 
 LOG = logging.getLogger(__name__)
 
@@ -37,43 +37,37 @@ def parse_arguments():
     parser.add_argument('bucket', help='the bucket to access')
     parser.add_argument('width', type=int, help='the frequency width')
     parser.add_argument('size', help='the minimum viable size')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='report what would be deleted without deleting it')
     parser.add_argument('-v', '--verbosity', action='count', default=0, help='increase output verbosity')
     return parser.parse_args()
 
 
-def remove_bad_splits(s3, bucket_name, width, size):
-    bucket = s3.Bucket(bucket_name)
-    deleted_count = 0
-    checked_count = 0
-    for key in bucket.objects.filter(Prefix='split_{0}'.format(width)):
-        if key.key.endswith('.tar'):
-            checked_count += 1
-            s3_object = s3.Object(bucket_name, key.key)
-            s3_size = s3_object.content_length
-
-            LOG.debug('checking key: {0}, size: {1:,}'.format(key.key, s3_size))
+def remove_bad_splits(bucket_name, width, size, dry_run=False, s3_client=None, catalog=None):
+    """
+    Delete the splits smaller than size along with their tar index
+    """
+    maintenance = BucketMaintenance(bucket_name, s3_client=s3_client, dry_run=dry_run, catalog=catalog)
+    objects = maintenance.list_objects('split_{0}/'.format(width))
+    tars = [s3_object for s3_object in objects if s3_object.key.endswith('.tar')]
+    bad_keys = set([s3_object.key for s3_object in tars if s3_object.size < size])
+    bad_objects = [s3_object for s3_object in objects if s3_object.key in bad_keys or (
+        s3_object.key.endswith(INDEX_SUFFIX) and s3_object.key[:-len(INDEX_SUFFIX)] in bad_keys
+    )]
 
-            if s3_size < size:
-                LOG.info('deleting key: {0}, size: {1:,}'.format(key.key, s3_size))
-                s3_object.delete()
-                deleted_count += 1
-
-    LOG.info('Checked {0} files. Deleted {1} files smaller than {2:,} bytes'.format(checked_count, deleted_count, size))
+    maintenance.delete_objects(bad_objects)
+    maintenance.report.log()
+    LOG.info('Checked {0} files. {1} {2} files smaller than {3:,} bytes'.format(
+        len(tars), 'Would delete' if dry_run else 'Deleted', len(bad_keys), size))
+    return maintenance.report
 
 
 def main():
     arguments = parse_arguments()
-    session = boto3.Session(profile_name='aws-chiles02')
-    s3 = session.resource('s3', use_ssl=False)
+    set_logging_level(arguments.verbosity)
 
     size_as_number = human2bytes(arguments.size)
-    remove_bad_splits(s3, arguments.bucket, arguments.width, size_as_number)
+    remove_bad_splits(arguments.bucket, arguments.width, size_as_number, dry_run=arguments.dry_run)
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    logging.getLogger('boto3').setLevel(logging.WARNING)
-    logging.getLogger('botocore').setLevel(logging.WARNING)
-    logging.getLogger('nose').setLevel(logging.INFO)
-
     main()
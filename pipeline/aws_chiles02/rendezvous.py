@@ -0,0 +1,184 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Where the instances of a run say they have started.
+
+Each run gets its own SQS queue, so it never has to look at, or hide, the messages of
+another run. The messages are deleted in batches and the wait returns as soon as the
+instances asked for have reported. For testing, or a cluster that can reach this machine,
+an HTTP server takes the place of the queue.
+
+A message holds the uuid of its group and the ip address, instance type, cores, memory
+and disk of the instance.
+"""
+import json
+import logging
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from aws_chiles02.aws_registry import get_client
+from aws_chiles02.settings_file import AWS_REGION, QUEUE
+
+LOG = logging.getLogger(__name__)
+
+# The longest SQS will long poll for
+MAX_WAIT_TIME_SECONDS = 20
+# A run's queue is only needed while it starts up
+MESSAGE_RETENTION_PERIOD = 3600
+
+
+def get_run_queue_name(uuid):
+    """
+    >>> get_run_queue_name('4c7f6f56-2df4-4e0e-a1b7-1fb9d3c2b5c1')
+    'startup_complete-4c7f6f56-2df4-4e0e-a1b7-1fb9d3c2b5c1'
+    """
+    return '{0}-{1}'.format(QUEUE, uuid)
+
+
+class Rendezvous(object):
+    """
+    The messages of several groups of instances, by the uuid of the group
+    """
+    def __init__(self, uuids):
+        self._received = dict([(uuid, {}) for uuid in uuids])
+        self._counts = dict([(uuid, 0) for uuid in uuids])
+        self._condition = threading.Condition()
+
+    def add(self, message_details):
+        """
+        :return: False if the message is not for one of our groups
+        """
+        uuid = message_details.get('uuid')
+        with self._condition:
+            if uuid not in self._received:
+                return False
+            self._received[uuid].setdefault(message_details['instance_type'], []).append(message_details)
+            self._counts[uuid] += 1
+            self._condition.notify_all()
+        LOG.info('{0} - {1} has started successfully with {2} cores'.format(
+            message_details['ip_address'],
+            message_details['instance_type'],
+            message_details.get('cores', '?')))
+        return True
+
+    def count(self, uuid):
+        with self._condition:
+            return self._counts[uuid]
+
+    def _receive(self, uuid, count, timeout):
+        """
+        Take in what has arrived, waiting up to timeout seconds for something
+        """
+        raise NotImplementedError()
+
+    def wait(self, uuid, count, wait=600):
+        """
+        Wait for count instances of the group to report in
+
+        :return: the details of the instances by instance type
+        """
+        stop_time = time.time() + wait
+        while self.count(uuid) < count:
+            remaining = stop_time - time.time()
+            if remaining <= 0:
+                LOG.warning('Only {0} of {1} started after {2} seconds'.format(self.count(uuid), count, wait))
+                break
+            self._receive(uuid, count, remaining)
+            LOG.info('{0} of {1} started'.format(self.count(uuid), count))
+        return self._received[uuid]
+
+    def close(self):
+        pass
+
+
+class SqsRendezvous(Rendezvous):
+    def __init__(self, uuids, queue_name, region=AWS_REGION, sqs_client=None):
+        """
+        The queue is created here and deleted by close
+        """
+        super(SqsRendezvous, self).__init__(uuids)
+        self._sqs = sqs_client if sqs_client is not None else get_client('sqs', region=region)
+        self._queue_url = self._sqs.create_queue(
+            QueueName=queue_name,
+            Attributes={'MessageRetentionPeriod': str(MESSAGE_RETENTION_PERIOD)}
+        )['QueueUrl']
+
+    def _receive(self, uuid, count, timeout):
+        response = self._sqs.receive_message(
+            QueueUrl=self._queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=max(0, min(MAX_WAIT_TIME_SECONDS, int(timeout)))
+        )
+        entries = []
+        for message in response.get('Messages', []):
+            if self.add(json.loads(message['Body'])):
+                entries.append({'Id': str(len(entries)), 'ReceiptHandle': message['ReceiptHandle']})
+            else:
+                LOG.warning('Ignoring a message for another run: {0}'.format(message['Body']))
+        if len(entries) > 0:
+            self._sqs.delete_message_batch(QueueUrl=self._queue_url, Entries=entries)
+
+    def close(self):
+        self._sqs.delete_queue(QueueUrl=self._queue_url)
+
+
+class _RendezvousHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        try:
+            accepted = self.server.rendezvous.add(json.loads(body))
+        except (ValueError, KeyError):
+            accepted = False
+        self.send_response(200 if accepted else 400)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        LOG.debug(format % args)
+
+
+class HttpRendezvous(Rendezvous):
+    """
+    Stands in for the queue: the instances POST their message to the url
+    """
+    def __init__(self, uuids, host='127.0.0.1', port=0):
+        super(HttpRendezvous, self).__init__(uuids)
+        self._server = HTTPServer((host, port), _RendezvousHandler)
+        self._server.rendezvous = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{0}:{1}/'.format(host, port)
+
+    def _receive(self, uuid, count, timeout):
+        # The server thread adds the messages, so just wait to be told
+        with self._condition:
+            if self._counts[uuid] < count:
+                self._condition.wait(timeout)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
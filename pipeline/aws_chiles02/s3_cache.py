@@ -0,0 +1,231 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+A node local cache of the tar files fetched from S3.
+
+The same split and uvsub tars are read by several graphs, and a clean parameter sweep
+reads the same uvsub tars every time. Objects are stored under a name derived from the
+bucket, key and ETag so a changed object is never served stale. The least recently used
+entries are evicted to keep the cache under its size cap, apart from those in use.
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from aws_chiles02.common import bytes2human
+from aws_chiles02.s3_codec import extract_tar_file
+from aws_chiles02.s3_download import download_file_resumable, CHECKPOINT_SUFFIX
+from aws_chiles02.s3_governor import get_governor, PRIORITY_INPUT
+from aws_chiles02.settings_file import CACHE_DIRECTORY, CACHE_SIZE
+
+LOG = logging.getLogger(__name__)
+
+PARTIAL_SUFFIX = '.part'
+
+
+def get_cache_name(bucket_name, key, etag):
+    return hashlib.sha1('{0}/{1}/{2}'.format(bucket_name, key, etag)).hexdigest()
+
+
+class CacheEntry(object):
+    def __init__(self, cache, name, hit):
+        self._cache = cache
+        self.name = name
+        self.hit = hit
+        self.path = os.path.join(cache.directory, name)
+        self.partial_path = self.path + PARTIAL_SUFFIX
+
+    def commit(self):
+        """
+        Move the fully downloaded partial file into the cache
+        """
+        os.rename(self.partial_path, self.path)
+        self._cache.add(self.name, os.path.getsize(self.path))
+
+
+class NodeCache(object):
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+        self._entries = OrderedDict()
+        self._pinned = {}
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._bytes_saved = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._load()
+
+    def _load(self):
+        # Rebuild the LRU order from the access times left by an earlier process
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(PARTIAL_SUFFIX) or name.endswith(CHECKPOINT_SUFFIX) or name.endswith('.tmp'):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_atime, name, stat.st_size))
+
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._size += size
+        LOG.info('Cache {0} holds {1} entries, {2}'.format(self.directory, len(self._entries), bytes2human(self._size)))
+
+    def contains(self, path):
+        """
+        Is the path the cache directory, inside it or a parent of it
+        """
+        path = os.path.realpath(path)
+        directory = os.path.realpath(self.directory)
+        return path == directory \
+            or path.startswith(directory + os.sep) \
+            or directory.startswith(path.rstrip(os.sep) + os.sep)
+
+    @contextmanager
+    def open_entry(self, bucket_name, key, etag):
+        """
+        Pin the entry for an object while it is fetched and read. Only one thread
+        fetches an object, the others wait and then find it in the cache.
+        """
+        name = get_cache_name(bucket_name, key, etag)
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(name, threading.Lock())
+
+        with fetch_lock:
+            with self._lock:
+                self._pinned[name] = self._pinned.get(name, 0) + 1
+                hit = name in self._entries
+                if hit:
+                    size = self._entries.pop(name)
+                    self._entries[name] = size
+                    self._hits += 1
+                    self._bytes_saved += size
+                else:
+                    self._misses += 1
+
+            entry = CacheEntry(self, name, hit)
+            if hit:
+                os.utime(entry.path, None)
+            try:
+                yield entry
+            finally:
+                with self._lock:
+                    self._pinned[name] -= 1
+                    if self._pinned[name] == 0:
+                        del self._pinned[name]
+
+    def add(self, name, size):
+        with self._lock:
+            self._size -= self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._size += size
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries that are not in use until the cache fits
+        """
+        removed = []
+        with self._lock:
+            for name in list(self._entries.keys()):
+                if self._size <= self._max_size:
+                    break
+                if name in self._pinned:
+                    continue
+                self._size -= self._entries.pop(name)
+                self._evictions += 1
+                removed.append(name)
+
+        for name in removed:
+            LOG.info('Evicting {0} from the cache'.format(name))
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                LOG.exception('Cannot remove {0} from the cache'.format(name))
+
+    def statistics(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_size': self._max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'bytes_saved': self._bytes_saved,
+            }
+
+    def log_statistics(self):
+        statistics = self.statistics()
+        LOG.info('Cache: {0} entries, {1} of {2}, {3} hits, {4} misses, {5} evictions, {6} not transferred'.format(
+            statistics['entries'],
+            bytes2human(statistics['size']),
+            bytes2human(statistics['max_size']),
+            statistics['hits'],
+            statistics['misses'],
+            statistics['evictions'],
+            bytes2human(statistics['bytes_saved'])))
+
+
+def extract_tar_from_cache(cache, s3_client, bucket_name, key, directory, callback=None, member_filter=None):
+    """
+    Extract a tar from the cache, fetching it from S3 into the cache on a miss
+    """
+    head = s3_client.head_object(Bucket=bucket_name, Key=key)
+    etag = head['ETag']
+    with cache.open_entry(bucket_name, key, etag) as entry:
+        if entry.hit:
+            LOG.info('Cache hit for {0}'.format(key))
+        else:
+            # Download into the partial file, so a failed fetch resumes on the next attempt
+            with get_governor().transfer(PRIORITY_INPUT, callback) as governed_callback:
+                download_file_resumable(s3_client, bucket_name, key, entry.partial_path, callback=governed_callback)
+            entry.commit()
+
+        extract_tar_file(entry.path, directory, head.get('Metadata'), member_filter)
+
+    cache.log_statistics()
+
+
+_lock = threading.Lock()
+_cache = None
+
+
+def get_cache():
+    """
+    The cache shared by every app in this process, or None if the settings do not set one up
+    """
+    global _cache
+    if CACHE_DIRECTORY is None:
+        return None
+
+    with _lock:
+        if _cache is None:
+            _cache = NodeCache(CACHE_DIRECTORY, CACHE_SIZE)
+        return _cache
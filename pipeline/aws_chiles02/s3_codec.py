@@ -0,0 +1,402 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Compress the tar files sent to S3.
+
+The codec is recorded in the object's metadata so a reader decodes it without being told.
+zstd compresses on a pool of threads inside the library, lz4 compresses independent
+frames on a pool of threads here. Both libraries are optional, gzip always works.
+
+Run as a script to benchmark the codecs on a directory of visibility tables.
+"""
+import argparse
+import logging
+import os
+import resource
+import tarfile
+import threading
+import time
+import zlib
+from Queue import Queue
+from collections import deque
+
+from aws_chiles02.common import bytes2human
+from aws_chiles02.tar_members import extract_members
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+LOG = logging.getLogger(__name__)
+
+CODEC_METADATA = 'codec'
+SIZE_1MB = 1048576
+BLOCK_SIZE = 4 * SIZE_1MB
+THREADS = 4
+
+
+class CodecException(Exception):
+    """
+    The codec isn't known or its library isn't installed
+    """
+    pass
+
+
+class CompressingWriter(object):
+    """
+    Write through a zlib style compressobj, closing the raw file when done
+    """
+    def __init__(self, raw, compressobj):
+        self._raw = raw
+        self._compressobj = compressobj
+
+    def write(self, data):
+        compressed = self._compressobj.compress(data)
+        if compressed:
+            self._raw.write(compressed)
+
+    def close(self):
+        self._raw.write(self._compressobj.flush())
+        self._raw.close()
+
+    def abort(self):
+        self._raw.abort()
+
+
+class ParallelBlockWriter(object):
+    """
+    Compress fixed size blocks on a pool of threads and write the results in order.
+    Each block is a complete frame, so the output is a valid stream of concatenated frames.
+    """
+    def __init__(self, raw, compress_block, threads=THREADS, block_size=BLOCK_SIZE):
+        self._raw = raw
+        self._compress_block = compress_block
+        self._block_size = block_size
+        self._buffer = []
+        self._buffer_size = 0
+        self._next_block = 0
+        self._next_to_write = 0
+        self._results = {}
+        self._error = None
+        self._condition = threading.Condition()
+        self._queue = Queue(maxsize=threads)
+        self._threads = []
+        for count in range(threads):
+            thread = threading.Thread(target=self._compress_blocks, name='compress-{0}'.format(count))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self._block_size:
+            self._submit_block()
+
+    def close(self):
+        if self._buffer_size > 0:
+            self._submit_block()
+        self._stop_threads()
+        self._write_results()
+        self._raw.close()
+
+    def abort(self):
+        with self._condition:
+            if self._error is None:
+                self._error = 'Aborted'
+        self._stop_threads()
+        self._raw.abort()
+
+    def _stop_threads(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _submit_block(self):
+        self._queue.put((self._next_block, ''.join(self._buffer)))
+        self._next_block += 1
+        self._buffer = []
+        self._buffer_size = 0
+        self._write_results()
+
+    def _write_results(self):
+        # Called from the writing thread only, so the raw file sees the blocks in order
+        while True:
+            with self._condition:
+                if self._error is not None:
+                    raise CodecException(self._error)
+                if self._next_to_write not in self._results:
+                    return
+                data = self._results.pop(self._next_to_write)
+                self._next_to_write += 1
+            self._raw.write(data)
+
+    def _compress_blocks(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            block_number, data = item
+            with self._condition:
+                if self._error is not None:
+                    # Keep draining the queue so the writer never blocks on it
+                    continue
+            try:
+                compressed = self._compress_block(data)
+            except Exception as exception:
+                LOG.exception('Compressing block {0}'.format(block_number))
+                with self._condition:
+                    self._error = 'Compressing block {0} failed: {1}'.format(block_number, exception)
+                continue
+
+            with self._condition:
+                self._results[block_number] = compressed
+                self._condition.notify_all()
+
+
+class DecompressingReader(object):
+    """
+    Read through a decompressor that stops at the end of each frame, starting a new
+    decompressor on the unused data so concatenated frames are read as one stream.
+
+    The decompressed chunks are queued as they are and only the bytes returned are
+    copied, tarfile reads 10KB at a time and rebuilding a buffer on each read would
+    copy the whole backlog every time.
+    """
+    def __init__(self, raw, new_decompressor, block_size=BLOCK_SIZE):
+        self._raw = raw
+        self._new_decompressor = new_decompressor
+        self._decompressor = new_decompressor()
+        self._block_size = block_size
+        self._chunks = deque()
+        # Where the unread bytes start in the first chunk
+        self._offset = 0
+        self._buffered = 0
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or self._buffered < size):
+            data = self._raw.read(self._block_size)
+            if not data:
+                self._eof = True
+                break
+            while data:
+                decompressed = self._decompressor.decompress(data)
+                if decompressed:
+                    self._chunks.append(decompressed)
+                    self._buffered += len(decompressed)
+                data = self._decompressor.unused_data
+                if data:
+                    self._decompressor = self._new_decompressor()
+
+        wanted = self._buffered if size is None or size < 0 else min(size, self._buffered)
+        self._buffered -= wanted
+        pieces = []
+        while wanted > 0:
+            chunk = self._chunks[0]
+            available = len(chunk) - self._offset
+            if available <= wanted:
+                pieces.append(chunk[self._offset:] if self._offset > 0 else chunk)
+                self._chunks.popleft()
+                self._offset = 0
+                wanted -= available
+            else:
+                pieces.append(chunk[self._offset:self._offset + wanted])
+                self._offset += wanted
+                wanted = 0
+        return ''.join(pieces)
+
+    def close(self):
+        pass
+
+
+class Codec(object):
+    def __init__(self, name, level=None, threads=THREADS):
+        self.name = name
+        self.level = level
+        self.threads = threads
+
+    def writer(self, raw):
+        """
+        Wrap a writable file, closing the wrapper flushes the compressor and closes raw
+        """
+        raise NotImplementedError()
+
+    def reader(self, raw):
+        raise NotImplementedError()
+
+
+class GzipCodec(Codec):
+    def __init__(self, level=6, threads=1):
+        super(GzipCodec, self).__init__('gzip', level, threads)
+
+    def writer(self, raw):
+        return CompressingWriter(raw, zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS))
+
+    def reader(self, raw):
+        return DecompressingReader(raw, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+
+
+class ZstdCodec(Codec):
+    def __init__(self, level=3, threads=THREADS):
+        if zstandard is None:
+            raise CodecException('The zstandard package is not installed')
+        super(ZstdCodec, self).__init__('zstd', level, threads)
+
+    def writer(self, raw):
+        return CompressingWriter(raw, zstandard.ZstdCompressor(level=self.level, threads=self.threads).compressobj())
+
+    def reader(self, raw):
+        return zstandard.ZstdDecompressor().stream_reader(raw)
+
+
+class Lz4Codec(Codec):
+    def __init__(self, level=0, threads=THREADS):
+        if lz4 is None:
+            raise CodecException('The lz4 package is not installed')
+        super(Lz4Codec, self).__init__('lz4', level, threads)
+
+    def writer(self, raw):
+        return ParallelBlockWriter(raw, lambda data: lz4.frame.compress(data, compression_level=self.level), self.threads)
+
+    def reader(self, raw):
+        return DecompressingReader(raw, lz4.frame.LZ4FrameDecompressor)
+
+
+CODECS = {
+    'gzip': GzipCodec,
+    'zstd': ZstdCodec,
+    'lz4': Lz4Codec,
+}
+
+
+def get_codec(name, **kwargs):
+    """
+    Get a codec by name, None or 'none' for no compression
+    """
+    if name is None or name == 'none':
+        return None
+    if name not in CODECS:
+        raise CodecException('Unknown codec {0}'.format(name))
+    return CODECS[name](**kwargs)
+
+
+def get_codec_from_metadata(metadata):
+    """
+    Get the codec an object was written with
+    """
+    if metadata is None:
+        return None
+    return get_codec(metadata.get(CODEC_METADATA))
+
+
+def extract_tar_file(filename, directory, metadata=None, member_filter=None):
+    """
+    Extract a tar file on disk, decoding it with the codec in the metadata
+    """
+    codec = get_codec_from_metadata(metadata)
+    with open(filename, 'rb') as input_file:
+        fileobj = codec.reader(input_file) if codec is not None else input_file
+        tar = tarfile.open(fileobj=fileobj, mode='r|')
+        try:
+            extract_members(tar, directory, member_filter)
+        finally:
+            tar.close()
+
+
+class CountingSink(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def close(self):
+        pass
+
+
+def benchmark(directory, codec_names, threads=THREADS):
+    """
+    Tar a directory through each codec and measure the ratio against the CPU used
+
+    :return: a list of (codec, input size, output size, wall seconds, cpu seconds)
+    """
+    members = sorted(os.listdir(directory))
+    results = []
+    for name in codec_names:
+        codec = get_codec(name, threads=threads) if name != 'none' else None
+        sink = CountingSink()
+        counting = CountingSink()
+        writer = codec.writer(sink) if codec is not None else sink
+
+        class Tee(object):
+            def write(self, data):
+                counting.write(data)
+                writer.write(data)
+
+        start_wall = time.time()
+        start_cpu = resource.getrusage(resource.RUSAGE_SELF)
+        tar = tarfile.open(fileobj=Tee(), mode='w|')
+        for member in members:
+            tar.add(os.path.join(directory, member), arcname=member)
+        tar.close()
+        writer.close()
+        end_cpu = resource.getrusage(resource.RUSAGE_SELF)
+        wall = time.time() - start_wall
+        cpu = (end_cpu.ru_utime - start_cpu.ru_utime) + (end_cpu.ru_stime - start_cpu.ru_stime)
+        results.append((name, counting.size, sink.size, wall, cpu))
+    return results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser('Benchmark the compression codecs on a directory of visibility tables')
+    parser.add_argument('directory', help='the directory, for example a split or uvsub measurement set')
+    parser.add_argument('--codecs', nargs='+', default=['none', 'lz4', 'zstd', 'gzip'], help='the codecs to try')
+    parser.add_argument('--threads', type=int, default=THREADS, help='the compression threads')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    for name, input_size, output_size, wall, cpu in benchmark(arguments.directory, arguments.codecs, arguments.threads):
+        LOG.info('{0:5} {1} -> {2}, ratio {3:.2f}, wall {4:.1f}s, cpu {5:.1f}s, {6}/cpu second'.format(
+            name,
+            bytes2human(input_size),
+            bytes2human(output_size),
+            float(input_size) / max(output_size, 1),
+            wall,
+            cpu,
+            bytes2human(input_size / max(cpu, 0.001))))
+
+
+if __name__ == "__main__":
+    main()
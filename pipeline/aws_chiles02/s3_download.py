@@ -0,0 +1,350 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+A resumable download of large S3 objects using parallel ranged GETs.
+
+The object is split into parts which a pool of threads fetch straight into their place
+in a preallocated file. Every completed part is recorded in a sidecar checkpoint so a
+rerun of the drop only fetches the parts that are missing. Once the queue of parts is
+empty any part taking much longer than the others is requested again on an idle thread
+and whichever copy finishes first wins.
+
+When the ETag is given the parts are aligned with the parts of the upload, so each
+thread hashes its own bytes and the ETag is checked without reading the file again.
+"""
+import binascii
+import json
+import logging
+import os
+import threading
+import time
+from Queue import Queue
+
+from aws_chiles02.s3_etag import ETagVerifier
+from aws_chiles02.s3_stream import S3StreamException, SIZE_1MB
+
+LOG = logging.getLogger(__name__)
+
+PART_SIZE = 64 * SIZE_1MB
+PARALLEL_STREAMS = 8
+RETRIES = 3
+CHUNK_SIZE = SIZE_1MB
+CHECKPOINT_SUFFIX = '.checkpoint'
+# A part is a straggler once it has taken this many times the median part time
+STRAGGLER_FACTOR = 3.0
+# Seconds between the checks for stragglers
+MONITOR_INTERVAL = 5.0
+
+
+def get_checkpoint_name(filename):
+    return filename + CHECKPOINT_SUFFIX
+
+
+class RangedDownload(object):
+    def __init__(
+            self,
+            s3_client,
+            bucket_name,
+            key,
+            filename,
+            size,
+            etag=None,
+            metadata=None,
+            part_size=PART_SIZE,
+            parallel_streams=PARALLEL_STREAMS,
+            callback=None,
+            straggler_factor=STRAGGLER_FACTOR,
+            monitor_interval=MONITOR_INTERVAL):
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self._key = key
+        self._filename = filename
+        self._checkpoint_name = get_checkpoint_name(filename)
+        self._size = size
+        self._etag = etag
+        self._verifier = None
+        if etag is not None:
+            verifier = ETagVerifier(etag, size, metadata)
+            if verifier.verifiable:
+                self._verifier = verifier
+                if verifier.multipart:
+                    part_size = verifier.part_size * max(1, part_size // verifier.part_size)
+                else:
+                    # The MD5 of a single PUT can only be built in order
+                    part_size = max(1, size)
+        self._part_size = part_size
+        self._number_parts = max(1, (size + part_size - 1) // part_size)
+        self._parallel_streams = max(1, min(parallel_streams, self._number_parts))
+        self._callback = callback
+        self._straggler_factor = straggler_factor
+        self._monitor_interval = monitor_interval
+
+        self._condition = threading.Condition()
+        self._queue = Queue()
+        self._completed = set()
+        self._digests = {}
+        self._in_flight = {}
+        self._speculated = set()
+        self._durations = []
+        self._errors = []
+        self._pending = 0
+
+    @property
+    def completed_parts(self):
+        return set(self._completed)
+
+    @property
+    def number_parts(self):
+        return self._number_parts
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self._checkpoint_name) or not os.path.exists(self._filename):
+            return set()
+
+        try:
+            with open(self._checkpoint_name, 'r') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except (IOError, ValueError):
+            LOG.warning('Ignoring the unreadable checkpoint {0}'.format(self._checkpoint_name))
+            return set()
+
+        if checkpoint.get('bucket') != self._bucket_name \
+                or checkpoint.get('key') != self._key \
+                or checkpoint.get('size') != self._size \
+                or checkpoint.get('etag') != self._etag \
+                or checkpoint.get('part_size') != self._part_size \
+                or os.path.getsize(self._filename) != self._size:
+            LOG.warning('The checkpoint {0} is for a different object, starting again'.format(self._checkpoint_name))
+            return set()
+
+        completed = set([part for part in checkpoint['completed'] if 0 <= part < self._number_parts])
+        if self._verifier is not None:
+            digests = checkpoint.get('digests', {})
+            completed = set([part for part in completed if str(part) in digests])
+            for part in completed:
+                self._digests[part] = [binascii.unhexlify(digest) for digest in digests[str(part)]]
+        return completed
+
+    def _save_checkpoint(self):
+        # Called with the condition held. Write then rename so a crash never leaves half a checkpoint
+        temporary_name = self._checkpoint_name + '.tmp'
+        with open(temporary_name, 'w') as checkpoint_file:
+            json.dump(
+                {
+                    'bucket': self._bucket_name,
+                    'key': self._key,
+                    'size': self._size,
+                    'etag': self._etag,
+                    'part_size': self._part_size,
+                    'completed': sorted(self._completed),
+                    'digests': dict([(str(part), [binascii.hexlify(digest) for digest in digests]) for part, digests in self._digests.iteritems()]),
+                },
+                checkpoint_file
+            )
+        os.rename(temporary_name, self._checkpoint_name)
+
+    def _prepare_file(self):
+        if not os.path.exists(self._filename) or os.path.getsize(self._filename) != self._size:
+            with open(self._filename, 'wb') as output_file:
+                output_file.truncate(self._size)
+
+    def download(self):
+        """
+        Fetch the missing parts and return the number of bytes fetched
+        """
+        self._completed = self._load_checkpoint()
+        if self._completed:
+            LOG.info('Resuming {0}, {1} of {2} parts already downloaded'.format(self._key, len(self._completed), self._number_parts))
+        else:
+            self._prepare_file()
+
+        missing = [part for part in range(self._number_parts) if part not in self._completed]
+        for part in missing:
+            self._put(part)
+
+        for count in range(min(self._parallel_streams, len(missing))):
+            thread = threading.Thread(target=self._fetch_parts, name='{0}-{1}'.format(self._key, count))
+            # A hung request must not stop the drop finishing once a speculative copy completes
+            thread.daemon = True
+            thread.start()
+
+        with self._condition:
+            while len(self._completed) < self._number_parts and not (self._errors and self._pending == 0):
+                self._condition.wait(self._monitor_interval)
+                self._speculate()
+
+        for _ in range(self._parallel_streams):
+            self._queue.put(None)
+
+        if len(self._completed) < self._number_parts:
+            raise S3StreamException(
+                'Downloaded {0} of {1} parts of {2}: {3}'.format(
+                    len(self._completed),
+                    self._number_parts,
+                    self._key,
+                    '; '.join(self._errors)))
+
+        if os.path.getsize(self._filename) != self._size:
+            raise S3StreamException('The sizes for {0} differ S3: {1}, local FS: {2}'.format(self._filename, self._size, os.path.getsize(self._filename)))
+
+        if self._verifier is not None:
+            digests = []
+            for part in range(self._number_parts):
+                digests.extend(self._digests[part])
+            if not self._verifier.matches(digests):
+                # Which part is bad can't be known, so the next attempt starts again
+                os.remove(self._checkpoint_name)
+                raise S3StreamException('The contents of {0} do not match the ETag {1}'.format(self._key, self._etag))
+
+        os.remove(self._checkpoint_name)
+        return sum([end - start + 1 for start, end in [self._get_range(part) for part in missing]])
+
+    def _put(self, part):
+        # Called with the condition held, or before the threads start
+        self._pending += 1
+        self._queue.put(part)
+
+    def _get_range(self, part):
+        start = part * self._part_size
+        return start, min(start + self._part_size, self._size) - 1
+
+    def _speculate(self):
+        """
+        Called with the condition held. Once the queue has drained re-request the parts
+        that are taking far longer than the median.
+        """
+        if not self._queue.empty() or not self._durations or not self._in_flight:
+            return
+
+        durations = sorted(self._durations)
+        median = durations[len(durations) // 2]
+        now = time.time()
+        for part, start_times in self._in_flight.items():
+            if part not in self._speculated and now - min(start_times) > self._straggler_factor * median:
+                LOG.info('Part {0} of {1} is straggling, requesting it again'.format(part, self._key))
+                self._speculated.add(part)
+                self._put(part)
+
+    def _fetch_parts(self):
+        with open(self._filename, 'r+b') as output_file:
+            while True:
+                part = self._queue.get()
+                if part is None:
+                    return
+
+                with self._condition:
+                    if part in self._completed:
+                        self._pending -= 1
+                        self._condition.notify_all()
+                        continue
+                    self._in_flight.setdefault(part, []).append(time.time())
+
+                start = time.time()
+                error = None
+                digests = None
+                for attempt in range(RETRIES):
+                    try:
+                        digests = self._fetch_part(output_file, part)
+                        error = None
+                        break
+                    except Exception as exception:
+                        error = exception
+                        LOG.warning('Part {0} of {1} failed, attempt {2}: {3}'.format(part, self._key, attempt + 1, exception))
+
+                with self._condition:
+                    self._pending -= 1
+                    start_times = self._in_flight.get(part, [])
+                    if start_times:
+                        start_times.pop(0)
+                    if not start_times:
+                        self._in_flight.pop(part, None)
+
+                    if error is not None:
+                        self._errors.append('part {0}: {1}'.format(part, error))
+                    elif part not in self._completed and digests is not None:
+                        self._completed.add(part)
+                        if self._verifier is not None:
+                            self._digests[part] = digests
+                        self._durations.append(time.time() - start)
+                        self._save_checkpoint()
+                        # Only the copy of a part that completes first reports its bytes, so a
+                        # speculative copy isn't counted twice
+                        if self._callback is not None:
+                            part_start, part_end = self._get_range(part)
+                            self._callback(part_end - part_start + 1)
+                    self._condition.notify_all()
+
+    def _fetch_part(self, output_file, part):
+        """
+        Fetch a part into its place in the file, returning the MD5s of the upload parts it covers.
+        Returns None if another thread finishes it first.
+        """
+        start, end = self._get_range(part)
+        kwargs = {
+            'Bucket': self._bucket_name,
+            'Key': self._key,
+            'Range': 'bytes={0}-{1}'.format(start, end),
+        }
+        if self._etag is not None:
+            kwargs['IfMatch'] = self._etag
+        body = self._s3_client.get_object(**kwargs)['Body']
+        hasher = self._verifier.hasher() if self._verifier is not None else None
+        try:
+            output_file.seek(start)
+            written = 0
+            chunk = body.read(CHUNK_SIZE)
+            while chunk:
+                if part in self._completed:
+                    return None
+                output_file.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                written += len(chunk)
+                chunk = body.read(CHUNK_SIZE)
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        finally:
+            body.close()
+
+        if written != end - start + 1:
+            raise S3StreamException('Part {0} of {1} was {2} bytes, expected {3}'.format(part, self._key, written, end - start + 1))
+        return hasher.digests() if hasher is not None else []
+
+
+def download_file_resumable(s3_client, bucket_name, key, filename, part_size=PART_SIZE, parallel_streams=PARALLEL_STREAMS, callback=None):
+    """
+    Download an object to filename, resuming from the checkpoint left by an earlier attempt
+    """
+    head = s3_client.head_object(Bucket=bucket_name, Key=key)
+    download = RangedDownload(
+        s3_client,
+        bucket_name,
+        key,
+        filename,
+        head['ContentLength'],
+        etag=head.get('ETag'),
+        metadata=head.get('Metadata'),
+        part_size=part_size,
+        parallel_streams=parallel_streams,
+        callback=callback
+    )
+    return download.download()
@@ -0,0 +1,233 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Check the contents of S3 objects against their ETags.
+
+For an object uploaded in one PUT the ETag is the MD5 of its contents. For a multipart
+upload it is the MD5 of the concatenated binary MD5s of the parts followed by '-' and
+the number of parts, so the part size used by the upload has to be known. The uploads
+made by s3_stream record it in the object's metadata, S3Transfer uses 8MB parts.
+"""
+import argparse
+import binascii
+import hashlib
+import logging
+import os
+import threading
+
+LOG = logging.getLogger(__name__)
+
+SIZE_1MB = 1048576
+# The multipart_chunksize S3Transfer uses unless told otherwise
+S3TRANSFER_PART_SIZE = 8 * SIZE_1MB
+PART_SIZE_METADATA = 'part-size'
+BLOCK_SIZE = 8 * SIZE_1MB
+
+
+class PartHasher(object):
+    """
+    Compute the MD5 of each part of a stream as the bytes go past
+    """
+    def __init__(self, part_size=None):
+        """
+        :param part_size: the size of the upload parts, None for an object uploaded in one PUT
+        """
+        self._part_size = part_size
+        self._md5 = hashlib.md5()
+        self._in_part = 0
+        self._digests = []
+        self.size = 0
+
+    def update(self, data):
+        self.size += len(data)
+        if self._part_size is None:
+            self._md5.update(data)
+            return
+
+        offset = 0
+        while offset < len(data):
+            take = min(len(data) - offset, self._part_size - self._in_part)
+            self._md5.update(data[offset:offset + take])
+            self._in_part += take
+            offset += take
+            if self._in_part == self._part_size:
+                self._digests.append(self._md5.digest())
+                self._md5 = hashlib.md5()
+                self._in_part = 0
+
+    def digests(self):
+        """
+        The binary MD5 of every part seen so far, including the part in progress
+        """
+        if self._part_size is None or self._in_part > 0 or not self._digests:
+            return self._digests + [self._md5.digest()]
+        return list(self._digests)
+
+
+def get_etag(digests, multipart):
+    """
+    Build the ETag S3 would give an object with the part MD5s
+
+    >>> get_etag([hashlib.md5('').digest()], False)
+    '"d41d8cd98f00b204e9800998ecf8427e"'
+    >>> get_etag([hashlib.md5('a').digest(), hashlib.md5('b').digest()], True)
+    '"96e024ba2074fe77e8e965ba43a704be-2"'
+    """
+    if not multipart:
+        return '"{0}"'.format(binascii.hexlify(digests[0]))
+    return '"{0}-{1}"'.format(hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+
+
+def parse_etag(etag):
+    """
+    Split an ETag into the MD5 and the number of parts, which is None for a single PUT
+
+    >>> parse_etag('"d41d8cd98f00b204e9800998ecf8427e"')
+    ('d41d8cd98f00b204e9800998ecf8427e', None)
+    >>> parse_etag('"96e024ba2074fe77e8e965ba43a704be-2"')
+    ('96e024ba2074fe77e8e965ba43a704be', 2)
+    """
+    etag = etag.strip('"')
+    if '-' in etag:
+        md5, parts = etag.split('-', 1)
+        return md5, int(parts)
+    return etag, None
+
+
+class ETagVerifier(object):
+    def __init__(self, etag, size, metadata=None):
+        self.etag = etag
+        self.size = size
+        md5, self.parts = parse_etag(etag)
+        self.multipart = self.parts is not None
+        self.part_size = None
+        self.verifiable = len(md5) == 32
+
+        if self.multipart:
+            self.part_size = self._find_part_size(metadata)
+            if self.part_size is None:
+                LOG.warning('Cannot work out the part size for the ETag {0}, size {1}'.format(etag, size))
+                self.verifiable = False
+
+    def _find_part_size(self, metadata):
+        candidates = []
+        if metadata is not None and PART_SIZE_METADATA in metadata:
+            candidates.append(int(metadata[PART_SIZE_METADATA]))
+        candidates.append(S3TRANSFER_PART_SIZE)
+        # Most tools use a whole number of MB
+        per_part = (self.size + self.parts - 1) // self.parts
+        candidates.append(((per_part + SIZE_1MB - 1) // SIZE_1MB) * SIZE_1MB)
+
+        for part_size in candidates:
+            if part_size > 0 and (self.size + part_size - 1) // part_size == self.parts:
+                return part_size
+        return None
+
+    def hasher(self):
+        return PartHasher(self.part_size)
+
+    def matches(self, digests):
+        etag = get_etag(digests, self.multipart)
+        if etag != self.etag:
+            LOG.error('ETag mismatch, expected {0}, calculated {1}'.format(self.etag, etag))
+            return False
+        return True
+
+
+def get_file_digests(filename, part_size=None, parallel_streams=4):
+    """
+    Hash the parts of a file on disk, with a thread per stream for a multipart ETag.
+    A single PUT ETag is the MD5 of the whole file so it has to be read in order.
+    """
+    size = os.path.getsize(filename)
+    if part_size is None:
+        hasher = PartHasher()
+        with open(filename, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(BLOCK_SIZE), b''):
+                hasher.update(block)
+        return hasher.digests()
+
+    number_parts = max(1, (size + part_size - 1) // part_size)
+    digests = [None] * number_parts
+    next_part = [0]
+    lock = threading.Lock()
+
+    def hash_parts():
+        with open(filename, 'rb') as input_file:
+            while True:
+                with lock:
+                    part = next_part[0]
+                    next_part[0] += 1
+                if part >= number_parts:
+                    return
+
+                md5 = hashlib.md5()
+                input_file.seek(part * part_size)
+                remaining = min(part_size, size - part * part_size)
+                while remaining > 0:
+                    block = input_file.read(min(BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    md5.update(block)
+                    remaining -= len(block)
+                digests[part] = md5.digest()
+
+    threads = [threading.Thread(target=hash_parts) for _ in range(max(1, min(parallel_streams, number_parts)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return digests
+
+
+def verify_file(filename, etag, metadata=None, parallel_streams=4):
+    """
+    Check a file on disk against an ETag, returns None if the ETag cannot be checked
+    """
+    verifier = ETagVerifier(etag, os.path.getsize(filename), metadata)
+    if not verifier.verifiable:
+        return None
+    return verifier.matches(get_file_digests(filename, verifier.part_size, parallel_streams))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser('Calculate the S3 ETag of a file')
+    parser.add_argument('file', help='the file')
+    parser.add_argument('--part_size', type=int, help='the multipart part size in MB, leave out for a single PUT')
+    parser.add_argument('--etag', help='the ETag to check the file against')
+    parser.add_argument('--parallel_streams', type=int, default=4, help='the number of threads hashing parts')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    if args.etag is not None:
+        LOG.info('{0} matches {1}: {2}'.format(args.file, args.etag, verify_file(args.file, args.etag, parallel_streams=args.parallel_streams)))
+    else:
+        part_size = args.part_size * SIZE_1MB if args.part_size is not None else None
+        digests = get_file_digests(args.file, part_size, args.parallel_streams)
+        LOG.info('ETag: {0}'.format(get_etag(digests, part_size is not None)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+A node wide governor for the S3 transfers.
+
+All the copy apps on a node run in the one node manager process, so they share a
+governor that limits the number of transfers in flight, meters the bytes through a
+token bucket and admits waiting transfers in priority order. Inputs that a CASA
+slot is waiting on go first, product uploads second and logs and metrics last.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from aws_chiles02.common import bytes2human
+from aws_chiles02.settings_file import S3_BANDWIDTH, S3_MAX_TRANSFERS
+
+LOG = logging.getLogger(__name__)
+
+PRIORITY_INPUT = 0
+PRIORITY_PRODUCT = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {
+    PRIORITY_INPUT: 'input',
+    PRIORITY_PRODUCT: 'product',
+    PRIORITY_BACKGROUND: 'background',
+}
+# How many seconds of history the throughput is averaged over
+RATE_WINDOW = 10.0
+
+
+class TokenBucket(object):
+    """
+    Meter bytes at a steady rate. A consumer may overdraw the bucket, it then sleeps
+    until the debt is paid off so large chunks are still spread out in time.
+    """
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        self._rate = float(rate)
+        self._capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self._capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Take amount tokens from the bucket and return how long we slept waiting for them
+        """
+        if self._rate <= 0:
+            return 0.0
+
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= amount
+            delay = -self._tokens / self._rate if self._tokens < 0 else 0.0
+
+        if delay > 0:
+            self._sleep(delay)
+        return delay
+
+
+class _Counter(object):
+    def __init__(self):
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.bytes = 0
+        self.history = deque()
+
+    def add(self, amount, now):
+        self.bytes += amount
+        self.history.append((now, amount))
+        self.trim(now)
+
+    def trim(self, now):
+        while self.history and self.history[0][0] < now - RATE_WINDOW:
+            self.history.popleft()
+
+    def rate(self, now):
+        self.trim(now)
+        return sum([amount for _, amount in self.history]) / RATE_WINDOW
+
+
+class GovernedCallback(object):
+    """
+    A boto3 transfer callback that meters the bytes through the governor before
+    passing them to the wrapped callback
+    """
+    def __init__(self, governor, priority, callback=None):
+        self._governor = governor
+        self._priority = priority
+        self._callback = callback
+
+    def __call__(self, bytes_amount):
+        self._governor.consume(self._priority, bytes_amount)
+        if self._callback is not None:
+            self._callback(bytes_amount)
+
+
+class TransferGovernor(object):
+    def __init__(self, max_transfers, bandwidth=0, reserved_for_input=1, clock=time.time, sleep=time.sleep):
+        """
+        :param max_transfers: the number of transfers that can be in flight at once
+        :param bandwidth: bytes per second across all the transfers, 0 for no limit
+        :param reserved_for_input: transfer slots only an input can take
+        """
+        self._max_transfers = max(1, max_transfers)
+        self._reserved_for_input = min(reserved_for_input, self._max_transfers - 1)
+        self._bucket = TokenBucket(bandwidth, clock=clock, sleep=sleep)
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._counters = dict([(priority, _Counter()) for priority in PRIORITY_NAMES.keys()])
+
+    def _limit(self, priority):
+        if priority == PRIORITY_INPUT:
+            return self._max_transfers
+        return self._max_transfers - self._reserved_for_input
+
+    def acquire(self, priority):
+        ticket = (priority, next(self._sequence))
+        with self._condition:
+            counter = self._counters[priority]
+            heapq.heappush(self._waiting, ticket)
+            counter.waiting += 1
+            try:
+                # Inputs always sort ahead of the other classes so only the head of the queue can go
+                while self._waiting[0] != ticket or self._active >= self._limit(priority):
+                    self._condition.wait(1.0)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                counter.waiting -= 1
+                self._condition.notify_all()
+            self._active += 1
+            counter.active += 1
+
+    def release(self, priority):
+        with self._condition:
+            self._active -= 1
+            counter = self._counters[priority]
+            counter.active -= 1
+            counter.completed += 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def transfer(self, priority, callback=None):
+        """
+        Hold a transfer slot for the duration of the block. The GovernedCallback it
+        yields should be passed to boto3 so the bytes are metered.
+        """
+        start = self._clock()
+        self.acquire(priority)
+        waited = self._clock() - start
+        if waited >= 1.0:
+            LOG.info('Waited {0:.1f}s for a {1} transfer slot'.format(waited, PRIORITY_NAMES[priority]))
+        try:
+            yield GovernedCallback(self, priority, callback)
+        finally:
+            self.release(priority)
+            self.log_statistics()
+
+    def consume(self, priority, bytes_amount):
+        with self._condition:
+            self._counters[priority].add(bytes_amount, self._clock())
+        self._bucket.consume(bytes_amount)
+
+    def statistics(self):
+        """
+        The live counters for each priority class
+        """
+        now = self._clock()
+        with self._condition:
+            return dict([
+                (PRIORITY_NAMES[priority], {
+                    'active': counter.active,
+                    'waiting': counter.waiting,
+                    'completed': counter.completed,
+                    'bytes': counter.bytes,
+                    'rate': counter.rate(now),
+                }) for priority, counter in self._counters.iteritems()
+            ])
+
+    def log_statistics(self):
+        statistics = self.statistics()
+        LOG.info('S3 transfers: {0}'.format(', '.join([
+            '{0} {1} active, {2} waiting, {3}/s'.format(
+                PRIORITY_NAMES[priority],
+                statistics[PRIORITY_NAMES[priority]]['active'],
+                statistics[PRIORITY_NAMES[priority]]['waiting'],
+                bytes2human(statistics[PRIORITY_NAMES[priority]]['rate'])
+            ) for priority in sorted(PRIORITY_NAMES.keys())
+        ])))
+
+
+_lock = threading.Lock()
+_governor = None
+
+
+def get_governor():
+    """
+    The governor shared by every app in this process
+    """
+    global _governor
+    with _lock:
+        if _governor is None:
+            _governor = TransferGovernor(S3_MAX_TRANSFERS, S3_BANDWIDTH)
+        return _governor
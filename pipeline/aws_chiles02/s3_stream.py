@@ -0,0 +1,598 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Stream tar files between S3 and the local file system without staging them on disk
+"""
+import base64
+import hashlib
+import logging
+import os
+import tarfile
+import threading
+from Queue import Queue
+
+from aws_chiles02.s3_codec import CODEC_METADATA, get_codec, get_codec_from_metadata
+from aws_chiles02.s3_etag import ETagVerifier, get_etag, PART_SIZE_METADATA
+from aws_chiles02.tar_index import IndexingTarFile, put_index
+from aws_chiles02.tar_members import extract_members
+
+LOG = logging.getLogger(__name__)
+
+SIZE_1MB = 1048576
+PART_SIZE = 16 * SIZE_1MB
+PARALLEL_STREAMS = 4
+RETRIES = 3
+# S3 limits a multipart upload to 10000 parts, keep some in reserve
+MAXIMUM_PARTS = 9000
+MINIMUM_PART_SIZE = 5 * SIZE_1MB
+
+
+class S3StreamException(Exception):
+    """
+    The stream from S3 failed
+    """
+    pass
+
+
+class S3RangedReader(object):
+    """
+    A read only file like object returning the contents of an S3 object in order.
+
+    With more than one stream the object is fetched as a series of ranged GETs by a pool
+    of threads and reassembled in order. At most parallel_streams * 2 parts are held in
+    memory at any one time. A hasher, if given, sees every byte in order.
+    """
+    def __init__(self, s3_client, bucket_name, key, size, part_size=PART_SIZE, parallel_streams=PARALLEL_STREAMS, callback=None, hasher=None):
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self._key = key
+        self._size = size
+        self._part_size = part_size
+        self._callback = callback
+        self._hasher = hasher
+        self._number_parts = (size + part_size - 1) // part_size
+        self._parallel_streams = max(1, min(parallel_streams, self._number_parts))
+        self._window = self._parallel_streams * 2
+
+        self._buffer = ''
+        self._buffer_offset = 0
+        self._bytes_read = 0
+        self._body = None
+        self._closed = False
+        self._error = None
+
+        self._condition = threading.Condition()
+        self._parts = {}
+        self._next_to_fetch = 0
+        self._next_to_read = 0
+        self._threads = []
+
+        if self._parallel_streams > 1:
+            for count in range(self._parallel_streams):
+                thread = threading.Thread(target=self._fetch_parts, name='{0}-{1}'.format(key, count))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    @property
+    def bytes_read(self):
+        return self._bytes_read
+
+    def read(self, size=-1):
+        if self._closed:
+            raise ValueError('I/O operation on closed reader')
+
+        if size is None or size < 0:
+            chunks = []
+            chunk = self.read(self._part_size)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self.read(self._part_size)
+            return ''.join(chunks)
+
+        if self._buffer_offset >= len(self._buffer):
+            self._buffer = self._next_part()
+            self._buffer_offset = 0
+
+        data = self._buffer[self._buffer_offset:self._buffer_offset + size]
+        self._buffer_offset += len(data)
+        self._bytes_read += len(data)
+        if self._hasher is not None:
+            self._hasher.update(data)
+        if self._callback is not None and len(data) > 0:
+            self._callback(len(data))
+        return data
+
+    def drain(self):
+        """
+        Read, and discard, whatever is left of the object. Tar stops reading at the
+        end of archive marker so the padding after it has to be consumed before the
+        sizes can be compared.
+        """
+        chunk = self.read(self._part_size)
+        while chunk:
+            chunk = self.read(self._part_size)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._parts.clear()
+            self._condition.notify_all()
+
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _next_part(self):
+        if self._parallel_streams == 1:
+            if self._body is None:
+                response = self._s3_client.get_object(Bucket=self._bucket_name, Key=self._key)
+                self._body = response['Body']
+            return self._body.read(self._part_size)
+
+        if self._next_to_read >= self._number_parts:
+            return ''
+
+        with self._condition:
+            while self._next_to_read not in self._parts and self._error is None:
+                self._condition.wait()
+
+            if self._error is not None:
+                raise S3StreamException(self._error)
+
+            data = self._parts.pop(self._next_to_read)
+            self._next_to_read += 1
+            self._condition.notify_all()
+
+        return data
+
+    def _fetch_parts(self):
+        while True:
+            with self._condition:
+                while not self._closed and self._error is None and self._next_to_fetch < self._number_parts \
+                        and self._next_to_fetch >= self._next_to_read + self._window:
+                    self._condition.wait()
+
+                if self._closed or self._error is not None or self._next_to_fetch >= self._number_parts:
+                    return
+
+                part_number = self._next_to_fetch
+                self._next_to_fetch += 1
+
+            try:
+                data = self._get_range(part_number)
+            except Exception as exception:
+                LOG.exception('Fetching part {0} of {1}'.format(part_number, self._key))
+                with self._condition:
+                    self._error = 'Part {0} of {1} failed: {2}'.format(part_number, self._key, exception)
+                    self._condition.notify_all()
+                return
+
+            with self._condition:
+                if not self._closed:
+                    self._parts[part_number] = data
+                self._condition.notify_all()
+
+    def _get_range(self, part_number):
+        start = part_number * self._part_size
+        end = min(start + self._part_size, self._size) - 1
+        expected = end - start + 1
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = self._s3_client.get_object(
+                    Bucket=self._bucket_name,
+                    Key=self._key,
+                    Range='bytes={0}-{1}'.format(start, end),
+                )
+                data = response['Body'].read()
+                if len(data) != expected:
+                    raise S3StreamException('Expected {0} bytes but got {1}'.format(expected, len(data)))
+                return data
+            except Exception:
+                if attempt >= RETRIES or self._closed:
+                    raise
+                LOG.warning('Retrying part {0} of {1}, attempt {2}'.format(part_number, self._key, attempt))
+
+
+def extract_tar_from_s3(s3_client, bucket_name, key, directory, size, parallel_streams=PARALLEL_STREAMS, part_size=PART_SIZE, callback=None, etag=None, metadata=None, member_filter=None):
+    """
+    Extract a tar file held in S3 directly into a directory.
+
+    Downloading and unpacking overlap and no copy of the tar file is written to disk.
+    Raises S3StreamException if the number of bytes read doesn't match the size in S3,
+    or if the bytes don't match the ETag. If the metadata names a codec the tar file is
+    decoded on the way through, the size and ETag are always those of the bytes in S3.
+
+    :param s3_client: the boto3 S3 client
+    :param bucket_name: the bucket
+    :param key: the key of the tar file
+    :param directory: the directory to extract into
+    :param size: the size of the object in S3
+    :param parallel_streams: the number of concurrent ranged GETs, 1 uses a single GET
+    :param part_size: the size of each ranged GET
+    :param callback: called with the number of bytes read
+    :param etag: the ETag of the object, the contents are checked against it while they stream
+    :param metadata: the object's metadata which may hold the part size and codec used to upload it
+    :param member_filter: a MemberFilter choosing the members to write, None for all of them
+    :return: the number of bytes read
+    """
+    codec = get_codec_from_metadata(metadata)
+    verifier = ETagVerifier(etag, size, metadata) if etag is not None else None
+    hasher = verifier.hasher() if verifier is not None and verifier.verifiable else None
+    with S3RangedReader(s3_client, bucket_name, key, size, part_size=part_size, parallel_streams=parallel_streams, callback=callback, hasher=hasher) as reader:
+        tar = tarfile.open(fileobj=codec.reader(reader) if codec is not None else reader, mode='r|')
+        try:
+            extract_members(tar, directory, member_filter)
+        finally:
+            tar.close()
+
+        reader.drain()
+        if reader.bytes_read != size:
+            raise S3StreamException('The sizes for {0} differ S3: {1}, streamed: {2}'.format(key, size, reader.bytes_read))
+        if hasher is not None and not verifier.matches(hasher.digests()):
+            raise S3StreamException('The contents of {0} do not match the ETag {1}'.format(key, etag))
+
+        return reader.bytes_read
+
+
+class S3MultipartWriter(object):
+    """
+    A write only file like object that pushes its contents to S3 as a multipart upload.
+
+    Each part is handed to a pool of upload threads as soon as it fills. Writes block while
+    parallel_streams parts are queued, so no more than parallel_streams * 2 + 1 parts are
+    held in memory.
+
+    Each part is sent with its MD5 so S3 rejects a corrupted part, and the ETag of the
+    completed object is checked against the one calculated from the parts.
+    """
+    def __init__(self, s3_client, bucket_name, key, part_size=PART_SIZE, parallel_streams=PARALLEL_STREAMS, extra_args=None, callback=None):
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self._key = key
+        self._part_size = max(part_size, MINIMUM_PART_SIZE)
+        self._callback = callback
+
+        self._buffer = []
+        self._buffer_size = 0
+        self._bytes_written = 0
+        self._part_number = 0
+        self._etags = {}
+        self._digests = {}
+        self._error = None
+        self._closed = False
+        self._completed = False
+        self.etag = None
+        self._lock = threading.Lock()
+
+        arguments = {
+            'Bucket': bucket_name,
+            'Key': key,
+        }
+        if extra_args is not None:
+            arguments.update(extra_args)
+        # Record the part size so a reader can rebuild the ETag
+        metadata = dict(arguments.get('Metadata', {}))
+        metadata[PART_SIZE_METADATA] = str(self._part_size)
+        arguments['Metadata'] = metadata
+        response = self._s3_client.create_multipart_upload(**arguments)
+        self._upload_id = response['UploadId']
+
+        self._queue = Queue(maxsize=parallel_streams)
+        self._threads = []
+        for count in range(parallel_streams):
+            thread = threading.Thread(target=self._upload_parts, name='{0}-{1}'.format(key, count))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def bytes_written(self):
+        return self._bytes_written
+
+    def write(self, data):
+        if self._closed:
+            raise ValueError('I/O operation on closed writer')
+        self._check_error()
+
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        self._bytes_written += len(data)
+        if self._buffer_size >= self._part_size:
+            # Every part but the last must be exactly the part size recorded in the metadata
+            # or the ETag can't be rebuilt, so the rest is carried into the next part
+            data = ''.join(self._buffer)
+            start = 0
+            while len(data) - start >= self._part_size:
+                self._submit_part(data[start:start + self._part_size])
+                start += self._part_size
+            remainder = data[start:]
+            self._buffer = [remainder] if remainder else []
+            self._buffer_size = len(remainder)
+
+    def close(self):
+        """
+        Flush the last part, wait for the uploads and complete the multipart upload
+        """
+        if self._closed:
+            return
+
+        if self._buffer_size > 0 or self._part_number == 0:
+            self._submit_part(''.join(self._buffer))
+            self._buffer = []
+            self._buffer_size = 0
+        self._stop_threads()
+        self._closed = True
+        self._check_error()
+
+        response = self._s3_client.complete_multipart_upload(
+            Bucket=self._bucket_name,
+            Key=self._key,
+            UploadId=self._upload_id,
+            MultipartUpload={
+                'Parts': [{'ETag': self._etags[part_number], 'PartNumber': part_number} for part_number in sorted(self._etags.keys())]
+            }
+        )
+        self._completed = True
+        self.etag = response.get('ETag')
+        etag = get_etag([self._digests[part_number] for part_number in sorted(self._digests.keys())], True)
+        if response.get('ETag') != etag:
+            # Don't leave a corrupted object where the next stage will pick it up
+            self._s3_client.delete_object(Bucket=self._bucket_name, Key=self._key)
+            raise S3StreamException('The ETag of {0} is {1}, the parts give {2}'.format(self._key, response.get('ETag'), etag))
+
+    def abort(self):
+        """
+        Throw away the parts uploaded so far so they don't linger in the bucket
+        """
+        if self._completed:
+            return
+
+        if not self._closed:
+            with self._lock:
+                if self._error is None:
+                    self._error = 'Aborted'
+            self._stop_threads()
+            self._closed = True
+
+        LOG.warning('Aborting the upload of {0}'.format(self._key))
+        self._s3_client.abort_multipart_upload(
+            Bucket=self._bucket_name,
+            Key=self._key,
+            UploadId=self._upload_id
+        )
+
+    def _submit_part(self, data):
+        self._part_number += 1
+        if self._part_number > MAXIMUM_PARTS:
+            raise S3StreamException('Too many parts for {0}, increase the part size'.format(self._key))
+
+        self._queue.put((self._part_number, data))
+
+    def _stop_threads(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _check_error(self):
+        with self._lock:
+            if self._error is not None:
+                raise S3StreamException(self._error)
+
+    def _upload_parts(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            part_number, data = item
+            with self._lock:
+                if self._error is not None:
+                    continue
+
+            try:
+                etag = self._upload_part(part_number, data)
+                with self._lock:
+                    self._etags[part_number] = etag
+                if self._callback is not None:
+                    self._callback(len(data))
+            except Exception as exception:
+                LOG.exception('Uploading part {0} of {1}'.format(part_number, self._key))
+                with self._lock:
+                    self._error = 'Part {0} of {1} failed: {2}'.format(part_number, self._key, exception)
+
+    def _upload_part(self, part_number, data):
+        digest = hashlib.md5(data).digest()
+        with self._lock:
+            self._digests[part_number] = digest
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = self._s3_client.upload_part(
+                    Bucket=self._bucket_name,
+                    Key=self._key,
+                    UploadId=self._upload_id,
+                    PartNumber=part_number,
+                    Body=data,
+                    ContentMD5=base64.b64encode(digest),
+                )
+                return response['ETag']
+            except Exception:
+                if attempt >= RETRIES:
+                    raise
+                LOG.warning('Retrying part {0} of {1}, attempt {2}'.format(part_number, self._key, attempt))
+
+
+def get_size_of_members(directory, members):
+    """
+    Get the number of bytes the members of a tar file will hold
+
+    :param directory: the directory the members are relative to
+    :param members: the files or directories
+    :return: the total size of the files
+    """
+    total = 0
+    for member in members:
+        path = os.path.join(directory, member)
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for filename in files:
+                    total += os.path.getsize(os.path.join(root, filename))
+        elif os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def get_part_size(expected_size, part_size=PART_SIZE):
+    """
+    Get a part size big enough to keep the upload under the limit on the number of parts
+
+    >>> get_part_size(1000)
+    16777216
+    >>> get_part_size(1000 * 16777216)
+    16777216
+    >>> get_part_size(10000 * 16777216)
+    18641352
+    """
+    return max(part_size, (expected_size + MAXIMUM_PARTS - 1) // MAXIMUM_PARTS)
+
+
+def upload_tar_to_s3(s3_client, bucket_name, key, directory, members, parallel_streams=PARALLEL_STREAMS, extra_args=None, callback=None, codec=None, write_index=False):
+    """
+    Tar the members of a directory straight into a multipart upload.
+
+    Members that don't exist are skipped, in the same way tar carries on without them.
+    A codec compresses the tar file on the way out and is recorded in the object's metadata.
+    The index of the members can be written to a key.idx sidecar.
+
+    :param s3_client: the boto3 S3 client
+    :param bucket_name: the bucket
+    :param key: the key of the tar file
+    :param directory: the directory the members are relative to
+    :param members: the files or directories to put in the tar file
+    :param parallel_streams: the number of parts uploading at the same time
+    :param extra_args: extra arguments for create_multipart_upload such as the StorageClass
+    :param callback: called with the number of bytes uploaded
+    :param codec: the name of the codec, None or 'none' for an uncompressed tar file
+    :param write_index: write the key.idx sidecar
+    :return: the list of members that were missing
+    """
+    codec = get_codec(codec)
+    if codec is not None:
+        extra_args = dict(extra_args or {})
+        metadata = dict(extra_args.get('Metadata', {}))
+        metadata[CODEC_METADATA] = codec.name
+        extra_args['Metadata'] = metadata
+
+    size = get_size_of_members(directory, members)
+    part_size = get_part_size(size)
+    missing = []
+    writer = S3MultipartWriter(s3_client, bucket_name, key, part_size=part_size, parallel_streams=parallel_streams, extra_args=extra_args, callback=callback)
+    output = codec.writer(writer) if codec is not None else writer
+    try:
+        tar = IndexingTarFile.open(fileobj=output, mode='w|')
+        for member in members:
+            path = os.path.join(directory, member)
+            if os.path.exists(path):
+                tar.add(path, arcname=member)
+            else:
+                LOG.warning('{0} does not exist'.format(path))
+                missing.append(member)
+        tar.close()
+        output.close()
+    except Exception:
+        writer.abort()
+        raise
+
+    if write_index:
+        tar.index.codec = codec.name if codec is not None else None
+        tar.index.etag = writer.etag
+        # The tar file is fine without its index, the readers fall back to scanning it
+        try:
+            put_index(s3_client, bucket_name, key, tar.index, (extra_args or {}).get('StorageClass'))
+        except Exception:
+            LOG.exception('Writing the index of {0}'.format(key))
+
+    if codec is not None:
+        LOG.info('Uploaded {0} bytes to {1}, {2} compressed {3:.2f} times'.format(writer.bytes_written, key, codec.name, float(size) / max(writer.bytes_written, 1)))
+    else:
+        LOG.info('Uploaded {0} bytes to {1}'.format(writer.bytes_written, key))
+    return missing
+
+
+def upload_tars_to_s3(s3_client, bucket_name, uploads, parallel_streams=PARALLEL_STREAMS, extra_args=None, callback_factory=None, codec=None, write_index=False, governor=None, priority=None):
+    """
+    Publish several tar files at the same time.
+
+    :param s3_client: the boto3 S3 client
+    :param bucket_name: the bucket
+    :param uploads: a list of (key, directory, members) tuples
+    :param parallel_streams: the number of parts uploading at the same time for each tar file
+    :param extra_args: extra arguments for create_multipart_upload
+    :param callback_factory: called with the key and expected size to build the progress callback
+    :param codec: the name of the codec for every tar file
+    :param write_index: write a key.idx sidecar for every tar file
+    :param governor: a TransferGovernor each tar file takes its own slot from
+    :param priority: the governor priority of the tar files
+    :return: a dictionary of key to the list of missing members
+    """
+    results = {}
+    errors = []
+
+    def upload(key, directory, members):
+        try:
+            callback = None
+            if callback_factory is not None:
+                callback = callback_factory(key, get_size_of_members(directory, members))
+            if governor is None:
+                results[key] = upload_tar_to_s3(s3_client, bucket_name, key, directory, members, parallel_streams=parallel_streams, extra_args=extra_args, callback=callback, codec=codec, write_index=write_index)
+            else:
+                with governor.transfer(priority, callback) as governed_callback:
+                    results[key] = upload_tar_to_s3(s3_client, bucket_name, key, directory, members, parallel_streams=parallel_streams, extra_args=extra_args, callback=governed_callback, codec=codec, write_index=write_index)
+        except Exception as exception:
+            LOG.exception('Uploading {0}'.format(key))
+            errors.append('{0}: {1}'.format(key, exception))
+
+    threads = []
+    for key, directory, members in uploads:
+        thread = threading.Thread(target=upload, args=(key, directory, members), name=key)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise S3StreamException(', '.join(errors))
+
+    return results
@@ -0,0 +1,293 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Assign the work in a graph to the nodes so they all finish at about the same time.
+
+The runtime of a task is predicted from its input size and frequency by a linear model for
+each kind of task, scaled by how fast the instance type is. The model starts from rough
+defaults and is fitted from the timings recorded by earlier runs. The tasks are then placed
+longest first, each on the node slot that would finish it soonest, which keeps the
+makespan close to the best possible across nodes of different sizes.
+"""
+import argparse
+import csv
+import heapq
+import logging
+import os
+from collections import namedtuple
+
+from aws_chiles02.instance_catalog import REFERENCE_INSTANCE_TYPE, get_instance_type, get_instance_type_names
+from aws_chiles02.settings_file import SIZE_1GB, TIMINGS_FILE
+
+LOG = logging.getLogger(__name__)
+
+TaskTiming = namedtuple('TaskTiming', ['kind', 'instance_type', 'size', 'frequency', 'seconds'])
+Assignment = namedtuple('Assignment', ['node_id', 'slot', 'start', 'finish'])
+
+# Seconds on an i2.2xlarge for a task: a fixed cost, per GB of input and per GHz of frequency
+DEFAULT_COEFFICIENTS = {
+    'mstransform': (600.0, 45.0, 0.0),
+    'uvsub': (900.0, 60.0, 0.0),
+    # About 120GB of uvsub output per frequency averages the two hours clean used to be given
+    'clean': (5400.0, 15.0, 0.0),
+    'stats': (120.0, 20.0, 0.0),
+}
+# The CSV the apps on a node append their timings to, it goes to S3 in the node's log tar
+TIMINGS_MEMBER = 'task_timings.csv'
+# The fewest timings a kind of task needs before its coefficients are fitted
+MIN_TIMINGS = 5
+FIT_ROUNDS = 10
+
+
+def _features(size, frequency):
+    return [1.0, float(size or 0) / SIZE_1GB, float(frequency or 0) / 1000.0]
+
+
+def _solve(matrix, vector):
+    """
+    Solve a small linear system by Gaussian elimination, None if it is singular
+
+    >>> _solve([[2.0, 0.0], [0.0, 4.0]], [2.0, 2.0])
+    [1.0, 0.5]
+    """
+    size = len(vector)
+    rows = [list(matrix[row]) + [vector[row]] for row in range(size)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-9:
+            return None
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for row in range(size):
+            if row != column:
+                factor = rows[row][column] / rows[column][column]
+                rows[row] = [value - factor * pivot_value for value, pivot_value in zip(rows[row], rows[column])]
+    return [rows[row][size] / rows[row][row] for row in range(size)]
+
+
+def least_squares(samples, targets):
+    """
+    Fit the coefficients of the features that vary, the others are left at 0
+    """
+    used = [0] + [index for index in range(1, len(samples[0])) if len(set([sample[index] for sample in samples])) > 1]
+    matrix = [[sum([sample[i] * sample[j] for sample in samples]) for j in used] for i in used]
+    vector = [sum([sample[i] * target for sample, target in zip(samples, targets)]) for i in used]
+    solution = _solve(matrix, vector)
+    if solution is None:
+        return None
+    coefficients = [0.0] * len(samples[0])
+    for index, value in zip(used, solution):
+        coefficients[index] = value
+    return tuple(coefficients)
+
+
+class CostModel(object):
+    def __init__(self, coefficients=None, speeds=None):
+        """
+        :param speeds: how much faster than an i2.2xlarge each instance type runs a task, to
+            override the instance catalog's speeds for each kind of task
+        """
+        self._coefficients = dict(DEFAULT_COEFFICIENTS if coefficients is None else coefficients)
+        self._speeds = dict(speeds or {})
+
+    def speed(self, instance_type, kind=None):
+        if instance_type in self._speeds:
+            return self._speeds[instance_type]
+        return get_instance_type(instance_type).speed(kind)
+
+    def coefficients(self, kind):
+        return self._coefficients.get(kind, (1.0, 0.0, 0.0))
+
+    def predict(self, kind, instance_type, size=0, frequency=None):
+        """
+        The seconds a task is expected to take on the instance type
+        """
+        seconds = sum([coefficient * feature for coefficient, feature in zip(self.coefficients(kind), _features(size, frequency))])
+        return max(seconds, 1.0) / self.speed(instance_type, kind)
+
+    def fit(self, timings, rounds=FIT_ROUNDS):
+        """
+        Fit the coefficients of each kind of task with enough timings and the speed of each
+        instance type. Each depends on the other so they are fitted in turn a few times.
+        """
+        by_kind = {}
+        for timing in timings:
+            by_kind.setdefault(timing.kind, []).append(timing)
+
+        for _ in range(rounds):
+            for kind, kind_timings in by_kind.iteritems():
+                if len(kind_timings) < MIN_TIMINGS:
+                    continue
+                coefficients = least_squares(
+                    [_features(timing.size, timing.frequency) for timing in kind_timings],
+                    [timing.seconds * self.speed(timing.instance_type, kind) for timing in kind_timings]
+                )
+                if coefficients is not None:
+                    self._coefficients[kind] = coefficients
+
+            by_instance_type = {}
+            for timing in timings:
+                predicted, actual = by_instance_type.get(timing.instance_type, (0.0, 0.0))
+                by_instance_type[timing.instance_type] = (
+                    predicted + self.predict(timing.kind, REFERENCE_INSTANCE_TYPE, timing.size, timing.frequency),
+                    actual + timing.seconds
+                )
+            for instance_type, (predicted, actual) in by_instance_type.iteritems():
+                if instance_type != REFERENCE_INSTANCE_TYPE and actual > 0:
+                    self._speeds[instance_type] = predicted / actual
+
+        for kind, kind_timings in by_kind.iteritems():
+            LOG.info('{0} from {1} timings: {2}'.format(kind, len(kind_timings), self.coefficients(kind)))
+        return self
+
+
+def load_timings(filename):
+    """
+    Read the timings from a CSV file of kind, instance type, size in bytes, frequency in MHz and seconds
+    """
+    timings = []
+    with open(filename, 'rb') as timings_file:
+        for row in csv.reader(timings_file):
+            if len(row) < 5 or row[0].startswith('#'):
+                continue
+            timings.append(TaskTiming(row[0], row[1], int(row[2]), int(row[3]) if row[3] else None, float(row[4])))
+    return timings
+
+
+def write_timings(filename, rows):
+    """
+    Append rows of kind, instance type, size, frequency, seconds and then anything
+    identifying the task, such as the session and drop uid, to a CSV file of timings
+    """
+    with open(filename, 'ab') as timings_file:
+        csv.writer(timings_file).writerows(rows)
+
+
+_cost_model = None
+
+
+def get_cost_model():
+    """
+    The default model fitted from the recorded timings, if there are any
+    """
+    global _cost_model
+    if _cost_model is None:
+        _cost_model = CostModel()
+        if TIMINGS_FILE is not None and os.path.exists(TIMINGS_FILE):
+            _cost_model.fit(load_timings(TIMINGS_FILE))
+    return _cost_model
+
+
+def get_nodes(node_details):
+    """
+    The (node id, instance type) of every node, in a stable order
+    """
+    nodes = []
+    for instance_type in sorted(node_details.keys()):
+        for instance_details in node_details[instance_type]:
+            nodes.append((instance_details['ip_address'], instance_details.get('instance_type', instance_type)))
+    return nodes
+
+
+class Schedule(object):
+    def __init__(self, kind, assignments, finish_times):
+        self.kind = kind
+        self.assignments = assignments
+        self.finish_times = finish_times
+
+    @property
+    def makespan(self):
+        return max(self.finish_times.values()) if self.finish_times else 0.0
+
+    def log(self):
+        LOG.info('Predicted makespan for {0}: {1:.1f} hours'.format(self.kind, self.makespan / 3600.0))
+        for node_id in sorted(self.finish_times.keys()):
+            LOG.info('  {0}: {1} tasks, finishing after {2:.1f} hours'.format(
+                node_id,
+                len([assignment for assignment in self.assignments if assignment.node_id == node_id]),
+                self.finish_times[node_id] / 3600.0))
+
+
+def schedule_tasks(kind, tasks, nodes, cost_model=None, slots=1, can_run=None):
+    """
+    Place the tasks longest first, each on the slot that finishes it earliest
+
+    :param kind: the kind of task, such as mstransform, which picks the coefficients
+    :param tasks: a list of (size, frequency)
+    :param nodes: a list of (node id, instance type)
+    :param slots: how many tasks a node runs side by side
+    :param can_run: an optional function of (task index, instance type) for tasks that only fit some nodes
+    :return: a Schedule whose assignments line up with the tasks
+    """
+    cost_model = cost_model if cost_model is not None else get_cost_model()
+    # A heap of (finish time, node id, slot) for each instance type, so the free-est slot is at the top
+    heaps = {}
+    for node_id, instance_type in nodes:
+        heap = heaps.setdefault(instance_type, [])
+        for slot in range(slots):
+            heap.append((0.0, node_id, slot))
+    for heap in heaps.values():
+        heapq.heapify(heap)
+    instance_types = sorted(heaps.keys())
+
+    order = sorted(range(len(tasks)), key=lambda index: -cost_model.predict(kind, REFERENCE_INSTANCE_TYPE, *tasks[index]))
+    assignments = [None] * len(tasks)
+    finish_times = dict([(node_id, 0.0) for node_id, _ in nodes])
+    for index in order:
+        size, frequency = tasks[index]
+        eligible = [instance_type for instance_type in instance_types if can_run is None or can_run(index, instance_type)]
+        if len(eligible) == 0:
+            LOG.warning('No node can run {0} task {1}, using any node'.format(kind, index))
+            eligible = instance_types
+
+        best = None
+        for instance_type in eligible:
+            start, node_id, slot = heaps[instance_type][0]
+            finish = start + cost_model.predict(kind, instance_type, size, frequency)
+            if best is None or (finish, node_id) < (best[0], best[2]):
+                best = (finish, instance_type, node_id, slot, start)
+
+        finish, instance_type, node_id, slot, start = best
+        heapq.heapreplace(heaps[instance_type], (finish, node_id, slot))
+        assignments[index] = Assignment(node_id, slot, start, finish)
+        finish_times[node_id] = max(finish_times[node_id], finish)
+
+    return Schedule(kind, assignments, finish_times)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser('Fit the cost model from recorded timings')
+    parser.add_argument('timings', nargs='?', default=TIMINGS_FILE, help='the CSV file of timings')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    cost_model = CostModel().fit(load_timings(arguments.timings))
+    for kind in sorted(DEFAULT_COEFFICIENTS.keys()):
+        LOG.info('{0}: {1}'.format(kind, cost_model.coefficients(kind)))
+    for instance_type in get_instance_type_names():
+        LOG.info('{0}: {1}'.format(instance_type, ', '.join(['{0} {1:.2f}'.format(kind, cost_model.speed(instance_type, kind)) for kind in sorted(DEFAULT_COEFFICIENTS.keys())])))
+
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,23 @@ CONTAINER_SV = 'jtmalarecki/sv:latest'
 SIZE_1GB = 1073741824
 QUEUE = 'startup_complete'
 DIM_PORT = 8001
+# The most streams a graph runs on a node, used to size the connection pools
+PARALLEL_STREAMS = 12
+# The S3 transfers a node runs at once and their total bytes per second, 0 for no limit.
+# The settings file gives the bandwidth in MB/s
+S3_MAX_TRANSFERS = 8
+S3_BANDWIDTH = 0
+# The optional node local cache of S3 inputs and its size cap, in GB in the settings file
+CACHE_DIRECTORY = None
+CACHE_SIZE = 200 * SIZE_1GB
+# The compression codec for the tar files each stage publishes, from the [codecs] section
+CODECS = {}
+# Start downloading a node's next day once this fraction of the current day's splits are done, 0 to wait for the listobs
+PREFETCH_FRACTION = 0.0
+# The task timings recorded by earlier runs that the scheduler's cost model is fitted from
+TIMINGS_FILE = expanduser('~/.aws-chiles02/timings.csv')
+# Instance types to add to the catalog or override
+INSTANCE_CATALOG_FILE = expanduser('~/.aws-chiles02/instances.csv')
 
 AWS_KEY = expanduser('~/.ssh/aws-chiles02-oregon.pem')
 USERNAME = 'ec2-user'
@@ -55,3 +72,12 @@ if exists(config_file_name):
     AWS_DATABASE_ID = config['database_server']
     AWS_REGION = config['region']
     AWS_SUBNETS = config['subnets']
+    PARALLEL_STREAMS = int(config.get('parallel_streams', PARALLEL_STREAMS))
+    S3_MAX_TRANSFERS = int(config.get('s3_max_transfers', S3_MAX_TRANSFERS))
+    S3_BANDWIDTH = int(config.get('s3_bandwidth', S3_BANDWIDTH)) * 1024 * 1024
+    CACHE_DIRECTORY = config.get('cache_directory', CACHE_DIRECTORY)
+    CACHE_SIZE = int(config.get('cache_size', CACHE_SIZE // SIZE_1GB)) * SIZE_1GB
+    CODECS = dict(config.get('codecs', CODECS))
+    PREFETCH_FRACTION = float(config.get('prefetch_fraction', PREFETCH_FRACTION))
+    TIMINGS_FILE = expanduser(config.get('timings_file', TIMINGS_FILE))
+    INSTANCE_CATALOG_FILE = expanduser(config.get('instance_catalog_file', INSTANCE_CATALOG_FILE))
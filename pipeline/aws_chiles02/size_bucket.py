@@ -25,8 +25,7 @@ Retrieve measurement sets from glacier
 import argparse
 import logging
 
-import boto3
-
+from aws_chiles02.bucket_maintenance import BucketMaintenance
 from aws_chiles02.common import bytes2human
 
 LOG = logging.getLogger(__name__)
@@ -46,15 +45,13 @@ def parser_arguments():
 
 
 def retrieve_files(args):
-    session = boto3.Session(profile_name='aws-chiles02')
-    s3 = session.resource('s3')
-
-    bucket = s3.Bucket(args.bucket)
+    maintenance = BucketMaintenance(args.bucket)
     size = 0
-    for key in bucket.objects.all():
-        size += key.size
-        LOG.info('{0}, {1}, {2}, {3}'.format(key.key, bytes2human(key.size), size, bytes2human(size)))
+    for s3_object in sorted(maintenance.list_objects()):
+        size += s3_object.size
+        LOG.info('{0}, {1}, {2}, {3}'.format(s3_object.key, bytes2human(s3_object.size), size, bytes2human(size)))
 
+    maintenance.report.log()
     LOG.info('Size = {0}'.format(bytes2human(size)))
 
 if __name__ == '__main__':
@@ -25,8 +25,7 @@ Retrieve measurement sets from glacier
 import argparse
 import logging
 
-import boto3
-
+from aws_chiles02.bucket_maintenance import BucketMaintenance
 from aws_chiles02.common import bytes2human
 
 LOG = logging.getLogger(__name__)
@@ -39,6 +38,7 @@ logging.getLogger('s3transfer').setLevel(logging.INFO)
 def parser_arguments():
     parser = argparse.ArgumentParser('Size of measurement sets files in bucket')
     parser.add_argument('bucket', help='the s3 bucket')
+    parser.add_argument('-p', '--prefix', default='split_4/', help='the prefix to size')
     parser.add_argument('-v', '--verbosity', action='count', default=0, help='increase output verbosity')
 
     args = parser.parse_args()
@@ -47,21 +47,21 @@ def parser_arguments():
 
 
 def retrieve_files(args):
-    session = boto3.Session(profile_name='aws-chiles02')
-    s3 = session.resource('s3', use_ssl=False)
+    maintenance = BucketMaintenance(args.bucket)
+    objects = sorted(maintenance.list_objects(args.prefix))
+    size = sum([s3_object.size for s3_object in objects])
 
-    bucket = s3.Bucket(args.bucket)
-    size = 0
-    for key in bucket.objects.all():
-        # if  key.key.endswith('_calibrated_deepfield.ms.tar'):
-        if key.key.startswith('split_4/'):
-            obj = s3.Object(key.bucket_name, key.key)
-            storage_class = obj.storage_class
-            restore = obj.restore
-            size += key.size
-            if args.verbosity >= 1:
-                LOG.info('{0}, {1}, {2}, {3}'.format(key.key, storage_class, restore, size))
+    if args.verbosity >= 1:
+        # The listing has the storage class, only the restore status needs a HEAD
+        glacier_keys = [s3_object.key for s3_object in objects if s3_object.storage_class == 'GLACIER']
+        heads = maintenance.head_objects(glacier_keys)
+        running_size = 0
+        for s3_object in objects:
+            running_size += s3_object.size
+            restore = heads[s3_object.key].get('Restore') if s3_object.key in heads else None
+            LOG.info('{0}, {1}, {2}, {3}'.format(s3_object.key, s3_object.storage_class, restore, running_size))
 
+    maintenance.report.log()
     LOG.info('Size = {0}'.format(bytes2human(size)))
 
 if __name__ == '__main__':
@@ -0,0 +1,312 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Provision the spot instances for every instance type at once.
+
+Every batch of every instance type is requested straight away in the cheapest zone under
+the bid, and a single poller follows all the requests, backing off while nothing changes. A
+request that fails, or is still open after the zone timeout, is cancelled and the shortfall
+asked for again in the next cheapest zone. Once every zone has been tried the next larger
+instance type of the family is asked for instead, fewer of them at a higher bid. Anything
+not running by the deadline is cancelled.
+"""
+import datetime
+import logging
+import math
+import time
+from collections import defaultdict
+
+from aws_chiles02.instance_catalog import get_fallback
+
+LOG = logging.getLogger(__name__)
+
+START_SPOTS_STEP = 10
+# Seconds between polls, backing off to the maximum while nothing changes
+POLL_INTERVAL = 5.0
+MAX_POLL_INTERVAL = 60.0
+BACKOFF = 1.5
+# Seconds a request can stay open in a zone before trying elsewhere
+ZONE_TIMEOUT = 180.0
+# Seconds to get all the instances in
+DEADLINE = 600.0
+# The status codes of an open request that won't be fulfilled in that zone
+FAILED_STATUS_CODES = [
+    'bad-parameters',
+    'capacity-not-available',
+    'capacity-oversubscribed',
+    'constraint-not-fulfillable',
+    'price-too-low',
+    'system-error',
+]
+
+
+def get_spot_prices(ec2_client, instance_types, zones):
+    """
+    The (price, zone) of each instance type in the zones, cheapest first, from one call
+    """
+    prices = ec2_client.describe_spot_price_history(
+        StartTime=datetime.datetime.now().isoformat(),
+        InstanceTypes=sorted(instance_types),
+        ProductDescriptions=['Linux/UNIX (Amazon VPC)'],
+    )
+    zone_prices = defaultdict(dict)
+    for spot_price in prices['SpotPriceHistory']:
+        price = float(spot_price['SpotPrice'])
+        zone = spot_price['AvailabilityZone']
+        if zone not in zones or price == 0.0:
+            continue
+        # The newest price comes first
+        zone_prices[spot_price['InstanceType']].setdefault(zone, price)
+
+    return dict([
+        (instance_type, sorted([(price, zone) for zone, price in by_zone.iteritems()])) for instance_type, by_zone in zone_prices.iteritems()
+    ])
+
+
+class SpotBatch(object):
+    """
+    A call to request_spot_instances for some of the instances of an instance type
+    """
+    def __init__(self, target, instance_type, zone, spot_price, units, submitted, tried):
+        """
+        :param target: the instance type that was asked for
+        :param units: how many of the target each instance stands in for
+        :param tried: the (instance type, zone) already tried for these instances
+        """
+        self.target = target
+        self.instance_type = instance_type
+        self.zone = zone
+        self.spot_price = spot_price
+        self.units = units
+        self.submitted = submitted
+        self.tried = tried
+        self.request_ids = []
+
+
+class ProvisioningReport(object):
+    def __init__(self, start):
+        self.start = start
+        self.required = defaultdict(int)
+        self.fulfilled = defaultdict(int)
+        self.time_to_first = {}
+        self.time_to_capacity = {}
+        self.instance_ids = []
+        self.instance_types = defaultdict(int)
+        # The units of each target no zone or fallback could be bid for
+        self.priced_out = defaultdict(int)
+        self.requests = 0
+        self.fallbacks = 0
+
+    def add_instance(self, batch, instance_id, now):
+        self.instance_ids.append(instance_id)
+        self.instance_types[batch.instance_type] += 1
+        self.fulfilled[batch.target] += batch.units
+        self.time_to_first.setdefault(batch.target, now - self.start)
+        if self.fulfilled[batch.target] >= self.required[batch.target]:
+            self.time_to_capacity.setdefault(batch.target, now - self.start)
+
+    @property
+    def complete(self):
+        return all([self.fulfilled[target] >= required for target, required in self.required.iteritems()])
+
+    def log(self):
+        for target in sorted(self.required.keys()):
+            LOG.info('{0}: {1} of {2} running, first after {3}, all after {4}'.format(
+                target,
+                self.fulfilled[target],
+                self.required[target],
+                '{0:.0f}s'.format(self.time_to_first[target]) if target in self.time_to_first else '-',
+                '{0:.0f}s'.format(self.time_to_capacity[target]) if target in self.time_to_capacity else '-'))
+        LOG.info('{0} instances ({1}) from {2} requests, {3} fallbacks'.format(
+            len(self.instance_ids),
+            ', '.join(['{0} {1}'.format(count, instance_type) for instance_type, count in sorted(self.instance_types.iteritems())]),
+            self.requests,
+            self.fallbacks))
+
+
+class SpotProvisioner(object):
+    def __init__(self, ec2_client, launch_specification, zones, deadline=DEADLINE, zone_timeout=ZONE_TIMEOUT, start_spots_step=START_SPOTS_STEP, clock=time.time, sleep=time.sleep):
+        """
+        :param launch_specification: a function of (zone, instance type) giving the LaunchSpecification
+        :param zones: the availability zones we have subnets in
+        """
+        self._ec2_client = ec2_client
+        self._launch_specification = launch_specification
+        self._zones = set(zones)
+        self._deadline = deadline
+        self._zone_timeout = zone_timeout
+        self._start_spots_step = start_spots_step
+        self._clock = clock
+        self._sleep = sleep
+        self._prices = {}
+        self._batches = {}
+        self._open = set()
+        self._cancelled = set()
+        self._report = None
+
+    def _get_zone_prices(self, instance_types):
+        self._prices = get_spot_prices(self._ec2_client, instance_types, self._zones)
+        for instance_type, prices in self._prices.iteritems():
+            LOG.info('Spot prices for {0}: {1}'.format(
+                instance_type,
+                ', '.join(['{0} {1}'.format(zone, price) for price, zone in prices])))
+
+    def _submit(self, target, instance_type, units_needed, spot_price, units=1, tried=None):
+        """
+        Ask for enough instances to make up the units in the cheapest zone not yet tried
+        """
+        tried = set() if tried is None else tried
+        zones = [zone for price, zone in self._prices.get(instance_type, []) if price <= spot_price and (instance_type, zone) not in tried]
+        if len(zones) == 0:
+            fallback = get_fallback(instance_type)
+            if fallback is None:
+                LOG.warning('No zone has {0} under {1}, {2} {3} short'.format(instance_type, spot_price, units_needed, target))
+                self._report.priced_out[target] += units_needed
+                return
+            fallback_type, factor = fallback
+            LOG.info('Falling back from {0} to {1}'.format(instance_type, fallback_type))
+            self._report.fallbacks += 1
+            self._submit(target, fallback_type, units_needed, spot_price * factor, units * factor, tried)
+            return
+
+        zone = zones[0]
+        total = int(math.ceil(float(units_needed) / units))
+        valid_until = datetime.datetime.utcnow() + datetime.timedelta(seconds=self._deadline)
+        for start in range(0, total, self._start_spots_step):
+            number_instances = min(self._start_spots_step, total - start)
+            try:
+                spot_request = self._ec2_client.request_spot_instances(
+                    SpotPrice=str(spot_price),
+                    InstanceCount=number_instances,
+                    ValidUntil=valid_until.isoformat(),
+                    LaunchSpecification=self._launch_specification(zone, instance_type)
+                )
+            except Exception:
+                LOG.exception('Requesting {0} {1} in {2}'.format(number_instances, instance_type, zone))
+                self._submit(target, instance_type, (total - start) * units, spot_price, units, tried | set([(instance_type, zone)]))
+                return
+
+            self._report.requests += 1
+            batch = SpotBatch(target, instance_type, zone, spot_price, units, self._clock(), tried | set([(instance_type, zone)]))
+            for request in spot_request['SpotInstanceRequests']:
+                batch.request_ids.append(request['SpotInstanceRequestId'])
+                self._batches[request['SpotInstanceRequestId']] = batch
+                self._open.add(request['SpotInstanceRequestId'])
+            LOG.info('Requested {0} {1} in {2} at {3}'.format(number_instances, instance_type, zone, spot_price))
+
+    def _poll(self, resubmit=True):
+        """
+        Check every request that is still open or being cancelled in one call
+
+        :return: True if any request changed state
+        """
+        request_ids = sorted(self._open | self._cancelled)
+        try:
+            requests = self._ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=request_ids)
+        except Exception:
+            # The new requests may not be visible yet, or we are being throttled
+            LOG.exception('Describing {0} spot requests'.format(len(request_ids)))
+            return False
+
+        now = self._clock()
+        changed = False
+        to_cancel = []
+        shortfalls = defaultdict(int)
+        for request_status in requests['SpotInstanceRequests']:
+            request_id = request_status['SpotInstanceRequestId']
+            batch = self._batches[request_id]
+            state = request_status['State']
+            code = request_status['Status']['Code']
+            instance_id = request_status.get('InstanceId')
+            if instance_id is not None and (state == 'active' or code == 'request-canceled-and-instance-running'):
+                LOG.info('{0}: {1} {2} in {3}'.format(request_id, instance_id, batch.instance_type, batch.zone))
+                if request_id in self._cancelled:
+                    LOG.warning('{0} started as it was cancelled, keeping it'.format(instance_id))
+                self._report.add_instance(batch, instance_id, now)
+                self._open.discard(request_id)
+                self._cancelled.discard(request_id)
+                changed = True
+            elif request_id in self._cancelled:
+                if state in ['cancelled', 'closed', 'failed']:
+                    self._cancelled.discard(request_id)
+            elif state in ['cancelled', 'closed', 'failed']:
+                LOG.warning('Request {0} {1}: {2}'.format(request_id, state, code))
+                self._open.discard(request_id)
+                shortfalls[batch] += batch.units
+                changed = True
+            elif code in FAILED_STATUS_CODES or now - batch.submitted > self._zone_timeout:
+                LOG.warning('Request {0} still open in {1}: {2}'.format(request_id, batch.zone, code))
+                self._open.discard(request_id)
+                self._cancelled.add(request_id)
+                to_cancel.append(request_id)
+                shortfalls[batch] += batch.units
+                changed = True
+
+        if len(to_cancel) > 0:
+            self._cancel(to_cancel)
+        if resubmit:
+            for batch, units_needed in shortfalls.iteritems():
+                self._submit(batch.target, batch.instance_type, units_needed, batch.spot_price, batch.units, batch.tried)
+        return changed
+
+    def _cancel(self, request_ids):
+        try:
+            self._ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=request_ids)
+        except Exception:
+            LOG.exception('Cancelling {0} spot requests'.format(len(request_ids)))
+
+    def provision(self, instances_required):
+        """
+        :param instances_required: a list of dicts of instance_type, number_instances and spot_price
+        :return: a ProvisioningReport
+        """
+        self._report = ProvisioningReport(self._clock())
+        instance_types = set()
+        for instance_required in instances_required:
+            instance_type = instance_required['instance_type']
+            while instance_type is not None:
+                instance_types.add(instance_type)
+                instance_type = (get_fallback(instance_type) or (None, 0))[0]
+        self._get_zone_prices(instance_types)
+
+        for instance_required in instances_required:
+            instance_type = instance_required['instance_type']
+            self._report.required[instance_type] += instance_required['number_instances']
+            self._submit(instance_type, instance_type, instance_required['number_instances'], float(instance_required['spot_price']))
+
+        interval = POLL_INTERVAL
+        while self._open and self._clock() - self._report.start < self._deadline:
+            self._sleep(interval)
+            interval = POLL_INTERVAL if self._poll() else min(MAX_POLL_INTERVAL, interval * BACKOFF)
+
+        if self._open:
+            LOG.warning('Cancelling {0} requests still open at the deadline'.format(len(self._open)))
+            request_ids = sorted(self._open)
+            self._cancel(request_ids)
+            self._cancelled.update(request_ids)
+            self._open.clear()
+        if self._cancelled:
+            # Pick up any instance that started as its request was cancelled
+            self._poll(resubmit=False)
+
+        self._report.log()
+        return self._report
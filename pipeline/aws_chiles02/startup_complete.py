@@ -21,15 +21,22 @@
 #
 """
 Startup is complete so put a message on the queue
+
+The message says what the instance has to work with: its cores, memory and disk, and
+how long each phase of the start up script took.
 """
 import json
 import logging
 import argparse
+import multiprocessing
+import os
+import time
 import urllib2
 
 import boto3
 
 LOG = logging.getLogger(__name__)
+METADATA_URL = 'http://169.254.169.254/latest/meta-data/'
 
 
 def parser_arguments():
@@ -37,25 +44,92 @@ def parser_arguments():
     parser.add_argument('queue', help='the queue')
     parser.add_argument('region', help='the region')
     parser.add_argument('uuid', help='the uuid')
+    parser.add_argument('--disk', default='/mnt/dfms', help='the scratch disk to report the size of')
+    parser.add_argument('--url', help='post the message to this url rather than the queue')
+    parser.add_argument('--boot-phases', help='the file the start up script timed its phases in')
 
     args = parser.parse_args()
     return args
 
 
+def get_memory():
+    """
+    The bytes of memory from /proc/meminfo
+    """
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def get_disk(path):
+    """
+    The total and free bytes of the disk, or None if it isn't there
+    """
+    if not os.path.exists(path):
+        return None, None
+    stat = os.statvfs(path)
+    return stat.f_blocks * stat.f_frsize, stat.f_bavail * stat.f_frsize
+
+
+def get_booted():
+    """
+    When the instance booted from /proc/uptime
+    """
+    with open('/proc/uptime') as uptime:
+        return time.time() - float(uptime.read().split()[0])
+
+
+def read_boot_phases(path, booted):
+    """
+    Read the phases the start up script timed as [name, start, end] in seconds since the
+    instance booted. The time before the first phase is cloud-init getting to the script.
+
+    >>> from StringIO import StringIO
+    >>> read_boot_phases(StringIO('yum_update 1000.5 1060.5\\nsetup_disks 1060.5 1200.0\\n'), 990.0)
+    [['cloud_init', 0.0, 10.5], ['yum_update', 10.5, 70.5], ['setup_disks', 70.5, 210.0]]
+    """
+    phases = []
+    for line in path:
+        elements = line.split()
+        if len(elements) == 3:
+            phases.append([elements[0], float(elements[1]) - booted, float(elements[2]) - booted])
+    if len(phases) > 0:
+        phases.insert(0, ['cloud_init', 0.0, min([phase[1] for phase in phases])])
+    return phases
+
+
+def build_message(uuid, disk, boot_phases=None):
+    disk_total, disk_free = get_disk(disk)
+    booted = get_booted()
+    phases = []
+    if boot_phases is not None and os.path.exists(boot_phases):
+        with open(boot_phases) as boot_phases_file:
+            phases = read_boot_phases(boot_phases_file, booted)
+    return {
+        'ip_address': urllib2.urlopen(METADATA_URL + 'public-ipv4').read(),
+        'uuid': uuid,
+        'instance_type': urllib2.urlopen(METADATA_URL + 'instance-type').read(),
+        'cores': multiprocessing.cpu_count(),
+        'memory': get_memory(),
+        'disk_total': disk_total,
+        'disk_free': disk_free,
+        'booted': booted,
+        'ready': time.time() - booted,
+        'boot_phases': phases,
+    }
+
+
 def build_file(args):
+    json_message = json.dumps(build_message(args.uuid, args.disk, args.boot_phases), indent=2)
+    if args.url is not None:
+        urllib2.urlopen(args.url, json_message).read()
+        return
+
     session = boto3.Session(profile_name='aws-chiles02')
     sqs = session.resource('sqs', region_name=args.region)
     queue = sqs.get_queue_by_name(QueueName=args.queue)
-
-    # Load the public IP address
-    ip_address = urllib2.urlopen('http://169.254.169.254/latest/meta-data/public-ipv4').read()
-    instance_type = urllib2.urlopen('http://169.254.169.254/latest/meta-data/instance-type').read()
-    message = {
-        'ip_address': ip_address,
-        'uuid': args.uuid,
-        'instance_type': instance_type,
-    }
-    json_message = json.dumps(message, indent=2)
     queue.send_message(
         MessageBody=json_message,
     )
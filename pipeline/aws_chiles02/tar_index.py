@@ -0,0 +1,393 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+An index of the members of a tar file held in S3.
+
+The upload apps write a small key.tar.idx sidecar next to each tar file giving the name,
+offset, size and MD5 of every file in it. With the index a tar file can be checked, or a
+single table read with a ranged GET, without fetching the gigabytes around it. Tar files
+uploaded before the index existed are indexed by walking their headers with ranged GETs.
+
+Run as a script to check the measurement sets in a set of tar files.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tarfile
+import zlib
+from collections import namedtuple
+
+from botocore.exceptions import ClientError
+
+from aws_chiles02.aws_registry import get_s3_client
+from aws_chiles02.check_measurement_set import EXT_TO_24, EXT_TO_26, find_missing_tables
+from aws_chiles02.common import set_logging_level
+
+LOG = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+IndexEntry = namedtuple('IndexEntry', ['name', 'offset', 'size', 'md5'])
+
+
+class TarIndexException(Exception):
+    """
+    The tar file can't be indexed or read through its index
+    """
+    pass
+
+
+def get_index_key(key):
+    return key + INDEX_SUFFIX
+
+
+def get_padded_size(size):
+    """
+    The number of bytes a member's data takes up in the tar file
+
+    >>> get_padded_size(0)
+    0
+    >>> get_padded_size(1)
+    512
+    >>> get_padded_size(1024)
+    1024
+    """
+    return (size + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+
+
+def normalise_name(name):
+    """
+    >>> normalise_name('./vis_1020~1024/table.f1')
+    'vis_1020~1024/table.f1'
+    """
+    return os.path.normpath(name).lstrip('/')
+
+
+class TarIndex(object):
+    """
+    The regular files in a tar file. The offsets are into the uncompressed tar file, so
+    members can only be read with a ranged GET if the tar file wasn't compressed.
+    """
+    def __init__(self, entries=None, codec=None, etag=None):
+        self.entries = list(entries or [])
+        self.codec = codec
+        self.etag = etag
+        self._by_name = dict([(entry.name, entry) for entry in self.entries])
+
+    @property
+    def ranged(self):
+        return self.codec is None
+
+    @property
+    def names(self):
+        return [entry.name for entry in self.entries]
+
+    def add(self, name, offset, size, md5):
+        entry = IndexEntry(normalise_name(name), offset, size, md5)
+        self.entries.append(entry)
+        self._by_name[entry.name] = entry
+
+    def get(self, name):
+        return self._by_name.get(normalise_name(name))
+
+    def get_measurement_sets(self):
+        """
+        The top level directories, which for the split, uvsub and clean tar files are the measurement sets
+        """
+        return sorted(set([entry.name.split('/')[0] for entry in self.entries if '/' in entry.name]))
+
+    def check_tables(self, measurement_set, extension_list):
+        """
+        The same check as CheckMeasurementSet on a measurement set inside the tar file
+
+        :return: None if all the tables are there, otherwise an error message
+        """
+        measurement_set = normalise_name(measurement_set)
+        filenames = [
+            os.path.basename(entry.name) for entry in self.entries if os.path.dirname(entry.name) == measurement_set
+        ]
+        if len(filenames) == 0:
+            return 'Measurement Set: {0} is not in the tar file'.format(measurement_set)
+        return find_missing_tables(filenames, extension_list)
+
+    def check_tables_to_24(self, measurement_set):
+        return self.check_tables(measurement_set, EXT_TO_24)
+
+    def check_tables_to_26(self, measurement_set):
+        return self.check_tables(measurement_set, EXT_TO_26)
+
+    def to_string(self):
+        return zlib.compress(json.dumps(
+            {
+                'version': INDEX_VERSION,
+                'codec': self.codec,
+                'etag': self.etag,
+                'members': [list(entry) for entry in self.entries],
+            },
+            separators=(',', ':')
+        ))
+
+    @classmethod
+    def from_string(cls, data):
+        try:
+            index = json.loads(zlib.decompress(data))
+        except (zlib.error, ValueError) as exception:
+            raise TarIndexException('The index is corrupt: {0}'.format(exception))
+        if index.get('version') != INDEX_VERSION:
+            raise TarIndexException('Unknown index version {0}'.format(index.get('version')))
+        return TarIndex(
+            [IndexEntry(*member) for member in index['members']],
+            codec=index.get('codec'),
+            etag=index.get('etag'),
+        )
+
+
+class _HashingReader(object):
+    def __init__(self, fileobj, hasher):
+        self._fileobj = fileobj
+        self._hasher = hasher
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._hasher.update(data)
+        return data
+
+
+class IndexingTarFile(tarfile.TarFile):
+    """
+    A TarFile being written that records where the data of each file lands in the tar file
+    """
+    def __init__(self, *args, **kwargs):
+        self.index = TarIndex()
+        super(IndexingTarFile, self).__init__(*args, **kwargs)
+
+    def addfile(self, tarinfo, fileobj=None):
+        hasher = hashlib.md5()
+        if fileobj is not None:
+            fileobj = _HashingReader(fileobj, hasher)
+        super(IndexingTarFile, self).addfile(tarinfo, fileobj)
+        if tarinfo.isreg():
+            # The data is the last thing written, padded to a whole block
+            self.index.add(tarinfo.name, self.offset - get_padded_size(tarinfo.size), tarinfo.size, hasher.hexdigest())
+
+
+def build_index_from_file(filename):
+    """
+    Index a tar file on the local disk, such as one built by tar -cvf
+    """
+    index = TarIndex()
+    tar = tarfile.open(filename, 'r:')
+    try:
+        for member in tar:
+            if member.isreg():
+                hasher = hashlib.md5()
+                member_file = tar.extractfile(member)
+                for chunk in iter(lambda: member_file.read(1048576), ''):
+                    hasher.update(chunk)
+                index.add(member.name, member.offset_data, member.size, hasher.hexdigest())
+    finally:
+        tar.close()
+    return index
+
+
+def put_index(s3_client, bucket_name, key, index, storage_class=None):
+    arguments = {
+        'Bucket': bucket_name,
+        'Key': get_index_key(key),
+        'Body': index.to_string(),
+    }
+    if storage_class is not None:
+        arguments['StorageClass'] = storage_class
+    s3_client.put_object(**arguments)
+
+
+def put_index_for_file(s3_client, bucket_name, key, filename, storage_class=None):
+    """
+    Write the index of a tar file that has been uploaded from the local disk.
+    The tar file is usable without it, so a failure is only logged.
+    """
+    try:
+        index = build_index_from_file(filename)
+        index.etag = s3_client.head_object(Bucket=bucket_name, Key=key)['ETag']
+        put_index(s3_client, bucket_name, key, index, storage_class)
+    except Exception:
+        LOG.exception('Writing the index of {0}'.format(key))
+
+
+def get_index(s3_client, bucket_name, key, etag=None):
+    """
+    Get the sidecar index of a tar file
+
+    :param etag: the ETag of the tar file, an index written for a different version is ignored
+    :return: the TarIndex or None if there isn't a usable one
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=get_index_key(key))
+    except ClientError as exception:
+        if exception.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+
+    index = TarIndex.from_string(response['Body'].read())
+    if etag is not None and index.etag is not None and index.etag != etag:
+        LOG.warning('The index of {0} is for {1} not {2}, ignoring it'.format(key, index.etag, etag))
+        return None
+    return index
+
+
+def _get_range(s3_client, bucket_name, key, start, size):
+    response = s3_client.get_object(
+        Bucket=bucket_name,
+        Key=key,
+        Range='bytes={0}-{1}'.format(start, start + size - 1),
+    )
+    data = response['Body'].read()
+    if len(data) != size:
+        raise TarIndexException('Expected {0} bytes from {1} at {2} but got {3}'.format(size, key, start, len(data)))
+    return data
+
+
+def scan_index(s3_client, bucket_name, key, size):
+    """
+    Index an uncompressed tar file in S3 by reading just its headers, one ranged GET per member
+    """
+    index = TarIndex()
+    offset = 0
+    long_name = None
+    while offset + BLOCK_SIZE <= size:
+        header = _get_range(s3_client, bucket_name, key, offset, BLOCK_SIZE)
+        if header == tarfile.NUL * BLOCK_SIZE:
+            break
+
+        try:
+            tarinfo = tarfile.TarInfo.frombuf(header)
+        except tarfile.HeaderError as exception:
+            raise TarIndexException('Bad header in {0} at {1}: {2}'.format(key, offset, exception))
+
+        data_offset = offset + BLOCK_SIZE
+        if tarinfo.type == tarfile.GNUTYPE_LONGNAME:
+            long_name = tarfile.nts(_get_range(s3_client, bucket_name, key, data_offset, tarinfo.size))
+        elif tarinfo.type in (tarfile.XHDTYPE, tarfile.XGLTYPE):
+            raise TarIndexException('{0} has pax headers which cannot be scanned'.format(key))
+        elif tarinfo.type != tarfile.GNUTYPE_LONGLINK:
+            if tarinfo.isreg():
+                index.add(long_name or tarinfo.name, data_offset, tarinfo.size, None)
+            long_name = None
+
+        offset = data_offset + get_padded_size(tarinfo.size)
+
+    return index
+
+
+class S3TarReader(object):
+    """
+    List, check and read the members of a tar file in S3 without downloading it
+    """
+    def __init__(self, s3_client, bucket_name, key):
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self._key = key
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            head = self._s3_client.head_object(Bucket=self._bucket_name, Key=self._key)
+            index = get_index(self._s3_client, self._bucket_name, self._key, head['ETag'])
+            if index is None:
+                if 'codec' in head.get('Metadata', {}):
+                    raise TarIndexException('{0} is compressed and has no index'.format(self._key))
+                LOG.info('No index for {0}, scanning the headers'.format(self._key))
+                index = scan_index(self._s3_client, self._bucket_name, self._key, head['ContentLength'])
+            self._index = index
+        return self._index
+
+    def list_members(self):
+        return self.index.names
+
+    def check_tables(self, measurement_set, extension_list):
+        return self.index.check_tables(measurement_set, extension_list)
+
+    def read_member(self, name):
+        """
+        Read one file with a ranged GET, checking it against the MD5 in the index
+        """
+        entry = self.index.get(name)
+        if entry is None:
+            raise TarIndexException('{0} is not in {1}'.format(name, self._key))
+        if not self.index.ranged:
+            raise TarIndexException('{0} is compressed with {1} so members cannot be read directly'.format(self._key, self.index.codec))
+        if entry.size == 0:
+            return ''
+
+        data = _get_range(self._s3_client, self._bucket_name, self._key, entry.offset, entry.size)
+        if entry.md5 is not None and hashlib.md5(data).hexdigest() != entry.md5:
+            raise TarIndexException('{0} in {1} does not match its MD5'.format(name, self._key))
+        return data
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser('Check the measurement sets in tar files without downloading them')
+    parser.add_argument('bucket', help='the bucket to access')
+    parser.add_argument('prefix', help='the prefix of the tar files, for example split_4')
+    parser.add_argument('--tables', type=int, choices=[24, 26], default=24, help='the tables a measurement set should have')
+    parser.add_argument('-v', '--verbosity', action='count', default=0, help='increase output verbosity')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    set_logging_level(arguments.verbosity)
+    s3_client = get_s3_client()
+    extension_list = EXT_TO_24 if arguments.tables == 24 else EXT_TO_26
+
+    bad = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=arguments.bucket, Prefix=arguments.prefix):
+        for s3_object in page.get('Contents', []):
+            key = s3_object['Key']
+            if not key.endswith('.tar'):
+                continue
+
+            try:
+                index = S3TarReader(s3_client, arguments.bucket, key).index
+                measurement_sets = index.get_measurement_sets()
+                errors = [index.check_tables(measurement_set, extension_list) for measurement_set in measurement_sets]
+                errors = [error for error in errors if error is not None]
+                if len(measurement_sets) == 0:
+                    errors.append('No measurement sets')
+            except TarIndexException as exception:
+                errors = [str(exception)]
+
+            if len(errors) > 0:
+                LOG.error('{0}: {1}'.format(key, ', '.join(errors)))
+                bad.append(key)
+
+    LOG.info('{0} bad tar files\n{1}'.format(len(bad), '\n'.join(bad)))
+
+
+if __name__ == "__main__":
+    main()
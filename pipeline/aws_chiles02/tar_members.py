@@ -0,0 +1,121 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Choose which members of a tar file are extracted.
+
+Most stages only need part of the tar they read, the concatenation only needs the
+images from a clean. Members that aren't wanted are read past in the stream and never
+written to the disk.
+"""
+import fnmatch
+import logging
+import os
+
+from aws_chiles02.common import bytes2human
+
+LOG = logging.getLogger(__name__)
+
+
+class MemberFilter(object):
+    """
+    Include and exclude members with shell patterns.
+
+    A pattern matches a member if it matches the name or any of its parent directories,
+    so '*.flux' excludes everything in a clean_1020~1024.flux table. With no include
+    patterns everything not excluded is extracted.
+
+    >>> member_filter = MemberFilter(exclude=['*.flux', '*.psf'])
+    >>> member_filter.accepts('clean_1020~1024.flux/table.f1')
+    False
+    >>> member_filter.accepts('clean_1020~1024.image/table.f1')
+    True
+    >>> MemberFilter(include=['*.image']).accepts('clean_1020~1024.psf')
+    False
+    """
+    def __init__(self, include=None, exclude=None):
+        self._include = list(include or [])
+        self._exclude = list(exclude or [])
+        self.members_written = 0
+        self.members_skipped = 0
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+
+    @property
+    def active(self):
+        return len(self._include) > 0 or len(self._exclude) > 0
+
+    def accepts(self, name):
+        names = _get_names(name)
+        if len(self._include) > 0 and not _matches(names, self._include):
+            return False
+        return not _matches(names, self._exclude)
+
+    def extract(self, tar, directory):
+        """
+        Extract the accepted members of a tar opened for streaming
+        """
+        for member in tar:
+            if self.accepts(member.name):
+                tar.extract(member, directory)
+                self.members_written += 1
+                self.bytes_written += member.size
+            else:
+                self.members_skipped += 1
+                self.bytes_skipped += member.size
+
+    def log_statistics(self, key):
+        if self.members_written + self.members_skipped == 0:
+            # The tar file was extracted by tar
+            return
+        LOG.info('{0}: wrote {1} members, {2}, skipped {3} members, {4}'.format(
+            key,
+            self.members_written,
+            bytes2human(self.bytes_written),
+            self.members_skipped,
+            bytes2human(self.bytes_skipped)))
+
+
+def _get_names(name):
+    names = []
+    name = os.path.normpath(name)
+    while name not in ('', '.', os.sep):
+        names.append(name)
+        name = os.path.dirname(name)
+    return names
+
+
+def _matches(names, patterns):
+    for name in names:
+        for pattern in patterns:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+    return False
+
+
+def extract_members(tar, directory, member_filter=None):
+    """
+    Extract a tar opened for streaming, all of it if there is no filter
+    """
+    if member_filter is None:
+        tar.extractall(directory)
+    else:
+        member_filter.extract(tar, directory)
@@ -31,6 +31,7 @@ from os.path import dirname, join
 
 from mako.lookup import TemplateLookup
 
+from aws_chiles02.instance_catalog import get_instance_type, get_instance_type_names
 from aws_chiles02.settings_file import QUEUE, AWS_REGION
 
 LOG = logging.getLogger(__name__)
@@ -47,7 +48,7 @@ def get_user_data(cloud_init_data):
     return encoded_data
 
 
-def get_node_manager_user_data(boto_data, uuid, max_request_size=10, chiles=True, jpeg2000=False, log_level='vvv'):
+def get_node_manager_user_data(boto_data, uuid, max_request_size=10, chiles=True, jpeg2000=False, log_level='vvv', queue=QUEUE):
     here = dirname(__file__)
     user_data = join(here, '../user_data')
     mako_lookup = TemplateLookup(directories=[user_data])
@@ -62,19 +63,23 @@ def get_node_manager_user_data(boto_data, uuid, max_request_size=10, chiles=True
     template = mako_lookup.get_template('node_manager_start_up.bash')
     user_script = template.render(
         uuid=uuid,
-        queue=QUEUE,
+        queue=queue,
         region=AWS_REGION,
         max_request_size=max_request_size,
         chiles=chiles,
         jpeg2000=jpeg2000,
-        log_level=log_level
+        log_level=log_level,
+        instance_types=[get_instance_type(name) for name in get_instance_type_names()],
     )
 
     user_data = get_user_data([cloud_init, user_script])
     return user_data
 
 
-def get_data_island_manager_user_data(boto_data, hosts, uuid, need_node_manager=False, max_request_size=10, log_level='vvv'):
+def get_data_island_manager_user_data(boto_data, hosts, uuid, need_node_manager=False, max_request_size=10, log_level='vvv', hosts_bucket=None, hosts_key=None, queue=QUEUE):
+    """
+    If hosts is None the island manager waits for them to be written to hosts_key in hosts_bucket
+    """
     here = dirname(__file__)
     user_data = join(here, '../user_data')
     mako_lookup = TemplateLookup(directories=[user_data])
@@ -89,8 +94,10 @@ def get_data_island_manager_user_data(boto_data, hosts, uuid, need_node_manager=
     template = mako_lookup.get_template('island_manager_start_up.bash')
     user_script = template.render(
         hosts=hosts,
+        hosts_bucket=hosts_bucket,
+        hosts_key=hosts_key,
         uuid=uuid,
-        queue=QUEUE,
+        queue=queue,
         region=AWS_REGION,
         max_request_size=max_request_size,
         need_node_manager=need_node_manager,
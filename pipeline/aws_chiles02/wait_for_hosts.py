@@ -0,0 +1,70 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Wait for the hosts of the node managers to be written to S3 and print them
+
+The island manager is started alongside the node managers, so it does not know where
+they are until they have all reported in.
+"""
+import argparse
+import logging
+import sys
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+LOG = logging.getLogger(__name__)
+
+
+def parser_arguments():
+    parser = argparse.ArgumentParser('Wait for the hosts of the node managers')
+    parser.add_argument('bucket', help='the bucket')
+    parser.add_argument('key', help='the key the hosts are written to')
+    parser.add_argument('--wait', type=int, default=3600, help='the seconds to wait')
+    parser.add_argument('--poll', type=int, default=10, help='the seconds between checks')
+
+    args = parser.parse_args()
+    return args
+
+
+def wait_for_hosts(args):
+    session = boto3.Session(profile_name='aws-chiles02')
+    s3 = session.client('s3')
+    stop_time = time.time() + args.wait
+    while time.time() <= stop_time:
+        try:
+            return s3.get_object(Bucket=args.bucket, Key=args.key)['Body'].read().strip()
+        except ClientError as exception:
+            if exception.response['Error']['Code'] not in ['NoSuchKey', '404']:
+                raise
+        time.sleep(args.poll)
+    return None
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    arguments = parser_arguments()
+    hosts = wait_for_hosts(arguments)
+    if hosts is None:
+        LOG.error('No hosts after {0} seconds'.format(arguments.wait))
+        sys.exit(1)
+    print(hosts)
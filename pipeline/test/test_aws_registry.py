@@ -0,0 +1,99 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the boto3 registry
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from aws_chiles02 import aws_registry
+
+
+class TestAwsRegistry(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        credentials = os.path.join(self._directory, 'credentials')
+        with open(credentials, 'w') as credentials_file:
+            credentials_file.write('[aws-chiles02]\naws_access_key_id = KEY\naws_secret_access_key = SECRET\nregion = us-west-2\n')
+        self._old_environment = os.environ.get('AWS_SHARED_CREDENTIALS_FILE')
+        os.environ['AWS_SHARED_CREDENTIALS_FILE'] = credentials
+        self._reset()
+
+    def tearDown(self):
+        if self._old_environment is None:
+            del os.environ['AWS_SHARED_CREDENTIALS_FILE']
+        else:
+            os.environ['AWS_SHARED_CREDENTIALS_FILE'] = self._old_environment
+        self._reset()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    @staticmethod
+    def _reset():
+        aws_registry._sessions.clear()
+        aws_registry._clients.clear()
+        aws_registry._transfers.clear()
+        aws_registry._queue_urls.clear()
+        aws_registry._parallel_streams = None
+
+    def test_clients_shared(self):
+        clients = []
+
+        def get_client():
+            clients.append(aws_registry.get_s3_client())
+
+        threads = [threading.Thread(target=get_client) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(8, len(clients))
+        self.assertTrue(all(client is clients[0] for client in clients))
+        self.assertIs(aws_registry.get_s3_transfer(), aws_registry.get_s3_transfer())
+        self.assertIsNot(clients[0], aws_registry.get_client('sqs', region='us-west-2'))
+
+    def test_pool_sized_to_streams(self):
+        aws_registry.set_parallel_streams(3)
+        client = aws_registry.get_s3_client()
+        self.assertEqual(3 * aws_registry.TRANSFER_CONCURRENCY + 2, client.meta.config.max_pool_connections)
+
+        aws_registry.set_parallel_streams(5)
+        client2 = aws_registry.get_s3_client()
+        self.assertIsNot(client, client2)
+        self.assertEqual(5 * aws_registry.TRANSFER_CONCURRENCY + 2, client2.meta.config.max_pool_connections)
+
+        # A graph with fewer streams keeps the bigger pools
+        aws_registry.set_parallel_streams(2)
+        self.assertIs(client2, aws_registry.get_s3_client())
+        self.assertEqual(5 * aws_registry.TRANSFER_CONCURRENCY + 2, aws_registry.get_max_pool_connections())
+
+    def test_pool_defaults_to_settings(self):
+        self.assertEqual(
+            aws_registry.PARALLEL_STREAMS * aws_registry.TRANSFER_CONCURRENCY + 2,
+            aws_registry.get_max_pool_connections())
+
+
+if __name__ == '__main__':
+    unittest.main()
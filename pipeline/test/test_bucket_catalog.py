@@ -0,0 +1,128 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the local catalog of the bucket
+"""
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from aws_chiles02.bucket_catalog import BucketCatalog
+
+DAY1 = '13B-266.sb28624226.eb28625769.56669.43262586805'
+DAY2 = '13B-266.sb29386434.eb29452185.56751.30497712963'
+
+
+class FakePaginator(object):
+    def __init__(self, client):
+        self._client = client
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        self._client.listings.append(Prefix)
+        contents = []
+        common_prefixes = set()
+        for key in sorted(self._client.objects.keys()):
+            if not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter is not None and Delimiter in rest:
+                common_prefixes.add(Prefix + rest[:rest.index(Delimiter) + 1])
+            else:
+                contents.append({
+                    'Key': key,
+                    'Size': self._client.objects[key],
+                    'ETag': '"{0}"'.format(self._client.objects[key]),
+                    'LastModified': datetime.datetime(2016, 5, 1),
+                })
+        # Two pages to check they are joined up
+        middle = len(contents) // 2
+        yield {'Contents': contents[:middle], 'CommonPrefixes': [{'Prefix': prefix} for prefix in sorted(common_prefixes)]}
+        yield {'Contents': contents[middle:]}
+
+
+class FakeS3Client(object):
+    def __init__(self, objects):
+        self.objects = objects
+        self.listings = []
+
+    def get_paginator(self, name):
+        return FakePaginator(self)
+
+
+class TestBucketCatalog(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._client = FakeS3Client({
+            'observation_data/{0}_calibrated_deepfield.ms.tar'.format(DAY1): 100,
+            'observation_data/{0}_calibrated_deepfield.ms.tar'.format(DAY2): 200,
+            'split_4/1020_1024/{0}.tar'.format(DAY1): 10,
+            'split_4/1020_1024/{0}.tar.idx'.format(DAY1): 1,
+            'split_4/1024_1028/{0}.tar'.format(DAY1): 10,
+            'split_4/1024_1028/{0}.tar'.format(DAY2): 10,
+            'uvsub_4/1024_1028/{0}.tar'.format(DAY2): 10,
+        })
+        self._catalog = BucketCatalog('bucket', filename=os.path.join(self._directory, 'catalog.db'), s3_client=self._client)
+        self._catalog.refresh(['observation_data', 'split_4', 'uvsub_4'])
+
+    def tearDown(self):
+        self._catalog.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_queries(self):
+        self.assertEqual(
+            [(DAY1 + '_calibrated_deepfield.ms.tar', 100), (DAY2 + '_calibrated_deepfield.ms.tar', 200)],
+            self._catalog.get_observations()
+        )
+        self.assertEqual({DAY1: ['1020_1024', '1024_1028'], DAY2: ['1024_1028']}, dict(
+            [(day, sorted(frequencies)) for day, frequencies in self._catalog.get_frequencies_by_day('split_4').items()]
+        ))
+        self.assertEqual([DAY2], self._catalog.get_days_missing_frequency('split_4', '1020_1024'))
+        self.assertEqual(
+            [('1020_1024', DAY1), ('1024_1028', DAY1)],
+            [tuple(row) for row in self._catalog.get_missing('split_4', 'uvsub_4')]
+        )
+        self.assertEqual({'1024_1028'}, self._catalog.get_frequencies('uvsub_4'))
+        self.assertEqual({'1020_1024': 10, '1024_1028': 20}, self._catalog.get_size_by_frequency('split_4'))
+
+    def test_sub_prefixes_listed(self):
+        self.assertIn('split_4/1020_1024/', self._client.listings)
+        self.assertIn('split_4/1024_1028/', self._client.listings)
+
+    def test_fresh_prefix_not_listed_again(self):
+        self._client.listings = []
+        self._catalog.refresh(['split_4'])
+        self.assertEqual([], self._client.listings)
+
+    def test_incremental_refresh(self):
+        del self._client.objects['split_4/1020_1024/{0}.tar'.format(DAY1)]
+        self._client.objects['split_4/1028_1032/{0}.tar'.format(DAY2)] = 10
+        self._catalog.refresh(['split_4'], force=True)
+        self.assertEqual(
+            {'split_4/1024_1028/{0}.tar'.format(DAY1), 'split_4/1024_1028/{0}.tar'.format(DAY2), 'split_4/1028_1032/{0}.tar'.format(DAY2)},
+            self._catalog.get_keys('split_4')
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the bucket maintenance engine
+"""
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from aws_chiles02 import bucket_catalog
+from aws_chiles02.bucket_catalog import BucketCatalog
+from aws_chiles02.bucket_maintenance import BucketMaintenance, DELETE_BATCH_SIZE
+from aws_chiles02.remove_bad_splits import remove_bad_splits
+
+DAY = '13B-266.sb28624226.eb28625769.56669.43262586805'
+
+
+class FakePaginator(object):
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        if self._name == 'list_multipart_uploads':
+            yield {'Uploads': [upload for upload in self._client.uploads if upload['Key'].startswith(Prefix)]}
+            return
+
+        self._client.listings.append(Prefix)
+        contents = []
+        common_prefixes = set()
+        for key in sorted(self._client.objects.keys()):
+            if not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter is not None and Delimiter in rest:
+                common_prefixes.add(Prefix + rest[:rest.index(Delimiter) + 1])
+            else:
+                size, storage_class = self._client.objects[key]
+                contents.append({
+                    'Key': key,
+                    'Size': size,
+                    'ETag': '"{0}"'.format(size),
+                    'StorageClass': storage_class,
+                    'LastModified': datetime.datetime(2016, 5, 1),
+                })
+        yield {'Contents': contents, 'CommonPrefixes': [{'Prefix': prefix} for prefix in sorted(common_prefixes)]}
+
+
+class FakeS3Client(object):
+    def __init__(self, objects, uploads=None):
+        self.objects = objects
+        self.uploads = uploads or []
+        self.listings = []
+        self.batches = []
+        self.heads = []
+        self.aborted = []
+
+    def get_paginator(self, name):
+        return FakePaginator(self, name)
+
+    def delete_objects(self, Bucket, Delete):
+        keys = [item['Key'] for item in Delete['Objects']]
+        assert len(keys) <= DELETE_BATCH_SIZE
+        self.batches.append(keys)
+        for key in keys:
+            del self.objects[key]
+        return {}
+
+    def head_object(self, Bucket, Key):
+        self.heads.append(Key)
+        return {'ContentLength': self.objects[Key][0], 'Restore': 'ongoing-request="true"'}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+
+
+class TestBucketMaintenance(unittest.TestCase):
+    def setUp(self):
+        objects = {}
+        for frequency in range(940, 1420, 4):
+            key = 'split_4/{0}_{1}/{2}.tar'.format(frequency, frequency + 4, DAY)
+            objects[key] = (10 if frequency % 8 == 0 else 1000, 'STANDARD')
+            objects[key + '.idx'] = (1, 'STANDARD')
+        objects['observation_data/{0}_calibrated_deepfield.ms.tar'.format(DAY)] = (5000, 'GLACIER')
+        self._client = FakeS3Client(objects)
+
+        # Keep the deletes away from any real catalog
+        self._directory = tempfile.mkdtemp()
+        self._catalog_directory = bucket_catalog.CATALOG_DIRECTORY
+        bucket_catalog.CATALOG_DIRECTORY = self._directory
+
+    def tearDown(self):
+        bucket_catalog.CATALOG_DIRECTORY = self._catalog_directory
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_list_in_shards(self):
+        maintenance = BucketMaintenance('bucket', s3_client=self._client)
+        objects = maintenance.list_objects()
+        self.assertEqual(len(self._client.objects), len(objects))
+        self.assertIn('split_4/940_944/', self._client.listings)
+        self.assertEqual(len(self._client.objects), maintenance.report.checked)
+        self.assertEqual((1, 5000), maintenance.report.storage_classes['GLACIER'])
+        self.assertEqual((240, 60 * 10 + 60 * 1000 + 120), maintenance.report.prefixes['split_4'])
+
+    def test_delete_in_batches(self):
+        self._client.objects = dict([('uvsub_4/{0}.tar'.format(count), (1, 'STANDARD')) for count in range(2500)])
+        maintenance = BucketMaintenance('bucket', s3_client=self._client, threads=2)
+        maintenance.delete_objects(maintenance.list_objects())
+        self.assertEqual([500, 1000, 1000], sorted([len(batch) for batch in self._client.batches]))
+        self.assertEqual({}, self._client.objects)
+        self.assertEqual(2500, maintenance.report.deleted)
+
+    def test_remove_bad_splits(self):
+        report = remove_bad_splits('bucket', 4, 100, s3_client=self._client)
+        self.assertEqual(120, report.deleted)
+        self.assertEqual(1, len(self._client.batches))
+        self.assertFalse([key for key in self._client.objects.keys() if key.startswith('split_4/944_948')])
+        self.assertEqual(2, len([key for key in self._client.objects.keys() if key.startswith('split_4/940_944')]))
+        self.assertEqual([], self._client.heads)
+
+    def test_deletes_update_catalog(self):
+        catalog = BucketCatalog('bucket', filename=os.path.join(self._directory, 'catalog.db'), s3_client=self._client)
+        catalog.refresh(['split_4'])
+        self.assertEqual(120, len(catalog.get_keys('split_4')))
+
+        remove_bad_splits('bucket', 4, 100, s3_client=self._client, catalog=catalog)
+        self.assertEqual(60, len(catalog.get_keys('split_4')))
+        self.assertIsNone(catalog.get_size('split_4/944_948/{0}.tar'.format(DAY)))
+        self.assertFalse(catalog.is_fresh('split_4'))
+        catalog.close()
+
+    def test_dry_run(self):
+        count = len(self._client.objects)
+        report = remove_bad_splits('bucket', 4, 100, dry_run=True, s3_client=self._client)
+        self.assertEqual(120, report.deleted)
+        self.assertEqual(count, len(self._client.objects))
+        self.assertEqual([], self._client.batches)
+
+    def test_head_objects(self):
+        maintenance = BucketMaintenance('bucket', s3_client=self._client)
+        keys = sorted(self._client.objects.keys())[:20]
+        heads = maintenance.head_objects(keys)
+        self.assertEqual(sorted(keys), sorted(heads.keys()))
+        self.assertEqual(20, len(self._client.heads))
+
+    def test_abort_multipart_uploads(self):
+        self._client.uploads = [{'Key': 'key{0}'.format(count), 'UploadId': str(count), 'Initiated': count} for count in range(5)]
+        maintenance = BucketMaintenance('bucket', s3_client=self._client, dry_run=True)
+        maintenance.abort_multipart_uploads(maintenance.list_multipart_uploads())
+        self.assertEqual([], self._client.aborted)
+        self.assertEqual(5, maintenance.report.aborted)
+
+        maintenance = BucketMaintenance('bucket', s3_client=self._client)
+        maintenance.abort_multipart_uploads(maintenance.list_multipart_uploads())
+        self.assertEqual(['0', '1', '2', '3', '4'], sorted(self._client.aborted))
+
+
+if __name__ == '__main__':
+    unittest.main()
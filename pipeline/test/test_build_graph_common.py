@@ -0,0 +1,74 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the drop indexes and node binding of the abstract graph builder
+"""
+import unittest
+
+from aws_chiles02.benchmark_build_graph import SyntheticBuildGraph, scan_per_node
+
+
+class TestBuildGraphCommon(unittest.TestCase):
+    def setUp(self):
+        self._graph = SyntheticBuildGraph(days=6, frequencies=4, nodes=3)
+        self._graph.build_graph()
+
+    def test_indexes(self):
+        drop_list = self._graph.drop_list
+        self.assertEqual(len([drop for drop in drop_list if drop['type'] == 'app']), len(self._graph.get_drops_of_type('app')))
+        self.assertEqual(len(drop_list), sum([len(self._graph.get_drops_for_node(node_id)) for node_id in set([drop['node'] for drop in drop_list])]))
+
+    def test_copy_log_files(self):
+        copy_log_drops = [drop for drop in self._graph.drop_list if drop['oid'].startswith('copy_log_files_app')]
+        self.assertEqual(3, len(copy_log_drops))
+        # Each node's copy of the log files waits on its plain and container drops bar its own output
+        self.assertEqual(scan_per_node(self._graph) - 3, sum([len(drop['inputs']) for drop in copy_log_drops]))
+        for drop in copy_log_drops:
+            node_oids = set([node_drop['oid'] for node_drop in self._graph.get_drops_for_node(drop['node'], ['plain', 'container'])])
+            self.assertTrue(set(drop['inputs']) <= node_oids)
+
+    def test_tag_all_app_drops(self):
+        self._graph.tag_all_app_drops({'session_id': 'session'})
+        for drop in self._graph.drop_list:
+            self.assertEqual(drop['type'] == 'app', drop.get('session_id') == 'session')
+
+    def test_roots(self):
+        roots = self._graph.get_roots()
+        self.assertEqual(set(['s3_in__{0:06d}'.format(count) for count in range(1, 7)]), set([root for root in roots if root.startswith('s3_in')]))
+        self.assertFalse([root for root in roots if root.startswith('app_ms_transform')])
+
+    def test_bind_nodes(self):
+        node_details = {'i2.2xlarge': [{'ip_address': '54.0.0.{0}'.format(node)} for node in range(3)]}
+        self.assertTrue(self._graph.bind_nodes(node_details, dim_ip='54.0.1.1'))
+
+        self.assertEqual(set(['54.0.0.0', '54.0.0.1', '54.0.0.2']), set([drop['node'] for drop in self._graph.drop_list]))
+        self.assertEqual(len(self._graph.drop_list), sum([len(self._graph.get_drops_for_node('54.0.0.{0}'.format(node))) for node in range(3)]))
+        log_keys = [drop['key'] for drop in self._graph.drop_list if drop.get('key', '').startswith('session/')]
+        self.assertEqual(['session/54.0.0.0.tar', 'session/54.0.0.1.tar', 'session/54.0.0.2.tar'], sorted(log_keys))
+
+    def test_bind_different_nodes(self):
+        self.assertFalse(self._graph.bind_nodes({'i2.2xlarge': [{'ip_address': '54.0.0.1'}]}))
+        self.assertFalse(self._graph.bind_nodes({'i2.4xlarge': [{'ip_address': '54.0.0.{0}'.format(node)} for node in range(3)]}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test planning the instances for a deadline or a budget
+"""
+import unittest
+
+from aws_chiles02.capacity_planner import CapacityPlanner
+from aws_chiles02.scheduler import CostModel
+from aws_chiles02.settings_file import SIZE_1GB
+
+HOUR = 3600.0
+
+
+class TestCapacityPlanner(unittest.TestCase):
+    def setUp(self):
+        # An hour a task on an i2.2xlarge, half an hour on an i2.4xlarge
+        self._cost_model = CostModel(coefficients={'mstransform': (HOUR, 0.0, 0.0)}, speeds={'i2.2xlarge': 1.0, 'i2.4xlarge': 2.0})
+        self._prices = {'i2.2xlarge': 0.5, 'i2.4xlarge': 1.2}
+        self._tasks = [(100 * SIZE_1GB, None)] * 8
+
+    def _make_planner(self, boot_time=HOUR / 2, **kwargs):
+        return CapacityPlanner('mstransform', self._tasks, self._prices, cost_model=self._cost_model, boot_time=boot_time, max_nodes=8, **kwargs)
+
+    def test_evaluate(self):
+        plan = self._make_planner(boot_time=0.0).evaluate([('i2.2xlarge', 2), ('i2.4xlarge', 1)])
+        # Two tasks an hour on each i2.2xlarge and four on the i2.4xlarge
+        self.assertEqual(2 * HOUR, plan.makespan)
+        self.assertAlmostEqual(2 * 2 * 0.5 + 2 * 1.2, plan.cost)
+
+    def test_deadline(self):
+        planner = self._make_planner()
+        # The i2.2xlarge is cheaper per task and every node pays for its boot, so as few as the deadline allows
+        slow = planner.plan(deadline=4.5 * HOUR)
+        self.assertEqual((('i2.2xlarge', 2),), slow.fleet)
+        self.assertAlmostEqual(4.5, slow.cost)
+        self.assertEqual((('i2.2xlarge', 8),), planner.plan(deadline=1.5 * HOUR).fleet)
+        # Only the i2.4xlarge can do a task in half an hour
+        fast = planner.plan(deadline=HOUR)
+        self.assertEqual(HOUR, fast.makespan)
+        self.assertEqual((('i2.4xlarge', 8),), fast.fleet)
+
+    def test_budget(self):
+        planner = self._make_planner()
+        plan = planner.plan(budget=5.0)
+        self.assertEqual((('i2.2xlarge', 4),), plan.fleet)
+        self.assertEqual(2.5 * HOUR, plan.makespan)
+        self.assertGreater(plan.makespan, planner.plan(budget=10.0).makespan)
+
+    def test_impossible(self):
+        planner = self._make_planner()
+        # Nothing finishes in 10 minutes so the fastest is used
+        self.assertEqual(planner.plans()[0], planner.plan(deadline=600.0))
+        self.assertEqual(min([plan.cost for plan in planner.plans()]), planner.plan(budget=0.01).cost)
+
+    def test_can_run(self):
+        # The last task only fits on an i2.4xlarge
+        planner = self._make_planner(can_run=lambda index, instance_type: instance_type == 'i2.4xlarge' or index < 7)
+        plan = planner.plan(deadline=4.5 * HOUR)
+        self.assertIn('i2.4xlarge', [instance_type for instance_type, _ in plan.fleet])
+        self.assertIsNone(planner.evaluate([('i2.2xlarge', 4)]))
+
+    def test_nodes_required(self):
+        planner = self._make_planner()
+        nodes, node_count = planner.get_nodes_required(planner.evaluate([('i2.2xlarge', 3), ('i2.4xlarge', 1)]))
+        self.assertEqual(4, node_count)
+        self.assertEqual(
+            [
+                {'number_instances': 3, 'instance_type': 'i2.2xlarge', 'spot_price': 0.625},
+                {'number_instances': 1, 'instance_type': 'i2.4xlarge', 'spot_price': 1.5},
+            ],
+            nodes)
+
+
+if __name__ == '__main__':
+    unittest.main()
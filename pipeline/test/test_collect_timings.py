@@ -0,0 +1,112 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test collecting the task timings from the log tars
+"""
+import datetime
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from aws_chiles02.collect_timings import collect_timings
+from aws_chiles02.scheduler import CostModel, TIMINGS_MEMBER, load_timings, write_timings
+from aws_chiles02.settings_file import SIZE_1GB
+
+SESSION_ID = 'session'
+
+
+class FakePaginator(object):
+    def __init__(self, client):
+        self._client = client
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        yield {'Contents': [
+            {'Key': key, 'Size': len(data), 'ETag': '"etag"', 'LastModified': datetime.datetime(2016, 5, 1)}
+            for key, data in sorted(self._client.objects.items()) if key.startswith(Prefix)
+        ]}
+
+
+class FakeS3Client(object):
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_paginator(self, name):
+        return FakePaginator(self)
+
+    def get_object(self, Bucket, Key):
+        return {'Body': StringIO(self.objects[Key])}
+
+
+def make_log_tar(directory, rows):
+    timings_name = os.path.join(directory, TIMINGS_MEMBER)
+    if os.path.exists(timings_name):
+        os.remove(timings_name)
+    write_timings(timings_name, rows)
+    log_name = os.path.join(directory, 'dfms_node.log')
+    with open(log_name, 'w') as log_file:
+        log_file.write('started\n')
+
+    tar_buffer = StringIO()
+    tar = tarfile.open(fileobj=tar_buffer, mode='w')
+    tar.add(log_name, 'dfms_node.log')
+    tar.add(timings_name, TIMINGS_MEMBER)
+    tar.close()
+    return tar_buffer.getvalue()
+
+
+class TestCollectTimings(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._timings_file = os.path.join(self._directory, 'timings', 'timings.csv')
+
+        # uvsub taking 300s plus 100s per GB
+        rows = [
+            ['uvsub', 'i2.2xlarge', size * SIZE_1GB, 1020, 300.0 + 100.0 * size, SESSION_ID, 'uid_{0}'.format(size)]
+            for size in range(1, 7)
+        ]
+        self._client = FakeS3Client({
+            '{0}/10.0.0.1.tar'.format(SESSION_ID): make_log_tar(self._directory, rows[:3]),
+            '{0}/10.0.0.2.tar'.format(SESSION_ID): make_log_tar(self._directory, rows[3:]),
+            'other/10.0.0.1.tar': make_log_tar(self._directory, rows),
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_collect_once(self):
+        self.assertEqual(6, collect_timings('bucket', SESSION_ID, self._timings_file, s3_client=self._client))
+        self.assertEqual(0, collect_timings('bucket', SESSION_ID, self._timings_file, s3_client=self._client))
+        self.assertEqual(6, len(load_timings(self._timings_file)))
+
+    def test_recorded_timings_fit(self):
+        collect_timings('bucket', SESSION_ID, self._timings_file, s3_client=self._client)
+        fitted = CostModel().fit(load_timings(self._timings_file))
+
+        self.assertNotEqual(CostModel().predict('uvsub', 'i2.2xlarge', 10 * SIZE_1GB), fitted.predict('uvsub', 'i2.2xlarge', 10 * SIZE_1GB))
+        self.assertAlmostEqual(1300.0, fitted.predict('uvsub', 'i2.2xlarge', 10 * SIZE_1GB), delta=1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
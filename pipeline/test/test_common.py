@@ -25,7 +25,7 @@
 import logging
 import unittest
 
-from aws_chiles02.common import get_observation
+from aws_chiles02.common import get_observation, execute_command, run_command, get_free_space
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -35,5 +35,23 @@ class TestCommon(unittest.TestCase):
         observation = get_observation('13B-266.sb28624226.eb28625769.56669.43262586805_calibrated_deepfield.ms')
         self.assertEquals('13B-266.sb28624226.eb28625769.56669.43262586805', observation)
 
+    def test_run_command(self):
+        self.assertEquals(0, run_command('true'))
+        self.assertEquals(3, run_command('exit 3'))
+
+    def test_execute_command_keeps_head_and_tail(self):
+        result = execute_command('seq 1 1000', head_lines=2, tail_lines=2, sample_every=0)
+        self.assertEquals(0, result.return_code)
+        self.assertEquals(1000, result.lines)
+        self.assertEquals('1\n2\n... 996 lines skipped ...\n999\n1000\n', result.output)
+        self.assertGreater(result.max_rss, 0)
+
+    def test_execute_command_killed(self):
+        self.assertEquals(-9, execute_command('kill -9 $$').return_code)
+
+    def test_get_free_space(self):
+        free, total = get_free_space('/')
+        self.assertTrue(0 <= free <= total)
+
 if __name__ == '__main__':
     unittest.main()
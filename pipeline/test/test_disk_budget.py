@@ -0,0 +1,70 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the per node disk budget
+"""
+import unittest
+
+from aws_chiles02.disk_budget import DiskBudget
+from aws_chiles02.instance_catalog import get_instance_type
+from aws_chiles02.settings_file import SIZE_1GB
+
+NODE_DETAILS = {
+    'i2.2xlarge': [{'ip_address': '10.0.0.1'}],
+}
+
+
+class TestDiskBudget(unittest.TestCase):
+    def test_fits_without_gates(self):
+        budget = DiskBudget(NODE_DETAILS, ['/mnt/dfms/dfms_root'])
+        for count in range(7):
+            reservation = budget.reserve('10.0.0.1', 100 * SIZE_1GB)
+            self.assertEqual([], reservation.gates)
+            self.assertEqual('/mnt/dfms/dfms_root', reservation.volume)
+            reservation.release_on('release_{0}'.format(count))
+        self.assertEqual(700 * SIZE_1GB, budget.used('10.0.0.1'))
+
+    def test_gates_on_oldest_chains(self):
+        budget = DiskBudget(NODE_DETAILS, ['/mnt/dfms/dfms_root'], usable_fraction=1.0)
+        capacity = get_instance_type('i2.2xlarge').local_storage
+        for count in range(4):
+            budget.reserve('10.0.0.1', capacity // 4).release_on('release_{0}'.format(count))
+
+        reservation = budget.reserve('10.0.0.1', capacity // 2)
+        self.assertEqual(['release_0', 'release_1'], reservation.gates)
+        self.assertEqual(capacity, budget.used('10.0.0.1'))
+
+    def test_too_big_waits_for_everything(self):
+        budget = DiskBudget(NODE_DETAILS, ['/mnt/dfms/dfms_root'])
+        budget.reserve('10.0.0.1', 100 * SIZE_1GB).release_on('release_0')
+        reservation = budget.reserve('10.0.0.1', 10000 * SIZE_1GB)
+        self.assertEqual(['release_0'], reservation.gates)
+
+    def test_spread_across_volumes(self):
+        budget = DiskBudget(NODE_DETAILS, ['/mnt/disk0', '/mnt/disk1'])
+        volumes = [budget.reserve('10.0.0.1', 100 * SIZE_1GB).volume for _ in range(4)]
+        self.assertEqual(2, volumes.count('/mnt/disk0'))
+        self.assertEqual(2, volumes.count('/mnt/disk1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
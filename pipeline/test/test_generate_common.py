@@ -0,0 +1,67 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test aggregating the boot timelines the nodes report
+"""
+import unittest
+from StringIO import StringIO
+
+from aws_chiles02.generate_common import get_boot_timeline
+from aws_chiles02.startup_complete import read_boot_phases
+
+
+def make_node(ip_address, booted, lines, ready):
+    return {
+        'ip_address': ip_address,
+        'instance_type': 'i2.2xlarge',
+        'booted': booted,
+        'ready': ready,
+        'boot_phases': read_boot_phases(StringIO(lines), booted),
+    }
+
+
+class TestBootTimeline(unittest.TestCase):
+    def test_timeline(self):
+        reported_running = {'i2.2xlarge': [
+            make_node('10.0.0.1', 1000.0, 'yum_update 1020 1080\nsetup_disks 1080 1200\ninstall_software 1080 1300\n', 320.0),
+            make_node('10.0.0.2', 1005.0, 'yum_update 1025 1095\nsetup_disks 1095 1205\ninstall_software 1095 1405\n', 410.0),
+            make_node('10.0.0.3', 1010.0, 'yum_update 1040 1090\nsetup_disks 1090 1250\ninstall_software 1090 1290\n', 290.0),
+        ]}
+        timeline = get_boot_timeline(reported_running)
+
+        self.assertEqual(['cloud_init', 'yum_update', 'setup_disks', 'install_software', 'ready'], [phase.name for phase in timeline])
+        yum_update = timeline[1]
+        self.assertEqual(3, yum_update.nodes)
+        self.assertEqual(20.0, yum_update.start)
+        self.assertEqual(60.0, yum_update.duration)
+        self.assertEqual((70.0, '10.0.0.2'), (yum_update.slowest_duration, yum_update.slowest_node))
+        # The phases that ran alongside each other start together
+        self.assertEqual(timeline[2].start, timeline[3].start)
+        self.assertEqual((410.0, '10.0.0.2'), (timeline[-1].slowest_duration, timeline[-1].slowest_node))
+
+    def test_no_phases(self):
+        reported_running = {'i2.2xlarge': [{'ip_address': '10.0.0.1', 'instance_type': 'i2.2xlarge'}]}
+        self.assertEqual([], get_boot_timeline(reported_running))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test writing and batching the physical graphs
+"""
+import json
+import unittest
+from cStringIO import StringIO
+
+from aws_chiles02.graph_serializer import append_graph, encode_drop, get_batches, write_graph
+
+
+def make_drops(nodes, drops_per_node):
+    drops = []
+    for count in range(drops_per_node):
+        for node in range(nodes):
+            drops.append({
+                'type': 'app',
+                'app': 'aws_chiles02.apps_mstransform.CopyMsTransformToS3',
+                'oid': 'app_{0}_{1}'.format(node, count),
+                'node': '10.0.0.{0}'.format(node),
+                'inputs': ['dir_{0}_{1}'.format(node, count)],
+            })
+    return drops
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.batches = []
+
+    def append_graph(self, session_id, graph_spec):
+        self.batches.append(json.dumps(graph_spec))
+
+
+class TestGraphSerializer(unittest.TestCase):
+    def test_write_graph(self):
+        drops = make_drops(3, 10)
+        for chunk_size in [1, 7, 30, 100]:
+            output = StringIO()
+            self.assertEqual(30, write_graph(drops, output, chunk_size=chunk_size))
+            self.assertEqual(drops, json.loads(output.getvalue()))
+            self.assertNotIn('\n', output.getvalue())
+
+    def test_write_empty_graph(self):
+        output = StringIO()
+        self.assertEqual(0, write_graph([], output))
+        self.assertEqual([], json.loads(output.getvalue()))
+
+    def test_batches(self):
+        drops = make_drops(3, 50)
+        max_bytes = 10 * len(encode_drop(drops[0]))
+        batches = list(get_batches(drops, max_bytes))
+
+        self.assertEqual(sorted([drop['oid'] for drop in drops]), sorted([drop['oid'] for batch in batches for drop in batch]))
+        for batch in batches:
+            self.assertEqual(1, len(set([drop['node'] for drop in batch])))
+            self.assertLessEqual(len(json.dumps(batch, separators=(',', ':'))), max_bytes)
+
+    def test_append_graph(self):
+        client = FakeClient()
+        drops = make_drops(4, 20)
+        self.assertEqual(4, append_graph(client, 'session', drops))
+        self.assertEqual(80, sum([len(json.loads(batch)) for batch in client.batches]))
+
+
+if __name__ == '__main__':
+    unittest.main()
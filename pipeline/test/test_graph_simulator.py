@@ -0,0 +1,156 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test replaying a graph in the simulator
+"""
+import unittest
+
+from aws_chiles02.graph_simulator import NodeCapacity, SIZE_1MB, simulate, sweep
+from aws_chiles02.scheduler import CostModel
+from aws_chiles02.settings_file import SIZE_1GB
+
+COPY_FROM_S3 = 'aws_chiles02.apps_mstransform.CopyMsTransformFromS3'
+MS_TRANSFORM = 'aws_chiles02.apps_mstransform.DockerMsTransform'
+COPY_TO_S3 = 'aws_chiles02.apps_mstransform.CopyMsTransformToS3'
+
+
+class Graph(object):
+    """
+    Just enough of a graph builder to make the drop dicts
+    """
+    def __init__(self):
+        self.drop_list = []
+
+    def add(self, node_id, drop_type, **key_word_arguments):
+        drop = {'oid': 'drop_{0}'.format(len(self.drop_list)), 'type': drop_type, 'node': node_id}
+        drop.update(key_word_arguments)
+        self.drop_list.append(drop)
+        return drop
+
+    def app(self, node_id, app, inputs, outputs):
+        drop = self.add(node_id, 'app', app=app, inputs=[input_drop['oid'] for input_drop in inputs], outputs=[output['oid'] for output in outputs])
+        for output in outputs:
+            output.setdefault('producers', []).append(drop['oid'])
+        return drop
+
+    def day(self, node_id, key, splits):
+        s3_in = self.add(node_id, 'plain', storage='s3', key=key)
+        measurement_set = self.add(node_id, 'container')
+        self.app(node_id, COPY_FROM_S3, [s3_in], [measurement_set])
+        for _ in range(splits):
+            split = self.add(node_id, 'container')
+            self.app(node_id, MS_TRANSFORM, [measurement_set], [split])
+            self.app(node_id, COPY_TO_S3, [split], [self.add(node_id, 'plain', storage='s3', key='split')])
+
+
+class TestGraphSimulator(unittest.TestCase):
+    def setUp(self):
+        self._node_details = {
+            'i2.2xlarge': [{'ip_address': '10.0.0.1'}],
+            'i2.4xlarge': [{'ip_address': '10.0.0.2'}],
+        }
+        self._capacities = {
+            'i2.2xlarge': NodeCapacity(1, 60 * SIZE_1MB),
+            'i2.4xlarge': NodeCapacity(2, 240 * SIZE_1MB),
+        }
+        # 100 seconds per GB on an i2.2xlarge
+        self._cost_model = CostModel(coefficients={'mstransform': (0.0, 100.0, 0.0)})
+
+    def _simulate(self, graph, sizes):
+        return simulate(graph.drop_list, self._node_details, cost_model=self._cost_model, capacities=self._capacities, sizes=sizes)
+
+    def test_chain(self):
+        graph = Graph()
+        graph.day('10.0.0.1', 'day.tar', 1)
+        result = self._simulate(graph, {'day.tar': 120 * SIZE_1MB})
+
+        # Two seconds down, the split and two seconds up
+        split = 100.0 * 120 / 1024
+        self.assertAlmostEqual(4.0 + split, result.makespan)
+        self.assertEqual([COPY_FROM_S3, MS_TRANSFORM, COPY_TO_S3], [app for _, app, _, _, _ in result.critical_path])
+        compute, network = result.utilisation('10.0.0.1')
+        self.assertAlmostEqual(split / result.makespan, compute)
+        self.assertAlmostEqual(4.0 / result.makespan, network)
+
+    def test_splits_share_the_day_and_slots(self):
+        graph = Graph()
+        graph.day('10.0.0.1', 'day.tar', 4)
+        result = self._simulate(graph, {'day.tar': 4 * SIZE_1GB})
+
+        # One slot, so the four 100 second splits run one after the other and the last upload follows
+        copy_from_s3 = 4 * 1024 / 60.0
+        copy_to_s3 = 1024 / 60.0
+        self.assertAlmostEqual(copy_from_s3 + 400.0 + copy_to_s3, result.makespan)
+
+    def test_transfers_share_the_network(self):
+        graph = Graph()
+        for key in ['day1.tar', 'day2.tar']:
+            graph.day('10.0.0.1', key, 0)
+            graph.day('10.0.0.2', key, 0)
+        result = self._simulate(graph, {'day1.tar': 60 * SIZE_1MB, 'day2.tar': 120 * SIZE_1MB})
+
+        # Sharing 60MB/s on the i2.2xlarge, the first at 30MB/s until it is done, then the second at 60MB/s
+        self.assertAlmostEqual(3.0, result.node_finish['10.0.0.1'])
+        # A stream can't go past what one S3 connection gives
+        self.assertAlmostEqual(2.0, result.node_finish['10.0.0.2'])
+
+    def test_cost(self):
+        graph = Graph()
+        graph.day('10.0.0.1', 'day.tar', 1)
+        graph.day('10.0.0.2', 'day.tar', 1)
+        result = self._simulate(graph, {'day.tar': 36 * SIZE_1GB})
+
+        prices = {'i2.2xlarge': 0.5, 'i2.4xlarge': 1.0}
+        expected = sum([prices[result.instance_types[node_id]] * finish / 3600.0 for node_id, finish in result.node_finish.iteritems()])
+        self.assertAlmostEqual(expected, result.cost(prices))
+        self.assertAlmostEqual(0.1 * sum(result.node_finish.values()) / 3600.0, result.cost(0.1))
+        # The i2.4xlarge is twice as fast
+        self.assertLess(result.node_finish['10.0.0.2'], result.node_finish['10.0.0.1'])
+
+    def test_cycle(self):
+        graph = Graph()
+        container = graph.add('10.0.0.1', 'container')
+        app = graph.app('10.0.0.1', MS_TRANSFORM, [container], [])
+        app['outputs'] = [container['oid']]
+        with self.assertRaises(ValueError):
+            self._simulate(graph, {})
+
+    def test_sweep(self):
+        def make_graph(nodes):
+            graph = Graph()
+            for day in range(4):
+                graph.day('10.0.0.{0}'.format(day % nodes + 1), 'day.tar', 1)
+            node_details = {'i2.2xlarge': [{'ip_address': '10.0.0.{0}'.format(node + 1)} for node in range(nodes)]}
+            return graph.drop_list, node_details, {'day.tar': 36 * SIZE_1GB}
+
+        points = sweep(make_graph, {'nodes': [1, 2, 4]}, 1.0, cost_model=self._cost_model, capacities=self._capacities)
+        self.assertEqual(3, len(points))
+        self.assertEqual(sorted([point.cost for point in points]), [point.cost for point in points])
+
+        # Only four nodes finish within the deadline
+        deadline = min([point.makespan for point in points]) + 1.0
+        points = sweep(make_graph, {'nodes': [1, 2, 4]}, 1.0, deadline=deadline, cost_model=self._cost_model, capacities=self._capacities)
+        self.assertEqual({'nodes': 4}, points[0].parameters)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the instance catalog
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from aws_chiles02.instance_catalog import get_fallback, get_instance_type, load_catalog
+from aws_chiles02.scheduler import CostModel
+from aws_chiles02.settings_file import SIZE_1GB
+
+
+class TestInstanceCatalog(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_block_device_mappings(self):
+        self.assertEqual(
+            [{'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'}, {'DeviceName': '/dev/sdc', 'VirtualName': 'ephemeral1'}],
+            get_instance_type('i2.2xlarge').block_device_mappings())
+        self.assertEqual(8, len(get_instance_type('i2.8xlarge').block_device_mappings()))
+        # The NVMe volumes come with the instance
+        self.assertEqual([], get_instance_type('i3.4xlarge').block_device_mappings())
+        self.assertEqual([], get_instance_type('m4.large').block_device_mappings())
+
+    def test_fallback(self):
+        self.assertEqual(('i3.16xlarge', 2), get_fallback('i3.8xlarge'))
+        self.assertIsNone(get_fallback('m4.large'))
+        self.assertIsNone(get_fallback('c9.huge'))
+
+    def test_unknown(self):
+        self.assertEqual('i2.2xlarge', get_instance_type('c9.huge').name)
+
+    def test_speeds(self):
+        cost_model = CostModel()
+        self.assertEqual(2.0, cost_model.speed('i2.4xlarge', 'mstransform'))
+        # The NVMe disks help the I/O bound tasks most
+        self.assertGreater(cost_model.speed('i3.2xlarge', 'mstransform'), cost_model.speed('i3.2xlarge', 'clean'))
+        # Going by the vCPUs for kinds with no figures
+        self.assertEqual(2.0, get_instance_type('i3.4xlarge').speed('jpeg2000'))
+        self.assertEqual(3.0, CostModel(speeds={'i3.4xlarge': 3.0}).speed('i3.4xlarge', 'mstransform'))
+
+    def test_load_catalog(self):
+        filename = os.path.join(self._directory, 'instances.csv')
+        with open(filename, 'wb') as catalog_file:
+            catalog_file.write('# name, vCPUs, memory, disks, disk size, NVMe, network, speeds\n')
+            catalog_file.write('c5d.4xlarge,16,32,1,400,true,up-to-10G,2.5,2.2,2.2,2.5\n')
+            catalog_file.write('r4.large,2,15.25,0,0,false,up-to-10G\n')
+        c5d, r4 = load_catalog(filename)
+        self.assertEqual(400 * SIZE_1GB, c5d.local_storage)
+        self.assertTrue(c5d.nvme)
+        self.assertEqual(2.5, c5d.speed('stats'))
+        self.assertEqual(8, c5d.slots)
+        self.assertEqual(0.25, r4.speed('clean'))
+
+
+if __name__ == '__main__':
+    unittest.main()
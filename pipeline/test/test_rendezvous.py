@@ -0,0 +1,116 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the start up rendezvous
+"""
+import json
+import threading
+import time
+import unittest
+import urllib2
+
+from aws_chiles02.rendezvous import HttpRendezvous, SqsRendezvous
+
+
+def make_message(uuid, ip_address, instance_type='i2.2xlarge'):
+    return {'uuid': uuid, 'ip_address': ip_address, 'instance_type': instance_type, 'cores': 8, 'memory': 61 * 1024 ** 3}
+
+
+class FakeSQSClient(object):
+    """
+    Just enough of the boto3 SQS client for one queue
+    """
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.deleted = []
+        self.queues = []
+
+    def create_queue(self, QueueName, Attributes):
+        self.queues.append(QueueName)
+        return {'QueueUrl': 'https://sqs/{0}'.format(QueueName)}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+        batch, self.messages = self.messages[:MaxNumberOfMessages], self.messages[MaxNumberOfMessages:]
+        return {'Messages': [{'Body': json.dumps(message), 'ReceiptHandle': message['ip_address']} for message in batch]}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted.append([entry['ReceiptHandle'] for entry in Entries])
+
+    def delete_queue(self, QueueUrl):
+        self.queues.remove(QueueUrl.split('/')[-1])
+
+
+class TestSqsRendezvous(unittest.TestCase):
+    def test_wait(self):
+        messages = [make_message('nodes', '10.0.0.{0}'.format(index)) for index in range(12)]
+        messages.insert(3, make_message('dim', '10.0.1.1', 'm4.large'))
+        messages.insert(5, make_message('other', '10.0.2.1'))
+        client = FakeSQSClient(messages)
+        rendezvous = SqsRendezvous(['nodes', 'dim'], 'startup_complete-nodes', sqs_client=client)
+
+        running = rendezvous.wait('nodes', 12, wait=60)
+        self.assertEqual(12, len(running['i2.2xlarge']))
+        # Deleted ten at a time, leaving the other run's message
+        self.assertEqual([9, 4], [len(entries) for entries in client.deleted])
+        self.assertNotIn('10.0.2.1', [handle for entries in client.deleted for handle in entries])
+        # The island manager's message was kept for later
+        self.assertEqual(['10.0.1.1'], [details['ip_address'] for details in rendezvous.wait('dim', 1, wait=0)['m4.large']])
+
+        rendezvous.close()
+        self.assertEqual([], client.queues)
+
+
+class TestHttpRendezvous(unittest.TestCase):
+    def setUp(self):
+        self._rendezvous = HttpRendezvous(['nodes'])
+
+    def tearDown(self):
+        self._rendezvous.close()
+
+    def _post(self, message):
+        try:
+            return urllib2.urlopen(self._rendezvous.url, json.dumps(message)).getcode()
+        except urllib2.HTTPError as error:
+            return error.code
+
+    def test_returns_once_all_arrive(self):
+        def report():
+            for index in range(3):
+                time.sleep(0.05)
+                self._post(make_message('nodes', '10.0.0.{0}'.format(index)))
+        thread = threading.Thread(target=report)
+        thread.start()
+
+        start = time.time()
+        running = self._rendezvous.wait('nodes', 3, wait=30)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(['10.0.0.0', '10.0.0.1', '10.0.0.2'], sorted([details['ip_address'] for details in running['i2.2xlarge']]))
+        self.assertEqual(8, running['i2.2xlarge'][0]['cores'])
+        thread.join()
+
+    def test_other_run(self):
+        self.assertEqual(400, self._post(make_message('other', '10.0.0.1')))
+        self.assertEqual({}, self._rendezvous.wait('nodes', 1, wait=0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the node local cache of S3 inputs
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from aws_chiles02.s3_cache import NodeCache, extract_tar_from_cache, get_cache_name
+
+
+class FakeS3Client(object):
+    def __init__(self, objects):
+        self.objects = objects
+        self.gets = 0
+
+    def head_object(self, Bucket, Key):
+        data = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(data), 'ETag': '"{0}"'.format(hash(data))}
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        self.gets += 1
+        start, end = [int(value) for value in Range[len('bytes='):].split('-')]
+        return {'Body': StringIO(self.objects[(Bucket, Key)][start:end + 1])}
+
+
+def make_tar(name):
+    tar_buffer = StringIO()
+    tar = tarfile.open(fileobj=tar_buffer, mode='w')
+    data = os.urandom(2000)
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = len(data)
+    tar.addfile(tar_info, StringIO(data))
+    tar.close()
+    return tar_buffer.getvalue()
+
+
+class TestS3Cache(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._cache_directory = os.path.join(self._directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _add(self, cache, key, size):
+        with cache.open_entry('bucket', key, 'etag') as entry:
+            self.assertFalse(entry.hit)
+            with open(entry.partial_path, 'wb') as output_file:
+                output_file.write('x' * size)
+            entry.commit()
+
+    def test_lru_eviction(self):
+        cache = NodeCache(self._cache_directory, 3000)
+        self._add(cache, 'a', 1000)
+        self._add(cache, 'b', 1000)
+        self._add(cache, 'c', 1000)
+
+        # Touch a so b is the oldest
+        with cache.open_entry('bucket', 'a', 'etag') as entry:
+            self.assertTrue(entry.hit)
+        self._add(cache, 'd', 1000)
+
+        self.assertEqual(
+            sorted([get_cache_name('bucket', key, 'etag') for key in ['a', 'c', 'd']]),
+            sorted(os.listdir(self._cache_directory)))
+        statistics = cache.statistics()
+        self.assertEqual(1, statistics['hits'])
+        self.assertEqual(4, statistics['misses'])
+        self.assertEqual(1, statistics['evictions'])
+        self.assertEqual(1000, statistics['bytes_saved'])
+
+    def test_pinned_not_evicted(self):
+        cache = NodeCache(self._cache_directory, 1500)
+        self._add(cache, 'a', 1000)
+        with cache.open_entry('bucket', 'a', 'etag'):
+            self._add(cache, 'b', 1000)
+            self.assertEqual(2, cache.statistics()['entries'])
+        cache.evict()
+        self.assertEqual(1, cache.statistics()['entries'])
+
+    def test_reload(self):
+        cache = NodeCache(self._cache_directory, 3000)
+        self._add(cache, 'a', 1000)
+        cache = NodeCache(self._cache_directory, 3000)
+        with cache.open_entry('bucket', 'a', 'etag') as entry:
+            self.assertTrue(entry.hit)
+        self.assertEqual(1000, cache.statistics()['size'])
+
+    def test_contains(self):
+        cache = NodeCache(self._cache_directory, 3000)
+        self.assertTrue(cache.contains(self._cache_directory))
+        self.assertTrue(cache.contains(os.path.join(self._cache_directory, 'entry')))
+        self.assertTrue(cache.contains(self._directory))
+        self.assertFalse(cache.contains(os.path.join(self._directory, 'uvsub_1020~1024')))
+
+    def test_extract(self):
+        client = FakeS3Client({('bucket', 'split.tar'): make_tar('vis_1020~1024/table.dat')})
+        cache = NodeCache(self._cache_directory, 10 ** 6)
+        for count in range(2):
+            output = os.path.join(self._directory, 'output{0}'.format(count))
+            extract_tar_from_cache(cache, client, 'bucket', 'split.tar', output)
+            self.assertTrue(os.path.exists(os.path.join(output, 'vis_1020~1024', 'table.dat')))
+
+        self.assertEqual(1, client.gets)
+        self.assertEqual(1, cache.statistics()['hits'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the compression codecs
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import unittest
+from cStringIO import StringIO
+
+from aws_chiles02 import s3_codec
+from aws_chiles02.s3_codec import CODEC_METADATA, CodecException, get_codec, get_codec_from_metadata
+from aws_chiles02.s3_stream import extract_tar_from_s3, upload_tar_to_s3
+from test.test_s3_stream import FakeS3Client
+
+
+class MemoryFile(object):
+    def __init__(self):
+        self.buffer = StringIO()
+        self.closed = False
+        self.aborted = False
+
+    def write(self, data):
+        self.buffer.write(data)
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+class TestS3Codec(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def round_trip(self, name, data):
+        codec = get_codec(name, threads=2)
+        raw = MemoryFile()
+        writer = codec.writer(raw)
+        for start in range(0, len(data), 100000):
+            writer.write(data[start:start + 100000])
+        writer.close()
+        self.assertTrue(raw.closed)
+
+        reader = codec.reader(StringIO(raw.buffer.getvalue()))
+        chunks = []
+        chunk = reader.read(65536)
+        while chunk:
+            chunks.append(chunk)
+            chunk = reader.read(65536)
+        self.assertEqual(data, ''.join(chunks))
+
+    def test_gzip(self):
+        self.round_trip('gzip', os.urandom(1000) * 3000)
+
+    @unittest.skipIf(s3_codec.zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        self.round_trip('zstd', os.urandom(1000) * 3000)
+
+    @unittest.skipIf(s3_codec.lz4 is None, 'lz4 is not installed')
+    def test_lz4_frames(self):
+        # Several blocks so the reader has to cross the frame boundaries
+        self.round_trip('lz4', os.urandom(1000) * 10000)
+
+    def test_large_tar_stream(self):
+        # Compresses well so each block read decompresses to a large backlog
+        data = os.urandom(1000) * 48 * 1024
+        tar_buffer = StringIO()
+        tar = tarfile.open(fileobj=tar_buffer, mode='w')
+        tar_info = tarfile.TarInfo('table.f1')
+        tar_info.size = len(data)
+        tar.addfile(tar_info, StringIO(data))
+        tar.close()
+
+        codec = get_codec('gzip')
+        raw = MemoryFile()
+        writer = codec.writer(raw)
+        writer.write(tar_buffer.getvalue())
+        writer.close()
+
+        # tarfile reads in small records so the reader must not copy its backlog on each read
+        start = time.time()
+        tar = tarfile.open(fileobj=codec.reader(StringIO(raw.buffer.getvalue())), mode='r|')
+        member = tar.next()
+        self.assertEqual(data, tar.extractfile(member).read())
+        tar.close()
+        self.assertLess(time.time() - start, 10)
+
+    def test_no_codec(self):
+        self.assertIsNone(get_codec(None))
+        self.assertIsNone(get_codec('none'))
+        self.assertIsNone(get_codec_from_metadata({}))
+        with self.assertRaises(CodecException):
+            get_codec('bzip2')
+
+    def test_upload_round_trip(self):
+        source = os.path.join(self._directory, 'source')
+        os.makedirs(os.path.join(source, 'uvsub_1020~1024'))
+        data = os.urandom(1000) * 2000
+        with open(os.path.join(source, 'uvsub_1020~1024', 'table.f1'), 'wb') as output_file:
+            output_file.write(data)
+
+        client = FakeS3Client({})
+        upload_tar_to_s3(client, 'bucket', 'uvsub.tar', source, ['uvsub_1020~1024'], codec='gzip')
+        metadata = client.metadata[('bucket', 'uvsub.tar')]
+        self.assertEqual('gzip', metadata[CODEC_METADATA])
+
+        compressed = client.objects[('bucket', 'uvsub.tar')]
+        self.assertLess(len(compressed), len(data) // 10)
+
+        destination = os.path.join(self._directory, 'destination')
+        extract_tar_from_s3(client, 'bucket', 'uvsub.tar', destination, len(compressed), part_size=4096, metadata=metadata)
+        with open(os.path.join(destination, 'uvsub_1020~1024', 'table.f1'), 'rb') as input_file:
+            self.assertEqual(data, input_file.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
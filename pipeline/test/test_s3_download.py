@@ -0,0 +1,212 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the resumable ranged download
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from cStringIO import StringIO
+
+from aws_chiles02.s3_download import RangedDownload, download_file_resumable, get_checkpoint_name
+from aws_chiles02.s3_etag import get_etag, PART_SIZE_METADATA
+from aws_chiles02.s3_stream import S3StreamException
+
+PART_SIZE = 1000
+
+
+class BrokenBody(object):
+    """
+    Returns the first half of the part then drops the connection
+    """
+    def __init__(self, data):
+        self._data = data
+        self._read = False
+
+    def read(self, size):
+        if self._read:
+            raise IOError('Connection reset')
+        self._read = True
+        return self._data[:len(self._data) // 2]
+
+    def close(self):
+        pass
+
+
+class FakeS3Client(object):
+    def __init__(self, data, etag='"etag"', failing_parts=None, slow_parts=None, broken_parts=None, metadata=None):
+        self.data = data
+        self.etag = etag
+        self.metadata = metadata or {}
+        self.failing_parts = failing_parts or set()
+        self.slow_parts = slow_parts or set()
+        self.broken_parts = broken_parts or set()
+        self.requested = []
+        self._lock = threading.Lock()
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data), 'ETag': self.etag, 'Metadata': self.metadata}
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        if IfMatch != self.etag:
+            raise IOError('Precondition failed')
+        start, end = [int(value) for value in Range[len('bytes='):].split('-')]
+        part = start // PART_SIZE
+        with self._lock:
+            self.requested.append(part)
+            slow = part in self.slow_parts
+            self.slow_parts.discard(part)
+            broken = part in self.broken_parts
+            self.broken_parts.discard(part)
+        if part in self.failing_parts:
+            raise IOError('Connection reset')
+        if slow:
+            time.sleep(2)
+        if broken:
+            return {'Body': BrokenBody(self.data[start:end + 1])}
+        return {'Body': StringIO(self.data[start:end + 1])}
+
+
+class TestS3Download(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._filename = os.path.join(self._directory, 'ms.tar')
+        self._data = os.urandom(10 * PART_SIZE + 123)
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _read(self):
+        with open(self._filename, 'rb') as input_file:
+            return input_file.read()
+
+    def test_download(self):
+        client = FakeS3Client(self._data)
+        bytes_fetched = download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4)
+
+        self.assertEqual(len(self._data), bytes_fetched)
+        self.assertEqual(self._data, self._read())
+        self.assertEqual(range(11), sorted(client.requested))
+        self.assertFalse(os.path.exists(get_checkpoint_name(self._filename)))
+
+    def test_bytes_reported_once(self):
+        client = FakeS3Client(self._data, broken_parts={2, 5})
+        reported = []
+        download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4, callback=reported.append)
+
+        # The half parts read before the retries are not counted
+        self.assertEqual(2, client.requested.count(2))
+        self.assertEqual(len(self._data), sum(reported))
+        self.assertEqual(self._data, self._read())
+
+    def test_resume(self):
+        client = FakeS3Client(self._data, failing_parts={3, 7})
+        with self.assertRaises(S3StreamException):
+            download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4)
+
+        with open(get_checkpoint_name(self._filename)) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        self.assertEqual([0, 1, 2, 4, 5, 6, 8, 9, 10], checkpoint['completed'])
+
+        client = FakeS3Client(self._data)
+        bytes_fetched = download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4)
+        self.assertEqual(2 * PART_SIZE, bytes_fetched)
+        self.assertEqual([3, 7], sorted(client.requested))
+        self.assertEqual(self._data, self._read())
+
+    def test_changed_object_starts_again(self):
+        client = FakeS3Client(self._data, failing_parts={3})
+        with self.assertRaises(S3StreamException):
+            download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4)
+
+        data = os.urandom(len(self._data))
+        client = FakeS3Client(data, etag='"new"')
+        download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4)
+        self.assertEqual(range(11), sorted(client.requested))
+        self.assertEqual(data, self._read())
+
+    def test_straggler(self):
+        client = FakeS3Client(self._data, slow_parts={0})
+        reported = []
+        download = RangedDownload(
+            client,
+            'bucket',
+            'key',
+            self._filename,
+            len(self._data),
+            etag=client.etag,
+            part_size=PART_SIZE,
+            parallel_streams=2,
+            straggler_factor=2.0,
+            monitor_interval=0.05,
+            callback=reported.append
+        )
+        start = time.time()
+        download.download()
+
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(2, client.requested.count(0))
+        self.assertEqual(len(self._data), sum(reported))
+        self.assertEqual(self._data, self._read())
+
+    def _get_multipart_etag(self, data, part_size):
+        return get_etag([hashlib.md5(data[start:start + part_size]).digest() for start in range(0, len(data), part_size)], True)
+
+    def test_etag_checked(self):
+        etag = self._get_multipart_etag(self._data, 500)
+        client = FakeS3Client(self._data, etag=etag, metadata={PART_SIZE_METADATA: '500'})
+        download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4)
+        self.assertEqual(self._data, self._read())
+
+        # The same ETag but different contents
+        client = FakeS3Client(self._data[:-1] + 'x', etag=etag, metadata={PART_SIZE_METADATA: '500'})
+        os.remove(self._filename)
+        with self.assertRaises(S3StreamException):
+            download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4)
+        self.assertFalse(os.path.exists(get_checkpoint_name(self._filename)))
+
+    def test_etag_checked_after_resume(self):
+        etag = self._get_multipart_etag(self._data, 500)
+        client = FakeS3Client(self._data, etag=etag, failing_parts={4}, metadata={PART_SIZE_METADATA: '500'})
+        with self.assertRaises(S3StreamException):
+            download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4)
+
+        client = FakeS3Client(self._data, etag=etag, metadata={PART_SIZE_METADATA: '500'})
+        download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4)
+        self.assertEqual([4], client.requested)
+        self.assertEqual(self._data, self._read())
+
+    def test_single_put_etag(self):
+        etag = '"{0}"'.format(hashlib.md5(self._data).hexdigest())
+        client = FakeS3Client(self._data, etag=etag)
+        download_file_resumable(client, 'bucket', 'key', self._filename, part_size=PART_SIZE, parallel_streams=4)
+        self.assertEqual([0], client.requested)
+        self.assertEqual(self._data, self._read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test rebuilding S3 ETags
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from aws_chiles02.s3_etag import ETagVerifier, PartHasher, get_etag, get_file_digests, verify_file, PART_SIZE_METADATA
+
+SIZE_1MB = 1048576
+
+
+class TestS3Etag(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._filename = os.path.join(self._directory, 'data')
+        self._data = os.urandom(3 * SIZE_1MB + 12345)
+        with open(self._filename, 'wb') as output_file:
+            output_file.write(self._data)
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _get_digests(self, part_size):
+        return [hashlib.md5(self._data[start:start + part_size]).digest() for start in range(0, len(self._data), part_size)]
+
+    def test_part_hasher(self):
+        hasher = PartHasher(SIZE_1MB)
+        for start in range(0, len(self._data), 7777):
+            hasher.update(self._data[start:start + 7777])
+        self.assertEqual(self._get_digests(SIZE_1MB), hasher.digests())
+
+        hasher = PartHasher()
+        hasher.update(self._data)
+        self.assertEqual([hashlib.md5(self._data).digest()], hasher.digests())
+
+    def test_exact_parts(self):
+        hasher = PartHasher(1000)
+        hasher.update('x' * 2000)
+        self.assertEqual(2, len(hasher.digests()))
+
+    def test_file_digests_in_parallel(self):
+        self.assertEqual(self._get_digests(SIZE_1MB), get_file_digests(self._filename, SIZE_1MB, parallel_streams=3))
+        self.assertEqual([hashlib.md5(self._data).digest()], get_file_digests(self._filename))
+
+    def test_verify_file(self):
+        etag = get_etag(self._get_digests(SIZE_1MB), True)
+        self.assertTrue(verify_file(self._filename, etag, {PART_SIZE_METADATA: str(SIZE_1MB)}))
+        # 1MB parts can be worked out from the size without the metadata
+        self.assertTrue(verify_file(self._filename, etag))
+        self.assertFalse(verify_file(self._filename, get_etag(self._get_digests(SIZE_1MB)[::-1], True)))
+
+    def test_unknown_part_size(self):
+        etag = get_etag(self._get_digests(1500000), True)
+        verifier = ETagVerifier(etag, len(self._data))
+        self.assertFalse(verifier.verifiable)
+        self.assertIsNone(verify_file(self._filename, etag))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the S3 transfer governor
+"""
+import threading
+import time
+import unittest
+
+from aws_chiles02.s3_governor import TokenBucket, TransferGovernor, PRIORITY_INPUT, PRIORITY_PRODUCT, PRIORITY_BACKGROUND
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestS3Governor(unittest.TestCase):
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1000, clock=clock, sleep=clock.sleep)
+        self.assertEqual(0.0, bucket.consume(1000))
+        self.assertEqual(0.5, bucket.consume(500))
+        clock.now += 2.0
+        self.assertEqual(0.0, bucket.consume(800))
+
+    def test_unlimited(self):
+        clock = FakeClock()
+        bucket = TokenBucket(0, clock=clock, sleep=clock.sleep)
+        self.assertEqual(0.0, bucket.consume(10 ** 9))
+        self.assertEqual([], clock.sleeps)
+
+    def test_priority_order(self):
+        governor = TransferGovernor(2, reserved_for_input=1)
+        order = []
+        governor.acquire(PRIORITY_INPUT)
+
+        def transfer(priority):
+            governor.acquire(priority)
+            order.append(priority)
+            governor.release(priority)
+
+        threads = []
+        for priority in [PRIORITY_BACKGROUND, PRIORITY_PRODUCT, PRIORITY_INPUT]:
+            thread = threading.Thread(target=transfer, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.05)
+
+        # Only the input can take the slot reserved for it
+        self.assertEqual([PRIORITY_INPUT], order)
+        governor.release(PRIORITY_INPUT)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([PRIORITY_INPUT, PRIORITY_PRODUCT, PRIORITY_BACKGROUND], order)
+
+    def test_statistics(self):
+        governor = TransferGovernor(2)
+        seen = []
+        with governor.transfer(PRIORITY_PRODUCT, seen.append) as callback:
+            callback(100)
+            callback(200)
+            self.assertEqual(1, governor.statistics()['product']['active'])
+        statistics = governor.statistics()['product']
+        self.assertEqual([100, 200], seen)
+        self.assertEqual(300, statistics['bytes'])
+        self.assertEqual(0, statistics['active'])
+        self.assertEqual(1, statistics['completed'])
+        self.assertTrue(statistics['rate'] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test streaming tar files from S3
+"""
+import base64
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from botocore.exceptions import ClientError
+
+from aws_chiles02.s3_etag import get_etag, PART_SIZE_METADATA
+from aws_chiles02.s3_governor import PRIORITY_PRODUCT, TransferGovernor
+from aws_chiles02.s3_stream import S3RangedReader, extract_tar_from_s3, S3StreamException, upload_tar_to_s3, upload_tars_to_s3
+
+
+class FakeS3Client(object):
+    """
+    Just enough of the boto3 client to serve objects held in memory
+    """
+    def __init__(self, objects):
+        self.objects = objects
+        self.ranges = []
+        self.uploads = {}
+        self.metadata = {}
+        self.etags = {}
+        self.aborted = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        data = self.objects[(Bucket, Key)]
+        if Range is not None:
+            self.ranges.append(Range)
+            start, end = Range[len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+        return {'Body': StringIO(data)}
+
+    def head_object(self, Bucket, Key):
+        data = self.objects[(Bucket, Key)]
+        return {
+            'ContentLength': len(data),
+            'ETag': self.etags.get((Bucket, Key), '"{0}"'.format(hashlib.md5(data).hexdigest())),
+            'Metadata': self.metadata.get((Bucket, Key)) or {},
+        }
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body
+        return {'ETag': '"{0}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        upload_id = 'upload-{0}'.format(Key)
+        self.uploads[upload_id] = {}
+        self.metadata[(Bucket, Key)] = Metadata
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5):
+        if base64.b64encode(hashlib.md5(Body).digest()) != ContentMD5:
+            raise IOError('BadDigest')
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"{0}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        data = [parts[part['PartNumber']] for part in MultipartUpload['Parts']]
+        self.objects[(Bucket, Key)] = ''.join(data)
+        self.etags[(Bucket, Key)] = get_etag([hashlib.md5(part).digest() for part in data], True)
+        return {'ETag': self.etags[(Bucket, Key)]}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+        self.aborted.append(Key)
+
+
+def make_tar(directory, names):
+    tar_buffer = StringIO()
+    tar = tarfile.open(fileobj=tar_buffer, mode='w')
+    for name in names:
+        data = os.urandom(5000)
+        tar_info = tarfile.TarInfo(os.path.join(directory, name))
+        tar_info.size = len(data)
+        tar.addfile(tar_info, StringIO(data))
+    tar.close()
+    return tar_buffer.getvalue()
+
+
+class TestS3Stream(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_ranged_reader_in_order(self):
+        data = os.urandom(100000)
+        client = FakeS3Client({('bucket', 'key'): data})
+        with S3RangedReader(client, 'bucket', 'key', len(data), part_size=4096, parallel_streams=4) as reader:
+            self.assertEqual(data, reader.read())
+        self.assertEqual(25, len(client.ranges))
+
+    def test_single_stream(self):
+        data = os.urandom(10000)
+        client = FakeS3Client({('bucket', 'key'): data})
+        with S3RangedReader(client, 'bucket', 'key', len(data), part_size=4096, parallel_streams=1) as reader:
+            self.assertEqual(data, reader.read())
+        self.assertEqual(0, len(client.ranges))
+
+    def test_extract(self):
+        data = make_tar('vis_1020~1024', ['table.dat', 'table.f1', 'table.f2'])
+        client = FakeS3Client({('bucket', 'key.tar'): data})
+        bytes_read = extract_tar_from_s3(client, 'bucket', 'key.tar', self._directory, len(data), part_size=4096)
+
+        self.assertEqual(len(data), bytes_read)
+        self.assertEqual(['table.dat', 'table.f1', 'table.f2'], sorted(os.listdir(os.path.join(self._directory, 'vis_1020~1024'))))
+
+    def test_size_mismatch(self):
+        data = make_tar('vis_1020~1024', ['table.dat'])
+        client = FakeS3Client({('bucket', 'key.tar'): data + '\0' * 1024})
+        with self.assertRaises(S3StreamException):
+            extract_tar_from_s3(client, 'bucket', 'key.tar', self._directory, len(data) + 2048, parallel_streams=1)
+
+    def test_upload_round_trip(self):
+        source = os.path.join(self._directory, 'source')
+        os.makedirs(os.path.join(source, 'uvsub_1020~1024'))
+        for name in ['table.dat', 'table.f1']:
+            with open(os.path.join(source, 'uvsub_1020~1024', name), 'wb') as output_file:
+                output_file.write(os.urandom(3 * 1024 * 1024))
+
+        client = FakeS3Client({})
+        missing = upload_tar_to_s3(client, 'bucket', 'uvsub.tar', source, ['uvsub_1020~1024', 'missing'])
+        self.assertEqual(['missing'], missing)
+        self.assertEqual(0, len(client.uploads))
+
+        data = client.objects[('bucket', 'uvsub.tar')]
+        destination = os.path.join(self._directory, 'destination')
+        extract_tar_from_s3(client, 'bucket', 'uvsub.tar', destination, len(data), part_size=1024 * 1024)
+        for name in ['table.dat', 'table.f1']:
+            with open(os.path.join(source, 'uvsub_1020~1024', name), 'rb') as file1, open(os.path.join(destination, 'uvsub_1020~1024', name), 'rb') as file2:
+                self.assertEqual(file1.read(), file2.read())
+
+    def test_upload_multipart_round_trip(self):
+        source = os.path.join(self._directory, 'source')
+        os.makedirs(os.path.join(source, 'uvsub_1020~1024'))
+        for name in ['table.dat', 'table.f1', 'table.f2']:
+            with open(os.path.join(source, 'uvsub_1020~1024', name), 'wb') as output_file:
+                output_file.write(os.urandom(7 * 1024 * 1024 + 1))
+
+        client = FakeS3Client({})
+        upload_tar_to_s3(client, 'bucket', 'uvsub.tar', source, ['uvsub_1020~1024'])
+        head = client.head_object(Bucket='bucket', Key='uvsub.tar')
+        self.assertTrue(head['ETag'].endswith('-2"'))
+
+        # The ETag is checked against the part size in the metadata
+        destination = os.path.join(self._directory, 'destination')
+        extract_tar_from_s3(client, 'bucket', 'uvsub.tar', destination, head['ContentLength'], etag=head['ETag'], metadata=head['Metadata'])
+        for name in ['table.dat', 'table.f1', 'table.f2']:
+            with open(os.path.join(source, 'uvsub_1020~1024', name), 'rb') as file1, open(os.path.join(destination, 'uvsub_1020~1024', name), 'rb') as file2:
+                self.assertEqual(file1.read(), file2.read())
+
+    def test_upload_in_parallel(self):
+        for name in ['clean.image', 'clean.qa']:
+            with open(os.path.join(self._directory, name), 'wb') as output_file:
+                output_file.write(os.urandom(1000))
+
+        client = FakeS3Client({})
+        results = upload_tars_to_s3(client, 'bucket', [('key', self._directory, ['clean.image']), ('key.qa', self._directory, ['clean.qa'])])
+        self.assertEqual({'key': [], 'key.qa': []}, results)
+        self.assertIn(('bucket', 'key'), client.objects)
+        self.assertIn(('bucket', 'key.qa'), client.objects)
+
+    def test_upload_slot_per_tar(self):
+        for name in ['clean.image', 'clean.qa']:
+            with open(os.path.join(self._directory, name), 'wb') as output_file:
+                output_file.write(os.urandom(1000))
+
+        governor = TransferGovernor(4, reserved_for_input=0)
+        client = FakeS3Client({})
+        upload_tars_to_s3(
+            client, 'bucket', [('key', self._directory, ['clean.image']), ('key.qa', self._directory, ['clean.qa'])],
+            governor=governor, priority=PRIORITY_PRODUCT)
+        statistics = governor.statistics()['product']
+        self.assertEqual(2, statistics['completed'])
+        self.assertEqual(0, statistics['active'])
+        self.assertTrue(statistics['bytes'] > 2000)
+
+    def test_upload_aborted(self):
+        class FailingS3Client(FakeS3Client):
+            def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+                raise IOError('Connection reset')
+
+        with open(os.path.join(self._directory, 'clean.image'), 'wb') as output_file:
+            output_file.write(os.urandom(1000))
+
+        client = FailingS3Client({})
+        with self.assertRaises(S3StreamException):
+            upload_tar_to_s3(client, 'bucket', 'key', self._directory, ['clean.image'])
+        self.assertEqual(['key'], client.aborted)
+
+    def test_extract_checks_etag(self):
+        data = make_tar('vis_1020~1024', ['table.dat', 'table.f1'])
+        part_size = 8192
+        etag = get_etag([hashlib.md5(data[start:start + part_size]).digest() for start in range(0, len(data), part_size)], True)
+        client = FakeS3Client({('bucket', 'key.tar'): data})
+        metadata = {PART_SIZE_METADATA: str(part_size)}
+        extract_tar_from_s3(client, 'bucket', 'key.tar', self._directory, len(data), part_size=4096, etag=etag, metadata=metadata)
+
+        # Flip a byte in the padding at the end so the tar still unpacks
+        client.objects[('bucket', 'key.tar')] = data[:-1] + 'x'
+        with self.assertRaises(S3StreamException):
+            extract_tar_from_s3(client, 'bucket', 'key.tar', self._directory, len(data), part_size=4096, etag=etag, metadata=metadata)
+
+    def test_upload_records_part_size(self):
+        with open(os.path.join(self._directory, 'clean.image'), 'wb') as output_file:
+            output_file.write(os.urandom(1000))
+
+        client = FakeS3Client({})
+        upload_tar_to_s3(client, 'bucket', 'key', self._directory, ['clean.image'])
+        self.assertEqual({PART_SIZE_METADATA: str(16 * 1024 * 1024)}, client.metadata[('bucket', 'key')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the cost model and the scheduler
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from aws_chiles02.scheduler import CostModel, TaskTiming, get_nodes, load_timings, schedule_tasks
+from aws_chiles02.settings_file import SIZE_1GB
+
+
+class TestCostModel(unittest.TestCase):
+    def test_predict_scales_with_instance(self):
+        cost_model = CostModel()
+        self.assertAlmostEqual(
+            cost_model.predict('uvsub', 'i2.2xlarge', 100 * SIZE_1GB),
+            2 * cost_model.predict('uvsub', 'i2.4xlarge', 100 * SIZE_1GB))
+
+    def test_fit(self):
+        timings = []
+        for size in [10, 50, 100, 200, 300, 400]:
+            timings.append(TaskTiming('mstransform', 'i2.2xlarge', size * SIZE_1GB, None, 100.0 + 30.0 * size))
+            timings.append(TaskTiming('mstransform', 'i2.4xlarge', size * SIZE_1GB, None, (100.0 + 30.0 * size) / 1.5))
+        cost_model = CostModel().fit(timings)
+        self.assertAlmostEqual(1.5, cost_model.speed('i2.4xlarge'), places=3)
+        self.assertAlmostEqual(100.0 + 30.0 * 250, cost_model.predict('mstransform', 'i2.2xlarge', 250 * SIZE_1GB), delta=10.0)
+
+    def test_too_few_timings(self):
+        cost_model = CostModel().fit([TaskTiming('clean', 'i2.2xlarge', 0, 1020, 5.0)])
+        self.assertEqual(CostModel().coefficients('clean'), cost_model.coefficients('clean'))
+
+    def test_load_timings(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'timings.csv')
+            with open(filename, 'w') as timings_file:
+                timings_file.write('# kind, instance type, size, frequency, seconds\nuvsub,i2.2xlarge,1000,1020,60.5\nclean,i2.4xlarge,0,,7200\n')
+            self.assertEqual(
+                [TaskTiming('uvsub', 'i2.2xlarge', 1000, 1020, 60.5), TaskTiming('clean', 'i2.4xlarge', 0, None, 7200.0)],
+                load_timings(filename))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self._nodes = get_nodes({
+            'i2.4xlarge': [{'ip_address': '10.0.0.1'}],
+            'i2.2xlarge': [{'ip_address': '10.0.0.2'}, {'ip_address': '10.0.0.3'}],
+        })
+        self._cost_model = CostModel(coefficients={'test': (0.0, 1.0, 0.0)})
+
+    def test_balances_heterogeneous_nodes(self):
+        tasks = [(size * SIZE_1GB, None) for size in [100] * 8]
+        schedule = schedule_tasks('test', tasks, self._nodes, self._cost_model)
+        counts = dict([(node_id, len([assignment for assignment in schedule.assignments if assignment.node_id == node_id])) for node_id, _ in self._nodes])
+        # The i2.4xlarge is twice as fast so it gets twice the work
+        self.assertEqual({'10.0.0.1': 4, '10.0.0.2': 2, '10.0.0.3': 2}, counts)
+        self.assertAlmostEqual(200.0, schedule.makespan)
+
+    def test_lpt(self):
+        tasks = [(size * SIZE_1GB, None) for size in [70, 10, 30, 50, 40, 20, 60]]
+        nodes = [node for node in self._nodes if node[1] == 'i2.2xlarge']
+        schedule = schedule_tasks('test', tasks, nodes, self._cost_model)
+        self.assertEqual(140.0, schedule.makespan)
+        for node_id, _ in nodes:
+            self.assertEqual(
+                schedule.finish_times[node_id],
+                sum([assignment.finish - assignment.start for assignment in schedule.assignments if assignment.node_id == node_id]))
+
+    def test_can_run(self):
+        tasks = [(size * SIZE_1GB, None) for size in [600, 100, 100]]
+        schedule = schedule_tasks('test', tasks, self._nodes, self._cost_model, can_run=lambda index, instance_type: instance_type == 'i2.4xlarge' or tasks[index][0] <= 500 * SIZE_1GB)
+        self.assertEqual('10.0.0.1', schedule.assignments[0].node_id)
+
+    def test_slots(self):
+        schedule = schedule_tasks('test', [(SIZE_1GB, None)] * 12, [('10.0.0.2', 'i2.2xlarge')], self._cost_model, slots=4)
+        self.assertEqual([0, 1, 2, 3], sorted(set([assignment.slot for assignment in schedule.assignments])))
+        self.assertAlmostEqual(3.0, schedule.makespan)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test provisioning spot instances
+"""
+import unittest
+
+from aws_chiles02.spot_provisioner import MAX_POLL_INTERVAL, POLL_INTERVAL, SpotProvisioner
+
+FULFIL = 'fulfil'
+OVERSUBSCRIBED = 'oversubscribed'
+NEVER = 'never'
+
+
+class FakeEC2Client(object):
+    """
+    Just enough of the boto3 EC2 client to fulfil spot requests on a fake clock
+    """
+    def __init__(self, clock, prices, behaviour, delay=20.0):
+        """
+        :param behaviour: a function of (instance type, zone) returning FULFIL, OVERSUBSCRIBED or NEVER
+        """
+        self._clock = clock
+        self._prices = prices
+        self._behaviour = behaviour
+        self._delay = delay
+        self.requests = {}
+        self.calls = []
+
+    def describe_spot_price_history(self, StartTime, InstanceTypes, ProductDescriptions):
+        self.calls.append('describe_spot_price_history')
+        return {'SpotPriceHistory': [
+            {'InstanceType': instance_type, 'AvailabilityZone': zone, 'SpotPrice': str(price)}
+            for (instance_type, zone), price in sorted(self._prices.items()) if instance_type in InstanceTypes
+        ]}
+
+    def request_spot_instances(self, SpotPrice, InstanceCount, ValidUntil, LaunchSpecification):
+        self.calls.append('request_spot_instances')
+        request_ids = []
+        for _ in range(InstanceCount):
+            request_id = 'sir-{0}'.format(len(self.requests))
+            self.requests[request_id] = {
+                'instance_type': LaunchSpecification['InstanceType'],
+                'zone': LaunchSpecification['SubnetId'],
+                'spot_price': float(SpotPrice),
+                'submitted': self._clock(),
+                'cancelled': False,
+            }
+            request_ids.append({'SpotInstanceRequestId': request_id})
+        return {'SpotInstanceRequests': request_ids}
+
+    def describe_spot_instance_requests(self, SpotInstanceRequestIds):
+        self.calls.append('describe_spot_instance_requests')
+        statuses = []
+        for request_id in SpotInstanceRequestIds:
+            request = self.requests[request_id]
+            behaviour = self._behaviour(request['instance_type'], request['zone'])
+            status = {'SpotInstanceRequestId': request_id, 'State': 'open', 'Status': {'Code': 'pending-fulfillment'}}
+            if request['cancelled']:
+                status.update({'State': 'cancelled', 'Status': {'Code': 'canceled-before-fulfillment'}})
+            elif behaviour == OVERSUBSCRIBED:
+                status['Status'] = {'Code': 'capacity-oversubscribed'}
+            elif behaviour == FULFIL and self._clock() - request['submitted'] >= self._delay:
+                status.update({'State': 'active', 'Status': {'Code': 'fulfilled'}, 'InstanceId': 'i-{0}'.format(request_id)})
+            statuses.append(status)
+        return {'SpotInstanceRequests': statuses}
+
+    def cancel_spot_instance_requests(self, SpotInstanceRequestIds):
+        self.calls.append('cancel_spot_instance_requests')
+        for request_id in SpotInstanceRequestIds:
+            self.requests[request_id]['cancelled'] = True
+
+    def instance_types(self, report):
+        return sorted([self.requests[instance_id[len('i-'):]]['instance_type'] for instance_id in report.instance_ids])
+
+
+class TestSpotProvisioner(unittest.TestCase):
+    def setUp(self):
+        self._now = [0.0]
+        self._sleeps = []
+        self._prices = {
+            ('i2.2xlarge', 'us-west-2a'): 0.20,
+            ('i2.2xlarge', 'us-west-2b'): 0.25,
+            ('i2.4xlarge', 'us-west-2a'): 0.40,
+            ('i2.4xlarge', 'us-west-2b'): 0.45,
+            ('i2.8xlarge', 'us-west-2a'): 0.80,
+            ('m4.large', 'us-west-2a'): 0.03,
+        }
+
+    def _clock(self):
+        return self._now[0]
+
+    def _sleep(self, seconds):
+        self._sleeps.append(seconds)
+        self._now[0] += seconds
+
+    def _provision(self, behaviour, instances_required, deadline=600.0):
+        client = FakeEC2Client(self._clock, self._prices, behaviour)
+        provisioner = SpotProvisioner(
+            client,
+            lambda zone, instance_type: {'InstanceType': instance_type, 'SubnetId': zone},
+            ['us-west-2a', 'us-west-2b'],
+            deadline=deadline,
+            clock=self._clock,
+            sleep=self._sleep)
+        return client, provisioner.provision(instances_required)
+
+    def test_all_requested_at_once(self):
+        client, report = self._provision(
+            lambda instance_type, zone: FULFIL,
+            [
+                {'instance_type': 'i2.2xlarge', 'number_instances': 25, 'spot_price': 0.3},
+                {'instance_type': 'i2.4xlarge', 'number_instances': 5, 'spot_price': 0.5},
+            ])
+
+        # One price lookup, then all four batches before the first poll
+        self.assertEqual(['describe_spot_price_history'] + ['request_spot_instances'] * 4, client.calls[:5])
+        self.assertTrue(report.complete)
+        self.assertEqual(30, len(report.instance_ids))
+        self.assertEqual(set(['us-west-2a']), set([request['zone'] for request in client.requests.values()]))
+        self.assertLessEqual(report.time_to_capacity['i2.2xlarge'], 20.0 + MAX_POLL_INTERVAL)
+
+    def test_next_zone(self):
+        client, report = self._provision(
+            lambda instance_type, zone: OVERSUBSCRIBED if zone == 'us-west-2a' else FULFIL,
+            [{'instance_type': 'i2.2xlarge', 'number_instances': 4, 'spot_price': 0.3}])
+
+        self.assertTrue(report.complete)
+        self.assertEqual(0, report.fallbacks)
+        self.assertEqual(4, len([request for request in client.requests.values() if request['zone'] == 'us-west-2a' and request['cancelled']]))
+        self.assertEqual(['i2.2xlarge'] * 4, client.instance_types(report))
+
+    def test_next_instance_type(self):
+        client, report = self._provision(
+            lambda instance_type, zone: NEVER if instance_type == 'i2.2xlarge' else FULFIL,
+            [{'instance_type': 'i2.2xlarge', 'number_instances': 5, 'spot_price': 0.3}])
+
+        # Three i2.4xlarge stand in for the five i2.2xlarge, bid at twice the price
+        self.assertTrue(report.complete)
+        self.assertEqual(6, report.fulfilled['i2.2xlarge'])
+        self.assertEqual(['i2.4xlarge'] * 3, client.instance_types(report))
+        self.assertEqual(set([0.6]), set([request['spot_price'] for request in client.requests.values() if request['instance_type'] == 'i2.4xlarge']))
+        self.assertTrue(all([request['cancelled'] for request in client.requests.values() if request['instance_type'] == 'i2.2xlarge']))
+
+    def test_deadline(self):
+        client, report = self._provision(
+            lambda instance_type, zone: NEVER,
+            [{'instance_type': 'm4.large', 'number_instances': 2, 'spot_price': 0.05}],
+            deadline=120.0)
+
+        self.assertFalse(report.complete)
+        self.assertEqual(0, len(report.instance_ids))
+        self.assertTrue(all([request['cancelled'] for request in client.requests.values()]))
+        # Backing off while nothing happens
+        self.assertEqual(POLL_INTERVAL, self._sleeps[0])
+        self.assertEqual(sorted(self._sleeps), self._sleeps)
+
+    def test_priced_out(self):
+        client, report = self._provision(
+            lambda instance_type, zone: FULFIL,
+            [{'instance_type': 'm4.large', 'number_instances': 2, 'spot_price': 0.01}])
+
+        self.assertEqual({'m4.large': 2}, dict(report.priced_out))
+        self.assertEqual(0, len(client.requests))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test the tar index and reading members with ranged GETs
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from aws_chiles02.check_measurement_set import EXT_TO_24
+from aws_chiles02.s3_stream import upload_tar_to_s3
+from aws_chiles02.tar_index import S3TarReader, TarIndex, TarIndexException, build_index_from_file, get_index, get_index_key, scan_index
+from test.test_s3_stream import FakeS3Client
+
+
+class TestTarIndex(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._source = os.path.join(self._directory, 'source')
+        self._measurement_set = os.path.join(self._source, 'vis_1020~1024')
+        os.makedirs(os.path.join(self._measurement_set, 'ANTENNA'))
+        self._contents = {}
+        for extension in EXT_TO_24:
+            self._write('vis_1020~1024/table' + extension, os.urandom(700))
+        self._write('vis_1020~1024/ANTENNA/table.f0', os.urandom(3000))
+        # Long enough to need a GNU long name header
+        self._write('vis_1020~1024/' + 'x' * 120, 'long name')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _write(self, name, data):
+        with open(os.path.join(self._source, name), 'wb') as output_file:
+            output_file.write(data)
+        self._contents[name] = data
+
+    def _check_reader(self, reader):
+        self.assertEqual(sorted(self._contents.keys()), sorted(reader.list_members()))
+        for name, data in self._contents.items():
+            self.assertEqual(data, reader.read_member(name))
+        self.assertIsNone(reader.check_tables('vis_1020~1024', EXT_TO_24))
+
+    def test_upload_writes_index(self):
+        client = FakeS3Client({})
+        upload_tar_to_s3(client, 'bucket', 'split.tar', self._source, ['vis_1020~1024'], write_index=True)
+        self.assertIn(('bucket', get_index_key('split.tar')), client.objects)
+
+        index = get_index(client, 'bucket', 'split.tar')
+        self.assertEqual(['vis_1020~1024'], index.get_measurement_sets())
+        self.assertIn('.f26_TSM1', index.check_tables_to_26('vis_1020~1024'))
+
+        client.ranges = []
+        self._check_reader(S3TarReader(client, 'bucket', 'split.tar'))
+        # One ranged GET per member and nothing else
+        self.assertEqual(len(self._contents), len(client.ranges))
+
+    def test_scan_without_index(self):
+        client = FakeS3Client({})
+        upload_tar_to_s3(client, 'bucket', 'split.tar', self._source, ['vis_1020~1024'])
+        self.assertIsNone(get_index(client, 'bucket', 'split.tar'))
+        self._check_reader(S3TarReader(client, 'bucket', 'split.tar'))
+
+    def test_stale_index_ignored(self):
+        client = FakeS3Client({})
+        upload_tar_to_s3(client, 'bucket', 'split.tar', self._source, ['vis_1020~1024'], write_index=True)
+        self.assertIsNone(get_index(client, 'bucket', 'split.tar', etag='"something else"'))
+
+    def test_index_from_file_matches_scan(self):
+        tar_filename = os.path.join(self._directory, 'vis.tar')
+        tar = tarfile.open(tar_filename, 'w')
+        tar.add(self._measurement_set, arcname='vis_1020~1024')
+        tar.close()
+
+        index = build_index_from_file(tar_filename)
+        with open(tar_filename, 'rb') as input_file:
+            data = input_file.read()
+        client = FakeS3Client({('bucket', 'vis.tar'): data})
+        scanned = scan_index(client, 'bucket', 'vis.tar', len(data))
+        self.assertEqual([entry[:3] for entry in index.entries], [entry[:3] for entry in scanned.entries])
+
+        round_trip = TarIndex.from_string(index.to_string())
+        self.assertEqual(index.entries, round_trip.entries)
+
+    def test_missing_tables(self):
+        os.remove(os.path.join(self._measurement_set, 'table.f7'))
+        del self._contents['vis_1020~1024/table.f7']
+        client = FakeS3Client({})
+        upload_tar_to_s3(client, 'bucket', 'split.tar', self._source, ['vis_1020~1024'], write_index=True)
+        reader = S3TarReader(client, 'bucket', 'split.tar')
+        self.assertEqual('The following extensions are missing\n  .f7', reader.check_tables('vis_1020~1024', EXT_TO_24))
+        with self.assertRaises(TarIndexException):
+            reader.read_member('vis_1020~1024/table.f7')
+
+    def test_compressed_members_cannot_be_read(self):
+        client = FakeS3Client({})
+        upload_tar_to_s3(client, 'bucket', 'split.tar', self._source, ['vis_1020~1024'], codec='gzip', write_index=True)
+        reader = S3TarReader(client, 'bucket', 'split.tar')
+        self.assertIsNone(reader.check_tables('vis_1020~1024', EXT_TO_24))
+        with self.assertRaises(TarIndexException):
+            reader.read_member('vis_1020~1024/table.dat')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Test choosing the members of a tar file to extract
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from aws_chiles02.s3_stream import extract_tar_from_s3
+from aws_chiles02.tar_members import MemberFilter
+from test.test_s3_stream import FakeS3Client, make_tar
+
+
+class TestTarMembers(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_patterns(self):
+        member_filter = MemberFilter(include=['clean_*'], exclude=['*.psf', '*.model'])
+        self.assertTrue(member_filter.active)
+        self.assertTrue(member_filter.accepts('clean_1020~1024.image'))
+        self.assertTrue(member_filter.accepts('./clean_1020~1024.image/table.dat'))
+        self.assertFalse(member_filter.accepts('clean_1020~1024.psf/table.dat'))
+        self.assertFalse(member_filter.accepts('uvsub_1020~1024/table.dat'))
+        self.assertFalse(MemberFilter().active)
+
+    def test_skipped_members_are_not_written(self):
+        image = make_tar('clean_1020~1024.image', ['table.dat', 'table.f1'])
+        psf = make_tar('clean_1020~1024.psf', ['table.dat'])
+        client = FakeS3Client({('bucket', 'image.tar'): image, ('bucket', 'psf.tar'): psf})
+
+        member_filter = MemberFilter(exclude=['*.psf'])
+        extract_tar_from_s3(client, 'bucket', 'image.tar', self._directory, len(image), part_size=4096, member_filter=member_filter)
+        extract_tar_from_s3(client, 'bucket', 'psf.tar', self._directory, len(psf), part_size=4096, member_filter=member_filter)
+
+        self.assertEqual(['clean_1020~1024.image'], os.listdir(self._directory))
+        self.assertEqual(2, member_filter.members_written)
+        self.assertEqual(10000, member_filter.bytes_written)
+        self.assertEqual(1, member_filter.members_skipped)
+        self.assertEqual(5000, member_filter.bytes_skipped)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,13 @@ runuser -l ec2-user -c 'cd /home/ec2-user/dfms && source /home/ec2-user/virtuale
 
 cat /home/ec2-user/.ssh/id_dfms.pub >> /home/ec2-user/.ssh/authorized_keys
 
+% if hosts is None:
+# The node managers are booting alongside us, wait to be told where they are
+NODES=$(runuser -l ec2-user -c 'cd /home/ec2-user/aws-chiles02/pipeline/aws_chiles02 && source /home/ec2-user/virtualenv/aws-chiles02/bin/activate && python wait_for_hosts.py ${hosts_bucket} ${hosts_key}')
+% else:
+NODES="${hosts}"
+% endif
+
 # Do we need a node manager running
 % if need_node_manager:
 runuser -l ec2-user -c 'cd /home/ec2-user/dfms && source /home/ec2-user/virtualenv/dfms/bin/activate && dlg nm --daemon -${log_level} --dfms-path=/home/ec2-user/aws-chiles02/pipeline -H 0.0.0.0 --log-dir /tmp --error-listener=aws_chiles02.error_handling.ErrorListener --max-request-size ${max_request_size}'
@@ -20,11 +27,11 @@ runuser -l ec2-user -c 'cd /home/ec2-user/dfms && source /home/ec2-user/virtuale
 # Get my public IP address
 METADATA_URL_BASE="http://169.254.169.254/latest"
 export dim_ip=$(curl --silent $METADATA_URL_BASE/meta-data/public-ipv4)
-runuser -l ec2-user -c "cd /home/ec2-user/dfms && source /home/ec2-user/virtualenv/dfms/bin/activate && dlg dim --daemon -${log_level} -H 0.0.0.0 --ssh-pkey-path ~/.ssh/id_dfms --nodes ${hosts},$dim_ip --log-dir /tmp --max-request-size ${max_request_size}"
+runuser -l ec2-user -c "cd /home/ec2-user/dfms && source /home/ec2-user/virtualenv/dfms/bin/activate && dlg dim --daemon -${log_level} -H 0.0.0.0 --ssh-pkey-path ~/.ssh/id_dfms --nodes $NODES,$dim_ip --log-dir /tmp --max-request-size ${max_request_size}"
 % endif
 
 % if not need_node_manager:
-runuser -l ec2-user -c 'cd /home/ec2-user/dfms && source /home/ec2-user/virtualenv/dfms/bin/activate && dlg dim --daemon -${log_level} -H 0.0.0.0 --ssh-pkey-path ~/.ssh/id_dfms --nodes ${hosts} --log-dir /tmp --max-request-size ${max_request_size}'
+runuser -l ec2-user -c "cd /home/ec2-user/dfms && source /home/ec2-user/virtualenv/dfms/bin/activate && dlg dim --daemon -${log_level} -H 0.0.0.0 --ssh-pkey-path ~/.ssh/id_dfms --nodes $NODES --log-dir /tmp --max-request-size ${max_request_size}"
 % endif
 
 sleep 10